@@ -0,0 +1,54 @@
+"""
+工作单元执行节点：从协调存储以租约方式领取画像生成批次和模拟单元并执行
+协调进程（Web进程或任务工作进程）设置 DISTRIBUTED_UNITS=1 后，任务的工作单元发布到协调存储，由所有节点共同执行
+
+用法:
+    python -m agent.unit_worker [--threads 8] [--name unit-worker@主机名] [--store data/work_units.db]
+
+节点退出或失联后，其持有的单元在租约过期（DISTRIBUTED_LEASE_SECONDS）后被其他节点重新领取
+"""
+import argparse
+import os
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from models import get_model_pool_concurrency, load_model_pool
+from agent.utils.distributed_units import (
+    UNIT_LEASE_SECONDS,
+    UnitWorker,
+    WorkUnitStore,
+    get_work_unit_store_path,
+)
+from agent.utils.simulation_scheduler import DEFAULT_SIMULATION_WORKERS_CAP
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# 打印节点执行统计的间隔（秒）
+UNIT_WORKER_REPORT_SECONDS = 60
+
+
+def main():
+    parser = argparse.ArgumentParser(description="从协调存储领取并执行画像生成批次和模拟单元")
+    parser.add_argument("--threads", type=int, default=None, help="同时执行的单元数，默认等于模型池并发数")
+    parser.add_argument("--name", default=None, help="节点名称")
+    parser.add_argument("--store", default=None, help="协调存储路径，默认与协调进程一致")
+    parser.add_argument("--lease-seconds", type=float, default=UNIT_LEASE_SECONDS, help="租约时长（秒）")
+    args = parser.parse_args()
+
+    model_pool = load_model_pool()
+    threads = args.threads or get_model_pool_concurrency(model_pool, cap=DEFAULT_SIMULATION_WORKERS_CAP)
+    store = WorkUnitStore(args.store or get_work_unit_store_path(root=os.path.join(PROJECT_ROOT, 'data')))
+    worker = UnitWorker(store, model_pool, threads, name=args.name, lease_seconds=args.lease_seconds).start()
+    print(f"工作单元节点 {worker.name} 已启动，执行线程数 {worker.threads}，协调存储 {store.path}")
+    try:
+        while True:
+            time.sleep(UNIT_WORKER_REPORT_SECONDS)
+            print(f"节点 {worker.name} 统计: {worker.stats}，执行中 {len(worker.active)}")
+    except KeyboardInterrupt:
+        print(f"工作单元节点 {worker.name} 退出，未完成的单元将在租约过期后由其他节点执行")
+
+
+if __name__ == "__main__":
+    main()
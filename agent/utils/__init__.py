@@ -1,11 +1,81 @@
-from .runner import run_analysis_task
+from .runner import (
+    run_analysis_task,
+    resume_interrupted_tasks,
+    is_task_auto_resume_enabled,
+    run_queued_task,
+    enqueue_analysis_task,
+    submit_analysis_task,
+    settle_attached_tasks,
+)
+
+from .job_queue import (
+    JOB_RUNNING,
+    JobQueue,
+    TaskWorkerPool,
+    get_job_queue_path,
+    is_external_worker_mode,
+)
+
+from .task_store import (
+    TaskStore,
+)
+
+from .task_eta import (
+    ETA_STATUSES,
+    EtaModel,
+    format_remaining_time,
+    get_eta_model,
+)
+
+from .cancellation import (
+    CancellationToken,
+    TaskCancelled,
+    cancel_task_token,
+)
+
+from .distributed_units import (
+    LeasedUnitScheduler,
+    UnitWorker,
+    WorkUnitStore,
+    get_leased_unit_scheduler,
+    is_distributed_mode,
+)
+
+from .pipeline_profiles import (
+    PIPELINE_PROFILES,
+    estimate_pipeline,
+    get_pipeline_profile,
+    resolve_pipeline_profile,
+)
+
+from .checkpoint import (
+    TaskCheckpoint,
+    get_checkpoint_path,
+)
 
 from .persona_generate import (
     generate_user_personas,
+    DEFAULT_MAX_PERSONAS,
+    MAX_PERSONAS,
 )
 
 from .simulatiton_generate import (
     simulate_user_reactions,
+    simulate_task_reactions,
+)
+
+from .simulation_stats import (
+    SimulationStatsAggregator,
+)
+
+from .persona_stream import (
+    PersonaStream,
+    is_persona_streaming_enabled,
+)
+
+from .product_variants import (
+    MAX_PRODUCT_VARIANTS,
+    parse_product_variants,
 )
 
 from .api_utils import (
@@ -18,6 +88,7 @@ from .generate_utils import (
     create_existing_personas_context,
     create_error_persona,
     is_valid_persona,
+    normalize_persona,
 )
 
 from .conversations import (
@@ -32,6 +103,7 @@ from .tasks import (
     load_tasks, 
     update_task_status,
     stop_task,
+    merge_stored_task,
 )
 
 from .email import (
@@ -1,7 +1,108 @@
+import os
 import random
 import json
+import time
+import socket
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 from models import get_api_config
+from .call_latency import record_call_latency
+from .cancellation import TaskCancelled, current_cancellation_token
+from .generate_utils import estimate_tokens
+
+# 任务中的模型调用改用流式传输（默认关闭）：取消任务时在读取下一块数据时断开连接，并统计中止前已收到的部分回复
+# 需要确认所用的供应商都支持流式返回json_object和n采样；关闭时使用普通请求，取消任务时同样关闭进行中请求的连接
+CANCELLABLE_STREAMING = os.getenv("API_CANCELLABLE_STREAMING", "0").strip().lower() in ("1", "true", "yes", "on")
+
+# 当前线程正在通过哪个_AbortableAdapter发送请求，新建的连接登记到该适配器
+_sending = threading.local()
+
+
+class _AbortableConnectionMixin:
+    def connect(self):
+        super().connect()
+        adapter = getattr(_sending, "adapter", None)
+        if adapter is not None:
+            adapter.track(self.sock)
+
+
+class _AbortableHTTPConnection(_AbortableConnectionMixin, HTTPConnection):
+    pass
+
+
+class _AbortableHTTPSConnection(_AbortableConnectionMixin, HTTPSConnection):
+    pass
+
+
+class _AbortableHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _AbortableHTTPConnection
+
+
+class _AbortableHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _AbortableHTTPSConnection
+
+
+class _AbortableAdapter(HTTPAdapter):
+    """
+    记录所发请求的连接，abort时从其他线程关闭这些连接，正在等待回复的请求随之失败
+    Session.close只关闭连接池中空闲的连接，不能打断进行中的请求，因此直接对套接字执行shutdown
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._lock = threading.Lock()
+        self._sockets = []
+        self.aborted = False
+        super().__init__(*args, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _AbortableHTTPConnectionPool,
+            "https": _AbortableHTTPSConnectionPool,
+        }
+
+    def send(self, request, **kwargs):
+        _sending.adapter = self
+        try:
+            return super().send(request, **kwargs)
+        finally:
+            _sending.adapter = None
+
+    def track(self, sock):
+        with self._lock:
+            self._sockets.append(sock)
+            aborted = self.aborted
+        if aborted:
+            # abort发生在建立连接期间
+            _shutdown_socket(sock)
+
+    def abort(self):
+        with self._lock:
+            self.aborted = True
+            sockets = list(self._sockets)
+        for sock in sockets:
+            _shutdown_socket(sock)
+
+
+def _shutdown_socket(sock):
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+# 每个线程已发出的模型调用数
+_thread_calls = threading.local()
+
+
+def model_call_count() -> int:
+    """
+    当前线程已发出的call_ai_api调用数（单调递增），前后两次读取之差即期间发出的调用数
+    """
+    return getattr(_thread_calls, "count", 0)
 
 def call_ai_api_stream(messages, temp=0.7, model_name=None, model_pool=None):
     """
@@ -195,7 +296,7 @@ def call_ai_api_stream_with_web_search(messages, temp=0.7, model_name=None, mode
 
     yield "data: [DONE]\n\n"
 
-def call_ai_api(messages, response_format="text", temp=0.7, model_name=None, model_pool=None):
+def call_ai_api(messages, response_format="text", temp=0.7, model_name=None, model_pool=None, n=1):
     """
     调用AI API获取响应，支持多个模型轮换
     messages: 对话消息
@@ -203,6 +304,7 @@ def call_ai_api(messages, response_format="text", temp=0.7, model_name=None, mod
     temp: 温度
     model_name: 模型名称
     model_pool: 模型池
+    n: 同一提示词的采样数量，大于1时需要模型支持（见model_supports_n），返回各采样结果的列表
     """
     
     # 如果没有指定模型，从池中随机选择一个
@@ -221,6 +323,12 @@ def call_ai_api(messages, response_format="text", temp=0.7, model_name=None, mod
     # api_config['model] 也只包含模型名称 比如Pro/deepseek-ai/DeepSeek-V3
     use_model = api_config.get("model", model_name.split("/", 1)[1])
 
+    # 在任务中执行时检查取消令牌，已中止的任务不再发出新的调用
+    token = current_cancellation_token()
+    if token is not None:
+        token.raise_if_cancelled()
+    _thread_calls.count = model_call_count() + 1
+
     try:
         if model_name in ["siliconflow/Pro/deepseek-ai/DeepSeek-V3"]:
             # 硅基流动DeepSeek v3调用逻辑
@@ -238,34 +346,15 @@ def call_ai_api(messages, response_format="text", temp=0.7, model_name=None, mod
             
             if response_format == "json_object":
                 payload["response_format"] = {"type": "json_object"}
+            if n > 1:
+                payload["n"] = n
 
             # print(f"DEBUG - 发送请求到 {model_name}，URL: {api_config['api_url']}")
             # print(f"DEBUG - 请求头: {api_config['headers']}")
             # print(f"DEBUG - 请求载荷: {json.dumps(payload, ensure_ascii=False)[:500]}...")
 
-            response = requests.post(
-                api_config["api_url"],
-                json=payload,
-                headers=api_config["headers"],
-                timeout=600
-            )
-
-            # print(f"DEBUG - API响应状态码: {response.status_code}")
-            # print(f"DEBUG - API响应头: {response.headers}")
-            # print(f"DEBUG - API原始响应文本: {response.text[:500]}...")
-
-            if response.status_code != 200:
-                print(f"API调用失败，状态码：{response.status_code}")
-                print(f"错误信息：{response.text}")
-                raise Exception(f"API调用失败: {response.status_code}, {response.text[:200]}")
-
-            response_json = response.json()
-            # print(f"DEBUG - 解析的JSON响应: {json.dumps(response_json, ensure_ascii=False)[:500]}...")
-            
-            if "choices" not in response_json or len(response_json["choices"]) == 0:
-                raise Exception(f"API响应缺少choices字段: {json.dumps(response_json, ensure_ascii=False)[:200]}")
-            
-            content = response_json["choices"][0]["message"]["content"]
+            contents = _post_chat_completion(api_config, payload, token=token)
+            content = contents[0]
 
         if model_name in ["deepseek/deepseek-chat"]:
             # deepseek chat调用逻辑
@@ -283,34 +372,15 @@ def call_ai_api(messages, response_format="text", temp=0.7, model_name=None, mod
 
             if response_format == "json_object":
                 payload["response_format"] = {"type": "json_object"}
+            if n > 1:
+                payload["n"] = n
 
             # print(f"DEBUG - 发送请求到 {model_name}，URL: {api_config['api_url']}")
             # print(f"DEBUG - 请求头: {api_config['headers']}")
             # print(f"DEBUG - 请求载荷: {json.dumps(payload, ensure_ascii=False)[:500]}...")
 
-            response = requests.post(
-                api_config["api_url"],
-                json=payload,
-                headers=api_config["headers"],
-                timeout=600
-            )
-
-            # print(f"DEBUG - API响应状态码: {response.status_code}")
-            # print(f"DEBUG - API响应头: {response.headers}")
-            # print(f"DEBUG - API原始响应文本: {response.text[:500]}...")
-
-            if response.status_code != 200:
-                print(f"API调用失败，状态码：{response.status_code}")
-                print(f"错误信息：{response.text}")
-                raise Exception(f"API调用失败: {response.status_code}, {response.text[:200]}")
-
-            response_json = response.json()
-            # print(f"DEBUG - 解析的JSON响应: {json.dumps(response_json, ensure_ascii=False)[:500]}...")
-
-            if "choices" not in response_json or len(response_json["choices"]) == 0:
-                raise Exception(f"API响应缺少choices字段: {json.dumps(response_json, ensure_ascii=False)[:200]}")
-
-            content = response_json["choices"][0]["message"]["content"]
+            contents = _post_chat_completion(api_config, payload, token=token)
+            content = contents[0]
 
         if model_name in ["new_api_aliyun/kimi-k2-turbo-preview"]:
             # 阿里云API kimi模型调用逻辑
@@ -326,84 +396,213 @@ def call_ai_api(messages, response_format="text", temp=0.7, model_name=None, mod
 
             if response_format == "json_object":
                 payload["response_format"] = {"type": "json_object"}
+            if n > 1:
+                payload["n"] = n
 
             # print(f"DEBUG - 发送请求到 {model_name}，URL: {api_config['api_url']}")
             # print(f"DEBUG - 请求头: {api_config['headers']}")
             # print(f"DEBUG - 请求载荷: {json.dumps(payload, ensure_ascii=False)[:500]}...")
 
-            response = requests.post(
-                api_config["api_url"],
-                json=payload,
-                headers=api_config["headers"],
-                timeout=600
-            )
-
-            # print(f"DEBUG - API响应状态码: {response.status_code}")
-            # print(f"DEBUG - API响应头: {response.headers}")
-            # print(f"DEBUG - API原始响应文本: {response.text[:500]}...")
-
-            if response.status_code != 200:
-                print(f"API调用失败，状态码：{response.status_code}")
-                print(f"错误信息：{response.text}")
-                raise Exception(f"API调用失败: {response.status_code}, {response.text[:200]}")
-
-            response_json = response.json()
-            # print(f"DEBUG - 解析的JSON响应: {json.dumps(response_json, ensure_ascii=False)[:500]}...")
+            contents = _post_chat_completion(api_config, payload, token=token)
+            content = contents[0]
 
-            if "choices" not in response_json or len(response_json["choices"]) == 0:
-                raise Exception(f"API响应缺少choices字段: {json.dumps(response_json, ensure_ascii=False)[:200]}")
+        if n > 1:
+            return [_clean_response_content(c, messages, response_format) for c in contents]
+        return _clean_response_content(content, messages, response_format)
 
-            content = response_json["choices"][0]["message"]["content"]
-
-        # 处理JSON响应
-        if response_format == "json_object":
-            # print(f"DEBUG (call_ai_api) - Raw content received from {model_name}: {content[:500]}...")
-
-            # 清除可能存在的代码块标记
-            original_content_before_cleanup = content # 保存清理前的内容
-            if "```json" in content or "```" in content:
-                import re
-                json_matches = re.findall(r'```(?:json)?(.*?)```', content, re.DOTALL)
-                if json_matches:
-                    content = json_matches[0].strip()
-                elif content.startswith("```") and content.endswith("```"):
-                    content = content[3:-3].strip()
-
-            try:
-                parsed_json = json.loads(content)
-                if isinstance(parsed_json, list):
-                    # print(f"DEBUG (call_ai_api) - Parsed JSON is a list: {parsed_json}")
-                    pass
-                elif isinstance(parsed_json, dict):
-                    # print(f"DEBUG (call_ai_api) - Parsed JSON is a dict: {parsed_json}")
-                    pass
-                else:
-                    # print(f"DEBUG (call_ai_api) - Parsed JSON is of unexpected type: {type(parsed_json)}")
-                    pass
-
-                # print(f"DEBUG (call_ai_api) - JSON parsed successfully from {model_name}.")
-                return json.dumps(parsed_json, ensure_ascii=False)
-            except json.JSONDecodeError as e:
-                # print(f"DEBUG (call_ai_api) - JSONDecodeError from {model_name}: {e}")
-                # print(f"DEBUG (call_ai_api) - Content that failed parsing (after cleanup): {content[:500]}...")
-                # print(f"DEBUG (call_ai_api) - Original content before cleanup: {original_content_before_cleanup[:500]}...")
-                
-                # 如果解析失败，返回空对象或数组
-                if "产品描述:" in messages[1]["content"] and "用户画像" in messages[1]["content"]:
-                    return json.dumps([])
-                else:
-                    return json.dumps({})
-        
-        return content
-        
+    except TaskCancelled:
+        raise
     except Exception as e:
         print(f"API调用错误: {str(e)}")
         # 打印更多上下文
         # print(f"DEBUG (call_ai_api) - Error occurred for messages: {messages}")
+        if n > 1:
+            return []
         if response_format == "json_object":
             # 区分返回类型
             is_persona_request = False
             if "用户画像" in messages[1]["content"]:
                 is_persona_request = True
             return json.dumps([]) if is_persona_request else json.dumps({})
-        return f"API调用错误: {str(e)}"
\ No newline at end of file
+        return f"API调用错误: {str(e)}"
+
+def _parse_chat_completion(response):
+    """
+    解析非流式chat completions响应，返回各采样结果的内容列表
+    """
+    if response.status_code != 200:
+        print(f"API调用失败，状态码：{response.status_code}")
+        print(f"错误信息：{response.text}")
+        raise Exception(f"API调用失败: {response.status_code}, {response.text[:200]}")
+
+    response_json = response.json()
+    if "choices" not in response_json or len(response_json["choices"]) == 0:
+        raise Exception(f"API响应缺少choices字段: {json.dumps(response_json, ensure_ascii=False)[:200]}")
+
+    return [choice["message"]["content"] for choice in response_json["choices"]]
+
+
+def _post_chat_completion(api_config, payload, token=None):
+    """
+    发送chat completions请求，返回各采样结果的内容列表
+    在任务中执行时（token不为空）取消令牌会关闭进行中请求的连接并抛出TaskCancelled；开启API_CANCELLABLE_STREAMING时改用流式传输，
+    每读取一行检查取消令牌，中止前已收到的部分回复也计入统计。本次调用估算的token消耗登记到令牌上，用于统计中止后的额度消耗
+    api_config: API配置
+    payload: 请求载荷（stream为False）
+    token: 当前任务的取消令牌
+    成功的调用耗时记入当前调用延迟（见call_latency）
+    """
+    request_started_at = time.time()
+    if token is None:
+        response = requests.post(
+            api_config["api_url"],
+            json=payload,
+            headers=api_config["headers"],
+            timeout=600
+        )
+        contents = _parse_chat_completion(response)
+        record_call_latency(time.time() - request_started_at)
+        return contents
+
+    if not CANCELLABLE_STREAMING:
+        prompt_tokens = estimate_tokens(json.dumps(payload["messages"], ensure_ascii=False))
+        started_at = token.begin_call()
+        contents = []
+        aborted = False
+        # 每次调用使用独立的会话，取消时关闭其连接，等待中的请求立即失败
+        session = requests.Session()
+        adapter = _AbortableAdapter()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        abort_key = token.register(adapter.abort)
+        try:
+            try:
+                response = session.post(
+                    api_config["api_url"],
+                    json=payload,
+                    headers=api_config["headers"],
+                    timeout=600
+                )
+            except requests.RequestException:
+                if adapter.aborted:
+                    aborted = True
+                    raise TaskCancelled()
+                raise
+            contents = _parse_chat_completion(response)
+            record_call_latency(time.time() - request_started_at)
+            return contents
+        finally:
+            token.unregister(abort_key)
+            session.close()
+            token.end_call(started_at, prompt_tokens,
+                           estimate_tokens("".join(c or "" for c in contents)), aborted=aborted)
+
+    prompt_tokens = estimate_tokens(json.dumps(payload["messages"], ensure_ascii=False))
+    started_at = token.begin_call()
+    chunks = {}
+    finished = False
+    response = None
+    close_key = None
+    try:
+        response = requests.post(
+            api_config["api_url"],
+            json={**payload, "stream": True},
+            headers=api_config["headers"],
+            timeout=600,
+            stream=True
+        )
+        # 取消时从其他线程关闭连接，正在等待数据的读取随之结束
+        close_key = token.register(response.close)
+
+        if response.status_code != 200:
+            print(f"API调用失败，状态码：{response.status_code}")
+            print(f"错误信息：{response.text}")
+            raise Exception(f"API调用失败: {response.status_code}, {response.text[:200]}")
+
+        for line in response.iter_lines():
+            if token.cancelled:
+                break
+            if not line:
+                continue
+            decoded_line = line.decode('utf-8', errors='ignore')
+            if not decoded_line.startswith("data:"):
+                continue
+            data_str = decoded_line[5:].strip()
+            if data_str == "[DONE]":
+                finished = True
+                break
+            if not data_str:
+                continue
+            try:
+                data_json = json.loads(data_str)
+            except json.JSONDecodeError:
+                continue
+            for choice in data_json.get("choices") or []:
+                content = (choice.get("delta") or {}).get("content")
+                if content:
+                    chunks.setdefault(choice.get("index", 0), []).append(content)
+        else:
+            # 取消时连接被关闭，读取可能没有异常地结束，此时回复不完整
+            finished = not token.cancelled
+    except Exception:
+        if not token.cancelled:
+            raise
+    finally:
+        token.unregister(close_key)
+        if response is not None:
+            response.close()
+        aborted = token.cancelled and not finished
+        token.end_call(started_at, prompt_tokens,
+                       estimate_tokens("".join("".join(parts) for parts in chunks.values())), aborted=aborted)
+
+    if aborted:
+        raise TaskCancelled()
+    if not chunks:
+        raise Exception("API响应缺少choices字段: 流式响应中没有内容")
+    record_call_latency(time.time() - request_started_at)
+    return ["".join(chunks[index]) for index in sorted(chunks)]
+
+def _clean_response_content(content, messages, response_format):
+    """
+    清理模型返回的内容：JSON格式时去掉代码块标记并校验，解析失败返回空对象或数组
+    """
+    # 处理JSON响应
+    if response_format == "json_object":
+        # print(f"DEBUG (call_ai_api) - Raw content received from {model_name}: {content[:500]}...")
+
+        # 清除可能存在的代码块标记
+        original_content_before_cleanup = content # 保存清理前的内容
+        if "```json" in content or "```" in content:
+            import re
+            json_matches = re.findall(r'```(?:json)?(.*?)```', content, re.DOTALL)
+            if json_matches:
+                content = json_matches[0].strip()
+            elif content.startswith("```") and content.endswith("```"):
+                content = content[3:-3].strip()
+
+        try:
+            parsed_json = json.loads(content)
+            if isinstance(parsed_json, list):
+                # print(f"DEBUG (call_ai_api) - Parsed JSON is a list: {parsed_json}")
+                pass
+            elif isinstance(parsed_json, dict):
+                # print(f"DEBUG (call_ai_api) - Parsed JSON is a dict: {parsed_json}")
+                pass
+            else:
+                # print(f"DEBUG (call_ai_api) - Parsed JSON is of unexpected type: {type(parsed_json)}")
+                pass
+
+            # print(f"DEBUG (call_ai_api) - JSON parsed successfully from {model_name}.")
+            return json.dumps(parsed_json, ensure_ascii=False)
+        except json.JSONDecodeError as e:
+            # print(f"DEBUG (call_ai_api) - JSONDecodeError from {model_name}: {e}")
+            # print(f"DEBUG (call_ai_api) - Content that failed parsing (after cleanup): {content[:500]}...")
+            # print(f"DEBUG (call_ai_api) - Original content before cleanup: {original_content_before_cleanup[:500]}...")
+            
+            # 如果解析失败，返回空对象或数组
+            if "产品描述:" in messages[1]["content"] and "用户画像" in messages[1]["content"]:
+                return json.dumps([])
+            else:
+                return json.dumps({})
+    
+    return content
@@ -0,0 +1,60 @@
+import os
+import statistics
+import threading
+import time
+from collections import deque
+from typing import Optional
+
+# 计算当前模型调用延迟时使用的最近调用数和时间窗口（秒）
+CALL_LATENCY_WINDOW = 50
+CALL_LATENCY_MAX_AGE_SECONDS = float(os.getenv("ETA_LATENCY_WINDOW_SECONDS", "300"))
+# 样本少于该数量时不给出当前延迟
+MIN_LATENCY_SAMPLES = 3
+
+
+class CallLatencyTracker:
+    """
+    记录本进程最近成功的模型调用耗时，给出当前的调用延迟（时间窗口内的中位数）
+    预计完成时间模型用它把历史任务的单元耗时换算到当前的供应商延迟
+    """
+
+    def __init__(self, window=CALL_LATENCY_WINDOW, max_age=CALL_LATENCY_MAX_AGE_SECONDS):
+        """
+        window: 保留的最近调用数
+        max_age: 只使用该时间（秒）内的调用
+        """
+        self.samples = deque(maxlen=window)
+        self.max_age = max_age
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        with self.lock:
+            self.samples.append((time.time(), seconds))
+
+    def current(self) -> Optional[float]:
+        """
+        当前的调用延迟（秒），最近没有足够的调用时返回None
+        """
+        since = time.time() - self.max_age
+        with self.lock:
+            recent = [seconds for at, seconds in self.samples if at >= since]
+        if len(recent) < MIN_LATENCY_SAMPLES:
+            return None
+        return statistics.median(recent)
+
+
+_tracker = CallLatencyTracker()
+
+
+def record_call_latency(seconds):
+    """
+    记录一次成功的模型调用耗时
+    """
+    _tracker.record(seconds)
+
+
+def current_call_latency() -> Optional[float]:
+    """
+    本进程当前的模型调用延迟（秒），最近没有足够的调用时返回None
+    """
+    return _tracker.current()
@@ -0,0 +1,255 @@
+import functools
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+
+
+class TaskCancelled(Exception):
+    """
+    任务已被中止：模型调用、重试等待和尚未开始的工作单元遇到已取消的令牌时抛出，不再重试
+    """
+
+    def __init__(self, message="任务已被中止"):
+        super().__init__(message)
+
+
+class CancellationToken:
+    """
+    任务的协作式取消令牌
+    - 取消时立即执行登记的回调（关闭正在读取的HTTP流、取消尚未开始的工作单元）
+    - 模型调用开始前、流式读取的每一行、重试等待期间检查令牌，取消后在几秒内停止
+    - 记录取消时仍在进行的模型调用，以及取消之后仍然消耗的token（用于报告中止后的额度消耗）
+    """
+
+    def __init__(self, task_id=None):
+        """
+        task_id: 所属任务ID
+        """
+        self.task_id = task_id
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.reason = None
+        self.cancelled_at = None
+        self.callbacks = {}
+        self._next_key = 0
+        self.in_flight = 0
+        self.drained_at = None
+        self.drained = threading.Event()
+        self.usage = {
+            'in_flight_at_cancel': 0,
+            'calls_after_cancel': 0,
+            'aborted_calls': 0,
+            'prompt_tokens_in_flight': 0,
+            'tokens_after_cancel': 0,
+        }
+
+    @property
+    def cancelled(self) -> bool:
+        return self.event.is_set()
+
+    def cancel(self, reason="任务已被中止") -> bool:
+        """
+        取消令牌并执行所有登记的回调
+        返回: 是否为首次取消
+        """
+        with self.lock:
+            if self.event.is_set():
+                return False
+            self.reason = reason
+            self.cancelled_at = time.time()
+            self.usage['in_flight_at_cancel'] = self.in_flight
+            if self.in_flight == 0:
+                self.drained_at = self.cancelled_at
+                self.drained.set()
+            self.event.set()
+            callbacks = list(self.callbacks.values())
+            self.callbacks.clear()
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"执行取消回调时出错: {str(e)}")
+        return True
+
+    def raise_if_cancelled(self):
+        if self.event.is_set():
+            raise TaskCancelled(self.reason or "任务已被中止")
+
+    def sleep(self, seconds):
+        """
+        可被取消打断的等待（重试间隔），取消时抛出TaskCancelled
+        """
+        if self.event.wait(seconds):
+            self.raise_if_cancelled()
+
+    def register(self, callback: Callable[[], object]) -> Optional[int]:
+        """
+        登记取消时执行的回调，令牌已取消时立即执行
+        返回: 用于unregister的键，已取消时返回None
+        """
+        with self.lock:
+            if not self.event.is_set():
+                key = self._next_key
+                self._next_key += 1
+                self.callbacks[key] = callback
+                return key
+        callback()
+        return None
+
+    def unregister(self, key):
+        if key is None:
+            return
+        with self.lock:
+            self.callbacks.pop(key, None)
+
+    def begin_call(self) -> float:
+        """
+        登记一次开始的模型调用
+        返回: 调用开始时间，结束时传给end_call
+        """
+        with self.lock:
+            self.in_flight += 1
+        return time.time()
+
+    def end_call(self, started_at, prompt_tokens=0, completion_tokens=0, aborted=False):
+        """
+        登记一次结束（或因取消中断）的模型调用，取消之后结束的调用计入中止后的额度消耗
+        started_at: begin_call的返回值
+        prompt_tokens: 提示词的估算token数
+        completion_tokens: 已收到的回复的估算token数
+        aborted: 是否因取消而中断读取
+        """
+        with self.lock:
+            self.in_flight -= 1
+            if self.cancelled_at is not None:
+                self.usage['calls_after_cancel'] += 1
+                if aborted:
+                    self.usage['aborted_calls'] += 1
+                if started_at >= self.cancelled_at:
+                    # 取消后才发出的调用（不应出现），全部计入
+                    self.usage['tokens_after_cancel'] += prompt_tokens + completion_tokens
+                else:
+                    self.usage['prompt_tokens_in_flight'] += prompt_tokens
+                    if not aborted:
+                        # 取消时仍在生成、随后完整返回的回复
+                        self.usage['tokens_after_cancel'] += completion_tokens
+                if self.in_flight == 0:
+                    self.drained_at = time.time()
+                    self.drained.set()
+
+    def wait_drained(self, timeout=None) -> Dict:
+        """
+        等待取消时仍在进行的模型调用全部结束
+        timeout: 最长等待秒数，超时时报告中的in_flight为仍未结束的调用数
+        返回: report()
+        """
+        self.drained.wait(timeout)
+        return self.report()
+
+    def report(self) -> Dict:
+        """
+        取消报告：取消时间、所有调用停止所用的时间以及取消后的额度消耗（估算）
+        """
+        with self.lock:
+            report = {
+                'reason': self.reason,
+                'cancelled_at': self.cancelled_at,
+                'in_flight': self.in_flight,
+                'drain_seconds': (round(self.drained_at - self.cancelled_at, 2)
+                                  if self.drained_at is not None and self.cancelled_at is not None else None),
+                **self.usage,
+            }
+        report['prompt_tokens_in_flight'] = int(report['prompt_tokens_in_flight'])
+        report['tokens_after_cancel'] = int(report['tokens_after_cancel'])
+        return report
+
+
+_tokens: Dict[str, CancellationToken] = {}
+_tokens_lock = threading.Lock()
+_local = threading.local()
+
+
+def reset_cancellation_token(task_id) -> CancellationToken:
+    """
+    为开始执行的任务创建新的取消令牌（重新执行的任务不沿用上次已取消的令牌）
+    """
+    token = CancellationToken(task_id)
+    with _tokens_lock:
+        _tokens[task_id] = token
+    return token
+
+
+def cancel_task_token(task_id, reason="任务已被中止") -> bool:
+    """
+    取消正在本进程中执行的任务
+    返回: 任务是否有令牌且为首次取消
+    """
+    with _tokens_lock:
+        token = _tokens.get(task_id)
+    return token.cancel(reason) if token is not None else False
+
+
+def release_cancellation_token(task_id, token=None):
+    """
+    任务执行结束后移除令牌；提供token时只移除同一个令牌（任务可能已被重新执行）
+    """
+    with _tokens_lock:
+        if token is None or _tokens.get(task_id) is token:
+            _tokens.pop(task_id, None)
+
+
+def current_cancellation_token() -> Optional[CancellationToken]:
+    """
+    当前线程所在任务的取消令牌，不在任务中执行时为None
+    """
+    return getattr(_local, 'token', None)
+
+
+@contextmanager
+def cancellation_scope(token: Optional[CancellationToken]):
+    """
+    在当前线程中设置取消令牌，期间的模型调用和重试等待都会检查该令牌
+    """
+    previous = current_cancellation_token()
+    _local.token = token
+    try:
+        yield token
+    finally:
+        _local.token = previous
+
+
+def bind_cancellation(fn, token: Optional[CancellationToken] = None):
+    """
+    把当前线程的取消令牌绑定到函数上，供提交到线程池的函数在工作线程中使用同一令牌
+    """
+    token = token or current_cancellation_token()
+    if token is None:
+        return fn
+
+    @functools.wraps(fn)
+    def run(*args, **kwargs):
+        token.raise_if_cancelled()
+        with cancellation_scope(token):
+            return fn(*args, **kwargs)
+    return run
+
+
+def check_cancelled():
+    """
+    当前线程所在任务已取消时抛出TaskCancelled
+    """
+    token = current_cancellation_token()
+    if token is not None:
+        token.raise_if_cancelled()
+
+
+def cancellable_sleep(seconds):
+    """
+    重试等待：在任务中执行时可被取消打断（抛出TaskCancelled），否则普通等待
+    """
+    token = current_cancellation_token()
+    if token is None:
+        time.sleep(seconds)
+    else:
+        token.sleep(seconds)
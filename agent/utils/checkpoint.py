@@ -0,0 +1,131 @@
+import os
+import json
+import threading
+from typing import Dict, List, Tuple
+
+
+def get_checkpoint_path(task_id, app):
+    """
+    任务检查点文件路径
+    task_id: 任务ID
+    app: 应用实例
+    """
+    return os.path.join(app.config['UPLOAD_FOLDER'], f"{task_id}_checkpoint.jsonl")
+
+
+class TaskCheckpoint:
+    """
+    任务检查点：已完成的画像和模拟单元逐行追加写入JSONL文件
+    进程重启或任务失败后重新执行时，从检查点恢复，只执行尚未完成的部分
+    记录类型：
+    - persona: 画像阶段中被接受的一个画像及其到达顺序（错误替代画像占用顺序但不记录）
+    - personas_complete: 画像阶段结束，包含最终的画像列表（模拟阶段按该列表的顺序编号）；
+      之前记录的单元与该列表的顺序一致时（keep_units，重叠执行或从中断的画像阶段恢复）保留
+    - unit: 一个成功完成的模拟单元 (画像序号, 模拟序号, 模拟结果)，多方案任务另外记录方案序号
+    """
+
+    def __init__(self, path):
+        """
+        path: 检查点文件路径
+        """
+        self.path = path
+        self.lock = threading.Lock()
+
+    def _append(self, record):
+        with self.lock:
+            try:
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            except Exception as e:
+                print(f"写入任务检查点时出错: {str(e)}")
+
+    def load(self):
+        """
+        读取检查点，末尾因进程中断而不完整的行会被忽略
+        返回: {"personas": 画像列表, "personas_complete": 画像阶段是否已结束,
+               "units": {(画像序号, 模拟序号): 模拟结果}（第一个方案）,
+               "variant_units": {方案序号: {(画像序号, 模拟序号): 模拟结果}}}
+        画像阶段没有结束时，重叠执行中记录的单元按其画像在返回的画像列表中的序号重新编号
+        （恢复时这些画像按原顺序最先被重新接受），对应错误替代画像的单元被丢弃
+        """
+        personas: List[Dict] = []
+        # 画像阶段中各画像的到达顺序（即单元记录中的画像序号）
+        positions: List[int] = []
+        complete = False
+        variant_units: Dict[int, Dict[Tuple[int, int], Dict]] = {0: {}}
+        if not os.path.exists(self.path):
+            return {"personas": personas, "personas_complete": complete, "units": variant_units[0],
+                    "variant_units": variant_units}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    record_type = record.get("type")
+                    if record_type == "persona" and not complete:
+                        positions.append(record.get("position", len(personas)))
+                        personas.append(record["persona"])
+                    elif record_type == "personas_complete":
+                        personas = record["personas"]
+                        complete = True
+                        if not record.get("keep_units"):
+                            variant_units = {0: {}}
+                    elif record_type == "unit":
+                        units = variant_units.setdefault(record.get("variant", 0), {})
+                        units[(record["index"], record["sim_index"])] = record["result"]
+        except Exception as e:
+            print(f"读取任务检查点时出错: {str(e)}")
+        if not complete:
+            rank = {position: index for index, position in enumerate(positions)}
+            variant_units = {
+                variant: {(rank[index], sim_index): result
+                          for (index, sim_index), result in units.items() if index in rank}
+                for variant, units in variant_units.items()
+            }
+            variant_units.setdefault(0, {})
+        return {"personas": personas, "personas_complete": complete, "units": variant_units[0],
+                "variant_units": variant_units}
+
+    def reset(self):
+        """
+        清空检查点（重新生成画像前调用，已读取的画像会在重新接受时再次写入）
+        """
+        with self.lock:
+            try:
+                open(self.path, 'w', encoding='utf-8').close()
+            except Exception as e:
+                print(f"清空任务检查点时出错: {str(e)}")
+
+    def remove(self):
+        """
+        删除检查点文件（任务完成或要求从头重新执行时）
+        """
+        with self.lock:
+            try:
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+            except Exception as e:
+                print(f"删除任务检查点时出错: {str(e)}")
+
+    def record_persona(self, persona, position=None):
+        record = {"type": "persona", "persona": persona}
+        if position is not None:
+            record["position"] = position
+        self._append(record)
+
+    def record_personas_complete(self, personas, keep_units=False):
+        record = {"type": "personas_complete", "personas": personas}
+        if keep_units:
+            record["keep_units"] = True
+        self._append(record)
+
+    def record_unit(self, index, sim_index, result, variant=0):
+        record = {"type": "unit", "index": index, "sim_index": sim_index, "result": result}
+        if variant:
+            record["variant"] = variant
+        self._append(record)
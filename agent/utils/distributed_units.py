@@ -0,0 +1,653 @@
+import concurrent.futures
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+from models import get_model_pool_concurrency
+from .cancellation import CancellationToken, cancellation_scope
+from .persona_generate import generate_persona_batch
+from .simulatiton_generate import run_single_simulation
+from .simulation_scheduler import DEFAULT_SIMULATION_WORKERS_CAP, SlotExecutor, get_simulation_scheduler
+from .web_search_pipeline import WebEvidence
+
+# 租约时长（秒）：领取单元的节点需在此时间内续约，否则单元被重新分配给其他节点
+UNIT_LEASE_SECONDS = float(os.getenv("DISTRIBUTED_LEASE_SECONDS", "60"))
+# 单元最多被领取的次数（租约过期重新分配也计入），超过后判定为失败
+UNIT_MAX_LEASES = int(os.getenv("DISTRIBUTED_MAX_LEASES", "3"))
+# 领取单元、收集结果的轮询间隔（秒）
+UNIT_POLL_SECONDS = float(os.getenv("DISTRIBUTED_POLL_SECONDS", "0.5"))
+# 一个协调进程同时在途的单元数上限（所有节点合计），相当于分布式模式下的并发窗口
+DEFAULT_MAX_IN_FLIGHT = int(os.getenv("DISTRIBUTED_MAX_IN_FLIGHT", "64"))
+# 执行节点续约并检查单元是否已被取消的最长间隔（秒）
+UNIT_CANCEL_CHECK_SECONDS = 5
+# 已结束但没有被收集的单元（例如协调进程已退出）保留的时间（秒）
+UNIT_RETENTION_SECONDS = 24 * 3600
+
+UNIT_PENDING = "pending"
+UNIT_LEASED = "leased"
+UNIT_DONE = "done"
+UNIT_FAILED = "failed"
+UNIT_CANCELLED = "cancelled"
+
+_unit_scheduler = None
+_unit_scheduler_lock = threading.Lock()
+
+
+def is_distributed_mode() -> bool:
+    """
+    是否把画像生成批次和模拟单元分发给多个节点执行（DISTRIBUTED_UNITS）
+    """
+    return os.getenv("DISTRIBUTED_UNITS", "0").strip().lower() in ("1", "true", "yes", "on")
+
+
+def get_work_unit_store_path(app=None, root=None):
+    """
+    协调存储的位置：DISTRIBUTED_STORE_PATH，默认 data/work_units.db
+    app: 应用实例（使用其UPLOAD_FOLDER）
+    root: 没有应用实例时的数据目录
+    """
+    path = os.getenv("DISTRIBUTED_STORE_PATH", "").strip()
+    if path:
+        return path
+    folder = app.config['UPLOAD_FOLDER'] if app is not None else root
+    return os.path.join(folder, "work_units.db")
+
+
+def default_node_name(prefix="node"):
+    return f"{prefix}@{socket.gethostname()}:{os.getpid()}"
+
+
+class WorkUnitStore:
+    """
+    工作单元的协调存储（SQLite实现，作为单机多进程的本地替身）
+    - 协调进程发布单元，任意节点以租约方式领取，执行期间定期续约
+    - 租约过期（节点退出或失联）的单元被重新分配，超过最大领取次数后判定为失败
+    - 只有当前持有租约的节点能提交结果，过期节点的迟到结果被忽略
+    - 协调进程收集自己发布的已结束单元，收集后删除
+    多机部署时需要所有节点都能访问的存储，实现同样的接口即可替换
+    """
+
+    def __init__(self, path):
+        """
+        path: 数据库文件路径
+        """
+        self.path = path
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS work_units ("
+                " unit_id TEXT PRIMARY KEY,"
+                " task_id TEXT NOT NULL,"
+                " kind TEXT NOT NULL,"
+                " payload TEXT NOT NULL,"
+                " coordinator TEXT NOT NULL,"
+                " status TEXT NOT NULL,"
+                " owner TEXT,"
+                " lease_expires REAL,"
+                " leases INTEGER NOT NULL DEFAULT 0,"
+                " result TEXT,"
+                " error TEXT,"
+                " created_at REAL NOT NULL,"
+                " updated_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS work_units_status ON work_units (status, created_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS work_units_coordinator ON work_units (coordinator, status)")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def publish(self, unit_id, task_id, kind, payload, coordinator):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO work_units (unit_id, task_id, kind, payload, coordinator, status, created_at, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (unit_id, task_id, kind, json.dumps(payload, ensure_ascii=False), coordinator, UNIT_PENDING, now, now),
+            )
+
+    def lease(self, owner, limit, lease_seconds=UNIT_LEASE_SECONDS, max_leases=UNIT_MAX_LEASES):
+        """
+        领取最多limit个待执行或租约已过期的单元
+        owner: 领取节点标识
+        返回: [(单元ID, 类型, 参数)]
+        """
+        if limit <= 0:
+            return []
+        now = time.time()
+        leased = []
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute(
+                "SELECT unit_id, kind, payload, status, leases FROM work_units"
+                " WHERE status = ? OR (status = ? AND lease_expires < ?)"
+                " ORDER BY created_at LIMIT ?",
+                (UNIT_PENDING, UNIT_LEASED, now, limit * 2),
+            ).fetchall()
+            for row in rows:
+                if row["leases"] >= max_leases:
+                    conn.execute("UPDATE work_units SET status = ?, error = ?, updated_at = ? WHERE unit_id = ?",
+                                 (UNIT_FAILED, f"租约过期 {row['leases']} 次，放弃执行", now, row["unit_id"]))
+                    continue
+                if len(leased) >= limit:
+                    continue
+                if row["status"] == UNIT_LEASED:
+                    print(f"工作单元 {row['unit_id']} 的租约已过期，重新分配给 {owner}")
+                conn.execute(
+                    "UPDATE work_units SET status = ?, owner = ?, lease_expires = ?, leases = leases + 1,"
+                    " updated_at = ? WHERE unit_id = ?",
+                    (UNIT_LEASED, owner, now + lease_seconds, now, row["unit_id"]),
+                )
+                leased.append((row["unit_id"], row["kind"], json.loads(row["payload"])))
+            conn.execute("COMMIT")
+        return leased
+
+    def heartbeat(self, owner, unit_ids, lease_seconds=UNIT_LEASE_SECONDS):
+        """
+        为仍在执行的单元续约
+        返回: 仍由该节点持有的单元ID集合（不在其中的单元已被重新分配或取消）
+        """
+        unit_ids = list(unit_ids)
+        if not unit_ids:
+            return set()
+        now = time.time()
+        placeholders = ",".join("?" * len(unit_ids))
+        with self._connect() as conn:
+            conn.execute(
+                f"UPDATE work_units SET lease_expires = ?, updated_at = ?"
+                f" WHERE owner = ? AND status = ? AND unit_id IN ({placeholders})",
+                [now + lease_seconds, now, owner, UNIT_LEASED] + unit_ids,
+            )
+            rows = conn.execute(
+                f"SELECT unit_id FROM work_units WHERE owner = ? AND status = ? AND unit_id IN ({placeholders})",
+                [owner, UNIT_LEASED] + unit_ids,
+            ).fetchall()
+        return {row["unit_id"] for row in rows}
+
+    def _finish(self, unit_id, owner, status, result=None, error=None):
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE work_units SET status = ?, result = ?, error = ?, updated_at = ?"
+                " WHERE unit_id = ? AND owner = ? AND status = ?",
+                (status, result, error, time.time(), unit_id, owner, UNIT_LEASED),
+            )
+            return cursor.rowcount > 0
+
+    def complete(self, unit_id, owner, result) -> bool:
+        """
+        提交单元结果，只有当前持有租约的节点能提交
+        返回: 是否被接受
+        """
+        return self._finish(unit_id, owner, UNIT_DONE, result=json.dumps(result, ensure_ascii=False))
+
+    def fail(self, unit_id, owner, error) -> bool:
+        return self._finish(unit_id, owner, UNIT_FAILED, error=str(error))
+
+    def collect(self, coordinator):
+        """
+        取出协调进程发布的已结束单元并从存储中删除
+        返回: [(单元ID, 状态, 结果, 错误信息)]
+        """
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute(
+                "SELECT unit_id, status, result, error FROM work_units WHERE coordinator = ? AND status IN (?, ?, ?)",
+                (coordinator, UNIT_DONE, UNIT_FAILED, UNIT_CANCELLED),
+            ).fetchall()
+            if rows:
+                placeholders = ",".join("?" * len(rows))
+                conn.execute(f"DELETE FROM work_units WHERE unit_id IN ({placeholders})",
+                             [row["unit_id"] for row in rows])
+            conn.execute("COMMIT")
+        return [
+            (row["unit_id"], row["status"], json.loads(row["result"]) if row["result"] else None, row["error"])
+            for row in rows
+        ]
+
+    def cancel(self, unit_ids, include_leased=False):
+        """
+        取消单元
+        include_leased: 同时取消已被领取的单元，执行节点在下次续约时发现并中断执行；
+                        为False时只取消尚未被领取的单元，已被领取的单元会执行完，结果在收集时丢弃
+        返回: 被取消的单元数
+        """
+        unit_ids = list(unit_ids)
+        if not unit_ids:
+            return 0
+        placeholders = ",".join("?" * len(unit_ids))
+        statuses = [UNIT_PENDING, UNIT_LEASED] if include_leased else [UNIT_PENDING]
+        with self._connect() as conn:
+            cursor = conn.execute(
+                f"UPDATE work_units SET status = ?, updated_at = ?"
+                f" WHERE status IN ({','.join('?' * len(statuses))}) AND unit_id IN ({placeholders})",
+                [UNIT_CANCELLED, time.time()] + statuses + unit_ids,
+            )
+            return cursor.rowcount
+
+    def purge(self, older_than=UNIT_RETENTION_SECONDS):
+        """
+        删除长时间没有更新的单元（发布它们的协调进程已经退出）
+        """
+        with self._connect() as conn:
+            conn.execute("DELETE FROM work_units WHERE updated_at < ?", (time.time() - older_than,))
+
+    def counts(self) -> Dict[str, int]:
+        with self._connect() as conn:
+            return {row["status"]: row["count"] for row in
+                    conn.execute("SELECT status, COUNT(*) AS count FROM work_units GROUP BY status")}
+
+
+class UnitAdapter:
+    """
+    可分发的工作单元类型：把本地调用转换为可序列化的参数，在执行节点上还原执行，再把结果应用回本地
+    """
+
+    def __init__(self, kind, fn, encode, execute, apply):
+        """
+        kind: 单元类型名
+        fn: 对应的本地函数（调度器按函数识别可分发的单元）
+        encode: encode(args, kwargs) -> 可序列化的参数
+        execute: execute(参数, 模型池, 阶段线程池) -> 可序列化的结果（在执行节点上调用）
+        apply: apply(结果, args, kwargs) -> 本地调用的返回值（在协调进程中调用）
+        """
+        self.kind = kind
+        self.fn = fn
+        self.encode = encode
+        self.execute = execute
+        self.apply = apply
+
+
+def _encode_simulation(args, kwargs):
+    persona, persona_id, sim_index, instance_id, product_desc = args
+    web_context = kwargs.get("web_context") or ""
+    return {
+        "persona": persona,
+        "persona_id": persona_id,
+        "sim_index": sim_index,
+        "instance_id": instance_id,
+        "product_desc": product_desc,
+        "web_context": web_context.to_payload() if isinstance(web_context, WebEvidence) else web_context,
+        "outputs": kwargs.get("outputs") or {},
+        "profile": kwargs.get("profile"),
+    }
+
+
+def _execute_simulation(payload, model_pool, stage_executor):
+    web_context = payload["web_context"]
+    if isinstance(web_context, dict):
+        web_context = WebEvidence.from_payload(web_context)
+    outputs = payload["outputs"]
+    failures = []
+    result = run_single_simulation(
+        payload["persona"], payload["persona_id"], payload["sim_index"], payload["instance_id"],
+        payload["product_desc"], model_pool=model_pool, web_context=web_context,
+        stage_executor=stage_executor, outputs=outputs,
+        on_stage_failure=lambda stage, attempt, error, calls: failures.append([stage, attempt, str(error), calls]),
+        profile=payload["profile"],
+    )
+    return {
+        "result": result,
+        # 已完成阶段的输出带回协调进程，单元重试时跳过这些阶段
+        "outputs": outputs,
+        "stage_failures": failures,
+        "web_usage": web_context.usage() if isinstance(web_context, WebEvidence) else {},
+    }
+
+
+def _apply_simulation(unit_result, args, kwargs):
+    if kwargs.get("outputs") is not None:
+        kwargs["outputs"].update(unit_result.get("outputs") or {})
+    on_stage_failure = kwargs.get("on_stage_failure")
+    if on_stage_failure:
+        for stage, attempt, error, *calls in unit_result.get("stage_failures") or []:
+            on_stage_failure(stage, attempt, RuntimeError(error), *calls)
+    web_context = kwargs.get("web_context")
+    if isinstance(web_context, WebEvidence):
+        web_context.merge_usage(unit_result.get("web_usage"))
+    return unit_result["result"]
+
+
+def _encode_persona_batch(args, kwargs):
+    product_desc, existing_personas_context, cells, temperature = args
+    return {
+        "product_desc": product_desc,
+        "existing_personas_context": existing_personas_context,
+        "cells": list(cells),
+        "temperature": temperature,
+        "segment": kwargs.get("segment"),
+        "max_retries": kwargs.get("max_retries", 3),
+    }
+
+
+def _execute_persona_batch(payload, model_pool, stage_executor):
+    personas, attempts = generate_persona_batch(
+        payload["product_desc"], payload["existing_personas_context"], payload["cells"],
+        payload["temperature"], model_pool=model_pool, segment=payload["segment"],
+        max_retries=payload["max_retries"],
+    )
+    return {"personas": personas, "attempts": attempts}
+
+
+def _apply_persona_batch(unit_result, args, kwargs):
+    return unit_result["personas"], unit_result["attempts"]
+
+
+UNIT_ADAPTERS = {
+    adapter.kind: adapter for adapter in (
+        UnitAdapter("simulation", run_single_simulation,
+                    _encode_simulation, _execute_simulation, _apply_simulation),
+        UnitAdapter("persona_batch", generate_persona_batch,
+                    _encode_persona_batch, _execute_persona_batch, _apply_persona_batch),
+    )
+}
+_ADAPTERS_BY_FN = {adapter.fn: adapter for adapter in UNIT_ADAPTERS.values()}
+
+
+class UnitFuture(concurrent.futures.Future):
+    """
+    分布式工作单元的Future
+    单元被节点领取后不能再取消：cancel()先在存储中撤回尚未被领取的单元，
+    撤回失败（单元已被领取或已结束）时进入运行状态并返回False，与本地线程池中已开始执行的调用一致
+    """
+
+    def __init__(self, scheduler, unit_id):
+        super().__init__()
+        self.scheduler = scheduler
+        self.unit_id = unit_id
+
+    def cancel(self):
+        with self._condition:
+            if self.running() or self.done():
+                return super().cancel()
+            if not self.scheduler._withdraw(self.unit_id):
+                self.set_running_or_notify_cancel()
+                return False
+            return self._cancel_and_notify()
+
+    def cancel_withdrawn(self):
+        """
+        单元已在存储中取消（包括执行中的单元）时直接取消Future
+        """
+        with self._condition:
+            if self.running() or self.done():
+                return False
+            return self._cancel_and_notify()
+
+    def _cancel_and_notify(self):
+        super().cancel()
+        # 等待方在状态变为CANCELLED_AND_NOTIFIED时才被唤醒
+        self.set_running_or_notify_cancel()
+        return True
+
+    def start(self) -> bool:
+        """
+        单元结束、结果即将写入时进入运行状态
+        返回: 是否需要写入结果（已被取消或已结束时为False）
+        """
+        with self._condition:
+            if self.cancelled() or self.done():
+                return False
+            return self.running() or self.set_running_or_notify_cancel()
+
+
+class LeasedUnitScheduler:
+    """
+    分布式工作单元调度器，接口与SimulationScheduler一致，可直接传给simulate_task_reactions和画像生成引擎
+    - 可分发的单元（完整模拟、画像生成批次）发布到协调存储，由任意节点以租约方式领取执行
+    - 已发布而尚未收集的单元数不超过max_in_flight，超出的单元在本地排队，有单元结束后再发布
+    - 返回的Future在单元被节点领取后不能再取消（见UnitFuture）
+    - 其他调用（吞吐模式的打包、n采样）仍交给本地调度器
+    - 后台线程收集结果并完成对应的Future，失败的单元以异常返回，由调用方按原有逻辑重试
+    """
+
+    def __init__(self, store: WorkUnitStore, local_scheduler, max_in_flight=DEFAULT_MAX_IN_FLIGHT, name=None):
+        """
+        store: 协调存储
+        local_scheduler: 本地模拟调度器，执行不可分发的调用并提供阶段线程池
+        max_in_flight: 同时在途（已发布、待领取或执行中）的单元数上限（所有节点合计）
+        name: 协调进程标识，只收集自己发布的单元
+        """
+        self.store = store
+        self.local = local_scheduler
+        self.max_workers = max(1, int(max_in_flight))
+        self.stage_executor = local_scheduler.stage_executor
+        self.name = name or default_node_name("coordinator") + f":{uuid.uuid4().hex[:6]}"
+        self.lock = threading.Lock()
+        # 单元ID -> (future, 单元类型, args, kwargs, 任务ID)
+        self.pending = {}
+        # 等待发布的单元：单元ID -> (任务ID, 单元类型, 参数)，按提交顺序
+        self.waiting = OrderedDict()
+        # 已发布而尚未收集的单元数
+        self.in_flight = 0
+        self.collector = threading.Thread(target=self._collect_loop, daemon=True, name="unit-collector")
+        self.collector.start()
+
+    def submit(self, task_id, fn, *args, **kwargs):
+        adapter = _ADAPTERS_BY_FN.get(fn)
+        if adapter is None:
+            return self.local.submit(task_id, fn, *args, **kwargs)
+        unit_id = uuid.uuid4().hex
+        future = UnitFuture(self, unit_id)
+        try:
+            payload = adapter.encode(args, kwargs)
+        except Exception as e:
+            future.set_exception(e)
+            return future
+        with self.lock:
+            self.pending[unit_id] = (future, adapter, args, kwargs, task_id)
+            self.waiting[unit_id] = (task_id, adapter.kind, payload)
+        self._publish_waiting()
+        return future
+
+    def _publish_waiting(self):
+        """
+        在途单元数低于上限时按提交顺序发布等待中的单元
+        """
+        while True:
+            with self.lock:
+                if self.in_flight >= self.max_workers or not self.waiting:
+                    return
+                unit_id, (task_id, kind, payload) = self.waiting.popitem(last=False)
+                self.in_flight += 1
+            try:
+                self.store.publish(unit_id, task_id, kind, payload, self.name)
+            except Exception as e:
+                with self.lock:
+                    self.in_flight -= 1
+                    entry = self.pending.pop(unit_id, None)
+                if entry is not None and entry[0].start():
+                    entry[0].set_exception(e)
+
+    def _withdraw(self, unit_id):
+        """
+        撤回尚未执行的单元：尚未发布的单元移出队列，已发布的单元只在尚未被领取时取消
+        返回: 是否撤回成功
+        """
+        with self.lock:
+            if self.waiting.pop(unit_id, None) is not None:
+                self.pending.pop(unit_id, None)
+                return True
+        return self.store.cancel([unit_id]) > 0
+
+    def cancel_task(self, task_id):
+        """
+        取消任务的全部单元（包括执行节点上正在执行的单元和尚未发布的单元）和本地调度器中尚未开始的调用
+        返回: 被取消的单元数量
+        """
+        with self.lock:
+            entries = [(unit_id, entry[0]) for unit_id, entry in self.pending.items() if entry[4] == task_id]
+            published = [(unit_id, future) for unit_id, future in entries if unit_id not in self.waiting]
+            waiting = [future for unit_id, future in entries if unit_id in self.waiting]
+        cancelled = self.store.cancel([unit_id for unit_id, _ in published], include_leased=True)
+        for _, future in published:
+            future.cancel_withdrawn()
+        cancelled += sum(1 for future in waiting if future.cancel())
+        return cancelled + self.local.cancel_task(task_id)
+
+    def pending_count(self, task_id=None):
+        with self.lock:
+            return sum(1 for entry in self.pending.values() if task_id is None or entry[4] == task_id)
+
+    def _collect_loop(self):
+        last_purge = 0.0
+        while True:
+            try:
+                for unit_id, status, result, error in self.store.collect(self.name):
+                    with self.lock:
+                        self.in_flight -= 1
+                        entry = self.pending.pop(unit_id, None)
+                    if entry is None:
+                        continue
+                    future, adapter, args, kwargs, _ = entry
+                    if not future.start():
+                        continue
+                    if status == UNIT_DONE:
+                        try:
+                            future.set_result(adapter.apply(result, args, kwargs))
+                        except Exception as e:
+                            future.set_exception(e)
+                    else:
+                        future.set_exception(RuntimeError(error or f"工作单元{status}"))
+                if time.time() - last_purge > 3600:
+                    self.store.purge()
+                    last_purge = time.time()
+                self._publish_waiting()
+            except Exception as e:
+                print(f"收集工作单元结果时出错: {str(e)}")
+            time.sleep(UNIT_POLL_SECONDS)
+
+
+class UnitWorker:
+    """
+    工作单元执行节点：以租约方式领取单元并执行，执行期间定期续约
+    失联节点的租约过期后，单元会被其他节点重新领取
+    每个单元在自己的取消令牌下执行，续约时发现单元已被取消（或租约已被重新分配）则中断其模型调用
+    """
+
+    def __init__(self, store: WorkUnitStore, model_pool, threads: int, name: Optional[str] = None,
+                 lease_seconds: float = UNIT_LEASE_SECONDS):
+        """
+        store: 协调存储
+        model_pool: 本节点的模型池
+        threads: 同时执行的单元数
+        name: 节点标识
+        lease_seconds: 租约时长
+        """
+        self.store = store
+        self.model_pool = model_pool
+        self.threads = max(1, int(threads))
+        self.name = name or default_node_name("unit-worker")
+        self.lease_seconds = lease_seconds
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.threads,
+                                                              thread_name_prefix="unit-worker")
+        # 单元内部可以并行的阶段（广告文案和产品优化）与单元共享threads个槽位
+        self.slots = threading.Semaphore(self.threads)
+        self.stage_executor = SlotExecutor(self.slots, self.threads, thread_name_prefix="unit-stage")
+        # 执行中的单元ID -> 取消令牌
+        self.active = {}
+        self.lock = threading.Lock()
+        self.stats = {"executed": 0, "failed": 0, "lost_leases": 0}
+        self.threads_started = []
+
+    def start(self):
+        for target, name in ((self._lease_loop, "unit-lease"), (self._heartbeat_loop, "unit-heartbeat")):
+            thread = threading.Thread(target=target, daemon=True, name=name)
+            thread.start()
+            self.threads_started.append(thread)
+        return self
+
+    def _lease_loop(self):
+        while True:
+            try:
+                with self.lock:
+                    free = self.threads - len(self.active)
+                units = self.store.lease(self.name, free, lease_seconds=self.lease_seconds) if free > 0 else []
+                for unit_id, kind, payload in units:
+                    with self.lock:
+                        self.active[unit_id] = CancellationToken(unit_id)
+                    self.executor.submit(self._execute, unit_id, kind, payload)
+                if units:
+                    continue
+            except Exception as e:
+                print(f"领取工作单元时出错: {str(e)}")
+            time.sleep(UNIT_POLL_SECONDS)
+
+    def _execute(self, unit_id, kind, payload):
+        with self.lock:
+            token = self.active.get(unit_id)
+        self.slots.acquire()
+        try:
+            adapter = UNIT_ADAPTERS.get(kind)
+            if adapter is None:
+                raise ValueError(f"未知的工作单元类型: {kind}")
+            with cancellation_scope(token):
+                result = adapter.execute(payload, self.model_pool, self.stage_executor)
+            accepted = self.store.complete(unit_id, self.name, result)
+            with self.lock:
+                self.stats["executed"] += 1
+        except Exception as e:
+            print(f"执行工作单元 {unit_id} ({kind}) 失败: {str(e)}")
+            accepted = self.store.fail(unit_id, self.name, e)
+            with self.lock:
+                self.stats["failed"] += 1
+        finally:
+            self.slots.release()
+            with self.lock:
+                self.active.pop(unit_id, None)
+        if not accepted:
+            # 租约已过期并被重新分配，或单元已被取消
+            with self.lock:
+                self.stats["lost_leases"] += 1
+            print(f"工作单元 {unit_id} 的租约已失效，结果被丢弃")
+
+    def _heartbeat_loop(self):
+        while True:
+            time.sleep(max(1.0, min(self.lease_seconds / 3, UNIT_CANCEL_CHECK_SECONDS)))
+            try:
+                with self.lock:
+                    active = dict(self.active)
+                held = self.store.heartbeat(self.name, active, lease_seconds=self.lease_seconds)
+                for unit_id, token in active.items():
+                    if unit_id not in held and token.cancel("工作单元已被取消或重新分配"):
+                        print(f"工作单元 {unit_id} 已被取消或重新分配，中断执行")
+            except Exception as e:
+                print(f"续约工作单元时出错: {str(e)}")
+
+
+def get_local_unit_threads(model_pool=None) -> int:
+    """
+    协调进程自身执行单元的线程数（DISTRIBUTED_LOCAL_UNIT_THREADS），未设置或为空时等于模型池并发数
+    """
+    value = os.getenv("DISTRIBUTED_LOCAL_UNIT_THREADS", "").strip()
+    if value:
+        return int(value)
+    return get_model_pool_concurrency(model_pool, cap=DEFAULT_SIMULATION_WORKERS_CAP)
+
+
+def get_leased_unit_scheduler(model_pool=None, app=None):
+    """
+    获取进程内共享的分布式工作单元调度器
+    首次调用时同时启动本节点的单元执行线程（DISTRIBUTED_LOCAL_UNIT_THREADS，默认等于模型池并发数，
+    0表示本进程只协调不执行），其他节点用 python -m agent.unit_worker 加入
+    """
+    global _unit_scheduler
+    with _unit_scheduler_lock:
+        if _unit_scheduler is None:
+            store = WorkUnitStore(get_work_unit_store_path(app))
+            _unit_scheduler = LeasedUnitScheduler(store, get_simulation_scheduler(model_pool))
+            local_threads = get_local_unit_threads(model_pool)
+            if local_threads > 0:
+                UnitWorker(store, model_pool, local_threads).start()
+        return _unit_scheduler
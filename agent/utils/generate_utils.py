@@ -1,28 +1,38 @@
+import math
 import random
 import time
 import os
 import json
+import re
 import uuid
+from .persona_dedup import PersonaSimilarityIndex
 
-def create_existing_personas_context(all_personas):
+# 画像与模拟结果中允许的用户类型和使用频率
+VALID_USER_TYPES = ["核心用户", "边缘用户", "潜在用户", "非目标用户", "未知"]
+VALID_USAGE_FREQUENCIES = ["每天多次", "每天一次", "每周几次", "每周一次", "每月几次", "每月一次", "偶尔使用", "几乎不使用", "未知"]
+
+def estimate_tokens(text):
+    """
+    粗略估算文本的token数量（中文约1.5个字符对应1个token）
+    """
+    return math.ceil(len(text or "") / 1.5)
+
+def create_existing_personas_context(all_personas, similarity_index=None):
     """
     创建已有用户画像的上下文信息
+    使用紧凑的多样性摘要（分布统计 + 已覆盖人群）代替随机抽样的原始画像
     all_personas: 所有用户画像列表
+    similarity_index: 已构建好的画像相似度索引，未提供时临时构建
     """
     if not all_personas:
         return ""
-    
-    sample_size = min(10, len(all_personas))
-    sampled = random.sample(all_personas, sample_size)
-    existing_personas_texts = []
-    
-    for p in sampled:
-        desc = p.get("persona_description", "无描述")
-        user_type = p.get("user_type", "未知")
-        freq = p.get("usage_frequency", "未知")
-        existing_personas_texts.append(f"• {desc} (类型: {user_type}, 频率: {freq})")
-    
-    return "\n已有用户画像示例：\n" + "\n".join(existing_personas_texts)
+
+    if similarity_index is None:
+        similarity_index = PersonaSimilarityIndex()
+        for i, p in enumerate(all_personas):
+            similarity_index.add(str(p.get("persona_id", i)), p)
+
+    return similarity_index.diversity_summary()
 
 def create_error_persona(index, error_msg):
     """
@@ -66,13 +76,11 @@ def is_valid_persona(persona):
                 return False
         
         # 检查用户类型是否有效
-        valid_user_types = ["核心用户", "边缘用户", "潜在用户", "非目标用户", "未知"]
-        if persona["user_type"] not in valid_user_types:
+        if persona["user_type"] not in VALID_USER_TYPES:
             return False
         
         # 检查使用频率是否有效
-        valid_frequencies = ["每天多次", "每天一次", "每周几次", "每周一次", "每月几次", "每月一次", "偶尔使用", "几乎不使用", "未知"]
-        if persona["usage_frequency"] not in valid_frequencies:
+        if persona["usage_frequency"] not in VALID_USAGE_FREQUENCIES:
             return False
         
         # 检查location是否为空
@@ -83,6 +91,112 @@ def is_valid_persona(persona):
     except Exception:
         return False
     
+# 常见的用户类型近似写法
+_USER_TYPE_ALIASES = {
+    "核心": "核心用户", "重度用户": "核心用户", "主要用户": "核心用户", "目标用户": "核心用户",
+    "潜在": "潜在用户", "潜在客户": "潜在用户",
+    "边缘": "边缘用户", "次要用户": "边缘用户", "轻度用户": "边缘用户",
+    "非目标": "非目标用户", "非目标客户": "非目标用户", "非用户": "非目标用户",
+}
+
+_NUMBER_WORDS = "两二三四五六七八九十几多数"
+
+
+def _normalize_usage_frequency(value):
+    """
+    将使用频率的近似写法映射到规范值，无法识别时返回None
+    例如 "每周两次" -> "每周几次"，"一天一次" -> "每天一次"
+    """
+    text = re.sub(r"\s+", "", value).replace("星期", "周").replace("礼拜", "周")
+    text = text.replace("个月", "月")
+    text = re.sub(r"^(一|每个?)", "每", text)
+    if re.search(r"每[两二2]周", text):
+        return "每月几次"
+    if any(k in text for k in ("几乎不", "从不", "不使用", "不会使用", "极少")):
+        return "几乎不使用"
+    if any(k in text for k in ("偶尔", "很少", "不定期", "有时", "每季度", "每年", "少量")):
+        return "偶尔使用"
+    multiple = re.search(rf"[{_NUMBER_WORDS}]次|[2-9]次|\d{{2,}}次|多次|频繁", text) is not None
+    for prefixes, many, once in (
+        (("每天", "每日", "天天", "日常"), "每天多次", "每天一次"),
+        (("每周", "每週"), "每周几次", "每周一次"),
+        (("每月",), "每月几次", "每月一次"),
+    ):
+        if any(text.startswith(p) or p in text for p in prefixes):
+            return many if multiple else once
+    return None
+
+
+def normalize_persona(persona):
+    """
+    在验证前对模型输出做字段级归一化，尽量挽救近似合规的画像
+    - user_type / usage_frequency 的近似写法映射到最接近的规范值
+    - 字符串与列表字段互相转换，去除空值
+    - 缺失的 key_needs / usage_scenarios / location 填充安全默认值
+    persona_description 缺失或无法映射的枚举值仍会在 is_valid_persona 中被拒绝
+    persona: 用户画像
+    返回: (归一化后的画像副本, 被修改的字段列表)
+    """
+    if not isinstance(persona, dict):
+        return persona, []
+
+    normalized = dict(persona)
+    changed = []
+
+    description = normalized.get("persona_description")
+    if isinstance(description, list):
+        normalized["persona_description"] = "；".join(str(d).strip() for d in description if d)
+        changed.append("persona_description")
+    elif isinstance(description, str) and description != description.strip():
+        normalized["persona_description"] = description.strip()
+        changed.append("persona_description")
+
+    for field, default in (("key_needs", "未知需求"), ("usage_scenarios", "未知场景")):
+        value = normalized.get(field)
+        if isinstance(value, str):
+            items = [v.strip() for v in re.split(r"[，,；;、\n]", value)]
+        elif isinstance(value, list):
+            items = [str(v).strip() for v in value if v is not None]
+        else:
+            items = []
+        items = [v for v in items if v]
+        if not items:
+            items = [default]
+        if items != value:
+            normalized[field] = items
+            changed.append(field)
+
+    user_type = normalized.get("user_type")
+    if isinstance(user_type, str) and user_type not in VALID_USER_TYPES:
+        candidate = user_type.strip().strip('"“”\'')
+        if candidate not in VALID_USER_TYPES:
+            candidate = _USER_TYPE_ALIASES.get(candidate) or next(
+                (alias_value for alias, alias_value in _USER_TYPE_ALIASES.items() if alias in candidate), None
+            )
+        if candidate in VALID_USER_TYPES:
+            normalized["user_type"] = candidate
+            changed.append("user_type")
+
+    frequency = normalized.get("usage_frequency")
+    if isinstance(frequency, str) and frequency not in VALID_USAGE_FREQUENCIES:
+        candidate = frequency.strip().strip('"“”\'')
+        if candidate not in VALID_USAGE_FREQUENCIES:
+            candidate = _normalize_usage_frequency(candidate)
+        if candidate in VALID_USAGE_FREQUENCIES:
+            normalized["usage_frequency"] = candidate
+            changed.append("usage_frequency")
+
+    location = normalized.get("location")
+    if isinstance(location, list):
+        location = "、".join(str(l).strip() for l in location if l)
+    if not isinstance(location, str) or not location.strip():
+        location = normalized.get("location_tier") or "未知地区"
+    if location.strip() != normalized.get("location"):
+        normalized["location"] = location.strip()
+        changed.append("location")
+
+    return normalized, changed
+
 def save_personas_to_file(task_id, personas, app=None):
     """
     保存用户画像到文件
@@ -264,12 +378,10 @@ def process_simulation_result(result, persona, persona_id, sim_index, instance_i
     result["usage_frequency"] = persona.get("usage_frequency", "未知")
     
     # 标准化用户类型和使用频率
-    valid_user_types = ["核心用户", "边缘用户", "潜在用户", "非目标用户", "未知"]
-    if result["user_type"] not in valid_user_types:
+    if result["user_type"] not in VALID_USER_TYPES:
         result["user_type"] = "未知"
     
-    valid_frequencies = ["每天多次", "每天一次", "每周几次", "每周一次", "每月几次", "每月一次", "偶尔使用", "几乎不使用", "未知"]
-    if result["usage_frequency"] not in valid_frequencies:
+    if result["usage_frequency"] not in VALID_USAGE_FREQUENCIES:
         result["usage_frequency"] = "未知"
     
     # 添加ID和时间戳，确保唯一性
@@ -0,0 +1,148 @@
+import hashlib
+import json
+import os
+import re
+import time
+import unicodedata
+from typing import Dict, Optional, Tuple
+
+# 相同提交（产品描述、画像数、模拟次数、分析深度、提示词版本都相同）复用已有任务，TASK_DEDUP_ENABLED=0 关闭
+# 已完成任务的结果在该时间（秒）内直接复用，0表示只合并执行中的重复提交
+RESULT_CACHE_SECONDS = float(os.getenv("TASK_RESULT_CACHE_SECONDS", "86400"))
+# 执行中（尚未结束）的任务状态，重复提交关联到这些任务
+IN_FLIGHT_STATUSES = ('pending', 'running', 'generating_personas', 'simulating_reactions')
+# 结束但没有结果的任务状态，关联到这些任务的提交改为单独执行
+UNFINISHED_STATUSES = ('failed', 'stopped')
+# 复用方式：关联到执行中的任务 / 使用已完成任务的结果
+REUSE_IN_FLIGHT = 'in_flight'
+REUSE_CACHED = 'cached'
+
+_prompt_version = None
+
+
+def is_dedup_enabled() -> bool:
+    return os.getenv("TASK_DEDUP_ENABLED", "1").strip().lower() not in ("0", "false", "no", "off")
+
+
+def is_cross_owner_reuse_enabled() -> bool:
+    """
+    是否在不同提交者之间复用（TASK_DEDUP_CROSS_OWNER，默认关闭）：开启后其他提交者的相同提交
+    会关联到该任务或直接获得其报告，只适合所有提交者可以互相查看结果的部署
+    """
+    return os.getenv("TASK_DEDUP_CROSS_OWNER", "0").strip().lower() in ("1", "true", "yes", "on")
+
+
+def get_prompt_version() -> str:
+    """
+    提示词版本：PROMPT_VERSION（手动指定，修改代码中拼接的提示词时更新）加上提示词模板内容的哈希，
+    模板修改后旧任务的结果不再复用
+    """
+    global _prompt_version
+    if _prompt_version is None:
+        from agent import prompt_template
+        digest = hashlib.sha256()
+        for name in sorted(dir(prompt_template)):
+            value = getattr(prompt_template, name)
+            if name.endswith('_prompt') and isinstance(value, str):
+                digest.update(name.encode('utf-8'))
+                digest.update(value.encode('utf-8'))
+        _prompt_version = f"{os.getenv('PROMPT_VERSION', '')}:{digest.hexdigest()[:12]}"
+    return _prompt_version
+
+
+def normalize_product_description(text: str) -> str:
+    """
+    规范化产品描述：统一全角/半角字符和大小写，合并空白（忽略中文两侧的空格），忽略首尾标点差异
+    """
+    text = unicodedata.normalize('NFKC', text or '').lower()
+    text = re.sub(r'\s+', ' ', text).strip()
+    # 中文与其他字符之间的空格可有可无
+    text = re.sub(r'\s*([\u3000-\u303f\u4e00-\u9fff])\s*', r'\1', text)
+    return text.strip('。.!！?？;；,，、 ')
+
+
+def task_idempotency_key(task: Dict) -> str:
+    """
+    任务的幂等键：规范化的产品描述、画像数、模拟次数、分析深度、影响结果的模拟选项和提示词版本的哈希
+    task: 任务数据
+    """
+    from .sequential_sampling import is_adaptive_mode_default
+    from .simulatiton_generate import is_throughput_mode_default
+    payload = {
+        'product_description': normalize_product_description(task.get('product_description', '')),
+        'num_personas': int(task.get('num_personas', 0)),
+        'num_simulations': int(task.get('num_simulations', 0)),
+        'pipeline_profile': task.get('pipeline_profile') or '',
+        'throughput_mode': bool(task.get('throughput_mode', is_throughput_mode_default())),
+        'adaptive_sampling': bool(task.get('adaptive_sampling', is_adaptive_mode_default())),
+        'prompt_version': get_prompt_version(),
+    }
+    if task.get('variants'):
+        # 多方案任务：方案顺序决定基准方案
+        payload['variants'] = [normalize_product_description(variant['product_description'])
+                               for variant in task['variants']]
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def task_owner(task: Dict) -> str:
+    """
+    提交者标识：inline任务按来源地址，其他任务按邮箱
+    """
+    return task.get('queue_user') or task.get('email', '')
+
+
+def _has_report(task: Dict) -> bool:
+    report = (task.get('files') or {}).get('report')
+    return bool(report) and os.path.exists(report)
+
+
+def find_reusable_task(tasks: Dict[str, Dict], key: str, exclude=None, owner=None,
+                       now=None) -> Tuple[Optional[str], Optional[str]]:
+    """
+    查找可复用的任务：优先执行中的任务，其次新鲜期内完成且报告仍在的任务（都取最近创建的一个）
+    tasks: 全部任务数据
+    key: 幂等键
+    exclude: 不参与查找的任务ID（新提交的任务本身）
+    owner: 只查找该提交者的任务（见task_owner），为None时查找所有提交者的任务
+    返回: (任务ID, 复用方式)，没有可复用的任务时返回(None, None)
+    """
+    now = now or time.time()
+    in_flight = cached = None
+    for task_id, task in tasks.items():
+        if task_id == exclude or task.get('idempotency_key') != key or task.get('attached_to'):
+            continue
+        if owner is not None and task_owner(task) != owner:
+            continue
+        status = task.get('status')
+        if status in IN_FLIGHT_STATUSES:
+            if in_flight is None or task.get('created_at', '') > tasks[in_flight].get('created_at', ''):
+                in_flight = task_id
+        elif (status == 'completed' and RESULT_CACHE_SECONDS > 0
+              and now - task.get('end_time', 0) <= RESULT_CACHE_SECONDS and _has_report(task)):
+            if cached is None or task.get('end_time', 0) > tasks[cached].get('end_time', 0):
+                cached = task_id
+    if in_flight is not None:
+        return in_flight, REUSE_IN_FLIGHT
+    if cached is not None:
+        return cached, REUSE_CACHED
+    return None, None
+
+
+def copy_task_result(task: Dict, source: Dict, source_id: str):
+    """
+    把已完成任务的结果（报告等文件、统计）写入复用它的任务，任务标记为完成
+    """
+    now = time.time()
+    task.update({
+        'status': 'completed',
+        'start_time': task.get('start_time', now),
+        'end_time': now,
+        'stats': source.get('stats', {}),
+        'files': dict(source.get('files') or {}),
+        'progress': {'current_step': 'completed', 'completed': 100, 'total': 100, 'percentage': 100},
+        'reused_from': source_id,
+    })
+    for field in ('pipeline_estimate', 'adaptive_sampling_summary', 'web_evidence_stats',
+                  'variant_stats', 'variant_comparison'):
+        if field in source:
+            task[field] = source[field]
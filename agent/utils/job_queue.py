@@ -0,0 +1,318 @@
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
+
+# 优先级类别，数值越小越先执行；同一类别内按入队时间先后执行
+PRIORITY_CLASSES = {
+    "vip": 0,
+    "paid": 1,
+    "free": 2,
+    "inline": 3,
+}
+
+# 同时执行的分析任务数（每个任务内部的模拟单元另由共享的模拟调度器限流）
+DEFAULT_TASK_WORKERS = int(os.getenv("TASK_QUEUE_WORKERS", "2"))
+# 每个用户同时执行的任务数上限，VIP账户可用max_concurrent_tasks单独配置
+DEFAULT_PER_USER_CAP = int(os.getenv("TASK_QUEUE_PER_USER_CAP", "1"))
+# 工作线程轮询队列的间隔（秒），同一进程内入队会立即唤醒工作线程
+QUEUE_POLL_SECONDS = float(os.getenv("TASK_QUEUE_POLL_SECONDS", "2"))
+
+# 排队中 / 执行中 / 已结束 / 已取消
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_CANCELLED = "cancelled"
+
+
+def get_job_queue_path(app):
+    """
+    任务队列数据库路径
+    app: 应用实例
+    """
+    return os.path.join(app.config['UPLOAD_FOLDER'], "jobs.db")
+
+
+def is_external_worker_mode() -> bool:
+    """
+    是否由独立的工作进程（python -m agent.worker）执行任务（TASK_WORKER_MODE=external）
+    此时Web进程只负责入队和提供状态，不启动任务工作线程
+    """
+    return os.getenv("TASK_WORKER_MODE", "thread").strip().lower() == "external"
+
+
+def task_priority_class(task: Dict) -> str:
+    """
+    根据任务信息确定优先级类别：inline任务 / VIP / 付费 / 免费
+    task: 任务数据
+    """
+    if task.get('email') == 'inline@local':
+        return "inline"
+    if task.get('is_vip'):
+        return "vip"
+    if task.get('amount', 0) > 0:
+        return "paid"
+    return "free"
+
+
+class JobQueue:
+    """
+    基于SQLite的持久化任务队列
+    - 入队的任务在进程重启后仍然保留，执行中的任务在重启时重新排队
+    - 按 优先级类别, 入队时间 的顺序领取，跳过已达到并发上限的用户
+    - 使用WAL模式和BEGIN IMMEDIATE事务，多个线程（或进程）可以安全地同时领取
+    """
+
+    def __init__(self, path):
+        """
+        path: 数据库文件路径
+        """
+        self.path = path
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " task_id TEXT PRIMARY KEY,"
+                " user TEXT NOT NULL,"
+                " priority INTEGER NOT NULL,"
+                " priority_class TEXT NOT NULL,"
+                " user_cap INTEGER NOT NULL,"
+                " status TEXT NOT NULL,"
+                " enqueued_at REAL NOT NULL,"
+                " started_at REAL,"
+                " finished_at REAL,"
+                " worker TEXT,"
+                " cancel_requested INTEGER NOT NULL DEFAULT 0)"
+            )
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+            if "cancel_requested" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN cancel_requested INTEGER NOT NULL DEFAULT 0")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, priority, enqueued_at)")
+
+    @contextmanager
+    def _connect(self):
+        # 自动提交模式，每条语句单独提交；需要原子性的操作显式开启事务
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def enqueue(self, task_id, priority_class="free", user="", user_cap=None):
+        """
+        任务入队；已在队列中的任务重新排队（例如重启失败的任务），已排队的保留原来的位置
+        task_id: 任务ID
+        priority_class: 优先级类别（见PRIORITY_CLASSES）
+        user: 用户标识，用于限制每个用户的并发任务数
+        user_cap: 该用户的并发任务数上限，默认DEFAULT_PER_USER_CAP
+        """
+        priority = PRIORITY_CLASSES.get(priority_class, PRIORITY_CLASSES["free"])
+        user_cap = max(1, int(user_cap or DEFAULT_PER_USER_CAP))
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (task_id, user, priority, priority_class, user_cap, status, enqueued_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT(task_id) DO UPDATE SET"
+                " user = excluded.user, priority = excluded.priority, priority_class = excluded.priority_class,"
+                " user_cap = excluded.user_cap, started_at = NULL, finished_at = NULL, worker = NULL, cancel_requested = 0,"
+                " enqueued_at = CASE WHEN jobs.status = ? THEN jobs.enqueued_at ELSE excluded.enqueued_at END,"
+                " status = excluded.status",
+                (task_id, user or "", priority, priority_class, user_cap, JOB_QUEUED, time.time(), JOB_QUEUED),
+            )
+
+    def claim(self, worker=""):
+        """
+        领取下一个可执行的任务并标记为执行中
+        worker: 领取者标识
+        返回: 任务ID，没有可执行的任务时返回None
+        """
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            running = {
+                row["user"]: row["count"]
+                for row in conn.execute(
+                    "SELECT user, COUNT(*) AS count FROM jobs WHERE status = ? GROUP BY user", (JOB_RUNNING,))
+            }
+            task_id = None
+            for row in conn.execute(
+                    "SELECT task_id, user, user_cap FROM jobs WHERE status = ? ORDER BY priority, enqueued_at",
+                    (JOB_QUEUED,)):
+                if running.get(row["user"], 0) < row["user_cap"]:
+                    task_id = row["task_id"]
+                    break
+            if task_id is not None:
+                conn.execute("UPDATE jobs SET status = ?, started_at = ?, worker = ? WHERE task_id = ?",
+                             (JOB_RUNNING, time.time(), worker, task_id))
+            conn.execute("COMMIT")
+            return task_id
+
+    def finish(self, task_id, status=JOB_DONE):
+        """
+        标记任务执行结束
+        """
+        with self._connect() as conn:
+            conn.execute("UPDATE jobs SET status = ?, finished_at = ? WHERE task_id = ? AND status = ?",
+                         (status, time.time(), task_id, JOB_RUNNING))
+
+    def cancel(self, task_id):
+        """
+        取消任务：排队中的任务直接出队；执行中的任务记录取消请求，由执行它的进程设置中止标志
+        返回: 是否取消了排队中的任务
+        """
+        with self._connect() as conn:
+            cursor = conn.execute("UPDATE jobs SET status = ?, finished_at = ? WHERE task_id = ? AND status = ?",
+                                  (JOB_CANCELLED, time.time(), task_id, JOB_QUEUED))
+            if cursor.rowcount > 0:
+                return True
+            conn.execute("UPDATE jobs SET cancel_requested = 1 WHERE task_id = ? AND status = ?",
+                         (task_id, JOB_RUNNING))
+            return False
+
+    def cancel_requested(self, task_ids) -> set:
+        """
+        执行中且被请求取消的任务
+        task_ids: 要检查的任务ID
+        """
+        task_ids = list(task_ids)
+        if not task_ids:
+            return set()
+        with self._connect() as conn:
+            placeholders = ",".join("?" * len(task_ids))
+            rows = conn.execute(
+                f"SELECT task_id FROM jobs WHERE cancel_requested = 1 AND status = ? AND task_id IN ({placeholders})",
+                [JOB_RUNNING] + task_ids,
+            ).fetchall()
+        return {row["task_id"] for row in rows}
+
+    def remove(self, task_id):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM jobs WHERE task_id = ?", (task_id,))
+
+    def requeue_running(self, worker=None):
+        """
+        把执行中的任务重新排队（进程重启时，上次进程领取的任务已经中断），保留原来的入队时间
+        worker: 只重新排队该领取者的任务，为None时重新排队全部执行中的任务
+        返回: 重新排队的任务ID列表
+        """
+        with self._connect() as conn:
+            if worker is None:
+                rows = conn.execute("SELECT task_id FROM jobs WHERE status = ?", (JOB_RUNNING,)).fetchall()
+            else:
+                rows = conn.execute("SELECT task_id FROM jobs WHERE status = ? AND worker = ?",
+                                    (JOB_RUNNING, worker)).fetchall()
+            task_ids = [row["task_id"] for row in rows]
+            conn.executemany("UPDATE jobs SET status = ?, started_at = NULL, worker = NULL, cancel_requested = 0"
+                             " WHERE task_id = ?",
+                             [(JOB_QUEUED, task_id) for task_id in task_ids])
+        return task_ids
+
+    def position(self, task_id) -> Optional[Dict]:
+        """
+        任务在队列中的位置
+        返回: {state, priority_class, position（排队时为第几位，从1开始）, ahead, enqueued_at, waited_seconds}，
+              任务不在队列中时返回None
+        """
+        with self._connect() as conn:
+            job = conn.execute("SELECT * FROM jobs WHERE task_id = ?", (task_id,)).fetchone()
+            if job is None:
+                return None
+            info = {
+                "state": job["status"],
+                "priority_class": job["priority_class"],
+                "enqueued_at": job["enqueued_at"],
+            }
+            if job["status"] == JOB_QUEUED:
+                ahead = conn.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE status = ? AND (priority < ? OR (priority = ? AND enqueued_at < ?))",
+                    (JOB_QUEUED, job["priority"], job["priority"], job["enqueued_at"]),
+                ).fetchone()[0]
+                info.update(position=ahead + 1, ahead=ahead, waited_seconds=round(time.time() - job["enqueued_at"], 1))
+            elif job["started_at"]:
+                info["waited_seconds"] = round(job["started_at"] - job["enqueued_at"], 1)
+            return info
+
+    def recent_jobs(self, limit=50) -> List[Dict]:
+        """
+        最近执行结束的任务的排队和执行时间，用于估算排队等待时间
+        返回: [{task_id, enqueued_at, started_at, finished_at}]，按结束时间从近到远排列
+        """
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT task_id, enqueued_at, started_at, finished_at FROM jobs"
+                " WHERE status = ? AND started_at IS NOT NULL AND finished_at IS NOT NULL"
+                " ORDER BY finished_at DESC LIMIT ?",
+                (JOB_DONE, int(limit)),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def counts(self) -> Dict[str, int]:
+        with self._connect() as conn:
+            return {row["status"]: row["count"] for row in
+                    conn.execute("SELECT status, COUNT(*) AS count FROM jobs GROUP BY status")}
+
+
+class TaskWorkerPool:
+    """
+    有界的任务工作线程池：固定数量的工作线程从JobQueue领取任务并执行
+    取代每次提交任务都新建一个线程的做法，同时执行的完整分析流程不超过max_workers个
+    """
+
+    def __init__(self, queue: JobQueue, run_task: Callable[[str], object],
+                 max_workers: int = DEFAULT_TASK_WORKERS, name: str = "task-worker"):
+        """
+        queue: 任务队列
+        run_task: 执行任务的函数 run_task(task_id)
+        max_workers: 工作线程数
+        name: 工作线程名称前缀，也作为队列中的领取者标识（重启后用同一名称重新排队中断的任务）
+        """
+        self.queue = queue
+        self.run_task = run_task
+        self.max_workers = max(1, int(max_workers))
+        self.name = name
+        self.condition = threading.Condition()
+        self.workers = []
+
+    def start(self):
+        with self.condition:
+            while len(self.workers) < self.max_workers:
+                worker = threading.Thread(target=self._worker_loop, daemon=True,
+                                          name=f"{self.name}-{len(self.workers) + 1}")
+                worker.start()
+                self.workers.append(worker)
+        return self
+
+    def submit(self, task_id, priority_class="free", user="", user_cap=None):
+        """
+        任务入队并唤醒空闲的工作线程
+        """
+        self.queue.enqueue(task_id, priority_class=priority_class, user=user, user_cap=user_cap)
+        self.notify()
+
+    def notify(self):
+        with self.condition:
+            self.condition.notify_all()
+
+    def _worker_loop(self):
+        worker_name = threading.current_thread().name
+        while True:
+            try:
+                task_id = self.queue.claim(worker=self.name)
+            except Exception as e:
+                print(f"领取队列任务时出错: {str(e)}")
+                task_id = None
+            if task_id is None:
+                with self.condition:
+                    self.condition.wait(QUEUE_POLL_SECONDS)
+                continue
+            print(f"{worker_name} 开始执行任务: {task_id}")
+            try:
+                self.run_task(task_id)
+            except Exception as e:
+                print(f"执行任务 {task_id} 时出错: {str(e)}")
+            finally:
+                self.queue.finish(task_id)
+                # 任务结束后同一用户的下一个任务可能变为可执行
+                self.notify()
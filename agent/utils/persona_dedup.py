@@ -0,0 +1,218 @@
+import re
+import zlib
+import random
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+# MinHash使用的梅森素数，保证哈希值落在32位以内
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+# 归一化时去掉的空白与标点，避免格式差异影响相似度
+_STRIP_PATTERN = re.compile(r"[\s　，。、；：！？“”‘’（）《》【】,.;:!?\"'()\[\]<>\-_/]+")
+
+
+def persona_text(persona: Dict) -> str:
+    """
+    拼接用于相似度比较的画像文本：描述、需求和场景
+    persona: 用户画像
+    """
+    parts = [str(persona.get("persona_description", ""))]
+    for field in ("key_needs", "usage_scenarios"):
+        value = persona.get(field, [])
+        if isinstance(value, list):
+            parts.extend(str(v) for v in value if v)
+        elif value:
+            parts.append(str(value))
+    return " ".join(parts)
+
+
+def char_shingles(text: str, k: int = 3) -> set:
+    """
+    将文本切分为字符n-gram集合，中文无需分词即可比较
+    text: 文本
+    k: n-gram长度
+    """
+    normalized = _STRIP_PATTERN.sub("", (text or "").lower())
+    if not normalized:
+        return set()
+    if len(normalized) <= k:
+        return {normalized}
+    return {normalized[i:i + k] for i in range(len(normalized) - k + 1)}
+
+
+def jaccard(a: set, b: set) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+class MinHasher:
+    """
+    基于通用哈希族的MinHash签名生成器
+    """
+
+    def __init__(self, num_perm: int = 64, seed: int = 42):
+        rng = random.Random(seed)
+        self.num_perm = num_perm
+        self._params = [
+            (rng.randint(1, _MERSENNE_PRIME - 1), rng.randint(0, _MERSENNE_PRIME - 1))
+            for _ in range(num_perm)
+        ]
+
+    def signature(self, shingles: set) -> Tuple[int, ...]:
+        if not shingles:
+            return tuple([_MAX_HASH] * self.num_perm)
+        hashes = [zlib.crc32(s.encode("utf-8")) for s in shingles]
+        return tuple(
+            min(((a * h + b) % _MERSENNE_PRIME) & _MAX_HASH for h in hashes)
+            for a, b in self._params
+        )
+
+
+class TextSimilarityIndex:
+    """
+    通用文本近重复检索索引（MinHash + LSH分桶）
+    - 新文本只与同桶候选比较，条目数量增长到数百个时仍保持快速
+    - 候选再用精确Jaccard相似度确认，避免误判
+    """
+
+    def __init__(self, threshold: float = 0.5, num_perm: int = 64, bands: int = 16, shingle_size: int = 3):
+        """
+        threshold: 默认的Jaccard相似度阈值
+        num_perm: MinHash签名长度
+        bands: LSH分桶数量，num_perm必须能被整除
+        shingle_size: 字符n-gram长度
+        """
+        if num_perm % bands != 0:
+            raise ValueError("num_perm必须能被bands整除")
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        self.hasher = MinHasher(num_perm=num_perm)
+        self._buckets: List[Dict[Tuple[int, ...], List[str]]] = [{} for _ in range(bands)]
+        self._shingles: Dict[str, set] = {}
+
+    def __len__(self) -> int:
+        return len(self._shingles)
+
+    def __iter__(self):
+        return iter(self._shingles)
+
+    def _band_keys(self, signature: Tuple[int, ...]) -> List[Tuple[int, ...]]:
+        return [signature[i * self.rows:(i + 1) * self.rows] for i in range(self.bands)]
+
+    def add(self, key: str, text: str) -> None:
+        """
+        将文本加入索引
+        key: 条目ID
+        text: 文本
+        """
+        shingles = char_shingles(text, self.shingle_size)
+        signature = self.hasher.signature(shingles)
+        for band, band_key in enumerate(self._band_keys(signature)):
+            self._buckets[band].setdefault(band_key, []).append(key)
+        self._shingles[key] = shingles
+
+    def query(self, text: str, threshold: Optional[float] = None) -> List[Tuple[str, float]]:
+        """
+        查找相似度不低于阈值的条目，按相似度从高到低返回[(条目ID, 相似度)]
+        阈值明显低于LSH分桶的设计阈值时，候选可能不完整
+        """
+        threshold = self.threshold if threshold is None else threshold
+        shingles = char_shingles(text, self.shingle_size)
+        if not shingles:
+            return []
+        signature = self.hasher.signature(shingles)
+        candidates = set()
+        for band, key in enumerate(self._band_keys(signature)):
+            candidates.update(self._buckets[band].get(key, []))
+        matches = []
+        for key in candidates:
+            similarity = jaccard(shingles, self._shingles[key])
+            if similarity >= threshold:
+                matches.append((key, similarity))
+        matches.sort(key=lambda x: x[1], reverse=True)
+        return matches
+
+    def similarity(self, key_a: str, key_b: str) -> float:
+        return jaccard(self._shingles[key_a], self._shingles[key_b])
+
+
+class PersonaSimilarityIndex:
+    """
+    用户画像近重复检测索引，基于描述、需求和场景文本
+    """
+
+    def __init__(self, threshold: float = 0.5, **index_kwargs):
+        """
+        threshold: 判定为近重复的Jaccard相似度阈值
+        index_kwargs: 透传给TextSimilarityIndex的参数
+        """
+        self.threshold = threshold
+        self._index = TextSimilarityIndex(threshold=threshold, **index_kwargs)
+        self._personas: Dict[str, Dict] = {}
+
+    def __len__(self) -> int:
+        return len(self._personas)
+
+    def add(self, key: str, persona: Dict) -> None:
+        """
+        将画像加入索引
+        key: 画像ID
+        persona: 用户画像
+        """
+        self._index.add(key, persona_text(persona))
+        self._personas[key] = persona
+
+    def find_duplicate(self, persona: Dict) -> Optional[Tuple[str, float]]:
+        """
+        查找与给定画像最相似的已有画像，相似度超过阈值时返回(画像ID, 相似度)，否则返回None
+        persona: 用户画像
+        """
+        matches = self._index.query(persona_text(persona))
+        return matches[0] if matches else None
+
+    def representatives(self, max_examples: int = 8, max_similarity: float = 0.3) -> List[Dict]:
+        """
+        贪心挑选彼此差异较大的代表性画像，用于概括已覆盖的人群
+        """
+        chosen: List[str] = []
+        for key in self._personas:
+            if all(self._index.similarity(key, c) < max_similarity for c in chosen):
+                chosen.append(key)
+                if len(chosen) >= max_examples:
+                    break
+        return [self._personas[key] for key in chosen]
+
+    def diversity_summary(self, max_examples: int = 8, description_chars: int = 30) -> str:
+        """
+        生成紧凑的多样性摘要：各维度分布 + 已覆盖人群的简短描述
+        """
+        if not self._personas:
+            return ""
+
+        personas = list(self._personas.values())
+
+        def format_counts(field, top=None):
+            counts = Counter(str(p.get(field, "未知")).strip() or "未知" for p in personas)
+            return "、".join(f"{k}{v}个" for k, v in counts.most_common(top))
+
+        covered = []
+        for p in self.representatives(max_examples=max_examples):
+            desc = " ".join(str(p.get("persona_description", "")).split())
+            if len(desc) > description_chars:
+                desc = desc[:description_chars] + "…"
+            covered.append(f"• {desc}")
+
+        lines = [
+            f"\n已有用户画像概况（共{len(personas)}个）：",
+            f"- 用户类型分布：{format_counts('user_type')}",
+            f"- 使用频率分布：{format_counts('usage_frequency')}",
+            f"- 地区分布（前8）：{format_counts('location', top=8)}",
+            "- 已覆盖的人群（请勿生成相似画像）：",
+            *covered,
+            "请优先补充分布中较少的用户类型、使用频率和地区，并探索尚未覆盖的人群。",
+        ]
+        return "\n".join(lines)
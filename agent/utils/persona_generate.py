@@ -1,21 +1,45 @@
 import sys
 sys.path.append("..")
 
+import concurrent.futures
+import functools
+import math
+import os
 import random
+import threading
 import time
 import json
 from .generate_utils import (
     create_existing_personas_context,
     create_error_persona,
     is_valid_persona,
+    normalize_persona,
     save_personas_to_file,
     update_task_progress
 )
 from .api_utils import call_ai_api
+from .cancellation import TaskCancelled, bind_cancellation, cancellable_sleep, check_cancelled
+from .persona_dedup import PersonaSimilarityIndex
+from .persona_quota import (
+    DEFAULT_USER_TYPE_WEIGHTS,
+    PersonaQuotaPlanner,
+    allocate_counts,
+    describe_quota_cell,
+)
+from .persona_library import get_persona_library, is_persona_library_enabled
 from agent.prompt_template import *
+from models import get_model_pool_concurrency
+
+# 未单独授权的任务最多生成的画像数量
+DEFAULT_MAX_PERSONAS = 40
+# 大规模任务（如市场规模测算）最多生成的画像数量
+MAX_PERSONAS = int(os.getenv("PERSONA_MAX_COUNT", "2000"))
+# 画像数量超过该值时使用分层生成：先规划细分人群，再按人群并行生成
+HIERARCHICAL_THRESHOLD = int(os.getenv("PERSONA_HIERARCHICAL_THRESHOLD", "60"))
 
 def generate_initial_personas(product_desc, existing_personas_context, 
-                              num_personas, temperature, model_pool=None):
+                              num_personas, temperature, model_pool=None,
+                              quota_cells=None, segment=None):
     """
     生成初始用户画像
     product_desc: 产品描述
@@ -23,13 +47,25 @@ def generate_initial_personas(product_desc, existing_personas_context,
     num_personas: 需要生成的用户画像数量
     temperature: 温度
     model_pool: 模型池
+    quota_cells: 每个画像需要满足的配额单元(user_type, usage_frequency, 地区层级)
+    segment: 画像所属的细分人群（分层生成时）
     """
+    segment_text = ""
+    if segment:
+        segment_text = f"\n本批画像都属于以下细分人群，请在该人群内部保持多样性：\n{segment['name']}：{segment['description']}"
+
+    quota_text = ""
+    if quota_cells:
+        quota_text = "\n请按顺序生成满足以下指定特征的画像：\n" + "\n".join(
+            f"{i+1}. {describe_quota_cell(cell)}" for i, cell in enumerate(quota_cells)
+        )
+
     messages = [
         {"role": "system", "content": persona_system_prompt},
         {"role": "user", "content": f"""产品描述: {product_desc}
 {existing_personas_context}
 
-请帮我生成{num_personas}个用户画像，确保与以上已有画像不重复，并且格式严格符合要求。""".strip()}
+请帮我生成{num_personas}个用户画像，确保与以上已有画像不重复，并且格式严格符合要求。{segment_text}{quota_text}""".strip()}
     ]
     
     response = call_ai_api(messages, response_format="json_object", temp=temperature, model_pool=model_pool)
@@ -39,6 +75,36 @@ def generate_initial_personas(product_desc, existing_personas_context,
         print(f"JSON解析错误, 原始响应: {response[:100]}...")
         return []
     
+def generate_persona_batch(product_desc, existing_personas_context, cells, temperature,
+                           model_pool=None, segment=None, max_retries=3):
+    """
+    生成一个批次的初始用户画像，失败时重试，达到最大次数后抛出异常
+    （分布式执行时作为独立的工作单元在其他节点上运行，参数和返回值均可序列化）
+    cells: 本批次预留的配额单元，决定生成的数量
+    返回: (画像列表, 生成调用次数)
+    """
+    last_error = None
+    for retry_count in range(max_retries):
+        try:
+            print(f"尝试生成初始用户画像，尝试 {retry_count + 1}/{max_retries}")
+            initial_personas = generate_initial_personas(product_desc, existing_personas_context,
+                                                         len(cells), temperature,
+                                                         model_pool=model_pool,
+                                                         quota_cells=cells,
+                                                         segment=segment)
+            if not initial_personas or len(initial_personas) == 0:
+                raise ValueError("生成的用户画像为空")
+            if isinstance(initial_personas, dict):
+                initial_personas = [initial_personas]
+            return initial_personas, retry_count + 1
+        except TaskCancelled:
+            raise
+        except Exception as e:
+            last_error = e
+            print(f"生成初始用户画像失败 (尝试 {retry_count + 1}/{max_retries}): {str(e)}")
+            cancellable_sleep(1)
+    raise last_error
+
 def get_reviewer_questions(persona, product_desc, model_pool=None):
     """
     获取评审专家的问题
@@ -117,9 +183,769 @@ def refine_persona_with_questions(persona, questions, product_desc, temperature,
         print(f"解析完善后的画像时出错，原始响应: {response[:100]}...")
         return persona
     
+def get_reviewer_questions_batch(personas_by_key, product_desc, model_pool=None):
+    """
+    一次调用评审一批用户画像，产品描述和系统提示只发送一次
+    personas_by_key: {画像键: 用户画像}
+    product_desc: 产品描述
+    model_pool: 模型池
+    返回: {画像键: 评审问题列表}，缺失或解析失败的画像不包含在结果中
+    """
+    personas_text = "\n\n".join(
+        f"画像键 {key}：\n{json.dumps(persona, ensure_ascii=False, indent=2)}"
+        for key, persona in personas_by_key.items()
+    )
+    messages = [
+        {"role": "system", "content": persona_reviewer_system_prompt},
+        {"role": "user", "content": f"""
+请分别审查以下{len(personas_by_key)}个用户画像，为每个画像提出3-5个最关键的问题来完善它：
+
+产品描述：
+{product_desc}
+
+{personas_text}
+
+请用JSON格式返回，按画像键分别给出问题：
+{{
+    "reviews": [
+        {{"key": "画像键", "questions": [{{"dimension": "问题所属维度", "question": "具体问题", "reason": "为什么问这个问题"}}]}}
+    ]
+}}
+        """}
+    ]
+
+    response = call_ai_api(messages, response_format="json_object", temp=0.8, model_pool=model_pool)
+    try:
+        result = json.loads(response)
+    except json.JSONDecodeError:
+        print(f"解析批量评审问题时出错，原始响应: {response[:100]}...")
+        return {}
+
+    reviews = result.get("reviews", []) if isinstance(result, dict) else []
+    questions_by_key = {}
+    for review in reviews if isinstance(reviews, list) else []:
+        if not isinstance(review, dict):
+            continue
+        key = str(review.get("key", ""))
+        questions = review.get("questions")
+        if key in personas_by_key and isinstance(questions, list) and questions:
+            questions_by_key[key] = questions
+    return questions_by_key
+
+def refine_personas_batch(items_by_key, product_desc, temperature, model_pool=None):
+    """
+    一次调用根据评审问题完善一批用户画像
+    items_by_key: {画像键: (用户画像, 评审问题列表)}
+    product_desc: 产品描述
+    temperature: 温度
+    model_pool: 模型池
+    返回: {画像键: 完善后的画像}，缺失或解析失败的画像不包含在结果中
+    """
+    sections = []
+    for key, (persona, questions) in items_by_key.items():
+        questions_text = "\n".join([
+            f"{i+1}. [{q.get('dimension', '完善建议')}] {q.get('question', '')}"
+            for i, q in enumerate(questions)
+        ])
+        sections.append(f"""画像键 {key}：
+当前用户画像：
+{json.dumps(persona, ensure_ascii=False, indent=2)}
+评审问题：
+{questions_text}""")
+
+    messages = [
+        {"role": "system", "content": persona_system_prompt},
+        {"role": "user", "content": f"""
+请根据每个画像各自的评审问题分别完善以下{len(items_by_key)}个用户画像，确保新的画像更加真实、具体和深入：
+
+产品描述：
+{product_desc}
+
+{chr(10).join(sections)}
+
+请返回JSON对象，每个完善后的画像保持相同的字段格式，并附带对应的画像键：
+{{"personas": [{{"key": "画像键", "persona": {{完善后的用户画像}}}}]}}
+        """}
+    ]
+
+    response = call_ai_api(messages, response_format="json_object",
+                           temp=temperature, model_pool=model_pool)
+    try:
+        result = json.loads(response)
+    except json.JSONDecodeError:
+        print(f"解析批量完善后的画像时出错，原始响应: {response[:100]}...")
+        return {}
+
+    entries = result.get("personas", []) if isinstance(result, dict) else []
+    refined_by_key = {}
+    for entry in entries if isinstance(entries, list) else []:
+        if not isinstance(entry, dict):
+            continue
+        key = str(entry.get("key", ""))
+        refined = entry.get("persona")
+        if key in items_by_key and isinstance(refined, dict) and refined:
+            refined_by_key[key] = refined
+    return refined_by_key
+
+def plan_persona_segments(product_desc, num_personas, model_pool=None,
+                          personas_per_segment=25, max_segments=40):
+    """
+    分层生成的第一步：规划细分人群并为每个人群分配画像数量
+    各用户类型的总数按默认权重精确分配，同类型的人群之间再按模型给出的占比分配
+    模型没有覆盖的用户类型使用通用的细分人群补齐
+    product_desc: 产品描述
+    num_personas: 需要生成的用户画像总数
+    model_pool: 模型池
+    personas_per_segment: 每个细分人群的目标画像数量
+    max_segments: 最多规划的细分人群数量
+    返回: [{"name", "description", "user_type", "count"}]，count均大于0
+    """
+    num_segments = min(max_segments, max(len(DEFAULT_USER_TYPE_WEIGHTS),
+                                         math.ceil(num_personas / personas_per_segment)))
+    messages = [
+        {"role": "system", "content": persona_segment_system_prompt},
+        {"role": "user", "content": f"""产品描述: {product_desc}
+
+请为这个产品规划{num_segments}个细分人群，四种用户类型都需要覆盖。"""}
+    ]
+
+    segments = []
+    try:
+        response = call_ai_api(messages, response_format="json_object", temp=0.7, model_pool=model_pool)
+        result = json.loads(response)
+        raw_segments = result.get("segments", []) if isinstance(result, dict) else result
+        for raw in raw_segments if isinstance(raw_segments, list) else []:
+            if not isinstance(raw, dict):
+                continue
+            user_type = str(raw.get("user_type", "")).strip()
+            name = str(raw.get("name", "")).strip()
+            if user_type not in DEFAULT_USER_TYPE_WEIGHTS or not name:
+                continue
+            try:
+                share = float(raw.get("share", 1))
+            except (TypeError, ValueError):
+                share = 1.0
+            segments.append({
+                "name": name,
+                "description": str(raw.get("description", "")).strip() or name,
+                "user_type": user_type,
+                "share": share if share > 0 else 1.0,
+            })
+    except Exception as e:
+        print(f"规划细分人群失败，使用按用户类型划分的通用人群: {str(e)}")
+
+    for user_type in DEFAULT_USER_TYPE_WEIGHTS:
+        if not any(seg["user_type"] == user_type for seg in segments):
+            segments.append({
+                "name": f"其他{user_type}",
+                "description": f"与该产品关系属于{user_type}的各类人群",
+                "user_type": user_type,
+                "share": 1.0,
+            })
+
+    planned = []
+    type_counts = allocate_counts(num_personas, DEFAULT_USER_TYPE_WEIGHTS)
+    for user_type, type_count in type_counts.items():
+        type_segments = [seg for seg in segments if seg["user_type"] == user_type]
+        counts = allocate_counts(type_count, {str(i): seg["share"] for i, seg in enumerate(type_segments)})
+        for i, seg in enumerate(type_segments):
+            if counts[str(i)] > 0:
+                planned.append({
+                    "name": seg["name"],
+                    "description": seg["description"],
+                    "user_type": user_type,
+                    "count": counts[str(i)],
+                })
+    return planned
+
+class PersonaStreamWriter:
+    """
+    将被接受的画像逐行追加写入JSONL文件，并分配全局唯一的画像ID
+    多个生成引擎（分层生成时每个细分人群一个）共享同一个写入器
+    """
+
+    def __init__(self, path, total, tasks=None, task_id=None, checkpoint=None, on_persona=None):
+        """
+        path: JSONL文件路径，为空时只分配ID和更新进度
+        total: 目标画像总数，用于计算进度
+        tasks: 任务列表
+        task_id: 任务ID
+        checkpoint: 任务检查点，被接受的画像同时记录到检查点
+        on_persona: 画像被接受时的回调 on_persona(画像)（按写入顺序调用），提供时任务进度由回调方更新
+        """
+        self.path = path
+        self.total = total
+        self.tasks = tasks
+        self.task_id = task_id
+        self.checkpoint = checkpoint
+        self.on_persona = on_persona
+        self.counter = 0
+        self.written = 0
+        self.lock = threading.Lock()
+        if path:
+            # 重新生成时覆盖上一次的部分结果
+            open(path, 'w', encoding='utf-8').close()
+
+    def next_id(self):
+        with self.lock:
+            self.counter += 1
+            return self.counter
+
+    def write(self, persona):
+        with self.lock:
+            if self.path:
+                try:
+                    with open(self.path, 'a', encoding='utf-8') as f:
+                        f.write(json.dumps(persona, ensure_ascii=False) + "\n")
+                except Exception as e:
+                    print(f"写入画像流文件时出错: {str(e)}")
+            if self.checkpoint is not None and "error" not in persona:
+                self.checkpoint.record_persona(persona, position=self.written)
+            if self.on_persona is not None:
+                self.on_persona(persona)
+            self.written += 1
+            completed = self.written
+        if self.on_persona is None and self.tasks is not None and self.task_id in self.tasks:
+            self.tasks[self.task_id]['progress'] = {
+                'current_step': 'personas',
+                'completed': completed,
+                'total': self.total,
+                'percentage': round(min(completed, self.total) / self.total * 100, 1) if self.total else 100
+            }
+
+class PersonaGenerationEngine:
+    """
+    并发用户画像生成引擎
+    - 同时保持多个生成批次在途
+    - 已生成的画像立即进入评审+完善阶段，与后续批次的生成并行
+    - 每次提交生成请求时，基于当前已接受的画像构造多样性上下文
+    - 通过本地相似度索引立即拒绝近重复画像，由后续批次补齐
+    - 预先规划 user_type × usage_frequency × 地区层级 配额，每次调用只请求有缺口的单元
+    - 同一生成批次的画像合并为一次评审调用和一次完善调用，部分失败时逐个回退
+    - 验证前先做字段级归一化，近似合规的画像不再被丢弃重新生成
+    - 并发数由模型池中API密钥的限制决定
+    - 分层生成时每个细分人群一个引擎，共享相似度索引、锁和画像写入器
+    """
+
+    # 每次生成调用产出的画像数量
+    PERSONAS_PER_CALL = 2
+    TEMPERATURES = [0.8, 0.85, 0.9, 0.95]
+    MAX_RETRIES = 3
+
+    def __init__(self, task_id, product_desc, num_personas,
+                 tasks=None, model_pool=None, max_workers=None, batch_review=True,
+                 segment=None, personas_per_call=None, similarity_index=None,
+                 lock=None, sink=None, review=True, unit_scheduler=None):
+        """
+        task_id: 任务ID
+        product_desc: 产品描述
+        num_personas: 需要生成的用户画像数量
+        tasks: 任务列表
+        model_pool: 模型池
+        max_workers: 最大并发数，默认根据模型池限制计算
+        batch_review: 是否对同一批次的画像批量评审和完善
+        segment: 细分人群，指定后只生成该人群的画像，user_type固定为人群的类型
+        personas_per_call: 每次生成调用产出的画像数量，默认PERSONAS_PER_CALL
+        similarity_index: 共享的画像相似度索引，用于跨引擎去重（需同时提供lock）
+        lock: 保护相似度索引和画像列表的共享锁
+        sink: PersonaStreamWriter，提供时由其分配画像ID、写入文件并更新进度
+        review: 是否评审并完善生成的画像，关闭时通过验证和去重的画像直接接受
+        unit_scheduler: 分布式工作单元调度器（见distributed_units），提供时生成批次由各节点领取执行
+        """
+        self.task_id = task_id
+        self.product_desc = product_desc
+        self.num_personas = num_personas
+        self.tasks = tasks
+        self.model_pool = model_pool
+        self.max_workers = max_workers or get_model_pool_concurrency(model_pool)
+        self.batch_review = batch_review
+        self.review = review
+        self.segment = segment
+        self.personas_per_call = personas_per_call or self.PERSONAS_PER_CALL
+        self.sink = sink
+        self.unit_scheduler = unit_scheduler
+        # 生成批次最多占用一半的并发，剩余留给评审和完善
+        self.max_generation_batches = max(1, (unit_scheduler.max_workers if unit_scheduler else self.max_workers) // 2)
+
+        self.personas = []
+        self.persona_counter = 1
+        self.lock = lock or threading.Lock()
+        self.similarity_index = similarity_index if similarity_index is not None else PersonaSimilarityIndex()
+        if segment:
+            self.quota_planner = PersonaQuotaPlanner(num_personas, seed=f"{task_id}:{segment['name']}",
+                                                     user_type_weights={segment['user_type']: 1})
+        else:
+            self.quota_planner = PersonaQuotaPlanner(num_personas, seed=task_id)
+        self.stats = {
+            'generation_calls': 0,
+            'duplicates_rejected': 0,
+            'quota_rejected': 0,
+            'library_reused': 0,
+            'checkpoint_resumed': 0,
+            'review_calls': 0,
+            'refine_calls': 0,
+            'batch_fallbacks': 0,
+            'normalized': 0,
+            'regenerated': 0,
+            'normalized_fields': {},
+        }
+
+    def seed(self, personas, resumed=False):
+        """
+        预先接受已有画像（例如画像库中相似产品的画像），只计入仍有配额缺口的单元
+        personas: 候选画像列表
+        resumed: 是否为从任务检查点恢复的画像（不计入画像库复用）；
+                 恢复时遇到第一个未被接受的画像即停止，接受的画像保持检查点中的顺序和序号
+        返回: 实际接受的数量
+        """
+        accepted = 0
+        for persona in personas:
+            if len(self.personas) >= self.num_personas:
+                break
+            if self._accept(persona, seeded=True):
+                accepted += 1
+            elif resumed:
+                break
+        with self.lock:
+            key = 'checkpoint_resumed' if resumed else 'library_reused'
+            self.stats[key] += accepted
+        return accepted
+
+    def run(self):
+        """
+        执行画像生成，返回按接受顺序编号的画像列表
+        """
+        generation_futures = {}
+        refine_futures = {}
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            while len(self.personas) < self.num_personas:
+                # 任务被中止时停止提交新的批次，finally中取消尚未开始的请求
+                check_cancelled()
+                self._submit_generation_batches(executor, generation_futures)
+                pending = list(generation_futures) + list(refine_futures)
+                if not pending:
+                    break
+
+                done, _ = concurrent.futures.wait(pending, timeout=1, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    if future in generation_futures:
+                        temp, cells = generation_futures.pop(future)
+                        try:
+                            initial_personas, attempts = future.result()
+                            with self.lock:
+                                self.stats['generation_calls'] += attempts
+                        except TaskCancelled:
+                            raise
+                        except Exception as e:
+                            with self.lock:
+                                self.stats['generation_calls'] += self.MAX_RETRIES
+                            print(f"达到最大重试次数，添加 {len(cells)} 个错误替代画像: {str(e)}")
+                            self.quota_planner.consume(cells)
+                            self._add_error_personas(len(cells), str(e))
+                            continue
+                        print(f"成功生成 {len(initial_personas)} 个初始画像，进入评审完善阶段")
+                        candidates, candidate_cells = [], []
+                        for i, persona in enumerate(initial_personas):
+                            cell = cells[i] if i < len(cells) else None
+                            persona = self._normalize(persona)
+                            # 归一化后仍无效的画像无法通过完善修复，直接释放配额重新生成
+                            if not is_valid_persona(persona):
+                                self._reject_invalid(persona, cell)
+                                continue
+                            # 评审完善前先去重，避免为重复画像付出额外调用
+                            if self._is_duplicate(persona):
+                                self.quota_planner.release(cell)
+                                continue
+                            if isinstance(persona, dict):
+                                cell = self.quota_planner.retarget(cell, persona)
+                                if cell is None:
+                                    with self.lock:
+                                        self.stats['quota_rejected'] += 1
+                                    continue
+                            candidates.append(persona)
+                            candidate_cells.append(cell)
+                        # 模型返回的画像少于请求数量时，释放未使用的配额
+                        for cell in cells[len(initial_personas):]:
+                            self.quota_planner.release(cell)
+                        if not candidates:
+                            continue
+                        if not self.review:
+                            for persona, cell in zip(candidates, candidate_cells):
+                                self._accept(persona, cell)
+                        elif self.batch_review:
+                            future = executor.submit(bind_cancellation(self._review_and_refine_batch), candidates, temp)
+                            refine_futures[future] = candidate_cells
+                        else:
+                            for persona, cell in zip(candidates, candidate_cells):
+                                future = executor.submit(bind_cancellation(self._review_and_refine_batch),
+                                                         [persona], temp)
+                                refine_futures[future] = [cell]
+                    else:
+                        candidate_cells = refine_futures.pop(future)
+                        for refined, cell in zip(future.result(), candidate_cells):
+                            self._accept(refined, cell)
+        finally:
+            # 目标数量已满足，取消尚未开始的请求
+            for future in list(generation_futures) + list(refine_futures):
+                future.cancel()
+            executor.shutdown(wait=False)
+
+        self.stats['quota'] = self.quota_planner.summary()
+        return self.personas[:self.num_personas]
+
+    def _submit_generation_batches(self, executor, generation_futures):
+        """
+        在并发限制内补充生成批次，每个批次预留具体的配额单元，已预留的配额不会被重复请求
+        """
+        while len(generation_futures) < self.max_generation_batches:
+            cells = self.quota_planner.reserve(self.personas_per_call)
+            if not cells:
+                break
+            temp = random.choice(self.TEMPERATURES)
+            with self.lock:
+                existing_personas_context = create_existing_personas_context(
+                    self.personas, similarity_index=self.similarity_index
+                )
+            # 分布式执行时生成批次作为工作单元由任意节点领取，评审和完善仍在本节点进行
+            if self.unit_scheduler is not None:
+                submit = functools.partial(self.unit_scheduler.submit, self.task_id)
+            else:
+                submit = lambda fn, *args, **kwargs: executor.submit(bind_cancellation(fn), *args, **kwargs)
+            future = submit(generate_persona_batch, self.product_desc, existing_personas_context, cells, temp,
+                            model_pool=self.model_pool, segment=self.segment, max_retries=self.MAX_RETRIES)
+            generation_futures[future] = (temp, cells)
+
+    def _review_and_refine_batch(self, personas, temp):
+        """
+        第二阶段（批量）：一次评审调用 + 一次完善调用处理整个生成批次
+        批量结果按画像键拆分，缺失的评审或完善结果回退到逐个处理的路径
+        返回: 与输入顺序一致的完善后画像列表
+        """
+        if len(personas) == 1:
+            return [self._review_and_refine(personas[0], temp)]
+
+        personas_by_key = {f"candidate_{i+1}": persona for i, persona in enumerate(personas)}
+
+        with self.lock:
+            self.stats['review_calls'] += 1
+        try:
+            questions_by_key = get_reviewer_questions_batch(personas_by_key, self.product_desc,
+                                                            model_pool=self.model_pool)
+        except Exception as e:
+            print(f"批量获取评审问题失败，回退到逐个评审: {str(e)}")
+            questions_by_key = {}
+
+        refined_by_key = {}
+        items_by_key = {
+            key: (persona, questions_by_key[key])
+            for key, persona in personas_by_key.items() if key in questions_by_key
+        }
+        if items_by_key:
+            with self.lock:
+                self.stats['refine_calls'] += 1
+            try:
+                refined_by_key = refine_personas_batch(items_by_key, self.product_desc, temp,
+                                                       model_pool=self.model_pool)
+            except Exception as e:
+                print(f"批量完善用户画像失败，回退到逐个完善: {str(e)}")
+
+        results = []
+        for key, persona in personas_by_key.items():
+            if key in refined_by_key:
+                results.append(refined_by_key[key])
+                continue
+            with self.lock:
+                self.stats['batch_fallbacks'] += 1
+            print(f"批量评审完善缺少 {key} 的结果，回退到逐个处理")
+            results.append(self._review_and_refine(persona, temp, questions=questions_by_key.get(key)))
+        return results
+
+    def _review_and_refine(self, persona, temp, questions=None):
+        """
+        第二阶段：获取评审问题并完善画像，失败时回退到原始画像
+        questions: 已有的评审问题（批量评审成功但批量完善失败时），为空时重新评审
+        """
+        reviewer_questions = questions or []
+        for retry_count in range(0 if reviewer_questions else self.MAX_RETRIES):
+            try:
+                with self.lock:
+                    self.stats['review_calls'] += 1
+                reviewer_questions = get_reviewer_questions(persona, self.product_desc, model_pool=self.model_pool)
+                if not reviewer_questions:
+                    raise ValueError("获取评审问题失败")
+                break
+            except TaskCancelled:
+                raise
+            except Exception as e:
+                print(f"获取评审问题失败 (尝试 {retry_count + 1}/{self.MAX_RETRIES}): {str(e)}")
+                reviewer_questions = []
+                cancellable_sleep(1)
+
+        for retry_count in range(self.MAX_RETRIES):
+            try:
+                if reviewer_questions:
+                    with self.lock:
+                        self.stats['refine_calls'] += 1
+                refined_persona = refine_persona_with_questions(persona, reviewer_questions,
+                                                                self.product_desc, temp,
+                                                                model_pool=self.model_pool)
+                if not refined_persona:
+                    raise ValueError("完善用户画像失败")
+                return refined_persona
+            except TaskCancelled:
+                raise
+            except Exception as e:
+                print(f"完善用户画像失败 (尝试 {retry_count + 1}/{self.MAX_RETRIES}): {str(e)}")
+                cancellable_sleep(1)
+        return persona
+
+    def _accept(self, persona, cell=None, seeded=False):
+        """
+        第三阶段：验证画像并核销配额，有效则分配顺序ID并加入结果
+        persona: 用户画像
+        cell: 生成时预留的配额单元
+        seeded: 是否为生成开始前预先接受的已有画像
+        """
+        persona = self._normalize(persona)
+        if not is_valid_persona(persona):
+            self._reject_invalid(persona, cell)
+            return False
+
+        if self._is_duplicate(persona):
+            self.quota_planner.release(cell)
+            return False
+
+        with self.lock:
+            if len(self.personas) >= self.num_personas:
+                self.quota_planner.release(cell)
+                return False
+            if seeded:
+                filled_cell = self.quota_planner.absorb(persona)
+                if filled_cell is None:
+                    return False
+            else:
+                filled_cell = self.quota_planner.fulfil(cell, persona)
+            if filled_cell is None:
+                self.stats['quota_rejected'] += 1
+                print(f"画像类型/频率与配额不符且无剩余配额，已拒绝: {persona.get('user_type')}/{persona.get('usage_frequency')}")
+                return False
+            persona_number = self.sink.next_id() if self.sink else self.persona_counter
+            persona["persona_id"] = f"persona_{persona_number}"
+            persona["generated_at"] = time.strftime("%Y-%m-%d %H:%M:%S")
+            persona["location_tier"] = filled_cell[2]
+            if self.segment:
+                persona["segment"] = self.segment["name"]
+            self.personas.append(persona)
+            self.similarity_index.add(persona["persona_id"], persona)
+            self.persona_counter += 1
+            completed = len(self.personas)
+
+        print(f"添加有效画像 {persona['persona_id']}，当前总数: {completed}/{self.num_personas}")
+        self._update_progress(completed, [persona])
+        return True
+
+    def _normalize(self, persona):
+        """
+        归一化画像字段，并统计被修复的画像和字段
+        """
+        persona, changed_fields = normalize_persona(persona)
+        if changed_fields:
+            with self.lock:
+                self.stats['normalized'] += 1
+                for field in changed_fields:
+                    self.stats['normalized_fields'][field] = self.stats['normalized_fields'].get(field, 0) + 1
+        return persona
+
+    def _reject_invalid(self, persona, cell=None):
+        """
+        拒绝归一化后仍无法使用的画像，释放其配额以便重新生成
+        """
+        print(f"画像验证失败: {json.dumps(persona, ensure_ascii=False)[:200]}...")
+        self.quota_planner.release(cell)
+        with self.lock:
+            self.stats['regenerated'] += 1
+
+    def _is_duplicate(self, persona):
+        """
+        检查画像是否与已接受的画像近重复，重复则计数并拒绝
+        """
+        if not isinstance(persona, dict):
+            return False
+        with self.lock:
+            duplicate = self.similarity_index.find_duplicate(persona)
+            if duplicate:
+                self.stats['duplicates_rejected'] += 1
+        if duplicate:
+            print(f"画像与 {duplicate[0]} 近重复 (相似度 {duplicate[1]:.2f})，已拒绝")
+            return True
+        return False
+
+    def _add_error_personas(self, count, error_msg):
+        """
+        生成彻底失败时添加错误替代画像，保证任务能够继续
+        """
+        added = []
+        with self.lock:
+            count = min(count, self.num_personas - len(self.personas))
+            for _ in range(count):
+                persona_number = self.sink.next_id() if self.sink else self.persona_counter
+                added.append(create_error_persona(persona_number, error_msg))
+                self.persona_counter += 1
+            self.personas.extend(added)
+            completed = len(self.personas)
+        self._update_progress(completed, added)
+
+    def _update_progress(self, completed, added=()):
+        if self.sink is not None:
+            for persona in added:
+                self.sink.write(persona)
+            return
+        if self.tasks is None or self.task_id not in self.tasks:
+            return
+        self.tasks[self.task_id]['progress'] = {
+            'current_step': 'personas',
+            'completed': completed,
+            'total': self.num_personas,
+            'percentage': round((completed / self.num_personas) * 100, 1)
+        }
+
+class HierarchicalPersonaGenerator:
+    """
+    大规模分层画像生成（数百到数千个画像）
+    - 先用一次调用规划细分人群，并为每个人群分配画像数量
+    - 每个细分人群由一个生成引擎负责，多个人群并行生成
+    - 所有引擎共享相似度索引，跨人群去重
+    - 每次生成调用产出更多画像，评审和完善按批次合并，调用次数随画像数量亚线性增长
+    - 画像被接受后立即写入JSONL文件
+    """
+
+    # 分层生成时每次生成调用产出的画像数量
+    PERSONAS_PER_CALL = 5
+    # 每个细分人群引擎的并发数
+    SEGMENT_WORKERS = 4
+
+    def __init__(self, task_id, product_desc, num_personas,
+                 model_pool=None, max_workers=None, sink=None, review=True, batch_review=True,
+                 unit_scheduler=None):
+        """
+        task_id: 任务ID
+        product_desc: 产品描述
+        num_personas: 需要生成的用户画像数量
+        model_pool: 模型池
+        max_workers: 总并发数，默认根据模型池限制计算
+        sink: PersonaStreamWriter，负责分配画像ID、写入文件并更新进度
+        review: 是否评审并完善生成的画像
+        batch_review: 是否对同一批次的画像批量评审和完善
+        unit_scheduler: 分布式工作单元调度器，提供时各人群的生成批次由各节点领取执行
+        """
+        self.task_id = task_id
+        self.product_desc = product_desc
+        self.num_personas = num_personas
+        self.model_pool = model_pool
+        self.max_workers = max_workers or get_model_pool_concurrency(model_pool)
+        self.sink = sink or PersonaStreamWriter(None, num_personas)
+        self.review = review
+        self.batch_review = batch_review
+        self.unit_scheduler = unit_scheduler
+        self.lock = threading.Lock()
+        self.similarity_index = PersonaSimilarityIndex()
+        self.segments = None
+        self.engines = []
+
+    def _ensure_engines(self):
+        if self.segments is not None:
+            return
+        self.segments = plan_persona_segments(self.product_desc, self.num_personas, model_pool=self.model_pool)
+        print(f"规划了 {len(self.segments)} 个细分人群: " +
+              "、".join(f"{seg['name']}({seg['count']})" for seg in self.segments))
+        workers = min(self.SEGMENT_WORKERS, self.max_workers)
+        self.engines = [
+            PersonaGenerationEngine(self.task_id, self.product_desc, seg["count"],
+                                    model_pool=self.model_pool, max_workers=workers,
+                                    segment=seg, personas_per_call=self.PERSONAS_PER_CALL,
+                                    similarity_index=self.similarity_index,
+                                    lock=self.lock, sink=self.sink,
+                                    review=self.review, batch_review=self.batch_review,
+                                    unit_scheduler=self.unit_scheduler)
+            for seg in self.segments
+        ]
+
+    @property
+    def stats(self):
+        """
+        汇总各细分人群引擎的统计信息
+        """
+        stats = {'segments': [], 'segment_calls': 1 if self.segments is not None else 0}
+        quota = {'target': 0, 'filled': 0, 'absorbed': 0}
+        for engine in self.engines:
+            for key, value in engine.stats.items():
+                if key == 'quota':
+                    for quota_key in quota:
+                        quota[quota_key] += value.get(quota_key, 0)
+                elif key == 'normalized_fields':
+                    merged = stats.setdefault(key, {})
+                    for field, count in value.items():
+                        merged[field] = merged.get(field, 0) + count
+                else:
+                    stats[key] = stats.get(key, 0) + value
+            stats['segments'].append({
+                'name': engine.segment['name'],
+                'user_type': engine.segment['user_type'],
+                'target': engine.num_personas,
+                'generated': len(engine.personas),
+            })
+        stats['quota'] = quota
+        return stats
+
+    def seed(self, personas, resumed=False):
+        """
+        将已有画像分配给同类型的细分人群引擎，返回实际接受的数量
+        resumed: 是否为从任务检查点恢复的画像，恢复时遇到第一个未被接受的画像即停止
+        """
+        self._ensure_engines()
+        accepted = 0
+        for persona in personas:
+            for engine in self.engines:
+                if engine.segment['user_type'] != persona.get('user_type'):
+                    continue
+                if len(engine.personas) < engine.num_personas and engine.seed([persona], resumed=resumed):
+                    accepted += 1
+                    break
+            else:
+                if resumed:
+                    break
+        return accepted
+
+    def run(self):
+        """
+        并行执行各细分人群的生成，返回所有画像
+        """
+        self._ensure_engines()
+        parallel_segments = max(1, self.max_workers // self.SEGMENT_WORKERS)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=parallel_segments) as executor:
+            futures = {executor.submit(bind_cancellation(engine.run)): engine for engine in self.engines}
+            for future in concurrent.futures.as_completed(futures):
+                engine = futures[future]
+                try:
+                    future.result()
+                except TaskCancelled:
+                    raise
+                except Exception as e:
+                    print(f"细分人群 {engine.segment['name']} 生成失败，使用错误替代画像补齐: {str(e)}")
+                    engine._add_error_personas(engine.num_personas - len(engine.personas), str(e))
+
+        personas = []
+        for engine in self.engines:
+            personas.extend(engine.personas[:engine.num_personas])
+        personas.sort(key=lambda p: int(str(p.get("persona_id", "0")).rsplit("_", 1)[-1] or 0))
+        return personas[:self.num_personas]
+
 def generate_user_personas(task_id, product_desc, num_personas, 
                            tasks=None, tasks_file=None, model_pool=None,
-                           app=None):
+                           app=None, use_library=True, hierarchical=None,
+                           checkpoint=None, resume_personas=None, review=True, batch_review=True,
+                           unit_scheduler=None, on_persona=None, on_resumed=None):
     """
     用于生成用户画像
     task_id: 任务ID
@@ -129,128 +955,90 @@ def generate_user_personas(task_id, product_desc, num_personas,
     tasks_file(json): 任务文件路径
     model_pool: 模型池
     app: 应用实例
+    use_library: 是否从跨任务画像库复用相似产品的画像
+    hierarchical: 是否使用分层生成，默认在画像数量超过HIERARCHICAL_THRESHOLD时启用
+    checkpoint: 任务检查点，被接受的画像逐个记录
+    resume_personas: 上次执行中已被接受的画像（来自检查点），优先接受，只生成剩余部分
+    review: 是否评审并完善生成的画像（由任务的分析深度决定）
+    batch_review: 是否对同一批次的画像批量评审和完善
+    unit_scheduler: 分布式工作单元调度器（见distributed_units），提供时画像生成批次由各节点领取执行
+    on_persona: 画像被接受时立即调用 on_persona(画像)（例如放入PersonaStream供模拟阶段消费），
+                提供时任务进度由调用方更新
+    on_resumed: 检查点中的画像重新接受后、开始生成新画像前调用 on_resumed(重新接受的数量)
     """
     tasks[task_id]['status'] = 'generating_personas'
-    all_personas = []
-    
-    # 迭代生成时，每批次生成多少个新的用户画像
-    PERSONAS_PER_CALL = 2
-    temperatures = [0.8, 0.85, 0.9, 0.95]
-    max_retries = 3 # 添加重试机制
-    
-    # 添加计数器用于生成顺序的persona_id
-    persona_counter = 1
-    
-    while len(all_personas) < num_personas:
-        # 显示进度
-        completed = len(all_personas)
-        tasks[task_id]['progress'] = {
-            'current_step': 'personas',
-            'completed': completed,
-            'total': num_personas,
-            'percentage': round((completed / num_personas) * 100, 1)
+    tasks[task_id]['progress'] = {
+        'current_step': 'personas',
+        'completed': 0,
+        'total': num_personas,
+        'percentage': 0
+    }
+
+    if hierarchical is None:
+        hierarchical = num_personas > HIERARCHICAL_THRESHOLD
+
+    # 被接受的画像逐个追加到JSONL文件，大规模任务中途失败时已生成的画像不会丢失
+    stream_file = None
+    if app is not None:
+        stream_file = os.path.join(app.config['UPLOAD_FOLDER'], f"{task_id}_personas.jsonl")
+    sink = PersonaStreamWriter(stream_file, num_personas, tasks=tasks, task_id=task_id, checkpoint=checkpoint,
+                               on_persona=on_persona)
+
+    if hierarchical:
+        engine = HierarchicalPersonaGenerator(task_id, product_desc, num_personas,
+                                              model_pool=model_pool, sink=sink,
+                                              review=review, batch_review=batch_review,
+                                              unit_scheduler=unit_scheduler)
+    else:
+        engine = PersonaGenerationEngine(task_id, product_desc, num_personas,
+                                         tasks=tasks, model_pool=model_pool, sink=sink,
+                                         review=review, batch_review=batch_review,
+                                         unit_scheduler=unit_scheduler)
+
+    # 从检查点恢复上次执行已接受的画像
+    if resume_personas:
+        resumed = engine.seed([p for p in resume_personas if "error" not in p], resumed=True)
+        print(f"从检查点恢复 {resumed}/{len(resume_personas)} 个画像")
+        if on_resumed is not None:
+            on_resumed(resumed)
+
+    # 从画像库复用相似产品的画像，只生成缺口部分
+    library = None
+    library_seconds_per_persona = 0.0
+    if use_library and app is not None and is_persona_library_enabled():
+        try:
+            library = get_persona_library(os.path.join(app.config['UPLOAD_FOLDER'], 'persona_library'))
+            candidates, library_seconds_per_persona = library.lookup(
+                product_desc, limit=num_personas, exclude_task_id=task_id
+            )
+            if candidates:
+                reused = engine.seed(candidates)
+                print(f"画像库命中: 复用 {reused}/{len(candidates)} 个相似产品画像")
+        except Exception as e:
+            print(f"画像库查询失败，全部重新生成: {str(e)}")
+
+    print(f"开始{'分层' if hierarchical else '并发'}生成用户画像: 目标 {num_personas} 个，并发数 {engine.max_workers}")
+    start_time = time.time()
+    all_personas = engine.run()
+    generation_seconds = time.time() - start_time
+    tasks[task_id]['persona_stats'] = dict(engine.stats, mode='hierarchical' if hierarchical else 'standard')
+
+    generated = [p for p in all_personas if "reused_from" not in p and "error" not in p]
+    reused_count = engine.stats.get('library_reused', 0)
+    seconds_per_persona = generation_seconds / len(generated) if generated else 0.0
+    if library is not None:
+        library.add(task_id, product_desc, generated, seconds_per_persona=seconds_per_persona)
+        # 节省时间优先按画像库记录的耗时估算，没有记录时用本次任务的耗时
+        saved_per_persona = library_seconds_per_persona or seconds_per_persona
+        tasks[task_id]['persona_library'] = {
+            'reused': reused_count,
+            'generated': len(generated),
+            'hit_rate': round(reused_count / num_personas, 3) if num_personas else 0,
+            'estimated_seconds_saved': round(reused_count * saved_per_persona, 1),
         }
-        
-        # 随机选择温度增加多样性
-        temp = random.choice(temperatures)
-        
-        # 构造已有画像上下文
-        existing_personas_context = create_existing_personas_context(all_personas)
-        
-        # 第一阶段：生成初始用户画像
-        initial_personas = []
-        retry_count = 0
-        while retry_count < max_retries and not initial_personas:
-            try:
-                print(f"尝试生成初始用户画像，尝试 {retry_count + 1}/{max_retries}")
-                initial_personas = generate_initial_personas(product_desc, existing_personas_context, 
-                                                             PERSONAS_PER_CALL, temp, model_pool=model_pool)
-                if not initial_personas or len(initial_personas) == 0:
-                    raise ValueError("生成的用户画像为空")
-                print(f"成功生成 {len(initial_personas)} 个初始画像")
-            except Exception as e:
-                retry_count += 1
-                print(f"生成初始用户画像失败 (尝试 {retry_count}/{max_retries}): {str(e)}")
-                time.sleep(1)
-                if retry_count >= max_retries:
-                    print(f"达到最大重试次数，添加 {PERSONAS_PER_CALL} 个错误替代画像")
-                    for i in range(PERSONAS_PER_CALL):
-                        error_persona = create_error_persona(persona_counter, str(e))
-                        all_personas.append(error_persona)
-                        persona_counter += 1
-                    break
-        
-        if not initial_personas:
-            continue
-            
-        # 第二阶段：对每个生成的画像进行深度审查和完善
-        refined_personas = []
-        for i, persona in enumerate(initial_personas):
-            print(f"开始完善画像 {i+1}/{len(initial_personas)}")
-            
-            # 获取评审问题
-            reviewer_questions = []
-            retry_count = 0
-            while retry_count < max_retries and not reviewer_questions:
-                try:
-                    reviewer_questions = get_reviewer_questions(persona, product_desc, model_pool=model_pool)
-                    if not reviewer_questions:
-                        raise ValueError("获取评审问题失败")
-                except Exception as e:
-                    retry_count += 1
-                    print(f"获取评审问题失败 (尝试 {retry_count}/{max_retries}): {str(e)}")
-                    time.sleep(1)
-                    if retry_count >= max_retries:
-                        # 如果获取问题失败，使用空问题列表继续
-                        reviewer_questions = []
-                        break
-            
-            # 完善用户画像
-            refined_persona = None
-            retry_count = 0
-            while retry_count < max_retries and not refined_persona:
-                try:
-                    refined_persona = refine_persona_with_questions(persona, reviewer_questions, 
-                                                                    product_desc, temp, 
-                                                                    model_pool=model_pool)
-                    if not refined_persona:
-                        raise ValueError("完善用户画像失败")
-                except Exception as e:
-                    retry_count += 1
-                    print(f"完善用户画像失败 (尝试 {retry_count}/{max_retries}): {str(e)}")
-                    time.sleep(1)
-                    if retry_count >= max_retries:
-                        # 如果完善失败，使用原始画像
-                        refined_persona = persona
-                        break
-            
-            if refined_persona:
-                refined_personas.append(refined_persona)
-            
-            # 每个画像处理后增加间隔
-            time.sleep(2)
-        
-        # 第三阶段：验证和添加有效画像
-        valid_count = 0
-        for i, persona in enumerate(refined_personas):
-            if is_valid_persona(persona):
-                # 使用计数器生成顺序的persona_id
-                persona["persona_id"] = f"persona_{persona_counter}"
-                persona["generated_at"] = time.strftime("%Y-%m-%d %H:%M:%S")
-                all_personas.append(persona)
-                valid_count += 1
-                persona_counter += 1  # 递增计数器
-            else:
-                print(f"画像验证失败: {json.dumps(persona, ensure_ascii=False)[:200]}...")
-        
-        print(f"本批次添加了 {valid_count} 个有效画像，当前总数: {len(all_personas)}/{num_personas}")
-        
-        # 每次迭代后暂停以避免速率限制
-        time.sleep(1)
-    
-    # 保留所需数量的画像
-    all_personas = all_personas[:num_personas]
+
     save_personas_to_file(task_id, all_personas, app=app)
-    update_task_progress(task_id, num_personas, tasks=tasks)
+    if on_persona is None:
+        update_task_progress(task_id, num_personas, tasks=tasks)
     
-    return all_personas
\ No newline at end of file
+    return all_personas
@@ -0,0 +1,158 @@
+import os
+import json
+import time
+import uuid
+import threading
+from typing import Dict, List, Optional
+
+from .persona_dedup import PersonaSimilarityIndex, TextSimilarityIndex
+
+# 产品描述相似度达到该值才复用其画像（字符3-gram的Jaccard相似度）
+DEFAULT_LIBRARY_SIMILARITY = float(os.getenv("PERSONA_LIBRARY_SIMILARITY", "0.35"))
+
+_libraries = {}
+_libraries_lock = threading.Lock()
+
+
+def is_persona_library_enabled() -> bool:
+    """
+    是否使用跨任务画像库（PERSONA_LIBRARY_ENABLED，默认关闭）
+    画像库在所有提交者之间共享，保存各任务的产品描述和画像，只适合所有提交者可以互相查看结果的部署
+    """
+    return os.getenv("PERSONA_LIBRARY_ENABLED", "0").strip().lower() in ("1", "true", "yes", "on")
+
+
+def get_persona_library(library_dir):
+    """
+    获取指定目录的画像库实例，同一目录在进程内共享同一个实例
+    library_dir: 画像库目录
+    """
+    library_dir = os.path.abspath(library_dir)
+    with _libraries_lock:
+        if library_dir not in _libraries:
+            _libraries[library_dir] = PersonaLibrary(library_dir)
+        return _libraries[library_dir]
+
+
+class PersonaLibrary:
+    """
+    跨任务的用户画像库
+    - 每个任务生成的有效画像连同产品描述追加保存到 library.jsonl
+    - 通过产品描述的本地文本索引查找相似产品，复用其画像
+    - 记录每个画像的平均生成耗时，用于估算复用节省的时间
+    """
+
+    LIBRARY_FILE = "library.jsonl"
+
+    def __init__(self, library_dir, similarity_threshold: float = DEFAULT_LIBRARY_SIMILARITY):
+        """
+        library_dir: 画像库目录
+        similarity_threshold: 产品描述相似度阈值
+        """
+        self.library_dir = library_dir
+        self.library_file = os.path.join(library_dir, self.LIBRARY_FILE)
+        self.similarity_threshold = similarity_threshold
+        # 相似产品的阈值较低，使用更多的分桶保证召回
+        self.index = TextSimilarityIndex(threshold=similarity_threshold, num_perm=64, bands=32)
+        self.entries: Dict[str, Dict] = {}
+        self.lock = threading.Lock()
+        os.makedirs(library_dir, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.library_file):
+            return
+        try:
+            with open(self.library_file, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self._index_entry(entry)
+            print(f"画像库加载完成: {len(self.entries)} 个产品条目")
+        except Exception as e:
+            print(f"加载画像库时出错: {str(e)}")
+
+    def _index_entry(self, entry):
+        entry_id = entry.get("entry_id")
+        if not entry_id or not entry.get("personas"):
+            return
+        self.entries[entry_id] = entry
+        self.index.add(entry_id, entry.get("product_description", ""))
+
+    def add(self, task_id, product_description, personas, seconds_per_persona=0.0):
+        """
+        保存一个任务生成的有效画像
+        task_id: 任务ID
+        product_description: 产品描述
+        personas: 有效画像列表（错误替代画像和复用的画像会被过滤）
+        seconds_per_persona: 该任务生成单个画像的平均耗时
+        """
+        personas = [
+            {k: v for k, v in p.items() if k not in ("persona_id", "generated_at", "reused_from")}
+            for p in personas
+            if isinstance(p, dict) and "error" not in p and "reused_from" not in p
+        ]
+        if not personas:
+            return None
+
+        entry = {
+            "entry_id": str(uuid.uuid4()),
+            "task_id": task_id,
+            "product_description": product_description,
+            "personas": personas,
+            "seconds_per_persona": round(float(seconds_per_persona), 2),
+            "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        with self.lock:
+            try:
+                with open(self.library_file, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            except Exception as e:
+                print(f"保存画像库条目时出错: {str(e)}")
+                return None
+            self._index_entry(entry)
+        print(f"已将 {len(personas)} 个画像保存到画像库")
+        return entry["entry_id"]
+
+    def lookup(self, product_description, limit, exclude_task_id=None):
+        """
+        查找相似产品的画像，按产品相似度从高到低返回，并去除彼此近重复的画像
+        product_description: 产品描述
+        limit: 最多返回的画像数量
+        exclude_task_id: 不复用该任务自己保存的画像（例如重启任务时）
+        返回: (画像列表, 平均单个画像生成耗时)
+        """
+        with self.lock:
+            matches = self.index.query(product_description)
+            entries = [(self.entries[entry_id], similarity) for entry_id, similarity in matches]
+
+        dedup_index = PersonaSimilarityIndex()
+        personas: List[Dict] = []
+        seconds: List[float] = []
+        for entry, similarity in entries:
+            if exclude_task_id and entry.get("task_id") == exclude_task_id:
+                continue
+            for persona in entry["personas"]:
+                if len(personas) >= limit:
+                    break
+                if dedup_index.find_duplicate(persona):
+                    continue
+                reused = dict(persona)
+                reused["reused_from"] = {
+                    "entry_id": entry["entry_id"],
+                    "task_id": entry.get("task_id"),
+                    "product_similarity": round(similarity, 3),
+                }
+                dedup_index.add(str(len(personas)), reused)
+                personas.append(reused)
+                seconds.append(entry.get("seconds_per_persona", 0.0))
+            if len(personas) >= limit:
+                break
+
+        avg_seconds = sum(seconds) / len(seconds) if seconds else 0.0
+        return personas, avg_seconds
@@ -0,0 +1,265 @@
+import random
+import threading
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+# 配额规划使用的各维度取值及默认权重（不包含"未知"）
+DEFAULT_USER_TYPE_WEIGHTS = {
+    "核心用户": 0.3,
+    "潜在用户": 0.3,
+    "边缘用户": 0.2,
+    "非目标用户": 0.2,
+}
+
+DEFAULT_USAGE_FREQUENCY_WEIGHTS = {
+    "每天多次": 1,
+    "每天一次": 1,
+    "每周几次": 1,
+    "每周一次": 1,
+    "每月几次": 1,
+    "每月一次": 1,
+    "偶尔使用": 1,
+    "几乎不使用": 1,
+}
+
+# location是自由文本，配额按地区层级分配，由模型在该层级内选择具体城市
+DEFAULT_LOCATION_TIER_WEIGHTS = {
+    "一线城市": 0.25,
+    "新一线城市": 0.25,
+    "二三线城市": 0.25,
+    "县城及乡镇": 0.15,
+    "海外": 0.1,
+}
+
+QuotaCell = Tuple[str, str, str]
+
+
+def allocate_counts(total: int, weights: Dict[str, float]) -> Dict[str, int]:
+    """
+    按权重将总数分配到各取值（最大余数法），保证总和严格等于total
+    total: 总数
+    weights: 各取值的权重
+    """
+    weight_sum = float(sum(weights.values()))
+    if total <= 0 or weight_sum <= 0:
+        return {k: 0 for k in weights}
+    exact = {k: total * w / weight_sum for k, w in weights.items()}
+    counts = {k: int(v) for k, v in exact.items()}
+    remainder = total - sum(counts.values())
+    # 余数按小数部分从大到小分配，小数部分相同时保持权重字典的顺序
+    order = sorted(exact, key=lambda k: exact[k] - counts[k], reverse=True)
+    for k in order[:remainder]:
+        counts[k] += 1
+    return counts
+
+
+def plan_persona_quotas(num_personas: int,
+                        user_type_weights: Optional[Dict[str, float]] = None,
+                        usage_frequency_weights: Optional[Dict[str, float]] = None,
+                        location_tier_weights: Optional[Dict[str, float]] = None,
+                        seed=None) -> Counter:
+    """
+    预先为 user_type × usage_frequency × 地区层级 的每个单元分配目标数量
+    三个维度各自按权重精确分配，再随机配对组合，保证每个维度的分布都符合预期
+    num_personas: 需要生成的用户画像数量
+    seed: 随机种子，相同种子得到相同的规划
+    """
+    marginals = [
+        Counter(allocate_counts(num_personas, weights or default))
+        for weights, default in (
+            (user_type_weights, DEFAULT_USER_TYPE_WEIGHTS),
+            (usage_frequency_weights, DEFAULT_USAGE_FREQUENCY_WEIGHTS),
+            (location_tier_weights, DEFAULT_LOCATION_TIER_WEIGHTS),
+        )
+    ]
+    return pair_marginals(marginals, seed=seed)
+
+
+def pair_marginals(marginals: List[Counter], seed=None) -> Counter:
+    """
+    将各维度的目标数量随机配对为配额单元
+    marginals: [user_type计数, usage_frequency计数, 地区层级计数]，三者总数相同
+    """
+    rng = random.Random(seed)
+    columns = []
+    for counts in marginals:
+        labels = []
+        for label, count in counts.items():
+            labels.extend([label] * count)
+        rng.shuffle(labels)
+        columns.append(labels)
+    return Counter(zip(*columns))
+
+
+def describe_quota_cell(cell: QuotaCell) -> str:
+    user_type, usage_frequency, location_tier = cell
+    return f'user_type为"{user_type}"，usage_frequency为"{usage_frequency}"，location位于{location_tier}'
+
+
+class PersonaQuotaPlanner:
+    """
+    配额驱动的画像生成规划器
+    - 每次生成调用前预留具体的配额单元，只请求仍有缺口的单元
+    - 画像被接受时核销配额；类型或频率与预留不符时改记到同组合的其他单元
+    - 失败或被拒绝的画像释放预留，供后续调用重新请求
+    - 同一单元多次未被满足时放宽要求，避免为难以生成的组合无限重试
+    - 开始生成前可以吸收已有画像（如画像库复用），剩余配额重新配对
+    """
+
+    # 单元被模型偏离多少次后，接受任意类型的画像计入该单元
+    MAX_CELL_MISSES = 2
+
+    def __init__(self, num_personas: int, seed=None, **weights):
+        """
+        num_personas: 需要生成的用户画像数量
+        seed: 随机种子
+        weights: 透传给plan_persona_quotas的各维度权重
+        """
+        self.seed = seed
+        self.marginals = [
+            Counter(allocate_counts(num_personas, weights.get(name) or default))
+            for name, default in (
+                ("user_type_weights", DEFAULT_USER_TYPE_WEIGHTS),
+                ("usage_frequency_weights", DEFAULT_USAGE_FREQUENCY_WEIGHTS),
+                ("location_tier_weights", DEFAULT_LOCATION_TIER_WEIGHTS),
+            )
+        ]
+        self.targets = pair_marginals(self.marginals, seed=seed)
+        self.absorbed = 0
+        self.filled = Counter()
+        self.reserved = Counter()
+        self.misses = Counter()
+        self.lock = threading.Lock()
+
+    def _available(self, cell: QuotaCell) -> int:
+        return self.targets[cell] - self.filled[cell] - self.reserved[cell]
+
+    def has_available(self) -> bool:
+        with self.lock:
+            return any(self._available(cell) > 0 for cell in self.targets)
+
+    def absorb(self, persona: Dict) -> Optional[QuotaCell]:
+        """
+        在预留任何单元之前吸收一个已有画像：其类型和频率仍有名额时计入，并重新配对剩余配额
+        persona: 已有的用户画像
+        返回: 计入的单元，不需要该画像时返回None
+        """
+        user_type = persona.get("user_type")
+        usage_frequency = persona.get("usage_frequency")
+        user_types, frequencies, tiers = self.marginals
+        with self.lock:
+            if sum(self.reserved.values()) > 0:
+                return None
+            if user_types[user_type] <= 0 or frequencies[usage_frequency] <= 0:
+                return None
+            tier = persona.get("location_tier")
+            if tiers[tier] <= 0:
+                tier = max(tiers, key=lambda t: tiers[t])
+            user_types[user_type] -= 1
+            frequencies[usage_frequency] -= 1
+            tiers[tier] -= 1
+            self.absorbed += 1
+            self.targets = pair_marginals(self.marginals, seed=self.seed)
+            return (user_type, usage_frequency, tier)
+
+    def reserve(self, count: int) -> List[QuotaCell]:
+        """
+        预留最多count个配额单元，优先选择缺口最大的单元
+        """
+        cells: List[QuotaCell] = []
+        with self.lock:
+            for _ in range(count):
+                open_cells = [c for c in self.targets if self._available(c) > 0]
+                if not open_cells:
+                    break
+                cell = max(open_cells, key=self._available)
+                self.reserved[cell] += 1
+                cells.append(cell)
+        return cells
+
+    def release(self, cell: Optional[QuotaCell]) -> None:
+        """
+        释放预留的配额单元（画像生成失败或被拒绝）
+        """
+        if cell is None:
+            return
+        with self.lock:
+            if self.reserved[cell] > 0:
+                self.reserved[cell] -= 1
+
+    def retarget(self, cell: Optional[QuotaCell], persona: Dict) -> Optional[QuotaCell]:
+        """
+        生成后、评审完善前检查画像是否符合预留单元，不符合时改为预留同类型同频率的其他单元
+        返回画像最终预留的单元；无法匹配时释放预留并返回None，避免为其支付评审完善调用
+        cell: 生成时预留的单元，模型多返回的画像为None
+        persona: 用户画像
+        """
+        actual = (persona.get("user_type"), persona.get("usage_frequency"))
+        with self.lock:
+            if cell is not None and cell[:2] == actual:
+                return cell
+            for candidate in self.targets:
+                if candidate[:2] == actual and self._available(candidate) > 0:
+                    if cell is not None and self.reserved[cell] > 0:
+                        self.reserved[cell] -= 1
+                    self.reserved[candidate] += 1
+                    return candidate
+            if cell is None:
+                return None
+            if self.misses[cell] >= self.MAX_CELL_MISSES:
+                return cell
+            self.misses[cell] += 1
+            if self.reserved[cell] > 0:
+                self.reserved[cell] -= 1
+        return None
+
+    def fulfil(self, cell: Optional[QuotaCell], persona: Dict) -> Optional[QuotaCell]:
+        """
+        根据画像实际的类型和频率核销配额，返回最终计入的单元；没有可用配额时返回None
+        cell: 生成时预留的单元
+        persona: 用户画像
+        """
+        actual = (persona.get("user_type"), persona.get("usage_frequency"))
+        with self.lock:
+            if cell is not None and self.reserved[cell] > 0:
+                self.reserved[cell] -= 1
+            if cell is not None and cell[:2] == actual:
+                self.filled[cell] += 1
+                return cell
+            # 模型没有严格遵循指定单元：计入同类型同频率且仍有缺口的单元
+            for candidate in self.targets:
+                if candidate[:2] == actual and self._available(candidate) > 0:
+                    self.filled[candidate] += 1
+                    return candidate
+            if cell is not None:
+                if self.misses[cell] >= self.MAX_CELL_MISSES:
+                    self.filled[cell] += 1
+                    return cell
+                self.misses[cell] += 1
+        return None
+
+    def consume(self, cells: List[QuotaCell]) -> None:
+        """
+        直接核销预留单元（例如生成彻底失败时以错误画像替代）
+        """
+        with self.lock:
+            for cell in cells:
+                if self.reserved[cell] > 0:
+                    self.reserved[cell] -= 1
+                self.filled[cell] += 1
+
+    def summary(self) -> Dict:
+        """
+        返回配额完成情况，便于记录到任务中
+        """
+        with self.lock:
+            return {
+                "target_cells": len(self.targets),
+                "absorbed": self.absorbed,
+                "filled": sum(self.filled.values()) + self.absorbed,
+                "target": sum(self.targets.values()) + self.absorbed,
+                "unfilled_cells": [
+                    {"cell": list(c), "missing": self.targets[c] - self.filled[c]}
+                    for c in self.targets if self.targets[c] > self.filled[c]
+                ],
+            }
@@ -0,0 +1,95 @@
+import os
+import threading
+from concurrent.futures import Future
+from typing import Dict, List, Optional, Tuple
+
+from .cancellation import TaskCancelled
+
+
+def is_persona_streaming_enabled() -> bool:
+    """
+    是否让模拟与画像生成重叠执行（PERSONA_STREAMING_ENABLED，默认开启）
+    """
+    return os.getenv("PERSONA_STREAMING_ENABLED", "1").strip().lower() not in ("0", "false", "no", "off")
+
+
+class PersonaStream:
+    """
+    画像生成到模拟的流式交接：画像被接受后立即放入流中，模拟阶段随即开始模拟该画像，
+    不必等待全部画像（包括最慢的评审完善）结束
+    - 画像按放入的顺序编号，该顺序即模拟结果和检查点单元使用的画像序号
+    - 多个消费者（多方案任务的每个方案）各自从自己的位置读取，互不影响
+    - 画像生成结束（或失败）时关闭；消费者放弃后再放入画像会抛出TaskCancelled，使画像生成停止
+    """
+
+    def __init__(self, total: int):
+        """
+        total: 目标画像数量（流关闭前作为画像总数，实际数量以关闭时为准）
+        """
+        self.total = total
+        self.personas: List[Dict] = []
+        self.closed = False
+        self.error: Optional[BaseException] = None
+        self.abandoned = False
+        self.lock = threading.Lock()
+        self._arrival = Future()
+
+    def _notify(self):
+        """
+        唤醒等待新画像的消费者，调用方需持有锁
+        """
+        arrival, self._arrival = self._arrival, Future()
+        arrival.set_result(None)
+
+    def put(self, persona: Dict) -> None:
+        with self.lock:
+            if self.abandoned:
+                raise TaskCancelled()
+            self.personas.append(persona)
+            self._notify()
+
+    def close(self, error: Optional[BaseException] = None) -> None:
+        """
+        画像生成结束，error为生成失败的异常
+        """
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.error = error
+            self._notify()
+
+    def abandon(self) -> None:
+        """
+        模拟阶段失败或中止，不再接收画像
+        """
+        with self.lock:
+            self.abandoned = True
+
+    def expected(self) -> int:
+        """
+        当前预计的画像总数：关闭前为目标数量，关闭后为实际数量
+        """
+        with self.lock:
+            return len(self.personas) if self.closed else max(self.total, len(self.personas))
+
+    def read(self, start: int) -> Tuple[List[Dict], bool]:
+        """
+        读取从start开始新到达的画像
+        返回: (新画像列表, 流是否已关闭)，画像生成失败时抛出其异常
+        """
+        with self.lock:
+            if self.closed and self.error is not None:
+                raise self.error
+            return self.personas[start:], self.closed
+
+    def arrival(self, start: int) -> Future:
+        """
+        在start之后有新画像到达或流关闭时完成的future，可与模拟单元的future一起等待
+        """
+        with self.lock:
+            if len(self.personas) > start or self.closed:
+                future = Future()
+                future.set_result(None)
+                return future
+            return self._arrival
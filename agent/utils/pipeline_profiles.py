@@ -0,0 +1,140 @@
+import math
+import os
+from typing import Dict, Optional
+
+from models import get_model_pool_concurrency
+from .persona_generate import HIERARCHICAL_THRESHOLD, HierarchicalPersonaGenerator, PersonaGenerationEngine
+
+# 分析深度预设：决定画像阶段和模拟阶段执行哪些步骤
+# - persona_review: 画像生成后是否评审并完善
+# - persona_batch_review: 同一生成批次的画像是否合并评审（关闭时逐个评审，调用更多但更细致）
+# - inquiry_rounds: 模拟中"自我质疑 + 深入模拟"的轮数，0表示直接使用初步模拟结果
+# - ad_review: 广告文案是否评审并改进
+PIPELINE_PROFILES = {
+    "fast": {
+        "label": "快速",
+        "description": "跳过画像评审完善、模拟的自我质疑与深入模拟以及广告评审，适合快速验证",
+        "persona_review": False,
+        "persona_batch_review": True,
+        "inquiry_rounds": 0,
+        "ad_review": False,
+    },
+    "standard": {
+        "label": "标准",
+        "description": "画像批量评审完善，模拟进行一轮自我质疑与深入模拟，广告文案评审改进",
+        "persona_review": True,
+        "persona_batch_review": True,
+        "inquiry_rounds": 1,
+        "ad_review": True,
+    },
+    "deep": {
+        "label": "深度",
+        "description": "画像逐个评审完善，模拟进行两轮自我质疑与深入模拟，广告文案评审改进",
+        "persona_review": True,
+        "persona_batch_review": False,
+        "inquiry_rounds": 2,
+        "ad_review": True,
+    },
+}
+
+DEFAULT_PIPELINE_PROFILE = os.getenv("PIPELINE_PROFILE", "standard")
+# 非VIP任务可选的分析深度，VIP用户可在账户信息中用pipeline_profiles单独配置
+NON_VIP_PIPELINE_PROFILES = ("fast", "standard")
+# 估算耗时使用的单次模型调用平均耗时（秒）
+PIPELINE_SECONDS_PER_CALL = float(os.getenv("PIPELINE_SECONDS_PER_CALL", "12"))
+
+
+def get_pipeline_profile(name: Optional[str] = None) -> Dict:
+    """
+    获取分析深度预设，未知名称时使用默认预设
+    name: 预设名称（fast / standard / deep）
+    返回: 包含name字段的预设副本
+    """
+    if name not in PIPELINE_PROFILES:
+        name = DEFAULT_PIPELINE_PROFILE if DEFAULT_PIPELINE_PROFILE in PIPELINE_PROFILES else "standard"
+    return dict(PIPELINE_PROFILES[name], name=name)
+
+
+def resolve_pipeline_profile(requested: Optional[str], vip_info: Optional[Dict] = None) -> str:
+    """
+    根据用户请求和VIP等级确定任务使用的分析深度
+    requested: 请求的预设名称，为空时使用默认预设（VIP账户可配置default_pipeline_profile）
+    vip_info: VIP账户信息，非VIP用户为None；pipeline_profiles字段限定可选的预设，未配置时全部可选
+    返回: 预设名称
+    """
+    if vip_info is not None:
+        allowed = vip_info.get("pipeline_profiles") or list(PIPELINE_PROFILES)
+        default = vip_info.get("default_pipeline_profile") or DEFAULT_PIPELINE_PROFILE
+    else:
+        allowed = NON_VIP_PIPELINE_PROFILES
+        default = DEFAULT_PIPELINE_PROFILE
+
+    if requested in PIPELINE_PROFILES and requested in allowed:
+        return requested
+    if default in PIPELINE_PROFILES and default in allowed:
+        return default
+    # 默认预设不可用时选择允许范围内最接近标准的预设
+    for name in ("standard", "fast", "deep"):
+        if name in allowed:
+            return name
+    return "fast"
+
+
+def simulation_calls_per_unit(profile: Dict) -> int:
+    """
+    单次模拟（一个画像×模拟次数单元）的模型调用次数
+    初步模拟1次，每轮自我质疑+深入模拟2次，广告文案1次（评审改进再加2次），产品优化1次
+    """
+    return 1 + 2 * profile["inquiry_rounds"] + (3 if profile["ad_review"] else 1) + 1
+
+
+def estimate_pipeline(name: Optional[str], num_personas: int, num_simulations: int,
+                      model_pool=None, num_variants: int = 1) -> Dict:
+    """
+    估算任务在指定分析深度下的模型调用次数和耗时
+    name: 预设名称
+    num_personas: 画像数量
+    num_simulations: 每个画像的模拟次数
+    model_pool: 模型池，用于确定并发数
+    num_variants: 产品方案数（多方案任务的画像只生成一次，每个方案分别模拟）
+    返回: {profile, persona_calls, simulation_calls, total_calls, estimated_seconds,
+           persona_seconds, simulation_seconds（两个阶段各自的估算耗时）}
+    """
+    profile = get_pipeline_profile(name)
+    concurrency = get_model_pool_concurrency(model_pool) if model_pool else 4
+
+    if num_personas > HIERARCHICAL_THRESHOLD:
+        personas_per_call = HierarchicalPersonaGenerator.PERSONAS_PER_CALL
+    else:
+        personas_per_call = PersonaGenerationEngine.PERSONAS_PER_CALL
+    generation_calls = math.ceil(num_personas / personas_per_call)
+    if not profile["persona_review"]:
+        review_calls = 0
+    elif profile["persona_batch_review"]:
+        review_calls = 2 * generation_calls
+    else:
+        review_calls = 2 * num_personas
+    persona_calls = generation_calls + review_calls
+
+    units = num_personas * num_simulations * max(1, num_variants)
+    simulation_calls = units * simulation_calls_per_unit(profile)
+
+    # 按关键路径估算：画像的生成批次最多占用一半并发，模拟单元占满并发
+    # 模拟单元内广告文案与产品优化并行，关键路径取较长的广告文案链
+    persona_chain = 1 + (2 if profile["persona_review"] else 0)
+    persona_waves = math.ceil(generation_calls / max(1, concurrency // 2))
+    simulation_chain = 1 + 2 * profile["inquiry_rounds"] + (3 if profile["ad_review"] else 1)
+    simulation_waves = math.ceil(units / max(1, concurrency))
+    persona_seconds = persona_waves * persona_chain * PIPELINE_SECONDS_PER_CALL
+    simulation_seconds = simulation_waves * simulation_chain * PIPELINE_SECONDS_PER_CALL
+    estimated_seconds = persona_seconds + simulation_seconds
+
+    return {
+        "profile": profile["name"],
+        "persona_calls": persona_calls,
+        "simulation_calls": simulation_calls,
+        "total_calls": persona_calls + simulation_calls,
+        "estimated_seconds": round(estimated_seconds),
+        "persona_seconds": round(persona_seconds),
+        "simulation_seconds": round(simulation_seconds),
+    }
@@ -0,0 +1,200 @@
+import json
+import math
+import os
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+from .cancellation import bind_cancellation
+from .idempotency import normalize_product_description
+from .persona_stream import PersonaStream
+from .sequential_sampling import DEFAULT_ADAPTIVE_Z
+from .simulation_stats import PERCENTAGE_METRICS
+from .simulatiton_generate import simulate_task_reactions
+
+# 多方案任务最多对比的产品方案数（每个方案的模拟调用数与单方案任务相同）
+MAX_PRODUCT_VARIANTS = int(os.getenv("MAX_PRODUCT_VARIANTS", "3"))
+VARIANT_LABELS = "ABCDEFGHIJ"
+# 对比报告中的指标名称
+METRIC_NAMES = {
+    'would_try': '愿意尝试',
+    'would_buy': '愿意购买',
+    'is_must_have': '刚需',
+    'would_recommend': '愿意推荐',
+}
+
+
+def parse_product_variants(raw, base_description: str = "") -> List[Dict]:
+    """
+    解析提交的产品方案（同一产品的不同描述/定位）
+    raw: 方案列表（JSON字符串或列表），元素为产品描述，或 {"label": 名称, "product_description": 描述}
+    base_description: 对话中提取的产品描述，不在列表中时作为第一个方案（基准方案）
+    返回: [{"label", "product_description"}]，去重后不足两个方案时返回空列表（按普通任务执行）
+    """
+    if not raw:
+        return []
+    if isinstance(raw, str):
+        try:
+            raw = json.loads(raw)
+        except json.JSONDecodeError:
+            raise ValueError("产品方案格式错误，应为JSON数组")
+    if not isinstance(raw, list):
+        raise ValueError("产品方案格式错误，应为JSON数组")
+
+    items = [{'product_description': base_description}] if base_description else []
+    for item in raw:
+        items.append(item if isinstance(item, dict) else {'product_description': item})
+    variants = []
+    seen = set()
+    for item in items:
+        description = str(item.get('product_description') or '').strip()
+        key = normalize_product_description(description)
+        if not key or key in seen:
+            continue
+        seen.add(key)
+        variants.append({'label': str(item.get('label') or '').strip(), 'product_description': description})
+    if len(variants) < 2:
+        return []
+    if len(variants) > MAX_PRODUCT_VARIANTS:
+        raise ValueError(f"最多对比 {MAX_PRODUCT_VARIANTS} 个产品方案")
+    for index, variant in enumerate(variants):
+        variant['label'] = variant['label'] or f"方案{VARIANT_LABELS[index]}"
+    return variants
+
+
+def task_product_variants(task: Dict) -> List[Dict]:
+    """
+    任务的产品方案列表，普通任务返回空列表
+    """
+    return task.get('variants') or []
+
+
+def simulate_variant_reactions(task_id, variants, personas, num_simulations, web_contexts=None,
+                               on_progress=None, completed_units=None, on_unit_complete=None,
+                               on_result=None, retry_stats=None, should_stop=None, **options):
+    """
+    多方案任务：同一组画像分别对每个方案的产品描述进行模拟
+    personas为PersonaStream时各方案各自从流中读取画像（与画像生成重叠执行）
+    各方案的单元同时提交到共享调度器（使用同一任务ID，与其他任务之间仍按一个任务公平调度）
+    任一方案失败或中止时，其他方案尚未开始的单元随之取消
+    variants: 产品方案列表
+    web_contexts: 每个方案的网络搜索证据（按各自的描述排序）
+    on_progress: 汇总全部方案的进度回调，参数同simulate_task_reactions（画像数、单元数为各方案之和）
+    completed_units: {方案序号: {(画像序号, 模拟序号): 模拟结果}}（从任务检查点恢复）
+    on_unit_complete: 单元成功完成时的回调 on_unit_complete(方案序号, 画像序号, 模拟序号, 模拟结果)
+    on_result: 模拟结果确定时的回调 on_result(方案序号, 模拟结果)
+    retry_stats: 提供时追加每个方案的重试统计
+    options: 传给simulate_task_reactions的其他参数（模型池、调度器、分析深度等）
+    返回: 每个方案的模拟结果列表
+    """
+    web_contexts = web_contexts or [""] * len(variants)
+    completed_units = completed_units or {}
+    # 与画像生成重叠执行时画像总数以流的预计数量为准
+    total_personas = personas.expected() if isinstance(personas, PersonaStream) else len(personas)
+    progress = [(0, total_personas, 0, total_personas * num_simulations) for _ in variants]
+    variant_stats = [{} for _ in variants]
+    progress_lock = threading.Lock()
+    failed = threading.Event()
+
+    def variant_callbacks(k):
+        def report_progress(completed_personas, total_personas, completed_count, units):
+            with progress_lock:
+                progress[k] = (completed_personas, total_personas, completed_count, units)
+                if on_progress:
+                    on_progress(*[sum(values) for values in zip(*progress)])
+
+        unit_complete = (lambda index, sim_index, result: on_unit_complete(k, index, sim_index, result)) \
+            if on_unit_complete else None
+        result_callback = (lambda result: on_result(k, result)) if on_result else None
+        return report_progress, unit_complete, result_callback
+
+    def run_variant(k):
+        report_progress, unit_complete, result_callback = variant_callbacks(k)
+        try:
+            return simulate_task_reactions(
+                task_id, variants[k]['product_description'], personas, num_simulations,
+                web_context=web_contexts[k],
+                should_stop=lambda: failed.is_set() or bool(should_stop and should_stop()),
+                on_progress=report_progress,
+                retry_stats=variant_stats[k],
+                completed_units=completed_units.get(k),
+                on_unit_complete=unit_complete,
+                on_result=result_callback,
+                **options,
+            )
+        except Exception:
+            failed.set()
+            raise
+
+    with ThreadPoolExecutor(max_workers=len(variants), thread_name_prefix=f"variants-{task_id[:8]}") as executor:
+        futures = [executor.submit(bind_cancellation(run_variant), k) for k in range(len(variants))]
+        results = [future.result() for future in futures]
+    if retry_stats is not None:
+        retry_stats.extend(variant_stats)
+    return results
+
+
+def _persona_rates(results, metric):
+    """
+    每个画像在该指标上的比例（该画像各次模拟的平均值），出错的模拟不计入
+    """
+    values = defaultdict(list)
+    for result in results:
+        if 'error' in result:
+            continue
+        values[result.get('persona_id')].append(1.0 if result.get(metric) == True else 0.0)
+    return {persona_id: sum(v) / len(v) for persona_id, v in values.items()}
+
+
+def compare_variants(variants, variant_results, variant_stats, z: float = DEFAULT_ADAPTIVE_Z) -> Dict:
+    """
+    对比各方案的模拟结果
+    各方案使用同一组画像，与基准方案（第一个方案）的差异按画像配对计算：
+    每个画像先取各次模拟的平均值，差值的置信区间使用配对差值的标准误，画像之间的差异不影响比较
+    variants: 产品方案列表
+    variant_results: 每个方案的模拟结果列表
+    variant_stats: 每个方案的stats
+    z: 置信区间的z值
+    返回: {"variants": [{label, product_description, stats}],
+           "metrics": {指标: {"name", "values": 各方案百分比, "best": 最高的方案序号,
+                              "deltas": 各方案相对基准的 {delta, low, high, significant, wins, losses, paired}}}}
+    """
+    comparison = {
+        'variants': [
+            {'label': variant['label'], 'product_description': variant['product_description'], 'stats': stats}
+            for variant, stats in zip(variants, variant_stats)
+        ],
+        'metrics': {},
+    }
+    for metric, stats_key in PERCENTAGE_METRICS.items():
+        values = [stats.get(stats_key, 0) for stats in variant_stats]
+        baseline = _persona_rates(variant_results[0], metric)
+        deltas = []
+        for results in variant_results:
+            rates = _persona_rates(results, metric)
+            differences = [rates[persona_id] - baseline[persona_id] for persona_id in rates if persona_id in baseline]
+            n = len(differences)
+            mean = sum(differences) / n if n else 0.0
+            if n > 1:
+                variance = sum((d - mean) ** 2 for d in differences) / (n - 1)
+                margin = z * math.sqrt(variance / n)
+            else:
+                margin = 1.0
+            low, high = mean - margin, mean + margin
+            deltas.append({
+                'delta': round(mean * 100, 1),
+                'low': round(max(-1.0, low) * 100, 1),
+                'high': round(min(1.0, high) * 100, 1),
+                'significant': n > 1 and (low > 0 or high < 0),
+                'wins': sum(1 for d in differences if d > 0),
+                'losses': sum(1 for d in differences if d < 0),
+                'paired': n,
+            })
+        comparison['metrics'][metric] = {
+            'name': METRIC_NAMES[metric],
+            'values': values,
+            'best': max(range(len(values)), key=lambda k: values[k]) if values else 0,
+            'deltas': deltas,
+        }
+    return comparison
@@ -1,9 +1,11 @@
 import json
-import pandas as pd
 from datetime import datetime
 import os
 import sys
 from collections import defaultdict
+from html import escape
+
+from .simulation_stats import SimulationStatsAggregator
 
 def generate_report(
     personas_file,
@@ -12,6 +14,10 @@ def generate_report(
     product_description=None,
     web_search_summary: str = "",
     web_search_references_markdown: str = "",
+    pipeline_profile=None,
+    pipeline_estimate=None,
+    adaptive_summary=None,
+    stats_aggregator=None,
 ):
     """
     从personas和simulations JSON文件生成HTML报告，使用前端Chart.js绘制图表
@@ -21,6 +27,10 @@ def generate_report(
     simulations_file: simulations JSON文件路径
     output_file: 输出HTML文件路径，如果为None则自动生成
     product_description: 产品描述文本
+    pipeline_profile: 任务使用的分析深度预设（见pipeline_profiles）
+    pipeline_estimate: 该分析深度下预估的模型调用次数和耗时
+    adaptive_summary: 自适应模拟的统计（置信区间是否收敛、节省的模拟次数）
+    stats_aggregator: 模拟过程中已累计全部结果的SimulationStatsAggregator，未提供时读取模拟结果后单遍统计
     """
     # 读取数据
     try:
@@ -111,10 +121,6 @@ def generate_report(
             
         cleaned_simulations.append(cleaned_sim)
     
-    # 创建DataFrame
-    personas_df = pd.DataFrame(personas)
-    simulations_df = pd.DataFrame(cleaned_simulations)
-    
     # 给personas添加排序值
     user_type_order = {
         '核心用户': 1,
@@ -143,53 +149,35 @@ def generate_report(
     # 先按用户类型排序，再按使用频率排序
     personas.sort(key=lambda x: (x.get('user_type_order', 999), x.get('frequency_order', 999)))
     
-    # 数据统计
-    total_users = len(simulations_df)
+    # 数据统计（与任务统计共用单遍累计的计数）
+    if stats_aggregator is None:
+        stats_aggregator = SimulationStatsAggregator.from_results(simulations, total_personas=len(personas))
+    summary = stats_aggregator.report_view()
+    total_users = summary['total']
     
     # 用户类型统计
-    user_types = {}
-    if 'user_type' in simulations_df.columns:
-        user_types = simulations_df['user_type'].fillna('未知').value_counts().to_dict()
+    user_types = summary['user_types']
     
-    # 刚需比例计算
-    must_have_percentage = 0
-    if 'is_must_have' in simulations_df.columns and not simulations_df['is_must_have'].empty:
-        must_have_percentage = (simulations_df['is_must_have'].fillna(False).astype(bool).sum() / total_users) * 100
+    # 刚需比例、推荐意愿比例
+    must_have_percentage = summary['must_have_percentage']
+    would_recommend_percentage = summary['would_recommend_percentage']
     
-    # 推荐意愿比例计算
-    would_recommend_percentage = 0
-    if 'would_recommend' in simulations_df.columns and not simulations_df['would_recommend'].empty:
-        would_recommend_percentage = (simulations_df['would_recommend'].fillna(False).astype(bool).sum() / total_users) * 100
+    def distribution(counts):
+        return {
+            'labels': list(counts.keys()),
+            'data': [round(count / total_users * 100, 1) for count in counts.values()]
+        }
     
     # 依赖水平统计
-    dependency_data = {}
-    if 'dependency_level' in simulations_df.columns and not simulations_df['dependency_level'].empty:
-        dependency_counts = simulations_df['dependency_level'].fillna('无所谓').value_counts()
-        dependency_percentages = (dependency_counts / dependency_counts.sum() * 100).round(1)
-        dependency_data = {
-            'labels': dependency_percentages.index.tolist(),
-            'data': dependency_percentages.values.tolist()
-        }
+    dependency_counts = summary['dependency_counts']
+    dependency_data = distribution(dependency_counts) if dependency_counts else {}
     
     # 使用频率统计
-    frequency_data = {}
-    if 'usage_frequency' in simulations_df.columns and not simulations_df['usage_frequency'].empty:
-        frequency_counts = simulations_df['usage_frequency'].fillna('未知').value_counts()
-        frequency_percentages = (frequency_counts / frequency_counts.sum() * 100).round(1)
-        frequency_data = {
-            'labels': frequency_percentages.index.tolist(),
-            'data': frequency_percentages.values.tolist()
-        }
+    frequency_counts = summary['frequency_counts']
+    frequency_data = distribution(frequency_counts) if frequency_counts else {}
     
-    # 地域分布统计
+    # 地域分布统计（清理后的模拟结果不含地域字段）
     location_data = {}
-    if 'location' in simulations_df.columns and not simulations_df['location'].empty:
-        location_counts = simulations_df['location'].fillna('未知').value_counts()
-        location_percentages = (location_counts / location_counts.sum() * 100).round(1)
-        location_data = {
-            'labels': location_percentages.index.tolist(),
-            'data': location_percentages.values.tolist()
-        }
     
     # 用户类型数据准备
     user_type_data = {
@@ -240,6 +228,21 @@ def generate_report(
     #     </div>
     #     """
 
+    # 记录本次分析使用的深度预设，便于解读结果的详细程度
+    pipeline_html = ""
+    if pipeline_profile:
+        pipeline_html = f'<p class="date">分析深度: {pipeline_profile.get("label", pipeline_profile.get("name", ""))}'
+        if pipeline_estimate:
+            pipeline_html += f'（预估 {pipeline_estimate.get("total_calls", 0)} 次模型调用）'
+        pipeline_html += f'</p><p class="date">{pipeline_profile.get("description", "")}</p>'
+    if adaptive_summary:
+        pipeline_html += (
+            f'<p class="date">自适应模拟: 执行 {adaptive_summary.get("executed_units", 0)}/'
+            f'{adaptive_summary.get("budget_units", 0)} 次模拟，节省 {adaptive_summary.get("saved_units", 0)} 次'
+            f'（{"各指标置信区间宽度均已不超过" if adaptive_summary.get("converged") else "预算用尽时仍有置信区间宽于"}'
+            f' {adaptive_summary.get("target_width")}）</p>'
+        )
+
     html_content = f"""
     <!DOCTYPE html>
     <html lang="zh-CN">
@@ -970,6 +973,7 @@ def generate_report(
         <div class="header">
             <h1>用户研究报告</h1>
             <p class="date">生成日期: {datetime.now().strftime('%Y-%m-%d')}</p>
+            {pipeline_html}
         </div>
 
         <div class="section" style="background-color: #e8f4f8; border-left: 4px solid #3498db;">
@@ -1008,7 +1012,7 @@ def generate_report(
             """
     
     # 添加刚需比例
-    if 'is_must_have' in simulations_df.columns and not simulations_df['is_must_have'].empty:
+    if total_users:
         html_content += f"""
                 <div class="stat-box">
                     <h3>刚需比例</h3>
@@ -1017,7 +1021,7 @@ def generate_report(
         """
     
     # 添加推荐意愿比例
-    if 'would_recommend' in simulations_df.columns and not simulations_df['would_recommend'].empty:
+    if total_users:
         html_content += f"""
                 <div class="stat-box">
                     <h3>推荐意愿比例</h3>
@@ -1127,12 +1131,8 @@ def generate_report(
                 </tr>
         """
         
-        frequency_counts = simulations_df['usage_frequency'].value_counts()
-        frequency_percentages = (frequency_counts / frequency_counts.sum() * 100).round(1)
-        
-        for i, freq in enumerate(frequency_data['labels']):
+        for freq, percentage in zip(frequency_data['labels'], frequency_data['data']):
             count = frequency_counts[freq]
-            percentage = frequency_percentages[freq]
             html_content += f"""
                 <tr>
                     <td>{freq}</td>
@@ -1157,12 +1157,8 @@ def generate_report(
                 </tr>
         """
         
-        dependency_counts = simulations_df['dependency_level'].value_counts()
-        dependency_percentages = (dependency_counts / dependency_counts.sum() * 100).round(1)
-        
-        for i, level in enumerate(dependency_data['labels']):
+        for level, percentage in zip(dependency_data['labels'], dependency_data['data']):
             count = dependency_counts[level]
-            percentage = dependency_percentages[level]
             html_content += f"""
                 <tr>
                     <td>{level}</td>
@@ -2432,6 +2428,244 @@ def generate_report(
         print(f"写入报告文件时出错: {e}")
         return None
 
+def generate_variant_comparison_report(
+    comparison,
+    output_file,
+    num_personas=0,
+    num_simulations=0,
+    pipeline_profile=None,
+    pipeline_estimate=None,
+):
+    """
+    生成多方案任务的方案对比报告（HTML，使用前端Chart.js绘制图表），各方案的完整报告单独生成
+
+    参数:
+    comparison: compare_variants的结果
+    output_file: 输出HTML文件路径
+    num_personas: 画像数量（各方案共用同一组画像）
+    num_simulations: 每个画像在每个方案下的模拟次数
+    pipeline_profile: 任务使用的分析深度预设
+    pipeline_estimate: 该分析深度下预估的模型调用次数和耗时
+    """
+    variants = comparison['variants']
+    metrics = comparison['metrics']
+    colors = [
+        'rgba(54, 162, 235, 0.7)',   # 蓝色
+        'rgba(255, 159, 64, 0.7)',   # 橙色
+        'rgba(75, 192, 192, 0.7)',   # 绿色
+        'rgba(255, 99, 132, 0.7)',   # 红色
+    ]
+
+    pipeline_html = ""
+    if pipeline_profile:
+        pipeline_html = f'<p class="date">分析深度: {pipeline_profile.get("label", pipeline_profile.get("name", ""))}'
+        if pipeline_estimate:
+            pipeline_html += f'（预估 {pipeline_estimate.get("total_calls", 0)} 次模型调用）'
+        pipeline_html += '</p>'
+
+    variants_html = "".join(
+        f"""
+            <div class="variant">
+                <h3>{escape(variant['label'])}{'（基准）' if k == 0 else ''}</h3>
+                <p>{escape(variant['product_description'])}</p>
+            </div>"""
+        for k, variant in enumerate(variants)
+    )
+
+    # 指标对比表：各方案的比例，以及相对基准方案的配对差异和置信区间
+    header_cells = "".join(f"<th>{escape(variant['label'])}</th>" for variant in variants)
+    metric_rows = ""
+    for metric in metrics.values():
+        cells = ""
+        for k, (value, delta) in enumerate(zip(metric['values'], metric['deltas'])):
+            cell = f"<strong>{value}%</strong>" if k == metric['best'] else f"{value}%"
+            if k > 0:
+                sign = '+' if delta['delta'] > 0 else ''
+                css = 'significant' if delta['significant'] else 'delta'
+                cell += (f'<div class="{css}">{sign}{delta["delta"]} 个百分点 '
+                         f'[{delta["low"]}, {delta["high"]}]</div>'
+                         f'<div class="delta">{delta["wins"]} 个画像更高，{delta["losses"]} 个更低</div>')
+            cells += f"<td>{cell}</td>"
+        metric_rows += f"<tr><td>{metric['name']}</td>{cells}</tr>"
+
+    # 各方案的依赖程度和主要采用障碍
+    detail_rows = ""
+    for variant in variants:
+        stats = variant['stats'] or {}
+        dependency = "，".join(f"{level} {value}%" for level, value in stats.get('dependency_percentages', {}).items())
+        barriers = "，".join(f"{escape(str(keyword))} ({count})" for keyword, count in stats.get('top_barriers', {}).items())
+        detail_rows += (f"<tr><td>{escape(variant['label'])}</td><td>{stats.get('total_simulations', 0)}</td>"
+                        f"<td>{dependency or '-'}</td><td>{barriers or '-'}</td></tr>")
+
+    # 每个方案一组柱子
+    chart_data = {
+        'labels': [metric['name'] for metric in metrics.values()],
+        'datasets': [
+            {
+                'label': variant['label'],
+                'data': [metric['values'][k] for metric in metrics.values()],
+                'backgroundColor': colors[k % len(colors)],
+            }
+            for k, variant in enumerate(variants)
+        ],
+    }
+
+    # 方案名称来自用户输入，嵌入<script>前转义，避免"</script>"提前结束脚本
+    chart_json = (json.dumps(chart_data, ensure_ascii=False)
+                  .replace('<', '\\u003c').replace('>', '\\u003e').replace('&', '\\u0026'))
+
+    html_content = f"""
+    <!DOCTYPE html>
+    <html lang="zh-CN">
+    <head>
+        <meta charset="UTF-8">
+        <meta name="viewport" content="width=device-width, initial-scale=1.0">
+        <title>产品方案对比报告</title>
+        <script src="https://cdn.jsdelivr.net/npm/chart.js@4.4.1/dist/chart.umd.min.js"></script>
+        <style>
+            body {{
+                font-family: 'Microsoft YaHei', 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
+                line-height: 1.6;
+                color: #333;
+                max-width: 1200px;
+                margin: 0 auto;
+                padding: 20px;
+                background-color: #f9f9f9;
+            }}
+            .header {{
+                text-align: center;
+                padding: 20px 0;
+                margin-bottom: 30px;
+                border-bottom: 1px solid #ddd;
+                background-color: #fff;
+                border-radius: 8px;
+                box-shadow: 0 2px 4px rgba(0,0,0,0.1);
+            }}
+            .header h1 {{
+                margin: 0;
+                color: #2c3e50;
+                font-size: 28px;
+            }}
+            .date {{
+                color: #7f8c8d;
+                font-style: italic;
+                font-size: 16px;
+            }}
+            .section {{
+                margin: 30px 0;
+                padding: 20px;
+                background-color: #fff;
+                border-radius: 8px;
+                box-shadow: 0 2px 4px rgba(0,0,0,0.1);
+            }}
+            .section h2 {{
+                color: #2980b9;
+                border-bottom: 2px solid #ecf0f1;
+                padding-bottom: 10px;
+                font-size: 24px;
+            }}
+            .variant {{
+                background-color: #ecf0f1;
+                border-radius: 8px;
+                padding: 15px;
+                margin: 10px 0;
+            }}
+            .variant h3 {{
+                margin: 0 0 8px;
+                color: #3498db;
+                font-size: 18px;
+            }}
+            table {{
+                width: 100%;
+                border-collapse: collapse;
+                margin: 20px 0;
+            }}
+            th, td {{
+                padding: 12px 15px;
+                border-bottom: 1px solid #ddd;
+                text-align: left;
+                vertical-align: top;
+            }}
+            th {{
+                background-color: #f2f2f2;
+                font-weight: bold;
+            }}
+            .delta {{
+                color: #7f8c8d;
+                font-size: 13px;
+            }}
+            .significant {{
+                color: #c0392b;
+                font-size: 13px;
+                font-weight: bold;
+            }}
+            .chart {{
+                position: relative;
+                height: 360px;
+            }}
+        </style>
+    </head>
+    <body>
+        <div class="header">
+            <h1>产品方案对比报告</h1>
+            <p class="date">生成日期: {datetime.now().strftime('%Y-%m-%d')}</p>
+            <p class="date">{len(variants)} 个方案，共用 {num_personas} 个用户画像，每个画像在每个方案下模拟 {num_simulations} 次</p>
+            {pipeline_html}
+        </div>
+
+        <div class="section">
+            <h2>产品方案</h2>
+            {variants_html}
+        </div>
+
+        <div class="section">
+            <h2>关键指标对比</h2>
+            <div class="chart"><canvas id="metricsChart"></canvas></div>
+            <table>
+                <thead><tr><th>指标</th>{header_cells}</tr></thead>
+                <tbody>{metric_rows}</tbody>
+            </table>
+            <p class="delta">差异为相对基准方案的百分点：同一画像在两个方案下的结果配对比较，方括号内为95%置信区间，
+            红色表示区间不包含0（差异显著）。各方案的最高值加粗显示。</p>
+        </div>
+
+        <div class="section">
+            <h2>依赖程度与采用障碍</h2>
+            <table>
+                <thead><tr><th>方案</th><th>模拟次数</th><th>依赖程度</th><th>主要采用障碍</th></tr></thead>
+                <tbody>{detail_rows}</tbody>
+            </table>
+            <p class="delta">各方案的完整分析见对应的方案报告。</p>
+        </div>
+
+        <div class="footer">
+            <p style="text-align: center; margin-top: 40px; color: #7f8c8d;">© {datetime.now().year} 用户研究报告 | 自动生成</p>
+        </div>
+
+        <script>
+            new Chart(document.getElementById('metricsChart'), {{
+                type: 'bar',
+                data: {chart_json},
+                options: {{
+                    responsive: true,
+                    maintainAspectRatio: false,
+                    scales: {{ y: {{ beginAtZero: true, max: 100, ticks: {{ callback: value => value + '%' }} }} }}
+                }}
+            }});
+        </script>
+    </body>
+    </html>
+    """
+
+    try:
+        with open(output_file, 'w', encoding='utf-8') as f:
+            f.write(html_content)
+        print(f"方案对比报告已生成: {output_file}")
+        return output_file
+    except Exception as e:
+        print(f"写入报告文件时出错: {e}")
+        return None
+
 def main():
     """命令行入口点"""
     import argparse
@@ -1,25 +1,81 @@
-from .report_generate import generate_report
-from .tasks import update_task_status
-from .persona_generate import generate_user_personas
-from .simulatiton_generate import simulate_user_reactions
+from .report_generate import generate_report, generate_variant_comparison_report
+from .tasks import save_tasks, update_task_status
+from .generate_utils import save_personas_to_file
+from .persona_generate import DEFAULT_MAX_PERSONAS, MAX_PERSONAS, generate_user_personas
+from .simulatiton_generate import (
+    is_throughput_mode_default,
+    simulate_task_reactions,
+    summarize_stage_timings,
+)
 from .email import send_report_email
+from .checkpoint import TaskCheckpoint, get_checkpoint_path
+from .pipeline_profiles import estimate_pipeline, get_pipeline_profile, simulation_calls_per_unit
+from .sequential_sampling import is_adaptive_mode_default
+from .job_queue import JOB_RUNNING, task_priority_class
+from .distributed_units import get_leased_unit_scheduler, is_distributed_mode
+from .simulation_stats import SimulationStatsAggregator
+from .task_eta import StageTimer, plan_stages
+from .product_variants import compare_variants, simulate_variant_reactions, task_product_variants
+from .idempotency import (
+    IN_FLIGHT_STATUSES,
+    REUSE_CACHED,
+    UNFINISHED_STATUSES,
+    copy_task_result,
+    find_reusable_task,
+    is_cross_owner_reuse_enabled,
+    is_dedup_enabled,
+    task_idempotency_key,
+    task_owner,
+)
+from .cancellation import (
+    TaskCancelled,
+    bind_cancellation,
+    cancellation_scope,
+    release_cancellation_token,
+    reset_cancellation_token,
+)
+from .persona_stream import PersonaStream, is_persona_streaming_enabled
+import concurrent.futures
 import time
 import os
 import json
+import threading
 
 from .web_search_pipeline import (
-    build_web_context_block,
+    compress_web_evidence,
     decide_web_search_queries,
     pick_large_model_name,
     run_web_search_session,
     summarize_web_docs_with_llm,
 )
 
+# 任务中止后等待进行中的模型调用断开的最长时间（秒），之后记录中止后的额度消耗
+CANCEL_DRAIN_SECONDS = float(os.getenv("TASK_CANCEL_DRAIN_SECONDS", "10"))
+# 模拟进行中刷新实时统计（任务状态中的stats）的最短间隔（秒）
+LIVE_STATS_INTERVAL_SECONDS = 1.0
+
+
 def run_analysis_task(task_id, product_description,
                        num_personas, num_simulations,
                        tasks, task_stop_flags,
                        TASKS_FILE, MODEL_POOL, app):
-    """运行分析任务"""
+    """
+    运行分析任务
+    任务在自己的取消令牌下执行：stop_task取消令牌后，各阶段的模型调用断开连接、重试停止、尚未开始的工作单元被取消
+    """
+    cancel_token = reset_cancellation_token(task_id)
+    try:
+        with cancellation_scope(cancel_token):
+            return _run_analysis_task(task_id, product_description, num_personas, num_simulations,
+                                      tasks, task_stop_flags, TASKS_FILE, MODEL_POOL, app, cancel_token)
+    finally:
+        release_cancellation_token(task_id, cancel_token)
+
+
+def _run_analysis_task(task_id, product_description,
+                       num_personas, num_simulations,
+                       tasks, task_stop_flags,
+                       TASKS_FILE, MODEL_POOL, app, cancel_token):
     try:
         # 初始化中止标志
         task_stop_flags[task_id] = False
@@ -28,16 +84,31 @@ def run_analysis_task(task_id, product_description,
         if num_personas == 2:
             num_simulations = 2
         else:
-            # 非极速尝鲜版才应用常规限制
-            num_personas = min(40, num_personas)
+            # 非极速尝鲜版才应用常规限制；大规模任务在创建时单独记录了允许的画像上限
+            max_personas = min(MAX_PERSONAS, tasks.get(task_id, {}).get('max_personas', DEFAULT_MAX_PERSONAS))
+            num_personas = min(max_personas, num_personas)
             num_simulations = min(2, num_simulations)
         
-        # 估算token（粗略：画像*模拟*800）
-        total_tokens = max(800, num_personas * num_simulations * 800)
+        # 多方案任务：画像只生成一次（按第一个方案的描述），每个方案分别模拟后生成对比报告
+        variants = task_product_variants(tasks[task_id])
+        num_variants = max(1, len(variants))
+
+        # 分析深度决定执行哪些阶段，未指定时使用默认预设
+        profile = get_pipeline_profile(tasks[task_id].get('pipeline_profile'))
+        tasks[task_id]['pipeline_profile'] = profile['name']
+        tasks[task_id]['pipeline_estimate'] = estimate_pipeline(profile['name'], num_personas, num_simulations,
+                                                                model_pool=MODEL_POOL, num_variants=num_variants)
+
+        # 估算token（粗略：画像*模拟*方案数*800，按分析深度相对标准预设的调用次数缩放）
+        call_ratio = simulation_calls_per_unit(profile) / simulation_calls_per_unit(get_pipeline_profile('standard'))
+        total_tokens = max(800, int(num_personas * num_simulations * num_variants * 800 * call_ratio))
 
         # 更新任务状态
         update_task_status(task_id, status='running', tasks=tasks, tasks_file=TASKS_FILE)
         tasks[task_id]['start_time'] = time.time()
+        # 记录各阶段的实际耗时，供状态接口估算剩余时间并作为之后任务的历史数据
+        stage_timer = StageTimer(tasks[task_id], plan_stages(num_personas, num_simulations * num_variants,
+                                                             tasks[task_id]['pipeline_estimate']))
         tasks[task_id]['progress'] = {
             'current_step': 'pending',
             'completed': 0,
@@ -49,24 +120,161 @@ def run_analysis_task(task_id, product_description,
         
         # 检查是否被中止
         if task_stop_flags.get(task_id):
-            raise Exception("任务已被中止")
+            cancel_token.cancel()
+        cancel_token.raise_if_cancelled()
+
+        # 读取检查点：重启或进程恢复后跳过已完成的画像和模拟单元
+        checkpoint = TaskCheckpoint(get_checkpoint_path(task_id, app))
+        checkpoint_state = checkpoint.load()
+        resumed_units = sum(len(units) for units in checkpoint_state['variant_units'].values())
+        if checkpoint_state['personas'] or resumed_units:
+            tasks[task_id]['resumed_from_checkpoint'] = {
+                'personas': len(checkpoint_state['personas']),
+                'simulation_units': resumed_units,
+            }
+            print(f"任务 {task_id} 从检查点恢复: {tasks[task_id]['resumed_from_checkpoint']}")
         
+        # 分布式模式下画像生成批次和模拟单元发布到协调存储，由所有节点共同执行
+        unit_scheduler = get_leased_unit_scheduler(MODEL_POOL, app) if is_distributed_mode() else None
+
+        # 每个模拟结果确定时单遍更新统计，模拟进行中即可查看实时统计，结束后直接得到最终统计
+        # 多方案任务每个方案各自统计，任务的stats为第一个方案的统计
+        variant_aggregators = [SimulationStatsAggregator(total_personas=num_personas) for _ in range(num_variants)]
+        stats_aggregator = variant_aggregators[0]
+        live_stats_at = [0.0]
+        throughput_mode = tasks[task_id].get('throughput_mode', is_throughput_mode_default())
+        adaptive = tasks[task_id].get('adaptive_sampling', is_adaptive_mode_default())
+
+        # 画像生成与模拟重叠执行时画像经流交给模拟阶段（自适应抽样和吞吐模式需要完整的画像列表，仍按顺序执行）
+        persona_stream = None
+        persona_future = None
+        # 重叠执行时总进度中画像阶段的权重（两个阶段的预估耗时之比）
+        estimate = tasks[task_id]['pipeline_estimate']
+        estimated_seconds = estimate.get('persona_seconds', 0) + estimate.get('simulation_seconds', 0)
+        persona_weight = estimate.get('persona_seconds', 0) / estimated_seconds if estimated_seconds else 0.0
+        # 模拟进度: [已完成画像数, 画像总数, 已完成单元数, 单元总数]
+        simulation_progress = [0, num_personas, 0, num_personas * num_simulations * num_variants]
+
+        def report_simulation_progress():
+            completed_personas, total_personas, completed_units, total_units = simulation_progress
+            fraction = completed_units / total_units if total_units else 1.0
+            progress = {
+                'current_step': 'simulations',
+                'completed': completed_personas,
+                'total': total_personas,
+            }
+            if persona_stream is not None:
+                # 两个阶段同时进行：分别给出各自的进度，总进度按预估耗时加权
+                generated = len(persona_stream.personas)
+                fraction = persona_weight * min(1.0, generated / num_personas) + (1 - persona_weight) * fraction
+                if not persona_stream.closed:
+                    progress['current_step'] = 'personas_and_simulations'
+                progress['personas'] = {'completed': generated, 'total': num_personas}
+                progress['simulations'] = {'completed': completed_units, 'total': total_units}
+            pct = round(fraction * 90, 1)
+            progress.update({
+                'percentage': pct,
+                'used_tokens': int(total_tokens * pct / 100),
+                'total_tokens': total_tokens
+            })
+            tasks[task_id]['progress'] = progress
+
+        def update_simulation_progress(completed_personas, total_personas, completed_units, total_units):
+            now = time.time()
+            if now - live_stats_at[0] >= LIVE_STATS_INTERVAL_SECONDS or completed_units >= total_units:
+                live_stats_at[0] = now
+                tasks[task_id]['live_stats'] = stats_aggregator.stats()
+                if variants:
+                    tasks[task_id]['variant_stats'] = [aggregator.stats() for aggregator in variant_aggregators]
+            stage_timer.progress('simulations', completed_units, total_units)
+            simulation_progress[:] = [completed_personas, total_personas, completed_units, total_units]
+            report_simulation_progress()
+
+        def stream_persona(persona):
+            persona_stream.put(persona)
+            report_simulation_progress()
+
+        def keep_resumed_units(accepted):
+            """
+            中断前重叠执行中完成的单元：检查点中的画像按原顺序最先重新接受，只保留前accepted个画像的单元，
+            并写回已清空的检查点（其余画像重新生成，序号不再对应）
+            """
+            for variant, units in checkpoint_state['variant_units'].items():
+                for key in [key for key in units if key[0] >= accepted]:
+                    del units[key]
+                for (index, sim_index), result in list(units.items()):
+                    checkpoint.record_unit(index, sim_index, result, variant=variant)
+
+        def generate_personas():
+            """
+            画像阶段：生成画像（检查点中的画像优先接受），结束时记录到检查点
+            """
+            personas = generate_user_personas(task_id, product_description, num_personas, 
+                                              tasks=tasks, tasks_file=TASKS_FILE, 
+                                              model_pool=MODEL_POOL, app=app,
+                                              checkpoint=checkpoint,
+                                              resume_personas=checkpoint_state['personas'],
+                                              review=profile['persona_review'],
+                                              batch_review=profile['persona_batch_review'],
+                                              unit_scheduler=unit_scheduler,
+                                              on_persona=stream_persona if persona_stream is not None else None,
+                                              on_resumed=keep_resumed_units if persona_stream is not None else None)
+            if persona_stream is not None:
+                # 模拟按画像到达的顺序编号，画像文件和检查点使用同一顺序
+                personas = list(persona_stream.personas)
+                save_personas_to_file(task_id, personas, app=app)
+                if tasks[task_id]['status'] == 'generating_personas':
+                    tasks[task_id]['status'] = 'simulating_reactions'
+            checkpoint.record_personas_complete(personas, keep_units=persona_stream is not None)
+            # 从画像库复用的画像不计入本阶段执行的单元
+            stage_timer.finish('personas', completed=num_personas - tasks[task_id].get('persona_library', {}).get('reused', 0))
+            return personas
+
+        def stream_personas():
+            try:
+                personas = generate_personas()
+            except BaseException as e:
+                persona_stream.close(error=e)
+                raise
+            persona_stream.close()
+            return personas
+
         # 1. 生成用户画像
-        personas = generate_user_personas(task_id, product_description, num_personas, 
-                                          tasks=tasks, tasks_file=TASKS_FILE, 
-                                          model_pool=MODEL_POOL, app=app)
+        if checkpoint_state['personas_complete'] and len(checkpoint_state['personas']) == num_personas:
+            personas = checkpoint_state['personas']
+            save_personas_to_file(task_id, personas, app=app)
+        else:
+            checkpoint.reset()
+            stage_timer.start('personas', done=len(checkpoint_state['personas']))
+            if is_persona_streaming_enabled() and not adaptive and not throughput_mode:
+                # 画像在后台线程生成，网络搜索和模拟随即开始，模拟阶段从流中读取被接受的画像，
+                # 不必等待最慢的画像评审完善
+                persona_stream = PersonaStream(num_personas)
+                persona_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1,
+                                                                         thread_name_prefix=f"personas-{task_id[:8]}")
+                persona_future = persona_executor.submit(bind_cancellation(stream_personas))
+                persona_executor.shutdown(wait=False)
+                personas = persona_stream
+            else:
+                # 画像列表的顺序与中断前的到达顺序无关，之前的单元无法对应
+                checkpoint_state['units'] = {}
+                checkpoint_state['variant_units'] = {0: checkpoint_state['units']}
+                personas = generate_personas()
         
         # 检查是否被中止
         if task_stop_flags.get(task_id):
-            raise Exception("任务已被中止")
+            cancel_token.cancel()
+        cancel_token.raise_if_cancelled()
         
-        # 2. 模拟用户反应
-        tasks[task_id]['status'] = 'simulating_reactions'
-        all_simulation_results = []
+        # 2. 模拟用户反应（重叠执行时画像阶段结束后才更新状态）
+        if persona_stream is None:
+            tasks[task_id]['status'] = 'simulating_reactions'
 
         # (Optional) Web search context for the simulation phase (task-level).
         web_session = None
         web_context = ""
+        variant_web_contexts = [""] * len(variants)
+        stage_timer.start('web_search')
         try:
             web_intent = (
                 "We are about to run user-reaction simulations for the following product.\n"
@@ -78,31 +286,71 @@ def run_analysis_task(task_id, product_description,
             )
             if should_search:
                 web_session = run_web_search_session(queries)
-                web_context = build_web_context_block(web_session)
+                # 按产品描述排序并去重，每个模拟阶段注入各自token预算内的证据
+                if web_session.all_docs():
+                    web_context = compress_web_evidence(web_session, product_description)
+                    # 多方案任务按各方案的描述分别排序证据
+                    variant_web_contexts = [compress_web_evidence(web_session, variant['product_description'])
+                                            for variant in variants]
         except Exception as e:
             print(f"Web search (simulation phase) skipped due to error: {e}")
-        
-        for i, persona in enumerate(personas):
-            # 检查是否被中止
-            if task_stop_flags.get(task_id):
-                raise Exception("任务已被中止")
-            
-            # 更新进度
-            pct = round(((i + 1) / len(personas)) * 90, 1)
-            used_tokens = int(total_tokens * pct / 100)
-            tasks[task_id]['progress'] = {
-                'current_step': 'simulations',
-                'completed': i + 1,
-                'total': len(personas),
-                'percentage': pct,
-                'used_tokens': used_tokens,
-                'total_tokens': total_tokens
-            }
-            
-            simulation_results = simulate_user_reactions(task_id, product_description, persona,
-                                                         num_simulations, model_pool=MODEL_POOL,
-                                                         web_context=web_context)
-            all_simulation_results.extend(simulation_results)
+        stage_timer.finish('web_search', completed=1)
+
+        # 所有 (画像, 模拟次数) 单元提交到共享调度器，空闲线程立即领取下一个单元
+        simulation_options = dict(
+            model_pool=MODEL_POOL, scheduler=unit_scheduler,
+            should_stop=lambda: task_stop_flags.get(task_id) or cancel_token.cancelled,
+            on_progress=update_simulation_progress,
+            throughput_mode=throughput_mode,
+            profile=profile,
+            adaptive=adaptive,
+        )
+        stage_timer.start('simulations', done=sum(len(units) for units in checkpoint_state['variant_units'].values()))
+        try:
+            if variants:
+                variant_retry_stats = []
+                variant_results = simulate_variant_reactions(
+                    task_id, variants, personas, num_simulations,
+                    web_contexts=variant_web_contexts,
+                    retry_stats=variant_retry_stats,
+                    completed_units=checkpoint_state['variant_units'],
+                    on_unit_complete=lambda k, index, sim_index, result: checkpoint.record_unit(
+                        index, sim_index, result, variant=k),
+                    on_result=lambda k, result: variant_aggregators[k].add(result),
+                    **simulation_options,
+                )
+                all_simulation_results = variant_results[0]
+                variant_adaptive = [variant_stats.get('adaptive') for variant_stats in variant_retry_stats]
+                retry_stats = variant_retry_stats[0]
+            else:
+                retry_stats = {}
+                all_simulation_results = simulate_task_reactions(
+                    task_id, product_description, personas, num_simulations,
+                    web_context=web_context,
+                    retry_stats=retry_stats,
+                    completed_units=checkpoint_state['units'],
+                    on_unit_complete=checkpoint.record_unit,
+                    on_result=stats_aggregator.add,
+                    **simulation_options,
+                )
+        except BaseException:
+            if persona_stream is not None:
+                # 模拟失败或中止时停止画像生成
+                persona_stream.abandon()
+                concurrent.futures.wait([persona_future])
+            raise
+        if persona_future is not None:
+            personas = persona_future.result()
+            for aggregator in variant_aggregators:
+                aggregator.total_personas = len(personas)
+        stage_timer.finish('simulations')
+        stage_timer.start('report')
+        if 'adaptive' in retry_stats:
+            tasks[task_id]['adaptive_sampling_summary'] = retry_stats.pop('adaptive')
+        tasks[task_id]['simulation_retry_stats'] = retry_stats
+        tasks[task_id]['simulation_stage_timings'] = summarize_stage_timings(all_simulation_results)
+        if web_context:
+            tasks[task_id]['web_evidence_stats'] = web_context.summary()
         
         # 更新进度到95%，表示开始生成报告
         tasks[task_id]['progress'] = {
@@ -123,87 +371,8 @@ def run_analysis_task(task_id, product_description,
         with open(simulations_file, 'w', encoding='utf-8') as f:
             json.dump(all_simulation_results, f, ensure_ascii=False, indent=2)
         
-        # 3. 生成统计
-        stats = {}
-        if all_simulation_results:
-            # 基础统计
-            total_simulations = len(all_simulation_results)
-            
-            # 意愿指标统计
-            would_try_count = sum(1 for sim in all_simulation_results if sim.get('would_try') == True)
-            would_buy_count = sum(1 for sim in all_simulation_results if sim.get('would_buy') == True)
-            must_have_count = sum(1 for sim in all_simulation_results if sim.get('is_must_have') == True)
-            would_recommend_count = sum(1 for sim in all_simulation_results if sim.get('would_recommend') == True)
-            
-            would_try_percentage = (would_try_count / total_simulations) * 100
-            would_buy_percentage = (would_buy_count / total_simulations) * 100
-            must_have_percentage = (must_have_count / total_simulations) * 100
-            would_recommend_percentage = (would_recommend_count / total_simulations) * 100
-            
-            # 依赖程度统计
-            dependency_counts = {"痛苦": 0, "可以接受": 0, "无所谓": 0}
-            for sim in all_simulation_results:
-                dep = sim.get('dependency_level')
-                if dep in dependency_counts:
-                    dependency_counts[dep] += 1
-            
-            dependency_percentages = {key: (value / total_simulations * 100) 
-                                   for key, value in dependency_counts.items()}
-            
-            # 用户类型统计
-            user_type_counts = {}
-            for sim in all_simulation_results:
-                user_type = sim.get('user_type', '未知')
-                user_type_counts[user_type] = user_type_counts.get(user_type, 0) + 1
-            
-            user_type_percentages = {key: (value / total_simulations * 100) 
-                                   for key, value in user_type_counts.items()}
-            
-            # 使用频率统计
-            usage_frequency_counts = {}
-            for sim in all_simulation_results:
-                freq = sim.get('usage_frequency', '未知')
-                usage_frequency_counts[freq] = usage_frequency_counts.get(freq, 0) + 1
-            
-            usage_frequency_percentages = {key: (value / total_simulations * 100) 
-                                        for key, value in usage_frequency_counts.items()}
-            
-            # 地域分布统计
-            location_counts = {}
-            for sim in all_simulation_results:
-                location = sim.get('location', '未知')
-                location_counts[location] = location_counts.get(location, 0) + 1
-            
-            location_percentages = {key: (value / total_simulations * 100) 
-                                 for key, value in location_counts.items()}
-            
-            # 采用障碍统计（提取出现频率最高的几个关键词）
-            barrier_keywords = {}
-            for sim in all_simulation_results:
-                barrier = sim.get('barrier_to_adoption', '')
-                if barrier and barrier != "未提供" and barrier != "模拟出错":
-                    # 简单分词
-                    keywords = [k.strip() for k in barrier.replace('，', ',').split(',')]
-                    for k in keywords:
-                        if k and len(k) > 1:
-                            barrier_keywords[k] = barrier_keywords.get(k, 0) + 1
-            
-            # 找出出现频率最高的5个障碍
-            top_barriers = sorted(barrier_keywords.items(), key=lambda x: x[1], reverse=True)[:5]
-            
-            stats = {
-                'would_try_percentage': round(would_try_percentage, 1),
-                'would_buy_percentage': round(would_buy_percentage, 1),
-                'must_have_percentage': round(must_have_percentage, 1),
-                'would_recommend_percentage': round(would_recommend_percentage, 1),
-                'dependency_percentages': {k: round(v, 1) for k, v in dependency_percentages.items()},
-                'user_type_percentages': {k: round(v, 1) for k, v in user_type_percentages.items()},
-                'usage_frequency_percentages': {k: round(v, 1) for k, v in usage_frequency_percentages.items()},
-                'location_percentages': {k: round(v, 1) for k, v in location_percentages.items()},
-                'top_barriers': dict(top_barriers),
-                'total_personas': len(personas),
-                'total_simulations': total_simulations
-            }
+        # 3. 生成统计（模拟过程中已逐个结果累计）
+        stats = stats_aggregator.stats()
         
         # 更新进度到97%，准备生成报告
         tasks[task_id]['progress'] = {
@@ -234,14 +403,45 @@ def run_analysis_task(task_id, product_description,
                 print(f"Web search summary generation failed: {e}")
 
         # 生成报告
-        report_path = generate_report(
-            personas_file,
-            simulations_file,
-            report_file,
-            product_description,
+        report_options = dict(
             web_search_summary=web_summary,
             web_search_references_markdown=web_references_md,
+            pipeline_profile=profile,
+            pipeline_estimate=tasks[task_id]['pipeline_estimate'],
         )
+        variant_files = []
+        if variants:
+            # 每个方案生成各自的完整报告，任务的报告为方案对比报告
+            for k, variant in enumerate(variants):
+                variant_simulations_file = os.path.join(app.config['UPLOAD_FOLDER'],
+                                                        f"{task_id}_variant{k + 1}_simulations.json")
+                variant_report_file = os.path.join(app.config['REPORTS_FOLDER'], f"{task_id}_variant{k + 1}_report.html")
+                with open(variant_simulations_file, 'w', encoding='utf-8') as f:
+                    json.dump(variant_results[k], f, ensure_ascii=False, indent=2)
+                if not generate_report(personas_file, variant_simulations_file, variant_report_file,
+                                       variant['product_description'], adaptive_summary=variant_adaptive[k],
+                                       stats_aggregator=variant_aggregators[k], **report_options):
+                    raise Exception(f"{variant['label']} 报告生成失败")
+                variant_files.append({'label': variant['label'], 'simulations': variant_simulations_file,
+                                      'report': variant_report_file})
+            variant_stats = [aggregator.stats() for aggregator in variant_aggregators]
+            tasks[task_id]['variant_stats'] = variant_stats
+            tasks[task_id]['variant_comparison'] = compare_variants(variants, variant_results, variant_stats)
+            report_path = generate_variant_comparison_report(
+                tasks[task_id]['variant_comparison'], report_file,
+                num_personas=len(personas), num_simulations=num_simulations,
+                pipeline_profile=profile, pipeline_estimate=tasks[task_id]['pipeline_estimate'],
+            )
+        else:
+            report_path = generate_report(
+                personas_file,
+                simulations_file,
+                report_file,
+                product_description,
+                adaptive_summary=tasks[task_id].get('adaptive_sampling_summary'),
+                stats_aggregator=stats_aggregator,
+                **report_options,
+            )
         
         # 更新进度到99%，准备发送邮件
         tasks[task_id]['progress'] = {
@@ -252,6 +452,8 @@ def run_analysis_task(task_id, product_description,
         }
         
         if report_path:
+            # 任务在发送邮件前即标记为完成，报告阶段到此结束
+            stage_timer.finish('report', completed=1)
             # 更新任务状态和文件列表
             tasks[task_id].update({
                 'status': 'completed',
@@ -260,7 +462,8 @@ def run_analysis_task(task_id, product_description,
                 'files': {
                     'personas': personas_file,
                     'simulations': simulations_file,
-                    'report': report_file
+                    'report': report_file,
+                    **({'variants': variant_files} if variant_files else {}),
                 }
             })
             
@@ -280,12 +483,165 @@ def run_analysis_task(task_id, product_description,
                 'used_tokens': total_tokens,
                 'total_tokens': total_tokens
             }, tasks=tasks, tasks_file=TASKS_FILE)
+            checkpoint.remove()
         else:
             raise Exception("报告生成失败")
         
         return True
     except Exception as e:
+        if isinstance(e, TaskCancelled) or cancel_token.cancelled:
+            # 等待进行中的调用断开后记录中止后的额度消耗，状态保持为stopped
+            cancellation = cancel_token.wait_drained(CANCEL_DRAIN_SECONDS)
+            tasks[task_id]['cancellation'] = cancellation
+            tasks[task_id]['error'] = "任务已被中止"
+            update_task_status(task_id, status='stopped', tasks=tasks, tasks_file=TASKS_FILE)
+            print(f"任务 {task_id} 已中止: {cancellation['in_flight_at_cancel']} 个调用在中止时进行中，"
+                  f"{cancellation['drain_seconds']} 秒后全部停止，中止后估算消耗 {cancellation['tokens_after_cancel']} tokens")
+            return False
         update_task_status(task_id, status='failed', tasks=tasks, tasks_file=TASKS_FILE)
         tasks[task_id]['error'] = str(e)
         print(f"任务 {task_id} 失败: {str(e)}")
         return False
+
+
+# 进程退出时仍处于这些状态的任务没有执行完，重启后重新排队
+INTERRUPTED_TASK_STATUSES = ('pending', 'running', 'generating_personas', 'simulating_reactions')
+
+
+def is_task_auto_resume_enabled() -> bool:
+    return os.getenv("TASK_AUTO_RESUME", "1").strip().lower() not in ("0", "false", "no", "off")
+
+
+def run_queued_task(task_id, tasks, task_stop_flags, TASKS_FILE, MODEL_POOL, app):
+    """
+    任务队列的工作线程领取任务后执行；排队期间被中止、删除或不再需要执行的任务直接跳过
+    """
+    task = tasks.get(task_id)
+    if not task or task.get('status') != 'pending':
+        print(f"跳过队列中的任务 {task_id}: {task.get('status') if task else '任务不存在'}")
+        return False
+    return run_analysis_task(task_id, task['product_description'],
+                             task['num_personas'], task['num_simulations'],
+                             tasks, task_stop_flags,
+                             TASKS_FILE, MODEL_POOL, app)
+
+
+def enqueue_analysis_task(task_id, tasks, task_pool, task_store=None):
+    """
+    分析任务进入持久化任务队列，按优先级类别和用户并发上限由工作线程池执行
+    用户标识默认为邮箱（inline任务使用创建时记录的queue_user），并发上限可由queue_user_cap覆盖
+    task_store: 独立工作进程模式下的共享任务存储，入队前写入任务数据供工作进程读取
+    """
+    task = tasks[task_id]
+    if task_store is not None:
+        task_store.put(task_id, task)
+    task_pool.submit(task_id, priority_class=task_priority_class(task),
+                     user=task.get('queue_user') or task.get('email', ''),
+                     user_cap=task.get('queue_user_cap'))
+
+
+def _send_reused_report(task_id, task):
+    """
+    在后台把复用的报告发送给提交者（inline任务免发送）
+    """
+    email = task.get('email')
+    if email and email != 'inline@local':
+        threading.Thread(target=send_report_email, args=(email, task_id, task['files']['report']),
+                         daemon=True).start()
+
+
+def submit_analysis_task(task_id, tasks, task_pool, TASKS_FILE, task_store=None, new_submission=True):
+    """
+    提交分析任务，相同的提交（幂等键相同，见idempotency）不重复执行：
+    - 同一提交者刚创建的重复任务（重复点击、重试）直接丢弃，返回已有的任务
+    - 其他相同提交关联到执行中的任务，该任务完成后获得同一份结果；
+      或直接使用新鲜期内已完成任务的结果并发送报告
+    - 默认只复用同一提交者的任务，开启TASK_DEDUP_CROSS_OWNER后也复用其他提交者的任务
+    - 没有可复用的任务时正常入队
+    new_submission: 任务是否刚刚创建（付款后启动的任务不会被丢弃）
+    返回: 提交者应查看的任务ID
+    """
+    task = tasks[task_id]
+    if is_dedup_enabled():
+        task['idempotency_key'] = task_idempotency_key(task)
+        owner = None if is_cross_owner_reuse_enabled() else task_owner(task)
+        source_id, reuse = find_reusable_task(tasks, task['idempotency_key'], exclude=task_id, owner=owner)
+        if source_id is not None:
+            source = tasks[source_id]
+            if new_submission and task_owner(source) == task_owner(task):
+                print(f"重复提交，使用已有任务 {source_id}")
+                tasks.pop(task_id)
+                save_tasks(tasks=tasks, tasks_file=TASKS_FILE)
+                return source_id
+            if reuse == REUSE_CACHED:
+                print(f"任务 {task_id} 使用已完成任务 {source_id} 的结果")
+                copy_task_result(task, source, source_id)
+                save_tasks(tasks=tasks, tasks_file=TASKS_FILE)
+                _send_reused_report(task_id, task)
+                return task_id
+            print(f"任务 {task_id} 关联到执行中的相同任务 {source_id}")
+            task['attached_to'] = source_id
+            save_tasks(tasks=tasks, tasks_file=TASKS_FILE)
+            return task_id
+    enqueue_analysis_task(task_id, tasks, task_pool, task_store=task_store)
+    return task_id
+
+
+def settle_attached_tasks(tasks, task_pool, TASKS_FILE, task_store=None, source_ids=None):
+    """
+    处理关联到其他任务的提交：关联的任务完成时复制其结果并发送报告，失败或被中止时改为单独入队执行
+    source_ids: 只处理关联到这些任务的提交，为None时处理全部
+    返回: 已处理的任务ID列表
+    """
+    settled = []
+    for task_id, task in list(tasks.items()):
+        source_id = task.get('attached_to')
+        if not source_id or task.get('status') not in IN_FLIGHT_STATUSES:
+            continue
+        if source_ids is not None and source_id not in source_ids:
+            continue
+        source = tasks.get(source_id)
+        if source is not None and source.get('status') == 'completed':
+            copy_task_result(task, source, source_id)
+            _send_reused_report(task_id, task)
+        elif source is None or source.get('status') in UNFINISHED_STATUSES:
+            print(f"关联的任务 {source_id} 没有完成，任务 {task_id} 改为单独执行")
+            task.pop('attached_to')
+            task['status'] = 'pending'
+        else:
+            continue
+        settled.append(task_id)
+    if settled:
+        save_tasks(tasks=tasks, tasks_file=TASKS_FILE)
+        for task_id in settled:
+            if tasks[task_id]['status'] == 'pending':
+                enqueue_analysis_task(task_id, tasks, task_pool, task_store=task_store)
+    return settled
+
+
+def resume_interrupted_tasks(tasks, task_pool, TASKS_FILE, task_store=None):
+    """
+    服务启动时重新排队上次进程退出时未完成的任务，已完成的画像和模拟单元从检查点恢复
+    仍在队列中的任务保留原来的排队位置，仍由工作进程执行中的任务不受影响
+    返回: 重新排队的任务ID列表
+    """
+    resumed = []
+    for task_id, task in tasks.items():
+        if task.get('status') not in INTERRUPTED_TASK_STATUSES or task.get('attached_to'):
+            # 关联到其他任务的提交由settle_attached_tasks处理
+            continue
+        job = task_pool.queue.position(task_id)
+        if job and job['state'] == JOB_RUNNING:
+            continue
+        resumed.append(task_id)
+    for task_id in resumed:
+        task = tasks[task_id]
+        task['status'] = 'pending'
+        task.pop('error', None)
+        task['resume_count'] = task.get('resume_count', 0) + 1
+        print(f"恢复未完成的任务: {task_id}")
+    if resumed:
+        save_tasks(tasks=tasks, tasks_file=TASKS_FILE)
+        for task_id in resumed:
+            enqueue_analysis_task(task_id, tasks, task_pool, task_store=task_store)
+    return resumed
@@ -0,0 +1,220 @@
+import math
+import os
+import threading
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+# 跟踪置信区间的比例类指标
+TRACKED_METRICS = ("would_try", "would_buy", "is_must_have", "would_recommend")
+
+# 置信区间的目标宽度（上下限之差），所有跟踪的区间都不超过该宽度时提前停止
+DEFAULT_ADAPTIVE_CI_WIDTH = float(os.getenv("SIMULATION_ADAPTIVE_CI_WIDTH", "0.2"))
+# 置信水平对应的z值（1.96 ≈ 95%）
+DEFAULT_ADAPTIVE_Z = float(os.getenv("SIMULATION_ADAPTIVE_Z", "1.96"))
+# user_type分群至少包含多少个画像才单独跟踪其置信区间，画像过少的分群无法靠追加模拟收敛
+DEFAULT_ADAPTIVE_MIN_SEGMENT_PERSONAS = int(os.getenv("SIMULATION_ADAPTIVE_MIN_SEGMENT_PERSONAS", "5"))
+
+
+def is_adaptive_mode_default() -> bool:
+    """
+    未在任务中指定时是否默认启用自适应模拟（SIMULATION_ADAPTIVE_MODE）
+    """
+    return os.getenv("SIMULATION_ADAPTIVE_MODE", "0").strip().lower() in ("1", "true", "yes", "on")
+
+
+def wilson_interval(successes: int, n: int, z: float = DEFAULT_ADAPTIVE_Z):
+    """
+    比例的Wilson置信区间，样本较少或比例接近0/1时比正态近似更稳定
+    返回: (下限, 上限)，n为0时返回(0, 1)
+    """
+    if n <= 0:
+        return 0.0, 1.0
+    p = successes / n
+    denominator = 1 + z * z / n
+    center = (p + z * z / (2 * n)) / denominator
+    margin = z * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / denominator
+    return max(0.0, center - margin), min(1.0, center + margin)
+
+
+class SequentialSampler:
+    """
+    模拟的序贯抽样
+    - 每个画像先完成一次模拟（保证覆盖全部画像），之后追加的模拟按需分配
+    - 对整体和每个user_type分群的各比例指标维护Wilson置信区间
+    - 追加的模拟优先分配给尚未收敛的分群中结果分歧最大（方差最高）的画像
+    - 所有跟踪的置信区间宽度都不超过目标宽度时停止追加
+    - 总模拟次数不超过 画像数 × 模拟次数 的预算，单个画像不超过max_per_persona次
+    """
+
+    def __init__(self, personas: List[Dict], num_simulations: int, max_per_persona: Optional[int] = None,
+                 target_width: float = DEFAULT_ADAPTIVE_CI_WIDTH, z: float = DEFAULT_ADAPTIVE_Z,
+                 min_segment_personas: int = DEFAULT_ADAPTIVE_MIN_SEGMENT_PERSONAS):
+        """
+        personas: 用户画像列表（序号与模拟任务中的画像序号一致）
+        num_simulations: 每个画像的平均模拟次数，决定总预算
+        max_per_persona: 单个画像最多模拟的次数，默认为num_simulations的两倍
+        target_width: 置信区间的目标宽度
+        z: 置信水平对应的z值
+        min_segment_personas: 单独跟踪的user_type分群的最少画像数
+        """
+        self.num_simulations = num_simulations
+        self.max_per_persona = max_per_persona or max(num_simulations * 2, 1)
+        self.budget = len(personas) * num_simulations
+        self.target_width = target_width
+        self.z = z
+        self.segments = {
+            index: (persona.get("user_type", "未知") if isinstance(persona, dict) else "未知")
+            for index, persona in enumerate(personas)
+        }
+        segment_sizes = defaultdict(int)
+        for segment in self.segments.values():
+            segment_sizes[segment] += 1
+        self.tracked_segments = sorted(s for s, size in segment_sizes.items() if size >= min_segment_personas)
+        self.untracked_segments = sorted(s for s, size in segment_sizes.items() if size < min_segment_personas)
+        # 范围（"overall"或分群名）-> 指标 -> [成功数, 样本数]
+        self.counts = defaultdict(lambda: {metric: [0, 0] for metric in TRACKED_METRICS})
+        # 画像序号 -> 指标 -> [成功数, 样本数]
+        self.persona_counts = defaultdict(lambda: {metric: [0, 0] for metric in TRACKED_METRICS})
+        # 画像序号 -> 已分配（包括执行中）的模拟次数
+        self.assigned = defaultdict(int)
+        self.recorded = 0
+        self.lock = threading.Lock()
+
+    def exclude(self, index: int) -> None:
+        """
+        排除无法模拟的画像（例如画像数据无效），不再为其分配模拟
+        """
+        with self.lock:
+            self.segments.pop(index, None)
+
+    def assign(self, index: int) -> None:
+        """
+        登记为画像分配了一次模拟（首轮模拟或从检查点恢复的模拟）
+        """
+        with self.lock:
+            self.assigned[index] += 1
+
+    def record(self, index: int, result: Dict) -> None:
+        """
+        记录一次完成的模拟结果，出错的结果不计入统计
+        """
+        if not isinstance(result, dict) or "error" in result:
+            return
+        with self.lock:
+            self.recorded += 1
+            scopes = ["overall", self.segments.get(index, "未知")]
+            for metric in TRACKED_METRICS:
+                value = result.get(metric)
+                if not isinstance(value, bool):
+                    continue
+                for scope in scopes:
+                    self.counts[scope][metric][0] += int(value)
+                    self.counts[scope][metric][1] += 1
+                self.persona_counts[index][metric][0] += int(value)
+                self.persona_counts[index][metric][1] += 1
+
+    def _interval(self, scope, metric):
+        successes, n = self.counts[scope][metric]
+        low, high = wilson_interval(successes, n, self.z)
+        return {
+            "p": round(successes / n, 3) if n else None,
+            "low": round(low, 3),
+            "high": round(high, 3),
+            "width": round(high - low, 3),
+            "n": n,
+        }
+
+    def _open_scopes(self):
+        """
+        置信区间仍宽于目标宽度的范围，调用方需持有锁
+        """
+        open_scopes = set()
+        for scope in ["overall"] + self.tracked_segments:
+            for metric in TRACKED_METRICS:
+                if self._interval(scope, metric)["width"] > self.target_width:
+                    open_scopes.add(scope)
+                    break
+        return open_scopes
+
+    def converged(self) -> bool:
+        with self.lock:
+            return not self._open_scopes()
+
+    def remaining_budget(self) -> int:
+        with self.lock:
+            return self.budget - sum(self.assigned.values())
+
+    def _persona_variance(self, index):
+        """
+        画像结果的方差估计：各指标p(1-p)的平均值，样本少时向所属分群的方差收缩
+        """
+        segment = self.segments.get(index, "未知")
+        segment_variance = sum(
+            (s / n) * (1 - s / n) if n else 0.25
+            for s, n in self.counts[segment].values()
+        ) / len(TRACKED_METRICS)
+        samples = max((n for _, n in self.persona_counts[index].values()), default=0)
+        if samples < 2:
+            return segment_variance
+        persona_variance = sum(
+            (s / n) * (1 - s / n) if n else 0.0
+            for s, n in self.persona_counts[index].values()
+        ) / len(TRACKED_METRICS)
+        return (samples * persona_variance + segment_variance) / (samples + 1)
+
+    def next_personas(self, count: int) -> List[int]:
+        """
+        选择接下来追加模拟的画像并登记分配
+        收敛或预算用尽时返回空列表；只在尚未收敛的范围内选择，未跟踪的分群只服务于整体区间
+        返回: 画像序号列表（同一画像可能出现多次）
+        """
+        selected = []
+        with self.lock:
+            open_scopes = self._open_scopes()
+            if not open_scopes:
+                return selected
+            for _ in range(count):
+                if sum(self.assigned.values()) >= self.budget:
+                    break
+                candidates = [
+                    index for index, segment in self.segments.items()
+                    if self.assigned[index] < self.max_per_persona
+                    and ("overall" in open_scopes or segment in open_scopes)
+                ]
+                if not candidates:
+                    break
+                # 追加一次模拟对均值方差的期望降幅约为 方差/(n(n+1))，优先分配给降幅最大的画像
+                index = max(candidates, key=lambda i: self._persona_variance(i) /
+                            (max(1, self.assigned[i]) * (self.assigned[i] + 1)))
+                self.assigned[index] += 1
+                selected.append(index)
+        return selected
+
+    def summary(self, executed_units: int, calls_per_unit: Optional[int] = None) -> Dict:
+        """
+        汇总自适应模拟的结果：各范围的置信区间、是否收敛以及相对完整预算节省的模拟次数
+        executed_units: 实际执行（包括从检查点恢复）的模拟单元数
+        calls_per_unit: 每个模拟单元的模型调用次数，用于估算节省的调用
+        """
+        with self.lock:
+            open_scopes = self._open_scopes()
+            intervals = {
+                scope: {metric: self._interval(scope, metric) for metric in TRACKED_METRICS}
+                for scope in ["overall"] + self.tracked_segments
+            }
+        saved_units = max(0, self.budget - executed_units)
+        summary = {
+            "target_width": self.target_width,
+            "converged": not open_scopes,
+            "unconverged_scopes": sorted(open_scopes),
+            "untracked_segments": self.untracked_segments,
+            "budget_units": self.budget,
+            "executed_units": executed_units,
+            "saved_units": saved_units,
+            "saved_ratio": round(saved_units / self.budget, 3) if self.budget else 0,
+            "max_per_persona": self.max_per_persona,
+            "intervals": intervals,
+        }
+        if calls_per_unit:
+            summary["saved_calls"] = saved_units * calls_per_unit
+        return summary
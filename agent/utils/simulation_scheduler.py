@@ -0,0 +1,245 @@
+import os
+import time
+import threading
+import concurrent.futures
+from collections import Counter, OrderedDict, deque
+
+from models import get_model_pool_concurrency
+from .cancellation import (
+    TaskCancelled,
+    bind_cancellation,
+    cancellable_sleep,
+    cancellation_scope,
+    current_cancellation_token,
+)
+
+# 全局模拟调度器的最大工作线程数（所有任务共享）
+DEFAULT_SIMULATION_WORKERS_CAP = int(os.getenv("SIMULATION_MAX_WORKERS", "32"))
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_simulation_scheduler(model_pool=None):
+    """
+    获取进程内共享的模拟调度器，首次调用时根据模型池的并发能力确定线程数
+    model_pool: 模型池
+    """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            max_workers = get_model_pool_concurrency(model_pool, cap=DEFAULT_SIMULATION_WORKERS_CAP)
+            _scheduler = SimulationScheduler(max_workers)
+        return _scheduler
+
+
+class SlotExecutor(concurrent.futures.Executor):
+    """
+    与工作单元共享并发槽位的阶段线程池
+    单元执行期间占用一个槽位，单元内部的并行阶段只在有空闲槽位时交给线程池，
+    否则在提交的线程中直接执行，实际并发的模型调用数不超过槽位数
+    """
+
+    def __init__(self, slots: threading.Semaphore, max_workers: int, thread_name_prefix: str = ""):
+        """
+        slots: 与工作单元共享的槽位
+        max_workers: 线程池大小（线程数不限制并发，并发由槽位限制）
+        """
+        self.slots = slots
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers,
+                                                              thread_name_prefix=thread_name_prefix)
+
+    def submit(self, fn, *args, **kwargs):
+        if self.slots.acquire(blocking=False):
+            try:
+                future = self.executor.submit(fn, *args, **kwargs)
+            except BaseException:
+                self.slots.release()
+                raise
+            future.add_done_callback(lambda _: self.slots.release())
+            return future
+        future = concurrent.futures.Future()
+        future.set_running_or_notify_cancel()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+    def shutdown(self, wait=True, **kwargs):
+        self.executor.shutdown(wait=wait, **kwargs)
+
+
+class SimulationScheduler:
+    """
+    任务级的模拟工作单元调度器
+    - 所有任务的 (画像, 模拟次数) 工作单元进入同一个有界线程池
+    - 任意工作线程空闲时立即领取下一个单元，不再按画像串行等待
+    - 多个任务同时运行时，优先调度正在运行单元最少的任务，保证公平
+    - 同一任务内部按提交顺序执行
+    - 单元和单元内部的并行阶段共享max_workers个槽位，实际并发调用数不超过max_workers
+    """
+
+    def __init__(self, max_workers):
+        """
+        max_workers: 工作线程数，通常等于模型提供商允许的并发请求数
+        """
+        self.max_workers = max(1, int(max_workers))
+        self.condition = threading.Condition()
+        # 任务ID -> 待执行单元队列，OrderedDict的顺序用于同等条件下的轮转
+        self.queues = OrderedDict()
+        self.running = Counter()
+        self.workers = []
+        # 单元执行期间占用一个槽位；单元内部可以并行的阶段（见run_stage_graph）使用空闲的槽位，不占用调度队列
+        self.slots = threading.Semaphore(self.max_workers)
+        self.stage_executor = SlotExecutor(self.slots, self.max_workers, thread_name_prefix="simulation-stage")
+
+    def _ensure_workers(self):
+        while len(self.workers) < self.max_workers:
+            worker = threading.Thread(target=self._worker_loop, daemon=True,
+                                      name=f"simulation-worker-{len(self.workers) + 1}")
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, task_id, fn, *args, **kwargs):
+        """
+        提交一个工作单元
+        task_id: 所属任务ID，用于公平调度和取消
+        fn: 执行函数
+        返回: concurrent.futures.Future
+        提交时所在任务的取消令牌随单元一起传给工作线程，任务取消后尚未开始的单元直接以TaskCancelled结束
+        """
+        future = concurrent.futures.Future()
+        token = current_cancellation_token()
+        with self.condition:
+            self._ensure_workers()
+            self.queues.setdefault(task_id, deque()).append((future, fn, args, kwargs, token))
+            self.condition.notify()
+        return future
+
+    def cancel_task(self, task_id):
+        """
+        取消任务中尚未开始的全部单元，正在执行的单元会继续运行到结束
+        返回: 被取消的单元数量
+        """
+        with self.condition:
+            queue = self.queues.pop(task_id, None)
+        cancelled = 0
+        for future, _, _, _, _ in queue or []:
+            if future.cancel():
+                cancelled += 1
+        return cancelled
+
+    def pending_count(self, task_id=None):
+        with self.condition:
+            if task_id is None:
+                return sum(len(q) for q in self.queues.values())
+            return len(self.queues.get(task_id, ()))
+
+    def _next_unit(self):
+        """
+        选出正在运行单元最少的任务并弹出其下一个单元，调用方需持有锁
+        """
+        task_id = min(self.queues, key=lambda t: self.running[t])
+        queue = self.queues.pop(task_id)
+        unit = queue.popleft()
+        # 被调度的任务移到末尾，同等条件下其他任务优先
+        if queue:
+            self.queues[task_id] = queue
+        self.running[task_id] += 1
+        return task_id, unit
+
+    def _worker_loop(self):
+        while True:
+            with self.condition:
+                while not self.queues:
+                    self.condition.wait()
+                task_id, (future, fn, args, kwargs, token) = self._next_unit()
+            # 并行阶段占用的槽位释放后再开始执行
+            self.slots.acquire()
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        if token is not None:
+                            token.raise_if_cancelled()
+                        with cancellation_scope(token):
+                            future.set_result(fn(*args, **kwargs))
+                    except BaseException as e:
+                        future.set_exception(e)
+            finally:
+                self.slots.release()
+                with self.condition:
+                    self.running[task_id] -= 1
+                    if self.running[task_id] <= 0:
+                        del self.running[task_id]
+
+
+def run_stage_graph(stages, executor=None, outputs=None, max_attempts=1, on_stage_failure=None, call_counter=None):
+    """
+    按依赖关系执行一组阶段（有向无环图），互不依赖的阶段并行执行
+    当前线程执行一个就绪阶段，其余就绪阶段提交到executor；未提供executor时按顺序执行
+    单个阶段失败时只重试该阶段，已完成阶段的输出保留在outputs中，再次调用时直接跳过
+    stages: {阶段名: (依赖的阶段名元组, fn(outputs) -> 阶段输出)}，字典顺序即顺序执行时的顺序
+    executor: 用于并行阶段的线程池
+    outputs: 已完成阶段的输出，会被原地更新
+    max_attempts: 每个阶段最多尝试的次数
+    on_stage_failure: 阶段某次尝试失败时的回调 on_stage_failure(阶段名, 第几次尝试, 异常, 该次尝试发出的调用数)
+    call_counter: 返回当前线程累计调用数的函数（见model_call_count），用于统计失败尝试的调用数，
+                  未提供时每次失败的尝试计为一次调用
+    返回: (各阶段输出, 本次执行的各阶段耗时秒数)
+    """
+    outputs = {} if outputs is None else outputs
+    timings = {}
+    remaining = {name: stage for name, stage in stages.items() if name not in outputs}
+    running = {}
+
+    def run_stage(name, fn):
+        start = time.time()
+        for attempt in range(1, max_attempts + 1):
+            calls_before = call_counter() if call_counter else 0
+            try:
+                return fn(outputs), time.time() - start
+            except TaskCancelled:
+                raise
+            except Exception as e:
+                if on_stage_failure:
+                    on_stage_failure(name, attempt, e, call_counter() - calls_before if call_counter else 1)
+                if attempt >= max_attempts:
+                    raise
+                print(f"阶段 {name} 失败 (尝试 {attempt}/{max_attempts})，仅重试该阶段: {str(e)}")
+                cancellable_sleep(1)
+
+    def finish(name, value, seconds):
+        outputs[name] = value
+        timings[name] = round(seconds, 3)
+
+    while remaining or running:
+        ready = [name for name, (deps, _) in remaining.items() if all(d in outputs for d in deps)]
+        if not ready and not running:
+            raise ValueError(f"阶段依赖无法满足: {list(remaining)}")
+
+        if executor is None:
+            for name in ready:
+                finish(name, *run_stage(name, remaining.pop(name)[1]))
+            continue
+
+        for name in ready[1:]:
+            running[executor.submit(bind_cancellation(run_stage), name, remaining.pop(name)[1])] = name
+        try:
+            if ready:
+                name = ready[0]
+                finish(name, *run_stage(name, remaining.pop(name)[1]))
+                done = [future for future in running if future.done()]
+            else:
+                done, _ = concurrent.futures.wait(list(running), return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                finish(running.pop(future), *future.result())
+        except Exception:
+            # 等待并行中的阶段结束，保留其成功的输出供下次调用复用
+            for future in concurrent.futures.as_completed(list(running)):
+                name = running.pop(future)
+                if future.exception() is None:
+                    finish(name, *future.result())
+            raise
+
+    return outputs, timings
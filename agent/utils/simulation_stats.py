@@ -0,0 +1,141 @@
+import threading
+from collections import Counter
+from typing import Dict, Iterable, Optional
+
+# 统计的比例类指标及其在stats中的字段名
+PERCENTAGE_METRICS = {
+    'would_try': 'would_try_percentage',
+    'would_buy': 'would_buy_percentage',
+    'is_must_have': 'must_have_percentage',
+    'would_recommend': 'would_recommend_percentage',
+}
+# 依赖程度的取值（stats中固定按此顺序输出）
+DEPENDENCY_LEVELS = ("痛苦", "可以接受", "无所谓")
+# 按取值计数的分类字段
+CATEGORY_FIELDS = ('user_type', 'usage_frequency', 'location', 'dependency_level')
+# 不计入采用障碍关键词的取值
+IGNORED_BARRIERS = ("未提供", "模拟出错")
+TOP_BARRIERS = 5
+
+# 模拟结果中缺少该字段（与字段值为None区分，两者在stats和报告中的处理不同）
+_MISSING = object()
+
+
+class SimulationStatsAggregator:
+    """
+    模拟结果的单遍流式统计
+    - 每个计入最终结果的模拟完成时调用add，只更新计数，与已有结果的数量无关
+    - stats() 随时生成与完整扫描全部结果相同的stats（任务进行中用于实时展示，结束后直接作为最终统计）
+    - report_view() 生成报告所需的汇总数据，报告不必再用pandas重新统计
+    分类字段保留原始取值的计数，stats和报告对缺失值、空值的不同处理在输出时分别映射
+    """
+
+    def __init__(self, total_personas: int = 0):
+        """
+        total_personas: 画像总数，写入stats的total_personas
+        """
+        self.total_personas = total_personas
+        self.lock = threading.Lock()
+        self.total = 0
+        # 指标 -> 值为True的次数（stats按 == True 计数）
+        self.true_counts = Counter()
+        # 指标 -> 值为真值的次数（报告按bool转换计数）
+        self.truthy_counts = Counter()
+        # 字段 -> 原始取值 -> 次数，Counter保持首次出现的顺序
+        self.categories = {field: Counter() for field in CATEGORY_FIELDS}
+        self.barrier_keywords = Counter()
+
+    @classmethod
+    def from_results(cls, results: Iterable[Dict], total_personas: int = 0):
+        aggregator = cls(total_personas)
+        for result in results:
+            aggregator.add(result)
+        return aggregator
+
+    def add(self, sim: Dict) -> None:
+        """
+        计入一个模拟结果
+        """
+        keywords = []
+        barrier = sim.get('barrier_to_adoption', '')
+        if barrier and barrier not in IGNORED_BARRIERS:
+            # 简单分词
+            keywords = [k.strip() for k in barrier.replace('，', ',').split(',')]
+            keywords = [k for k in keywords if k and len(k) > 1]
+        with self.lock:
+            self.total += 1
+            for metric in PERCENTAGE_METRICS:
+                value = sim.get(metric)
+                if value == True:
+                    self.true_counts[metric] += 1
+                if value is not None and bool(value):
+                    self.truthy_counts[metric] += 1
+            for field in CATEGORY_FIELDS:
+                self.categories[field][sim.get(field, _MISSING)] += 1
+            self.barrier_keywords.update(keywords)
+
+    @staticmethod
+    def _mapped_counts(counter, missing, none):
+        """
+        把原始取值的计数映射为输出用的计数：缺少字段记为missing，值为None记为none，保持首次出现的顺序
+        """
+        counts = {}
+        for value, count in counter.items():
+            key = missing if value is _MISSING else none if value is None else value
+            counts[key] = counts.get(key, 0) + count
+        return counts
+
+    def stats(self, total_personas: Optional[int] = None) -> Dict:
+        """
+        任务的stats（与run_analysis_task原先逐项扫描全部结果得到的结构和数值一致），没有结果时为空字典
+        total_personas: 画像总数，默认使用创建时的值
+        """
+        with self.lock:
+            total = self.total
+            if not total:
+                return {}
+            true_counts = dict(self.true_counts)
+            categories = {field: Counter(counter) for field, counter in self.categories.items()}
+            top_barriers = self.barrier_keywords.most_common(TOP_BARRIERS)
+
+        def percentages(counts):
+            return {key: round(value / total * 100, 1) for key, value in counts.items()}
+
+        # 缺少字段和值为None都计为'未知'（依赖程度只统计三个有效取值）
+        dependency = categories['dependency_level']
+        stats = {
+            name: round(true_counts.get(metric, 0) / total * 100, 1)
+            for metric, name in PERCENTAGE_METRICS.items()
+        }
+        stats.update({
+            'dependency_percentages': percentages({level: dependency.get(level, 0) for level in DEPENDENCY_LEVELS}),
+            'user_type_percentages': percentages(self._mapped_counts(categories['user_type'], '未知', None)),
+            'usage_frequency_percentages': percentages(self._mapped_counts(categories['usage_frequency'], '未知', None)),
+            'location_percentages': percentages(self._mapped_counts(categories['location'], '未知', None)),
+            'top_barriers': dict(top_barriers),
+            'total_personas': self.total_personas if total_personas is None else total_personas,
+            'total_simulations': total,
+        })
+        return stats
+
+    def report_view(self) -> Dict:
+        """
+        报告使用的汇总数据（与报告原先用pandas对清理后的模拟结果统计的数值和顺序一致）：
+        报告清理结果时缺少的字段取空字符串，值为None的字段按各自的默认值填充；各分布按次数从多到少排列
+        """
+        with self.lock:
+            total = self.total
+            truthy_counts = dict(self.truthy_counts)
+            categories = {field: Counter(counter) for field, counter in self.categories.items()}
+
+        def ranked(counts):
+            return dict(Counter(counts).most_common())
+
+        return {
+            'total': total,
+            'user_types': ranked(self._mapped_counts(categories['user_type'], '', '未知')),
+            'must_have_percentage': truthy_counts.get('is_must_have', 0) / total * 100 if total else 0,
+            'would_recommend_percentage': truthy_counts.get('would_recommend', 0) / total * 100 if total else 0,
+            'dependency_counts': ranked(self._mapped_counts(categories['dependency_level'], '', '无所谓')),
+            'frequency_counts': ranked(self._mapped_counts(categories['usage_frequency'], '', '未知')),
+        }
@@ -2,6 +2,7 @@ import sys
 sys.path.append("..")
 
 import concurrent.futures
+import os
 import random
 import time
 import uuid
@@ -10,12 +11,41 @@ from .generate_utils import (
     create_error_result,
     clean_persona_data,
     process_simulation_result,
-    fill_missing_results
+    fill_missing_results,
+    estimate_tokens
 )
-from .api_utils import call_ai_api
+from .api_utils import call_ai_api, model_call_count
+from .cancellation import TaskCancelled, bind_cancellation
+from .simulation_scheduler import get_simulation_scheduler, run_stage_graph
+from .pipeline_profiles import get_pipeline_profile
 from agent.prompt_template import *
 
-def _inject_web_context(messages, web_context: str):
+def is_throughput_mode_default() -> bool:
+    """
+    未在任务中指定时是否默认启用吞吐模式（SIMULATION_THROUGHPUT_MODE）
+    """
+    return os.getenv("SIMULATION_THROUGHPUT_MODE", "0").strip().lower() in ("1", "true", "yes", "on")
+
+# 吞吐模式下每次调用最多打包的画像数量
+THROUGHPUT_MAX_PERSONAS_PER_CALL = 8
+# 单个画像的模拟反应JSON大约占用的输出token数
+REACTION_OUTPUT_TOKENS = 700
+# call_ai_api请求中固定的max_tokens
+API_MAX_OUTPUT_TOKENS = 4096
+
+# 单个模拟阶段失败时最多尝试的次数（只重试失败的阶段）
+STAGE_MAX_ATTEMPTS = 2
+# 单个模拟单元（画像×模拟次数）最多执行的轮数，重新执行时复用已完成阶段的输出
+UNIT_MAX_ATTEMPTS = 3
+
+def _inject_web_context(messages, web_context, stage=None):
+    """
+    插入网络搜索上下文
+    web_context: 字符串，或按阶段压缩的WebEvidence（按stage取对应预算的证据块并记录注入的token数）
+    stage: 模拟阶段名（initial / inquiry / refined / ad_copy / optimized_product）
+    """
+    if hasattr(web_context, "for_stage"):
+        web_context = web_context.for_stage(stage)
     if web_context:
         # Insert early so the model can use it as evidence.
         messages = list(messages)
@@ -23,14 +53,7 @@ def _inject_web_context(messages, web_context: str):
     return messages
 
 
-def simulate_initial_reaction(persona, product_desc,
-                              model_name, model_pool=None, web_context: str = ""):
-    """进行初步的用户反应模拟
-    persona: 用户画像
-    product_desc: 产品描述
-    model_name: 模型名称
-    model_pool: 模型池
-    """
+def _initial_reaction_messages(persona, product_desc, web_context: str = ""):
     messages = [
         {"role": "system", "content": simulation_system_prompt},
         {"role": "user", "content": f"""
@@ -43,21 +66,57 @@ def simulate_initial_reaction(persona, product_desc,
 请完全从上述用户画像描述的人的角度，评估这个产品对你的价值和吸引力。
         """}
     ]
-    
-    messages = _inject_web_context(messages, web_context)
-    response = call_ai_api(messages, response_format="json_object",
-                           model_name=model_name, model_pool=model_pool)
-    
+    return _inject_web_context(messages, web_context, "initial")
+
+def _parse_initial_reaction(response):
     # 清理可能存在的不必要前缀或后缀
     if "```json" in response:
         response = response.split("```json")[1].split("```")[0].strip()
     
     try:
         result = json.loads(response)
-        return result
     except json.JSONDecodeError:
         print(f"JSON解析错误，响应内容: {response[:100]}...")
         raise ValueError("无法解析初步模拟的JSON响应")
+    # call_ai_api在请求或解析失败时返回空对象，视为失败以便只重试该阶段
+    if not result or not isinstance(result, dict):
+        raise ValueError("初步模拟返回了空的JSON响应")
+    return result
+
+def simulate_initial_reaction(persona, product_desc,
+                              model_name, model_pool=None, web_context: str = ""):
+    """进行初步的用户反应模拟
+    persona: 用户画像
+    product_desc: 产品描述
+    model_name: 模型名称
+    model_pool: 模型池
+    """
+    messages = _initial_reaction_messages(persona, product_desc, web_context)
+    response = call_ai_api(messages, response_format="json_object",
+                           model_name=model_name, model_pool=model_pool)
+    return _parse_initial_reaction(response)
+
+def simulate_initial_reactions_sampled(persona, product_desc, n,
+                                       model_name, model_pool=None, web_context: str = ""):
+    """
+    一次调用用n采样得到同一画像的多个独立初步反应（模型需支持n参数）
+    persona: 用户画像
+    product_desc: 产品描述
+    n: 采样数量
+    model_name: 模型名称
+    model_pool: 模型池
+    返回: 可用的初步模拟结果列表，可能少于n个
+    """
+    messages = _initial_reaction_messages(persona, product_desc, web_context)
+    responses = call_ai_api(messages, response_format="json_object",
+                            model_name=model_name, model_pool=model_pool, n=n)
+    results = []
+    for response in responses if isinstance(responses, list) else []:
+        try:
+            results.append(_parse_initial_reaction(response))
+        except ValueError:
+            continue
+    return results
 
 def generate_inquiry_questions(persona, product_desc, initial_result,
                                model_name, model_pool=None, web_context: str = ""):
@@ -86,7 +145,7 @@ def generate_inquiry_questions(persona, product_desc, initial_result,
         """}
     ]
     
-    messages = _inject_web_context(messages, web_context)
+    messages = _inject_web_context(messages, web_context, "inquiry")
     response = call_ai_api(messages, response_format="json_object",
                            model_name=model_name, model_pool=model_pool)
     
@@ -137,7 +196,7 @@ def simulate_refined_reaction(persona, product_desc, initial_result,
         """}
     ]
     
-    messages = _inject_web_context(messages, web_context)
+    messages = _inject_web_context(messages, web_context, "refined")
     response = call_ai_api(messages, response_format="json_object",
                             model_name=model_name, model_pool=model_pool)
     
@@ -147,13 +206,17 @@ def simulate_refined_reaction(persona, product_desc, initial_result,
     
     try:
         result = json.loads(response)
-        return result
     except json.JSONDecodeError:
         print(f"JSON解析错误，响应内容: {response[:100]}...")
         print("返回初步模拟结果作为备选")
         return initial_result
+    if not result or not isinstance(result, dict):
+        print("深入模拟返回了空结果，返回初步模拟结果作为备选")
+        return initial_result
+    return result
 
-def generate_ad_copy(persona, product_desc, user_feedback, model_name, model_pool=None, web_context: str = ""):
+def generate_ad_copy(persona, product_desc, user_feedback, model_name, model_pool=None, web_context: str = "",
+                     review=True):
     """
     生成针对用户痛点的广告文案
     persona: 用户画像
@@ -161,6 +224,7 @@ def generate_ad_copy(persona, product_desc, user_feedback, model_name, model_poo
     user_feedback: 用户反馈
     model_name: 模型名称
     model_pool: 模型池
+    review: 是否评审并改进初始广告文案
     """
     # 第一步：生成初始广告文案
     messages = [
@@ -179,7 +243,7 @@ def generate_ad_copy(persona, product_desc, user_feedback, model_name, model_poo
         """}
     ]
     
-    messages = _inject_web_context(messages, web_context)
+    messages = _inject_web_context(messages, web_context, "ad_copy")
     initial_ad = call_ai_api(messages, response_format="json_object",
                              model_name=model_name, model_pool=model_pool)
     try:
@@ -194,6 +258,9 @@ def generate_ad_copy(persona, product_desc, user_feedback, model_name, model_poo
             "controversial_point": "",
             "discussion_angle": ""
         }
+
+    if not review:
+        return initial_ad
     
     # 第二步：获取评审问题
     messages = [
@@ -215,7 +282,7 @@ def generate_ad_copy(persona, product_desc, user_feedback, model_name, model_poo
         """}
     ]
     
-    messages = _inject_web_context(messages, web_context)
+    messages = _inject_web_context(messages, web_context, "ad_copy")
     review_questions = call_ai_api(messages, response_format="json_object",
                                     model_name=model_name, model_pool=model_pool)
     try:
@@ -252,7 +319,7 @@ def generate_ad_copy(persona, product_desc, user_feedback, model_name, model_poo
             """}
         ]
         
-        messages = _inject_web_context(messages, web_context)
+        messages = _inject_web_context(messages, web_context, "ad_copy")
         improved_ad = call_ai_api(messages, response_format="json_object",
                                    model_name=model_name, model_pool=model_pool)
         try:
@@ -289,7 +356,7 @@ def optimize_product_description(persona, product_desc, user_feedback,
         """}
     ]
     
-    messages = _inject_web_context(messages, web_context)
+    messages = _inject_web_context(messages, web_context, "optimized_product")
     response = call_ai_api(messages, response_format="json_object",
                            model_name=model_name, model_pool=model_pool)
     try:
@@ -303,188 +370,454 @@ def optimize_product_description(persona, product_desc, user_feedback,
             "implementation_priority": "中"
         }
 
-# 模拟用户对产品的反应              
-def simulate_user_reactions(task_id, product_desc, persona, num_simulations, model_pool=None, web_context: str = ""):
+def _format_personas_for_batch(personas_by_id):
+    return "\n\n".join(
+        f"画像ID {persona_id}：\n{persona['persona_description']}"
+        for persona_id, persona in personas_by_id.items()
+    )
+
+def _parse_batch_reactions(response, expected_ids):
     """
-    对单个用户画像进行多次模拟，获取用户反应，使用并行模拟提高速度
-    task_id: 任务ID
+    解析批量模拟的响应 {"reactions": [{"persona_id", "reaction"}]}，只保留可用的元素
+    返回: {画像ID: 反应结果}
+    """
+    try:
+        result = json.loads(response)
+    except json.JSONDecodeError:
+        print(f"批量模拟JSON解析错误，响应内容: {response[:100]}...")
+        return {}
+
+    entries = result.get("reactions", []) if isinstance(result, dict) else result
+    reactions = {}
+    for entry in entries if isinstance(entries, list) else []:
+        if not isinstance(entry, dict):
+            continue
+        persona_id = str(entry.get("persona_id", ""))
+        reaction = entry.get("reaction")
+        if persona_id in expected_ids and is_usable_reaction(reaction):
+            reactions[persona_id] = reaction
+    return reactions
+
+def is_usable_reaction(reaction):
+    """
+    判断批量响应中的单个反应是否可用：必须是对象且包含核心的意愿字段和反馈
+    缺失的其他字段由process_simulation_result补齐
+    """
+    return (isinstance(reaction, dict)
+            and "would_try" in reaction
+            and bool(reaction.get("initial_impression") or reaction.get("feedback")))
+
+def simulate_initial_reactions_batch(personas_by_id, product_desc,
+                                     model_name, model_pool=None, web_context: str = ""):
+    """
+    吞吐模式：一次调用对多个用户画像进行初步模拟
+    personas_by_id: {画像ID: 用户画像}
+    product_desc: 产品描述
+    model_name: 模型名称
+    model_pool: 模型池
+    返回: {画像ID: 初步模拟结果}，缺失或不可用的画像不包含在结果中
+    """
+    messages = [
+        {"role": "system", "content": simulation_system_prompt},
+        {"role": "user", "content": f"""
+以下是{len(personas_by_id)}个互不相关的用户画像，请分别完全从每个画像描述的人的角度，独立评估这个产品对他的价值和吸引力，不要让不同画像之间互相影响。
+
+{_format_personas_for_batch(personas_by_id)}
+
+产品描述: 
+{product_desc}
+
+请返回JSON对象，每个画像的反应包含上面要求的全部字段，并附带对应的画像ID：
+{{"reactions": [{{"persona_id": "画像ID", "reaction": {{...}}}}]}}
+        """}
+    ]
+
+    messages = _inject_web_context(messages, web_context, "initial")
+    response = call_ai_api(messages, response_format="json_object",
+                           model_name=model_name, model_pool=model_pool)
+    return _parse_batch_reactions(response, personas_by_id)
+
+def simulate_refined_reactions_batch(items_by_id, product_desc,
+                                     model_name, model_pool=None, web_context: str = ""):
+    """
+    吞吐模式：一次调用基于各自的初步结果和质疑问题对多个用户画像进行深入模拟
+    items_by_id: {画像ID: (用户画像, 初步模拟结果, 质疑问题)}，质疑问题不能为空
+    product_desc: 产品描述
+    model_name: 模型名称
+    model_pool: 模型池
+    返回: {画像ID: 深入模拟结果}，缺失或不可用的画像不包含在结果中
+    """
+    sections = []
+    for persona_id, (persona, initial_result, inquiry_questions) in items_by_id.items():
+        questions_text = "\n".join([
+            f"{i+1}. [{q.get('aspect', '深入探讨')}] {q.get('question', '')}"
+            for i, q in enumerate(inquiry_questions)
+        ])
+        sections.append(f"""画像ID {persona_id}：
+用户画像: 
+{persona['persona_description']}
+
+你的初步反应:
+{json.dumps(initial_result, ensure_ascii=False, indent=2)}
+
+深入问题:
+{questions_text}""")
+
+    messages = [
+        {"role": "system", "content": refined_system_prompt},
+        {"role": "user", "content": f"""
+以下是{len(items_by_id)}个互不相关的用户画像及其对产品的初步反应，请分别扮演每个用户，基于各自的深入问题重新思考对产品的评估，不要让不同画像之间互相影响。
+
+产品描述: 
+{product_desc}
+
+{chr(10).join(sections)}
+
+请全面思考这些问题，给出更深入、更真实的反馈。返回JSON对象，每个画像的反应包含所有必需字段，并附带对应的画像ID：
+{{"reactions": [{{"persona_id": "画像ID", "reaction": {{...}}}}]}}
+        """}
+    ]
+
+    messages = _inject_web_context(messages, web_context, "refined")
+    response = call_ai_api(messages, response_format="json_object",
+                           model_name=model_name, model_pool=model_pool)
+    return _parse_batch_reactions(response, items_by_id)
+
+def choose_simulation_pack_size(model_pool, personas, product_desc, web_context: str = ""):
+    """
+    吞吐模式下每次调用打包的画像数量K：同时满足模型池中所有模型的输出上限和上下文长度
+    model_pool: 模型池（模型配置可选context_window，默认32000）
+    personas: 待打包的用户画像
     product_desc: 产品描述
+    web_context: 网络搜索上下文
+    """
+    persona_tokens = max((estimate_tokens(p.get("persona_description", "")) for p in personas), default=0)
+    base_tokens = estimate_tokens(refined_system_prompt + product_desc + str(web_context))
+    # 深入模拟的输入包含初步反应和问题，按最坏情况估算每个画像的输入
+    per_persona_input = persona_tokens + REACTION_OUTPUT_TOKENS + 200
+
+    pack_size = THROUGHPUT_MAX_PERSONAS_PER_CALL
+    for model_data in (model_pool or {}).values():
+        config = model_data.get("config", {})
+        output_limit = min(int(config.get("max_tokens", API_MAX_OUTPUT_TOKENS)), API_MAX_OUTPUT_TOKENS)
+        context_limit = int(config.get("context_window", 32000))
+        by_output = int(output_limit * 0.8) // REACTION_OUTPUT_TOKENS
+        by_context = (context_limit - base_tokens - output_limit) // max(1, per_persona_input)
+        pack_size = min(pack_size, by_output, by_context)
+    return max(1, pack_size)
+
+def run_simulation_pack(units, product_desc, model_pool=None, web_context: str = "",
+                        stage_executor=None, on_stage_failure=None, on_pack_call=None, inquiry=True):
+    """
+    吞吐模式的一个打包单元：对K个画像合并执行初步模拟和深入模拟，质疑问题逐个并行生成
+    结果写入各单元的outputs，之后每个单元照常调度，只执行尚未完成的阶段（广告文案、产品优化及打包中缺失的阶段）
+    units: [(用户画像, 画像ID, outputs字典)]，同一个打包中的画像ID互不相同
+    on_pack_call: 每次合并调用后的回调 on_pack_call(打包画像数, 结果中缺失、需要逐个补齐的画像数)
+    inquiry: 是否执行第一轮自我质疑和深入模拟（分析深度为fast时只合并初步模拟）
+    """
+    model_name = random.choice(list(model_pool.keys()))
+    map_fn = stage_executor.map if stage_executor else map
+
+    def record(packed, fallbacks):
+        if on_pack_call:
+            on_pack_call(packed, fallbacks)
+
+    # 第一步：合并的初步模拟
+    personas_by_id = {persona_id: persona for persona, persona_id, _ in units}
+    calls_before = model_call_count()
+    try:
+        initial_results = simulate_initial_reactions_batch(personas_by_id, product_desc, model_name,
+                                                           model_pool=model_pool, web_context=web_context)
+    except TaskCancelled:
+        raise
+    except Exception as e:
+        print(f"批量初步模拟失败，回退到逐个模拟: {str(e)}")
+        initial_results = {}
+    record(len(units), len(units) - len(initial_results))
+    if not initial_results and on_stage_failure:
+        on_stage_failure("initial_pack", 1, ValueError("批量初步模拟没有可用结果"), model_call_count() - calls_before)
+    for persona, persona_id, outputs in units:
+        if persona_id in initial_results:
+            outputs["initial"] = initial_results[persona_id]
+    if not inquiry:
+        return
+
+    # 第二步：逐个生成质疑问题（并行），缺少初步结果的单元留给常规调度补齐
+    ready = [(persona, persona_id, outputs) for persona, persona_id, outputs in units if "initial" in outputs]
+
+    def inquire(unit):
+        persona, _, outputs = unit
+        try:
+            outputs["inquiry"] = generate_inquiry_questions(persona, product_desc, outputs["initial"], model_name,
+                                                            model_pool=model_pool, web_context=web_context)
+        except TaskCancelled:
+            raise
+        except Exception as e:
+            print(f"生成质疑问题失败，留给逐个模拟补齐: {str(e)}")
+
+    list(map_fn(bind_cancellation(inquire), ready))
+
+    # 第三步：合并的深入模拟；没有问题的画像与逐个模拟一样直接沿用初步结果
+    items_by_id = {}
+    for persona, persona_id, outputs in ready:
+        if "inquiry" not in outputs:
+            continue
+        if not outputs["inquiry"]:
+            outputs["refined"] = outputs["initial"]
+        else:
+            items_by_id[persona_id] = (persona, outputs["initial"], outputs["inquiry"])
+    if items_by_id:
+        try:
+            refined_results = simulate_refined_reactions_batch(items_by_id, product_desc, model_name,
+                                                               model_pool=model_pool, web_context=web_context)
+        except TaskCancelled:
+            raise
+        except Exception as e:
+            print(f"批量深入模拟失败，回退到逐个模拟: {str(e)}")
+            refined_results = {}
+        record(len(items_by_id), len(items_by_id) - len(refined_results))
+        for persona, persona_id, outputs in ready:
+            if persona_id in refined_results:
+                outputs["refined"] = refined_results[persona_id]
+
+def run_initial_sampling(persona, outputs_list, product_desc, model_name, model_pool=None,
+                         web_context: str = "", on_sampling_call=None):
+    """
+    n采样预填充：一次调用得到同一画像全部模拟的初步反应，分别写入各模拟单元的outputs
+    之后每个单元作为独立的模拟链继续执行；采样不足的单元由常规调度补齐初步模拟
     persona: 用户画像
-    num_simulations: 模拟次数
+    outputs_list: 该画像每次模拟的outputs字典
+    model_name: 支持n采样的模型
+    on_sampling_call: 回调 on_sampling_call(请求的采样数, 可用的采样数)
     """
-    # 首先确保persona是有效的字典
-    if not isinstance(persona, dict):
-        print(f"用户画像格式错误: {type(persona)}，无法进行模拟")
-        error_result = create_error_result("unknown", "用户画像格式错误", f"用户画像格式错误: {type(persona)}")
-        return [error_result for _ in range(num_simulations)]
-    
-    # 确保persona包含用户描述
-    if "persona_description" not in persona or not persona["persona_description"] or persona["persona_description"] == "未提供":
-        print(f"用户画像 {persona.get('persona_id', 'unknown')} 缺少必要字段或字段为空: persona_description，无法进行模拟")
-        error_result = create_error_result(
-            persona.get('persona_id', 'unknown'),
-            "用户画像缺少必要字段",
-            "用户画像缺少必要字段或字段为空: persona_description"
-        )
-        return [error_result for _ in range(num_simulations)]
-    
-    # 清理persona数据
-    persona = clean_persona_data(persona)
-    
-    # 获取安全的persona_id，确保它是字符串
-    persona_id = str(persona.get('persona_id', f"unknown_{random.randint(1000, 9999)}"))
-    
-    # 批次重试机制
-    max_batch_retries = 3
-    batch_retry_count = 0
-    valid_simulation_results = False
-    
-    while batch_retry_count < max_batch_retries and not valid_simulation_results:
-        if batch_retry_count > 0:
-            print(f"批次模拟失败，正在进行第 {batch_retry_count}/{max_batch_retries} 次重试...")
-            time.sleep(2)  # 重试前暂停2秒
-        
-        # 生成一个随机的唯一标识符，用于确保同一个用户画像的不同模拟实例有唯一ID
-        simulation_instance_id = str(uuid.uuid4())[:8]
-        
-        # 创建用于存储结果的列表
-        simulation_results = []
-        
-        # 创建并行执行的函数
-        def run_single_simulation(sim_index):
-            print(f"DEBUG - 开始模拟用户 {persona_id} (第 {sim_index+1}/{num_simulations} 次)")
-            
-            # 从MODEL_POOL中随机选择一个模型
-            model_name = random.choice(list(model_pool.keys()))
-            print(f"DEBUG - 使用模型: {model_name}")
-            
-            try:
-                # 第一步：初步模拟用户反应
-                initial_result = simulate_initial_reaction(
-                    persona, product_desc, model_name, model_pool=model_pool, web_context=web_context
-                )
-                print(f"DEBUG - 完成初步模拟")
-                
+    try:
+        results = simulate_initial_reactions_sampled(persona, product_desc, len(outputs_list), model_name,
+                                                     model_pool=model_pool, web_context=web_context)
+    except TaskCancelled:
+        raise
+    except Exception as e:
+        print(f"n采样初步模拟失败，回退到逐个模拟: {str(e)}")
+        results = []
+    if on_sampling_call:
+        on_sampling_call(len(outputs_list), len(results))
+    for outputs, result in zip(outputs_list, results):
+        outputs["initial"] = result
+
+def run_single_simulation(persona, persona_id, sim_index, instance_id, product_desc,
+                          model_pool=None, web_context: str = "", stage_executor=None,
+                          outputs=None, on_stage_failure=None, profile=None):
+    """
+    执行一次完整的模拟（一个画像×模拟次数的工作单元），出错时返回错误替代结果
+    persona: 已清理的用户画像
+    persona_id: 用户画像ID
+    sim_index: 模拟序号（从0开始）
+    instance_id: 本批次模拟的实例ID
+    product_desc: 产品描述
+    model_pool: 模型池
+    web_context: 网络搜索上下文
+    stage_executor: 执行并行阶段的线程池，为空时各阶段按顺序执行
+    outputs: 该单元之前已完成阶段的输出，重试时跳过这些阶段（原地更新）
+    on_stage_failure: 阶段失败回调 on_stage_failure(阶段名, 第几次尝试, 异常, 该次尝试发出的调用数)，用于统计浪费的调用
+    profile: 分析深度预设（见pipeline_profiles），决定自我质疑的轮数和是否评审广告文案，默认标准
+    """
+    print(f"DEBUG - 开始模拟用户 {persona_id} (第 {sim_index+1} 次)")
+    profile = profile or get_pipeline_profile("standard")
+
+    # 从MODEL_POOL中随机选择一个模型
+    model_name = random.choice(list(model_pool.keys()))
+    print(f"DEBUG - 使用模型: {model_name}")
+
+    try:
+        def stage_initial(outputs):
+            # 第一步：初步模拟用户反应
+            result = simulate_initial_reaction(
+                persona, product_desc, model_name, model_pool=model_pool, web_context=web_context
+            )
+            print(f"DEBUG - 完成初步模拟")
+            return result
+
+        def stage_inquiry(previous):
+            def run(outputs):
                 # 第二步：让模型自我质疑，提出需要深入考虑的问题
-                inquiry_questions = generate_inquiry_questions(
-                    persona, product_desc, initial_result, model_name, model_pool=model_pool, web_context=web_context
+                questions = generate_inquiry_questions(
+                    persona, product_desc, outputs[previous], model_name, model_pool=model_pool, web_context=web_context
                 )
-                print(f"DEBUG - 生成了 {len(inquiry_questions)} 个深入探讨的问题")
-                
+                print(f"DEBUG - 生成了 {len(questions)} 个深入探讨的问题")
+                return questions
+            return run
+
+        def stage_refined(previous, inquiry):
+            def run(outputs):
                 # 第三步：基于问题，进行深入模拟
-                refined_result = simulate_refined_reaction(
+                result = simulate_refined_reaction(
                     persona,
                     product_desc,
-                    initial_result,
-                    inquiry_questions,
+                    outputs[previous],
+                    outputs[inquiry],
                     model_name,
                     model_pool=model_pool,
                     web_context=web_context,
                 )
                 print(f"DEBUG - 完成深入模拟")
-                
+                return result
+            return run
+
+        def stage_ad_copy(feedback):
+            def run(outputs):
                 # 第四步：生成广告文案
-                ad_result = generate_ad_copy(
-                    persona, product_desc, refined_result, model_name, model_pool=model_pool, web_context=web_context
+                result = generate_ad_copy(
+                    persona, product_desc, outputs[feedback], model_name, model_pool=model_pool,
+                    web_context=web_context, review=profile["ad_review"]
                 )
                 print(f"DEBUG - 完成广告文案生成")
-                
+                return result
+            return run
+
+        def stage_optimized_product(feedback):
+            def run(outputs):
                 # 第五步：优化产品描述
-                optimized_product = optimize_product_description(
-                    persona, product_desc, refined_result, model_name, model_pool=model_pool, web_context=web_context
+                result = optimize_product_description(
+                    persona, product_desc, outputs[feedback], model_name, model_pool=model_pool, web_context=web_context
                 )
                 print(f"DEBUG - 完成产品优化")
-                
-                # 合并所有结果
-                final_result = {
-                    **refined_result,
-                    "ad_copy": ad_result,
-                    "optimized_product": optimized_product
-                }
-                
-                # 处理结果，确保所有字段格式正确
-                result = process_simulation_result(final_result, persona, persona_id, sim_index+1, simulation_instance_id)
-                
                 return result
-                
-            except Exception as e:
-                print(f"模拟用户 {persona_id} 反应 {sim_index+1} 时出错: {str(e)}")
-                error_result = create_error_result(
-                    persona_id, 
-                    f"模拟过程中出错: {str(e)}", 
-                    str(e),
-                    sim_index=sim_index+1,
-                    instance_id=simulation_instance_id,
-                    user_type=persona.get("user_type", "未知"),
-                    usage_frequency=persona.get("usage_frequency", "未知")
-                )
-                return error_result
-        
-        try:
-            # 使用线程池并行执行模拟
-            with concurrent.futures.ThreadPoolExecutor(max_workers=min(num_simulations, 5)) as executor:
-                # 提交所有任务到线程池
-                future_to_index = {executor.submit(run_single_simulation, i): i for i in range(num_simulations)}
-                
-                # 收集结果
-                for future in concurrent.futures.as_completed(future_to_index):
-                    try:
-                        result = future.result()
-                        simulation_results.append(result)
-                    except Exception as e:
-                        index = future_to_index[future]
-                        print(f"处理模拟结果 {index+1} 时出错: {str(e)}")
-                        error_result = create_error_result(
-                            persona_id,
-                            f"处理结果时出错: {str(e)}",
-                            str(e),
-                            sim_index=index+1,
-                            instance_id=simulation_instance_id,
-                            user_type=persona.get("user_type", "未知"),
-                            usage_frequency=persona.get("usage_frequency", "未知")
-                        )
-                        simulation_results.append(error_result)
-            
-            # 验证批次结果
-            format_errors = 0
-            for result in simulation_results:
-                # 检查是否包含错误信息且与JSON格式相关
-                if "error" in result and any(err in result["error"] for err in ["JSON", "json", "格式"]):
-                    format_errors += 1
-            
-            # 如果格式错误超过10%，认为这个批次失败，需要重试
-            if format_errors > (len(simulation_results) / 10):
-                print(f"批次中格式错误数量过多: {format_errors}/{len(simulation_results)}，需要重试")
-                batch_retry_count += 1
-                # 清空结果，准备重试
-                simulation_results = []
-            else:
-                # 批次有效，跳出重试循环
-                valid_simulation_results = True
-                print(f"批次模拟成功，有效结果: {len(simulation_results) - format_errors}/{len(simulation_results)}")
-                
-        except Exception as e:
-            print(f"批次模拟过程中出错: {str(e)}")
-            batch_retry_count += 1
-    
-    # 如果达到最大重试次数仍未成功，创建错误结果
-    if not valid_simulation_results:
-        print(f"达到最大批次重试次数 {max_batch_retries}，返回错误结果")
-        simulation_results = []
-        for i in range(num_simulations):
-            error_result = create_error_result(
-                persona_id,
-                f"批次模拟失败，达到最大重试次数 {max_batch_retries}",
-                f"无法在 {max_batch_retries} 次尝试内获取有效的模拟结果",
-                sim_index=i+1,
-                instance_id=str(uuid.uuid4())[:8],
-                user_type=persona.get("user_type", "未知"),
-                usage_frequency=persona.get("usage_frequency", "未知")
-            )
-            simulation_results.append(error_result)
-    
-    # 确保返回足够数量的结果
-    if len(simulation_results) < num_simulations:
-        fill_missing_results(simulation_results, persona_id, persona, num_simulations, simulation_instance_id)
-    
-    return simulation_results
+            return run
+
+        # 每轮自我质疑基于上一轮的结果，第一轮的阶段名为inquiry/refined，之后为inquiry_2/refined_2...
+        stages = {"initial": ((), stage_initial)}
+        feedback = "initial"
+        for round_index in range(1, profile["inquiry_rounds"] + 1):
+            suffix = "" if round_index == 1 else f"_{round_index}"
+            inquiry, refined = f"inquiry{suffix}", f"refined{suffix}"
+            stages[inquiry] = ((feedback,), stage_inquiry(feedback))
+            stages[refined] = ((feedback, inquiry), stage_refined(feedback, inquiry))
+            feedback = refined
+        # 广告文案和产品优化都只依赖最终的模拟结果，两者并行执行
+        stages["ad_copy"] = ((feedback,), stage_ad_copy(feedback))
+        stages["optimized_product"] = ((feedback,), stage_optimized_product(feedback))
+
+        start_time = time.time()
+        outputs, stage_timings = run_stage_graph(stages, executor=stage_executor, outputs=outputs,
+                                                 max_attempts=STAGE_MAX_ATTEMPTS, on_stage_failure=on_stage_failure,
+                                                 call_counter=model_call_count)
+        stage_timings["total"] = round(time.time() - start_time, 3)
+
+        # 合并所有结果
+        final_result = {
+            **outputs[feedback],
+            "ad_copy": outputs["ad_copy"],
+            "optimized_product": outputs["optimized_product"]
+        }
+
+        # 处理结果，确保所有字段格式正确
+        result = process_simulation_result(final_result, persona, persona_id, sim_index+1, instance_id)
+        result["stage_timings"] = stage_timings
+        return result
+
+    except TaskCancelled:
+        raise
+    except Exception as e:
+        print(f"模拟用户 {persona_id} 反应 {sim_index+1} 时出错: {str(e)}")
+        return create_error_result(
+            persona_id,
+            f"模拟过程中出错: {str(e)}",
+            str(e),
+            sim_index=sim_index+1,
+            instance_id=instance_id,
+            user_type=persona.get("user_type", "未知"),
+            usage_frequency=persona.get("usage_frequency", "未知")
+        )
+
+def _prepare_persona(persona, num_simulations):
+    """
+    检查并清理用户画像
+    返回: (清理后的画像, 画像ID, 错误结果列表)，画像无法模拟时错误结果列表非空
+    """
+    # 首先确保persona是有效的字典
+    if not isinstance(persona, dict):
+        print(f"用户画像格式错误: {type(persona)}，无法进行模拟")
+        error_result = create_error_result("unknown", "用户画像格式错误", f"用户画像格式错误: {type(persona)}")
+        return persona, "unknown", [error_result for _ in range(num_simulations)]
+
+    # 确保persona包含用户描述
+    if "persona_description" not in persona or not persona["persona_description"] or persona["persona_description"] == "未提供":
+        print(f"用户画像 {persona.get('persona_id', 'unknown')} 缺少必要字段或字段为空: persona_description，无法进行模拟")
+        error_result = create_error_result(
+            persona.get('persona_id', 'unknown'),
+            "用户画像缺少必要字段",
+            "用户画像缺少必要字段或字段为空: persona_description"
+        )
+        return persona, persona.get('persona_id', 'unknown'), [error_result for _ in range(num_simulations)]
+
+    # 清理persona数据
+    persona = clean_persona_data(persona)
+
+    # 获取安全的persona_id，确保它是字符串
+    persona_id = str(persona.get('persona_id', f"unknown_{random.randint(1000, 9999)}"))
+    return persona, persona_id, []
+
+def simulate_task_reactions(task_id, product_desc, personas, num_simulations, model_pool=None,
+                            web_context: str = "", scheduler=None, should_stop=None, on_progress=None,
+                            retry_stats=None, throughput_mode=False, completed_units=None,
+                            on_unit_complete=None, profile=None, adaptive=False, on_result=None):
+    """
+    对任务的所有用户画像进行模拟：每个 (画像, 模拟次数) 单元提交到共享的模拟调度器
+    任意工作线程空闲即执行下一个单元，多个任务之间公平调度
+    失败只重试对应的阶段或单元，其他成功的结果和已完成阶段的输出都会保留
+    task_id: 任务ID
+    product_desc: 产品描述
+    personas: 用户画像列表，或PersonaStream（与画像生成重叠执行：画像到达后立即调度其模拟单元，
+              画像序号为到达顺序；不支持自适应模式和吞吐模式）
+    num_simulations: 每个画像的模拟次数
+    model_pool: 模型池
+    web_context: 网络搜索上下文
+    scheduler: 模拟调度器，默认使用进程共享的调度器
+    should_stop: 返回True时取消尚未开始的单元并抛出异常
+    on_progress: 进度回调 on_progress(已完成画像数, 画像总数, 已完成单元数, 单元总数)
+    retry_stats: 提供时写入重试统计（阶段重试、单元重试、最终失败的单元、浪费的调用次数）
+    throughput_mode: 吞吐模式，初步模拟和深入模拟把K个画像合并到一次调用中
+    completed_units: 已完成的单元 {(画像序号, 模拟序号): 模拟结果}（从任务检查点恢复），不再重新执行
+    on_unit_complete: 单元成功完成时的回调 on_unit_complete(画像序号, 模拟序号, 模拟结果)
+    profile: 分析深度预设，决定每个单元执行的阶段，默认标准
+    adaptive: 自适应模式，每个画像先模拟一次，再按指标置信区间向方差高的画像追加模拟，
+              区间收敛后提前停止（总数不超过 画像数×模拟次数），统计写入retry_stats['adaptive']
+    on_result: 每个计入返回列表的模拟结果确定时的回调 on_result(模拟结果)，用于流式统计（每个结果恰好调用一次）
+    返回: 按画像顺序排列的模拟结果列表
+    """
+    # 各模式的调度实现位于task_simulation（该模块依赖本模块的模拟函数，在此延迟导入）
+    from .task_simulation import AdaptiveTaskSimulation, TaskSimulation
+
+    simulation_class = AdaptiveTaskSimulation if adaptive else TaskSimulation
+    simulation = simulation_class(task_id, product_desc, personas, num_simulations, model_pool=model_pool,
+                                  web_context=web_context,
+                                  scheduler=scheduler or get_simulation_scheduler(model_pool),
+                                  should_stop=should_stop, on_progress=on_progress, retry_stats=retry_stats,
+                                  throughput_mode=throughput_mode, completed_units=completed_units,
+                                  on_unit_complete=on_unit_complete,
+                                  profile=profile or get_pipeline_profile("standard"), on_result=on_result)
+    return simulation.run()
+
+def summarize_stage_timings(simulation_results):
+    """
+    汇总各模拟阶段的平均耗时（秒），用于记录到任务中
+    simulation_results: 模拟结果列表
+    """
+    totals = {}
+    counts = {}
+    for result in simulation_results:
+        for stage, seconds in (result.get("stage_timings") or {}).items():
+            totals[stage] = totals.get(stage, 0.0) + seconds
+            counts[stage] = counts.get(stage, 0) + 1
+    return {stage: round(totals[stage] / counts[stage], 2) for stage in totals}
+
+# 模拟用户对产品的反应              
+def simulate_user_reactions(task_id, product_desc, persona, num_simulations, model_pool=None, web_context: str = ""):
+    """
+    对单个用户画像进行多次模拟，获取用户反应，各次模拟通过共享调度器并行执行
+    task_id: 任务ID
+    product_desc: 产品描述
+    persona: 用户画像
+    num_simulations: 模拟次数
+    """
+    return simulate_task_reactions(task_id, product_desc, [persona], num_simulations,
+                                   model_pool=model_pool, web_context=web_context)
@@ -0,0 +1,405 @@
+import heapq
+import math
+import os
+import statistics
+import threading
+import time
+from typing import Dict, List, Optional
+
+from .call_latency import current_call_latency
+from .pipeline_profiles import PIPELINE_SECONDS_PER_CALL
+
+# 任务执行的阶段，按执行顺序
+ETA_STAGES = ('personas', 'web_search', 'simulations', 'report')
+# 学习各阶段单元耗时使用的最近完成的任务数
+ETA_HISTORY_TASKS = int(os.getenv("ETA_HISTORY_TASKS", "30"))
+# 学习排队等待和任务执行时长使用的最近结束的队列任务数
+ETA_HISTORY_JOBS = 50
+# 重新读取队列历史的间隔（秒）
+ETA_QUEUE_REFRESH_SECONDS = 30
+# 当前阶段的实测速度与历史速度加权时，历史速度相当于的已完成单元数
+ETA_PRIOR_UNITS = 5
+# 历史样本数达到该数量后不再因样本少而放大不确定度
+ETA_MIN_SAMPLES = 3
+# 没有历史数据时网络搜索和报告阶段按该调用次数估算（搜索决策+搜索、证据摘要+报告）
+DEFAULT_STAGE_CALLS = {'web_search': 2, 'report': 2}
+# 不确定度（相对误差）：只有默认估算时 / 当前阶段实测速度的残余误差
+PRIOR_UNCERTAINTY = 1.0
+OBSERVED_UNCERTAINTY = 0.15
+# 换算历史耗时时当前延迟与历史延迟之比的范围，校准系数的范围
+LATENCY_RATIO_BOUNDS = (0.5, 3.0)
+CALIBRATION_BOUNDS = (0.5, 2.0)
+# 置信度等级的下限
+CONFIDENCE_LEVELS = (('high', 0.7), ('medium', 0.45), ('low', 0.0))
+# 计算预计完成时间的任务状态
+ETA_STATUSES = ('pending', 'running', 'generating_personas', 'simulating_reactions')
+
+
+def _clamp(value, bounds):
+    return min(max(value, bounds[0]), bounds[1])
+
+
+def plan_stages(num_personas, num_simulations, pipeline_estimate=None) -> Dict[str, Dict]:
+    """
+    任务各阶段需要执行的单元数和每单元的模型调用数（权重，不同分析深度的单元耗时按调用数换算）
+    num_personas: 画像数量
+    num_simulations: 每个画像的模拟次数
+    pipeline_estimate: estimate_pipeline的结果
+    """
+    estimate = pipeline_estimate or {}
+    units = num_personas * num_simulations
+    return {
+        'personas': {'units': num_personas,
+                     'weight': estimate.get('persona_calls', num_personas) / num_personas if num_personas else 1.0},
+        'web_search': {'units': 1, 'weight': 1.0},
+        'simulations': {'units': units,
+                        'weight': estimate.get('simulation_calls', units) / units if units else 1.0},
+        'report': {'units': 1, 'weight': 1.0},
+    }
+
+
+class StageTimer:
+    """
+    记录任务各阶段的耗时，写入任务数据的stage_timings（随任务持久化，完成的任务作为预计完成时间模型的历史数据）
+    每个阶段记录：开始/结束时间、需要执行的单元数、开始时已完成（从检查点恢复）的单元数、已完成单元数、
+    每单元的调用数以及期间的模型调用延迟
+    """
+
+    def __init__(self, task: Dict, plan: Dict[str, Dict]):
+        """
+        task: 任务数据，每次执行重新记录
+        plan: plan_stages的结果
+        """
+        self.task = task
+        self.timings = {stage: dict(plan[stage], started_at=None, finished_at=None, done=0, completed=0,
+                                    progress_at=None, latency=None)
+                        for stage in ETA_STAGES}
+        task['stage_timings'] = self.timings
+
+    def _sample_latency(self, timing):
+        latency = current_call_latency()
+        if latency is not None:
+            timing['latency'] = round(latency, 3)
+
+    def start(self, stage, done=0):
+        """
+        stage: 阶段名称
+        done: 开始时已完成的单元数（从检查点恢复的部分）
+        """
+        timing = self.timings[stage]
+        timing.update(started_at=time.time(), finished_at=None, done=done, completed=done, progress_at=None)
+        self._sample_latency(timing)
+
+    def progress(self, stage, completed, units=None):
+        timing = self.timings[stage]
+        if completed > timing['completed']:
+            # 最近一个单元完成的时间，之后的耗时属于执行中的单元
+            timing['progress_at'] = time.time()
+        timing['completed'] = completed
+        if units is not None:
+            timing['units'] = units
+        self._sample_latency(timing)
+
+    def finish(self, stage, completed=None):
+        """
+        completed: 阶段结束时的已完成单元数，默认为最近一次progress记录的数量
+        """
+        timing = self.timings[stage]
+        if completed is not None:
+            timing['completed'] = completed
+        timing['finished_at'] = time.time()
+        self._sample_latency(timing)
+
+
+def _quantile(values, q):
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q
+    low, high = math.floor(position), math.ceil(position)
+    return ordered[low] + (ordered[high] - ordered[low]) * (position - low)
+
+
+class EtaModel:
+    """
+    预计完成时间模型
+    - 从最近完成的任务学习各阶段每单元（按调用数加权）的耗时，历史耗时按当时与当前的模型调用延迟之比换算
+    - 用留一法检验模型对历史任务的预测误差：实际耗时/预测耗时的中位数作为校准系数，分散程度作为不确定度
+    - 从任务队列的入队、开始、结束时间学习任务执行时长，估算排队中的任务还需等待的时间
+    """
+
+    def __init__(self, history: List[Dict], jobs: List[Dict] = ()):
+        """
+        history: 最近完成的任务数据（含stage_timings）
+        jobs: 最近结束的队列任务（JobQueue.recent_jobs）
+        """
+        # 阶段 -> [(历史任务序号, 每加权单元耗时, 当时的调用延迟)]
+        self.samples = {stage: [] for stage in ETA_STAGES}
+        # 历史任务序号 -> 阶段 -> (执行的加权单元数, 耗时, 当时的调用延迟)
+        self.workloads = []
+        for index, task in enumerate(history):
+            workload = {}
+            for stage, timing in (task.get('stage_timings') or {}).items():
+                if stage not in self.samples or not timing.get('started_at') or not timing.get('finished_at'):
+                    continue
+                weighted_units = (timing.get('completed', 0) - timing.get('done', 0)) * timing.get('weight', 1.0)
+                seconds = timing['finished_at'] - timing['started_at']
+                if weighted_units <= 0 or seconds < 0:
+                    continue
+                self.samples[stage].append((index, seconds / weighted_units, timing.get('latency')))
+                workload[stage] = (weighted_units, seconds, timing.get('latency'))
+            self.workloads.append(workload)
+        self.history_tasks = len(history)
+        # 任务执行时长：优先使用队列记录，没有队列历史时使用完成任务的起止时间
+        self.service_seconds = ([job['finished_at'] - job['started_at'] for job in jobs] or
+                                [task['end_time'] - task['start_time'] for task in history if task.get('start_time')])
+        self.calibration = self._calibrate()
+
+    def stage_rate(self, stage, latency=None, exclude=None):
+        """
+        阶段每加权单元的耗时
+        latency: 当前的调用延迟，提供时历史样本按延迟之比换算
+        exclude: 不使用的历史任务序号（留一法检验）
+        返回: (中位数, 相对四分位距, 样本数)，没有样本时返回None
+        """
+        rates = []
+        for index, rate, sample_latency in self.samples[stage]:
+            if index == exclude:
+                continue
+            if latency and sample_latency:
+                rate *= _clamp(latency / sample_latency, LATENCY_RATIO_BOUNDS)
+            rates.append(rate)
+        if not rates:
+            return None
+        median = statistics.median(rates)
+        spread = (_quantile(rates, 0.75) - _quantile(rates, 0.25)) / median if median > 0 and len(rates) > 1 else 0.0
+        return median, spread, len(rates)
+
+    def _calibrate(self) -> Dict:
+        """
+        留一法：用其他历史任务学到的速度预测每个历史任务各阶段的总耗时，与实际耗时比较
+        返回: {factor（校准系数）, spread（相对误差的一半区间宽度）, samples}
+        """
+        ratios = []
+        for index, workload in enumerate(self.workloads):
+            predicted = actual = 0.0
+            for stage, (weighted_units, seconds, latency) in workload.items():
+                rate = self.stage_rate(stage, latency=latency, exclude=index)
+                if rate is None:
+                    continue
+                predicted += weighted_units * rate[0]
+                actual += seconds
+            if predicted > 0:
+                ratios.append(actual / predicted)
+        if len(ratios) < ETA_MIN_SAMPLES:
+            return {'factor': 1.0, 'spread': None, 'samples': len(ratios)}
+        median = statistics.median(ratios)
+        spread = (_quantile(ratios, 0.8) - _quantile(ratios, 0.2)) / 2 / median if median > 0 else None
+        return {'factor': round(_clamp(median, CALIBRATION_BOUNDS), 3),
+                'spread': round(spread, 3) if spread is not None else None,
+                'samples': len(ratios)}
+
+    def _history_rate(self, stage, latency, prior_rate):
+        """
+        阶段每加权单元的预计耗时及其不确定度，没有历史样本时使用默认估算
+        返回: (耗时, 不确定度, 来源)
+        """
+        rate = self.stage_rate(stage, latency=latency)
+        if rate is None:
+            return prior_rate, PRIOR_UNCERTAINTY, 'default'
+        median, spread, count = rate
+        uncertainty = self.calibration['spread'] if self.calibration['spread'] is not None else spread
+        # 样本少时放大不确定度
+        uncertainty = max(uncertainty, OBSERVED_UNCERTAINTY) * (1 + max(0, ETA_MIN_SAMPLES - count) / ETA_MIN_SAMPLES)
+        return median * self.calibration['factor'], min(uncertainty, PRIOR_UNCERTAINTY), 'history'
+
+    def queue_wait(self, queue_info: Optional[Dict], running=0, workers=1, default_service=0.0):
+        """
+        排队中的任务预计还需等待的时间：前面的任务和执行中的任务按历史执行时长占用工作线程
+        queue_info: JobQueue.position的结果
+        running: 执行中的任务数
+        workers: 任务工作线程数
+        default_service: 没有任何历史时假定的任务执行时长（本任务的预计执行时间）
+        返回: (秒数, 不确定度)
+        """
+        if not queue_info or queue_info.get('state') != 'queued':
+            return 0.0, 0.0
+        workers = max(1, workers)
+        slots = max(0, queue_info.get('ahead', 0) + running - workers + 1)
+        if not slots:
+            return 0.0, OBSERVED_UNCERTAINTY
+        if self.service_seconds:
+            service = statistics.median(self.service_seconds)
+            spread = ((_quantile(self.service_seconds, 0.75) - _quantile(self.service_seconds, 0.25)) / service
+                      if service > 0 and len(self.service_seconds) > 1 else PRIOR_UNCERTAINTY)
+            uncertainty = min(max(spread, OBSERVED_UNCERTAINTY), PRIOR_UNCERTAINTY)
+        else:
+            service, uncertainty = default_service, PRIOR_UNCERTAINTY
+        # 执行中的任务平均已完成一半
+        return (slots - 0.5) / workers * service, uncertainty
+
+    def estimate(self, task: Dict, now=None, latency=None, queue_info=None, running=0, workers=1) -> Dict:
+        """
+        任务的预计完成时间
+        task: 任务数据
+        latency: 当前的模型调用延迟，默认使用任务最近记录的延迟或本进程的延迟
+        queue_info / running / workers: 排队中的任务的队列位置、执行中的任务数、任务工作线程数
+        返回: {remaining_seconds, low_seconds, high_seconds, finish_at, confidence, confidence_level,
+               progress_percentage, current_stage, queue_seconds, stages, calibration, history_tasks, latency_seconds}
+        """
+        now = now or time.time()
+        timings = task.get('stage_timings')
+        if task.get('status') == 'pending' or not timings:
+            # 多方案任务的每个方案分别模拟
+            num_simulations = task.get('num_simulations', 0) * max(1, len(task.get('variants') or ()))
+            timings = {stage: dict(plan, started_at=None, finished_at=None, done=0, completed=0)
+                       for stage, plan in plan_stages(task.get('num_personas', 0), num_simulations,
+                                                      task.get('pipeline_estimate')).items()}
+        prior_rates = self._prior_rates(task, timings)
+
+        # 最后一个已开始的阶段之前的阶段都已结束（从检查点恢复时可能被跳过）
+        started = [stage for stage in ETA_STAGES if timings.get(stage, {}).get('started_at')]
+        if latency is None:
+            # 任务可能在其他进程中执行，优先使用执行进程最近记录的延迟
+            recorded = [timings[stage]['latency'] for stage in reversed(started) if timings[stage].get('latency')]
+            latency = recorded[0] if recorded else current_call_latency()
+        current = started[-1] if started and not timings[started[-1]].get('finished_at') else None
+        first_pending = ETA_STAGES.index(started[-1]) + 1 if started else 0
+
+        stages = {}
+        for position, stage in enumerate(ETA_STAGES):
+            timing = timings.get(stage) or {}
+            units = timing.get('units', 0)
+            weight = timing.get('weight', 1.0)
+            if stage != current and position < first_pending:
+                continue
+            hist_rate, hist_uncertainty, source = self._history_rate(stage, latency, prior_rates[stage])
+            if stage != current:
+                remaining_units = units
+                remaining = units * weight * hist_rate
+                uncertainty = hist_uncertainty
+            else:
+                completed = timing.get('completed', 0)
+                progress = task.get('progress') or {}
+                if stage == 'personas' and progress.get('current_step') == 'personas':
+                    # 画像阶段的进度由画像生成流程写入
+                    completed = max(completed, progress.get('completed', 0))
+                remaining_units = max(0, units - completed)
+                executed = completed - timing.get('done', 0)
+                elapsed = now - timing['started_at']
+                if executed > 0:
+                    # 实测速度只计到最近一个单元完成，之后的耗时从执行中单元的剩余时间中扣除，
+                    # 按预计速度推进时两次完成之间的进度不会回退
+                    progress_at = timing.get('progress_at') if completed == timing.get('completed') else None
+                    in_flight = max(0.0, now - progress_at) if progress_at else 0.0
+                    observed_rate = (elapsed - in_flight) / (executed * weight)
+                    observed_share = executed / (executed + ETA_PRIOR_UNITS)
+                    rate = observed_share * observed_rate + (1 - observed_share) * hist_rate
+                    remaining = max(0.0, remaining_units * weight * rate - in_flight)
+                    uncertainty = observed_share * OBSERVED_UNCERTAINTY + (1 - observed_share) * hist_uncertainty
+                    source = 'observed' if observed_share >= 0.5 else 'blended'
+                else:
+                    # 还没有单元完成（或单元并行执行）：按预计总耗时扣除已用时间
+                    remaining = max(0.0, (units - timing.get('done', 0)) * weight * hist_rate - elapsed)
+                    uncertainty = hist_uncertainty
+            stages[stage] = {
+                'remaining_seconds': round(remaining, 1),
+                'remaining_units': remaining_units,
+                'uncertainty': round(uncertainty, 3),
+                'source': source,
+            }
+
+        queue_seconds, queue_uncertainty = 0.0, 0.0
+        if task.get('status') == 'pending':
+            queue_seconds, queue_uncertainty = self.queue_wait(
+                queue_info, running=running, workers=workers,
+                default_service=sum(s['remaining_seconds'] for s in stages.values()))
+
+        parts = [(s['remaining_seconds'], s['uncertainty']) for s in stages.values()]
+        parts.append((queue_seconds, queue_uncertainty))
+        remaining = sum(seconds for seconds, _ in parts)
+        spread = sum(seconds * u for seconds, u in parts)
+        uncertainty = spread / remaining if remaining > 0 else 0.0
+        confidence = round(1 / (1 + 2 * uncertainty), 2)
+        elapsed = now - task['start_time'] if task.get('status') != 'pending' and task.get('start_time') else 0.0
+        return {
+            'remaining_seconds': round(remaining),
+            'low_seconds': round(max(0.0, remaining - spread)),
+            'high_seconds': round(remaining + spread),
+            'finish_at': round(now + remaining),
+            'confidence': confidence,
+            'confidence_level': next(level for level, floor in CONFIDENCE_LEVELS if confidence >= floor),
+            'progress_percentage': round(elapsed / (elapsed + remaining) * 100, 1) if elapsed + remaining > 0 else 0,
+            'current_stage': current,
+            'queue_seconds': round(queue_seconds) if task.get('status') == 'pending' else None,
+            'stages': stages,
+            'calibration': self.calibration,
+            'history_tasks': self.history_tasks,
+            'latency_seconds': round(latency, 2) if latency else None,
+        }
+
+    @staticmethod
+    def _prior_rates(task, timings) -> Dict[str, float]:
+        """
+        没有历史样本时各阶段每加权单元的默认耗时（按estimate_pipeline的估算）
+        """
+        estimate = task.get('pipeline_estimate') or {}
+        rates = {}
+        for stage, key in (('personas', 'persona_seconds'), ('simulations', 'simulation_seconds')):
+            timing = timings.get(stage) or {}
+            weighted_units = timing.get('units', 0) * timing.get('weight', 1.0)
+            if estimate.get(key) and weighted_units:
+                rates[stage] = estimate[key] / weighted_units
+            else:
+                rates[stage] = PIPELINE_SECONDS_PER_CALL
+        for stage, calls in DEFAULT_STAGE_CALLS.items():
+            rates[stage] = calls * PIPELINE_SECONDS_PER_CALL
+        return rates
+
+
+_model_lock = threading.Lock()
+_model_cache = {'key': None, 'model': None, 'jobs': [], 'jobs_at': 0.0}
+
+
+def recent_completed_tasks(tasks: Dict[str, Dict], limit=ETA_HISTORY_TASKS) -> List[Dict]:
+    """
+    最近完成且记录了阶段耗时的任务
+    """
+    completed = (task for task in tasks.values()
+                 if task.get('status') == 'completed' and task.get('stage_timings') and task.get('end_time'))
+    return heapq.nlargest(limit, completed, key=lambda task: task['end_time'])
+
+
+def get_eta_model(tasks: Dict[str, Dict], job_queue=None) -> EtaModel:
+    """
+    按最近完成的任务和队列历史构建的模型，历史不变时复用
+    tasks: 全部任务数据
+    job_queue: 任务队列，用于学习排队等待时间
+    """
+    history = recent_completed_tasks(tasks)
+    now = time.time()
+    with _model_lock:
+        if job_queue is not None and now - _model_cache['jobs_at'] >= ETA_QUEUE_REFRESH_SECONDS:
+            try:
+                _model_cache['jobs'] = job_queue.recent_jobs(ETA_HISTORY_JOBS)
+            except Exception as e:
+                print(f"读取队列历史时出错: {str(e)}")
+            _model_cache['jobs_at'] = now
+        key = (tuple((task.get('id'), task['end_time']) for task in history), _model_cache['jobs_at'])
+        if _model_cache['key'] != key:
+            _model_cache['model'] = EtaModel(history, _model_cache['jobs'])
+            _model_cache['key'] = key
+        return _model_cache['model']
+
+
+def format_remaining_time(seconds) -> str:
+    """
+    剩余时间的显示文本
+    """
+    if seconds <= 5:
+        return "即将完成"
+    minutes, seconds = divmod(int(seconds), 60)
+    if minutes > 60:
+        hours, minutes = divmod(minutes, 60)
+        return f"{hours}小时{minutes}分钟"
+    if minutes > 0:
+        return f"{minutes}分钟{seconds}秒"
+    return f"{seconds}秒"
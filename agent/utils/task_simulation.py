@@ -0,0 +1,529 @@
+import concurrent.futures
+import random
+import threading
+import uuid
+from typing import Dict, List, Optional
+
+from .generate_utils import create_error_result, fill_missing_results
+from .cancellation import TaskCancelled, current_cancellation_token
+from .pipeline_profiles import simulation_calls_per_unit
+from .persona_stream import PersonaStream
+from .sequential_sampling import SequentialSampler
+from .simulatiton_generate import (
+    STAGE_MAX_ATTEMPTS,
+    UNIT_MAX_ATTEMPTS,
+    _prepare_persona,
+    choose_simulation_pack_size,
+    run_initial_sampling,
+    run_simulation_pack,
+    run_single_simulation,
+)
+from models import model_supports_n
+
+
+class SimulationRunStats:
+    """
+    任务模拟的重试与调用统计，直接写入调用方提供的retry_stats字典（各调度线程共享，加锁更新）
+    """
+
+    def __init__(self, stats: Optional[Dict] = None):
+        self.stats = stats if stats is not None else {}
+        self.stats.update({'stage_retries': 0, 'unit_retries': 0, 'failed_units': 0, 'wasted_calls': 0})
+        self.lock = threading.Lock()
+
+    def add(self, key: str, count: int = 1) -> None:
+        with self.lock:
+            self.stats[key] = self.stats.get(key, 0) + count
+
+    def on_pack_call(self, packed, fallbacks):
+        with self.lock:
+            self.stats['pack_calls'] = self.stats.get('pack_calls', 0) + 1
+            self.stats['packed_personas'] = self.stats.get('packed_personas', 0) + packed
+            self.stats['pack_fallbacks'] = self.stats.get('pack_fallbacks', 0) + fallbacks
+
+    def on_sampling_call(self, requested, received):
+        with self.lock:
+            self.stats['sampling_calls'] = self.stats.get('sampling_calls', 0) + 1
+            self.stats['sampled_initial_reactions'] = self.stats.get('sampled_initial_reactions', 0) + received
+            # 每个可用采样省去一次单独的初步模拟请求（第一个采样本身占用这次请求）
+            self.stats['saved_initial_calls'] = self.stats.get('saved_initial_calls', 0) + max(0, received - 1)
+
+    def on_stage_failure(self, stage, attempt, error, calls=1):
+        # 失败的阶段尝试所做的调用没有产生可用结果（广告文案等阶段一次尝试包含多次调用）
+        with self.lock:
+            self.stats['wasted_calls'] += calls
+            if attempt < STAGE_MAX_ATTEMPTS:
+                self.stats['stage_retries'] += 1
+
+
+class PersonaUnits:
+    """
+    单个画像的模拟单元状态：已完成的结果、各单元的执行轮数和已完成阶段的输出
+    """
+
+    def __init__(self, persona: Dict, persona_id: str, max_sims: int):
+        self.persona = persona
+        self.persona_id = persona_id
+        # 生成一个随机的唯一标识符，用于确保同一个用户画像的不同模拟实例有唯一ID
+        self.instance_id = str(uuid.uuid4())[:8]
+        # 模拟序号 -> 模拟结果
+        self.results = {}
+        self.attempts = [0] * max_sims
+        self.outputs = [{} for _ in range(max_sims)]
+        self.next_sim = 0
+
+    def error_result(self, sim_index: int, error: Exception) -> Dict:
+        return create_error_result(
+            self.persona_id,
+            f"处理结果时出错: {str(error)}",
+            str(error),
+            sim_index=sim_index+1,
+            instance_id=self.instance_id,
+            user_type=self.persona.get("user_type", "未知"),
+            usage_frequency=self.persona.get("usage_frequency", "未知")
+        )
+
+    def ordered_results(self) -> List[Dict]:
+        return [self.results[i] for i in sorted(self.results)]
+
+
+class TaskSimulation:
+    """
+    固定次数模拟：每个画像执行num_simulations个 (画像, 模拟次数) 单元，全部提交到共享的模拟调度器
+    失败的单元保留已完成阶段后重新执行；画像可以来自完整列表或PersonaStream（到达后立即调度）
+    初步模拟可按吞吐模式打包，或对支持n采样的模型一次采样得到同一画像的全部初步反应
+    """
+
+    def __init__(self, task_id, product_desc, personas, num_simulations, model_pool=None,
+                 web_context: str = "", scheduler=None, should_stop=None, on_progress=None,
+                 retry_stats=None, throughput_mode=False, completed_units=None,
+                 on_unit_complete=None, profile=None, on_result=None):
+        self.task_id = task_id
+        self.product_desc = product_desc
+        self.num_simulations = num_simulations
+        self.model_pool = model_pool
+        self.web_context = web_context
+        self.scheduler = scheduler
+        self.should_stop = should_stop
+        self.on_progress = on_progress
+        self.on_unit_complete = on_unit_complete
+        self.on_result = on_result
+        self.profile = profile
+        self.throughput_mode = throughput_mode
+        self.completed_units = completed_units or {}
+        self.run_stats = SimulationRunStats(retry_stats)
+        self.stats = self.run_stats.stats
+
+        self.persona_stream = personas if isinstance(personas, PersonaStream) else None
+        if self.persona_stream is not None and throughput_mode:
+            raise ValueError("自适应模式和吞吐模式需要完整的画像列表，不能与画像生成重叠执行")
+        # 画像流中到达的画像逐个追加
+        self.personas = [] if self.persona_stream is not None else list(personas)
+        self.stream_closed = self.persona_stream is None
+        self.results_by_persona = [None] * len(self.personas)
+        # 画像序号 -> PersonaUnits
+        self.batches = {}
+        # future -> (画像序号, 模拟序号)
+        self.futures = {}
+        # 预填充单元（吞吐模式的打包、n采样）future -> [(画像序号, 模拟序号)]，完成后再调度这些单元
+        self.prefill_futures = {}
+        self.sampling_models = [name for name in (model_pool or {}) if model_supports_n(name, model_pool)]
+        self.use_sampling = self._uses_sampling()
+        self.resumed_units = 0
+        self.completed_count = 0
+        self.completed_personas = 0
+
+    # 每个画像首轮执行的模拟次数 / 单个画像最多执行的模拟次数
+    @property
+    def initial_sims(self) -> int:
+        return self.num_simulations
+
+    @property
+    def max_sims(self) -> int:
+        return self.num_simulations
+
+    def _uses_sampling(self) -> bool:
+        # n采样一次得到全部模拟的初步反应
+        return not self.throughput_mode and self.num_simulations > 1 and bool(self.sampling_models)
+
+    def _record_result(self, result):
+        if self.on_result:
+            self.on_result(result)
+
+    # ---------- 画像登记 ----------
+
+    def add_persona(self, index, persona):
+        """
+        登记画像并调度其尚未完成的模拟单元（吞吐模式的打包在全部画像登记后进行）
+        """
+        persona, persona_id, error_results = _prepare_persona(persona, self.num_simulations)
+        if error_results:
+            self.results_by_persona[index] = error_results
+            for result in error_results:
+                self._record_result(result)
+            self._on_persona_error(index)
+            return
+        batch = self.batches[index] = PersonaUnits(persona, persona_id, self.max_sims)
+        # 检查点中已完成的单元直接使用其结果
+        for sim_index in range(self.max_sims):
+            if (index, sim_index) in self.completed_units:
+                result = self.completed_units[(index, sim_index)]
+                if result.get('persona_id', persona_id) != persona_id:
+                    # 中断的画像阶段恢复时画像重新编号，沿用的结果对应到新的画像ID
+                    result = dict(result, persona_id=persona_id)
+                batch.results[sim_index] = result
+                self._record_result(result)
+                self.resumed_units += 1
+                self._on_resumed_unit(index, result)
+        batch.next_sim = max([self.initial_sims - 1] + list(batch.results)) + 1
+        missing = [sim_index for sim_index in range(self.initial_sims) if sim_index not in batch.results]
+        self._on_units_assigned(index, len(missing))
+        if not missing:
+            self._on_persona_resumed(index)
+        elif self.use_sampling and len(missing) > 1:
+            self._prefill_sampling(index, missing)
+        elif not self.throughput_mode:
+            for sim_index in missing:
+                self.submit_unit(index, sim_index)
+
+    def _on_persona_error(self, index):
+        pass
+
+    def _on_resumed_unit(self, index, result):
+        pass
+
+    def _on_units_assigned(self, index, count):
+        pass
+
+    def _on_persona_resumed(self, index):
+        # 全部单元都已从检查点恢复
+        batch = self.batches.pop(index)
+        self.results_by_persona[index] = [batch.results[i] for i in range(self.num_simulations)]
+
+    def receive_personas(self):
+        """
+        接收画像流中新到达的画像并立即调度其模拟单元
+        返回: 画像流是否已关闭
+        """
+        arrived, closed = self.persona_stream.read(len(self.personas))
+        for persona in arrived:
+            index = len(self.personas)
+            self.personas.append(persona)
+            self.results_by_persona.append(None)
+            self.add_persona(index, persona)
+            if self.results_by_persona[index] is not None:
+                self.completed_personas += 1
+                self.completed_count += self.num_simulations
+            else:
+                self.completed_count += len(self.batches[index].results)
+        return closed
+
+    # ---------- 调度 ----------
+
+    def submit_unit(self, index, sim_index):
+        batch = self.batches[index]
+        batch.attempts[sim_index] += 1
+        future = self.scheduler.submit(self.task_id, run_single_simulation,
+                                       batch.persona, batch.persona_id, sim_index,
+                                       batch.instance_id, self.product_desc,
+                                       model_pool=self.model_pool, web_context=self.web_context,
+                                       stage_executor=self.scheduler.stage_executor,
+                                       outputs=batch.outputs[sim_index],
+                                       on_stage_failure=self.run_stats.on_stage_failure, profile=self.profile)
+        self.futures[future] = (index, sim_index)
+        return future
+
+    def _prefill_sampling(self, index, missing):
+        """
+        同一画像的多次模拟共享初步模拟的提示词，用一次n采样请求得到全部初步反应
+        """
+        batch = self.batches[index]
+        future = self.scheduler.submit(self.task_id, run_initial_sampling, batch.persona,
+                                       [batch.outputs[i] for i in missing],
+                                       self.product_desc, random.choice(self.sampling_models),
+                                       model_pool=self.model_pool, web_context=self.web_context,
+                                       on_sampling_call=self.run_stats.on_sampling_call)
+        self.prefill_futures[future] = [(index, sim_index) for sim_index in missing]
+
+    def _prefill_packs(self):
+        """
+        吞吐模式：同一次模拟序号的不同画像打包在一起，打包完成后各单元再照常调度剩余阶段
+        """
+        pack_size = choose_simulation_pack_size(self.model_pool, [b.persona for b in self.batches.values()],
+                                                self.product_desc, self.web_context)
+        self.stats['pack_size'] = pack_size
+        indices = list(self.batches)
+        for sim_index in range(self.initial_sims):
+            for start in range(0, len(indices), pack_size):
+                pack = [(index, sim_index) for index in indices[start:start + pack_size]
+                        if sim_index not in self.batches[index].results]
+                if not pack:
+                    continue
+                units = [(self.batches[i].persona, self.batches[i].persona_id, self.batches[i].outputs[j])
+                         for i, j in pack]
+                future = self.scheduler.submit(self.task_id, run_simulation_pack, units, self.product_desc,
+                                               model_pool=self.model_pool, web_context=self.web_context,
+                                               stage_executor=self.scheduler.stage_executor,
+                                               on_stage_failure=self.run_stats.on_stage_failure,
+                                               on_pack_call=self.run_stats.on_pack_call,
+                                               inquiry=self.profile["inquiry_rounds"] > 0)
+                self.prefill_futures[future] = pack
+
+    def _schedule_more(self):
+        # 固定次数模拟在登记画像时已调度全部单元
+        pass
+
+    # ---------- 进度 ----------
+
+    def progress_totals(self):
+        """
+        (画像总数, 单元总数)，画像流关闭前按目标画像数量计算
+        """
+        total_personas = self.persona_stream.expected() if self.persona_stream is not None else len(self.personas)
+        return total_personas, total_personas * self.num_simulations
+
+    def _initial_counts(self):
+        """
+        (已完成单元数, 已完成画像数)，包括从检查点恢复的单元和出错的画像
+        """
+        total_units = len(self.personas) * self.num_simulations
+        completed_count = total_units - sum(self.num_simulations - len(b.results) for b in self.batches.values())
+        return completed_count, len(self.personas) - len(self.batches)
+
+    def report_progress(self):
+        if self.on_progress:
+            total_personas, total_units = self.progress_totals()
+            self.on_progress(self.completed_personas, total_personas,
+                             min(self.completed_count, total_units), total_units)
+
+    # ---------- 结果处理 ----------
+
+    def _handle_prefill(self, future):
+        # 预填充中失败或缺失的阶段由各单元自己的阶段图补齐
+        try:
+            future.result()
+        except TaskCancelled:
+            raise
+        except Exception as e:
+            print(f"预填充模拟失败，回退到逐个模拟: {str(e)}")
+        for index, sim_index in self.prefill_futures.pop(future):
+            self.submit_unit(index, sim_index)
+
+    def _handle_unit(self, future, token):
+        index, sim_index = self.futures.pop(future)
+        batch = self.batches[index]
+        try:
+            result = future.result()
+        except Exception as e:
+            if token is not None and token.cancelled:
+                raise TaskCancelled()
+            print(f"处理模拟结果 {sim_index+1} 时出错: {str(e)}")
+            result = batch.error_result(sim_index, e)
+
+        if "error" in result:
+            if batch.attempts[sim_index] < UNIT_MAX_ATTEMPTS:
+                print(f"模拟单元 {batch.persona_id} #{sim_index+1} 失败，"
+                      f"保留已完成阶段后重新执行 ({batch.attempts[sim_index]}/{UNIT_MAX_ATTEMPTS})")
+                self.run_stats.add('unit_retries')
+                self.submit_unit(index, sim_index)
+                return
+            self.run_stats.add('failed_units')
+        elif self.on_unit_complete:
+            self.on_unit_complete(index, sim_index, result)
+
+        self.completed_count += 1
+        self._accept_result(index, sim_index, result)
+        self.report_progress()
+
+    def _accept_result(self, index, sim_index, result):
+        batch = self.batches[index]
+        batch.results[sim_index] = result
+        self._record_result(result)
+        if len(batch.results) == self.num_simulations:
+            self.results_by_persona[index] = [batch.results[i] for i in range(self.num_simulations)]
+            self.completed_personas += 1
+            # 已完成画像的阶段输出不再需要
+            batch.outputs = None
+
+    # ---------- 执行 ----------
+
+    def run(self):
+        """
+        执行全部模拟单元
+        返回: 按画像顺序排列的模拟结果列表
+        """
+        for index, persona in enumerate(self.personas):
+            self.add_persona(index, persona)
+        if self.throughput_mode and self.batches:
+            self._prefill_packs()
+
+        self.completed_count, self.completed_personas = self._initial_counts()
+        if self.on_progress and self.completed_count:
+            total_personas, total_units = self.progress_totals()
+            self.on_progress(self.completed_personas, total_personas, self.completed_count, total_units)
+
+        # 任务取消时立即取消调度器中尚未开始的单元，不等待下一次检查中止标志
+        token = current_cancellation_token()
+        cancel_key = token.register(lambda: self.scheduler.cancel_task(self.task_id)) if token is not None else None
+        try:
+            self._schedule_more()
+            self._wait_all(token)
+        finally:
+            if token is not None:
+                token.unregister(cancel_key)
+            if self.futures or self.prefill_futures:
+                # 中止或出错时取消本任务尚未开始的单元
+                self.scheduler.cancel_task(self.task_id)
+                for future in list(self.futures) + list(self.prefill_futures):
+                    future.cancel()
+        if self.completed_units:
+            # 重叠执行时画像在执行过程中到达，恢复的单元数在全部画像到达后才确定
+            self.stats['resumed_units'] = self.resumed_units
+        return self.collect_results()
+
+    def _wait_all(self, token):
+        while self.futures or self.prefill_futures or not self.stream_closed:
+            if (self.should_stop and self.should_stop()) or (token is not None and token.cancelled):
+                raise TaskCancelled()
+            if not self.stream_closed:
+                received = len(self.personas)
+                self.stream_closed = self.receive_personas()
+                if self.stream_closed or len(self.personas) > received:
+                    self.report_progress()
+            waiting = list(self.futures) + list(self.prefill_futures)
+            if not self.stream_closed:
+                # 新画像到达时立即返回，调度其模拟单元
+                waiting.append(self.persona_stream.arrival(len(self.personas)))
+            if not waiting:
+                break
+            done, _ = concurrent.futures.wait(waiting, timeout=1, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future in self.prefill_futures:
+                    self._handle_prefill(future)
+                elif future in self.futures:
+                    self._handle_unit(future, token)
+
+    def collect_results(self):
+        if self.stats['wasted_calls'] or self.stats['failed_units']:
+            print(f"模拟重试统计: {self.stats}")
+
+        all_results = []
+        for index, simulation_results in enumerate(self.results_by_persona):
+            simulation_results = simulation_results or []
+            # 确保返回足够数量的结果
+            if len(simulation_results) < self.initial_sims and index in self.batches:
+                batch = self.batches[index]
+                filled = len(simulation_results)
+                fill_missing_results(simulation_results, batch.persona_id, batch.persona,
+                                     self.initial_sims, batch.instance_id)
+                for result in simulation_results[filled:]:
+                    self._record_result(result)
+            all_results.extend(simulation_results)
+        return all_results
+
+
+class AdaptiveTaskSimulation(TaskSimulation):
+    """
+    自适应模拟：每个画像先模拟一次，首轮全部完成后按指标置信区间向方差高的画像追加模拟，
+    区间收敛后取消排队中的追加单元（总数不超过 画像数×模拟次数），统计写入retry_stats['adaptive']
+    """
+
+    def __init__(self, task_id, product_desc, personas, num_simulations, **options):
+        if isinstance(personas, PersonaStream) or options.get("throughput_mode"):
+            raise ValueError("自适应模式和吞吐模式需要完整的画像列表，不能与画像生成重叠执行")
+        self.sampler = SequentialSampler(personas, num_simulations)
+        # 追加的单元 future 集合，收敛时取消尚未开始的部分
+        self.extra_futures = set()
+        super().__init__(task_id, product_desc, personas, num_simulations, **options)
+
+    @property
+    def initial_sims(self) -> int:
+        return 1
+
+    @property
+    def max_sims(self) -> int:
+        return self.sampler.max_per_persona
+
+    def _uses_sampling(self) -> bool:
+        # n采样一次得到全部模拟的初步反应，与按需追加模拟互斥
+        return False
+
+    def _on_persona_error(self, index):
+        self.sampler.exclude(index)
+
+    def _on_resumed_unit(self, index, result):
+        self.sampler.assign(index)
+        self.sampler.record(index, result)
+
+    def _on_units_assigned(self, index, count):
+        for _ in range(count):
+            self.sampler.assign(index)
+
+    def _on_persona_resumed(self, index):
+        # 首轮已完成的画像仍可能被追加模拟
+        pass
+
+    def submit_unit(self, index, sim_index):
+        future = super().submit_unit(index, sim_index)
+        if sim_index >= self.initial_sims:
+            self.extra_futures.add(future)
+        return future
+
+    def _first_pass_done(self):
+        return not self.prefill_futures and all(
+            len([j for j in batch.results if j < self.initial_sims]) == self.initial_sims
+            for batch in self.batches.values()
+        )
+
+    def _schedule_more(self):
+        """
+        首轮模拟全部完成后，在并发窗口内按置信区间追加模拟；区间收敛后取消排队中的追加单元
+        """
+        if not self._first_pass_done():
+            return
+        in_flight = len(self.extra_futures)
+        for index in self.sampler.next_personas(max(0, self.scheduler.max_workers - in_flight)):
+            batch = self.batches[index]
+            sim_index = batch.next_sim
+            batch.next_sim += 1
+            self.submit_unit(index, sim_index)
+        if self.sampler.converged():
+            for future in list(self.extra_futures):
+                if future.cancel():
+                    self.extra_futures.discard(future)
+                    self.futures.pop(future, None)
+
+    def progress_totals(self):
+        return len(self.personas), self.sampler.budget
+
+    def _initial_counts(self):
+        completed_count = (len(self.personas) - len(self.batches)) * self.num_simulations + self.resumed_units
+        completed_personas = len(self.personas) - len(self.batches) + \
+            sum(1 for b in self.batches.values() if b.results)
+        return completed_count, completed_personas
+
+    def _handle_unit(self, future, token):
+        self.extra_futures.discard(future)
+        super()._handle_unit(future, token)
+
+    def _accept_result(self, index, sim_index, result):
+        batch = self.batches[index]
+        # 追加的模拟是可选的，最终失败时直接丢弃，不写入错误替代结果
+        if "error" not in result or sim_index < self.initial_sims:
+            if not batch.results:
+                self.completed_personas += 1
+            batch.results[sim_index] = result
+            self._record_result(result)
+        self.sampler.record(index, result)
+        self._schedule_more()
+
+    def collect_results(self):
+        for index, batch in self.batches.items():
+            self.results_by_persona[index] = batch.ordered_results()
+        executed_units = sum(len(b.results) for b in self.batches.values()) + \
+            sum(self.num_simulations for i in range(len(self.personas)) if i not in self.batches)
+        self.stats['adaptive'] = self.sampler.summary(executed_units,
+                                                      calls_per_unit=simulation_calls_per_unit(self.profile))
+        print(f"自适应模拟: 执行 {executed_units}/{self.sampler.budget} 个单元，"
+              f"{'已收敛' if self.stats['adaptive']['converged'] else '预算用尽仍未收敛'}")
+        return super().collect_results()
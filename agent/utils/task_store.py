@@ -0,0 +1,98 @@
+import json
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Tuple
+
+
+class TaskStore:
+    """
+    多进程共享的任务数据存储（SQLite，每个任务一行JSON）
+    独立工作进程把执行中任务的进度和结果写入这里，Web进程从这里读取并合并到自己的任务字典
+    """
+
+    def __init__(self, path):
+        """
+        path: 数据库文件路径（可以与任务队列使用同一个文件）
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        # 任务ID -> 本实例最近一次写入的JSON，内容没有变化时跳过写入
+        self._written = {}
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS task_state ("
+                " task_id TEXT PRIMARY KEY,"
+                " data TEXT NOT NULL,"
+                " updated_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS task_state_updated ON task_state (updated_at)")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def put(self, task_id, task: Dict) -> bool:
+        """
+        写入任务数据
+        返回: 是否实际写入（内容与上次写入相同时跳过）
+        """
+        try:
+            data = json.dumps(task, ensure_ascii=False)
+        except Exception as e:
+            # 任务字典可能正被其他线程修改，下次写入时重试
+            print(f"序列化任务 {task_id} 时出错: {str(e)}")
+            return False
+        with self.lock:
+            if self._written.get(task_id) == data:
+                return False
+            try:
+                with self._connect() as conn:
+                    conn.execute(
+                        "INSERT INTO task_state (task_id, data, updated_at) VALUES (?, ?, ?)"
+                        " ON CONFLICT(task_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+                        (task_id, data, time.time()),
+                    )
+            except Exception as e:
+                print(f"写入共享任务数据时出错: {str(e)}")
+                return False
+            self._written[task_id] = data
+            return True
+
+    def save_many(self, tasks: Dict[str, Dict]) -> int:
+        """
+        批量写入任务数据（独立工作进程中代替save_tasks写tasks.json）
+        返回: 实际写入的任务数
+        """
+        return sum(1 for task_id, task in list(tasks.items()) if self.put(task_id, task))
+
+    def get(self, task_id):
+        with self._connect() as conn:
+            row = conn.execute("SELECT data FROM task_state WHERE task_id = ?", (task_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def changed_since(self, since: float) -> Tuple[List[Tuple[str, Dict]], float]:
+        """
+        读取某个时间点之后更新过的任务
+        since: 上次读取返回的时间戳，首次读取传0
+        返回: ([(任务ID, 任务数据)], 本次读到的最新更新时间)
+        """
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT task_id, data, updated_at FROM task_state WHERE updated_at > ? ORDER BY updated_at",
+                (since,),
+            ).fetchall()
+        latest = max((row[2] for row in rows), default=since)
+        return [(row[0], json.loads(row[1])) for row in rows], latest
+
+    def remove(self, task_id):
+        with self.lock:
+            self._written.pop(task_id, None)
+            with self._connect() as conn:
+                conn.execute("DELETE FROM task_state WHERE task_id = ?", (task_id,))
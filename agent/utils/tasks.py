@@ -1,12 +1,20 @@
 import json
 import os
+from .task_store import TaskStore
+from .cancellation import cancel_task_token
+
+# 已结束的任务状态
+FINISHED_TASK_STATUSES = ('completed', 'failed', 'stopped')
 
 def save_tasks(tasks=None, tasks_file=None):
     """
     将任务数据保存到文件
     tasks: 任务数据
-    tasks_file(json): 任务数据文件路径
+    tasks_file(json): 任务数据文件路径；独立工作进程中为共享的TaskStore
     """
+    if isinstance(tasks_file, TaskStore):
+        tasks_file.save_many(tasks)
+        return
     try:
         # 创建一个副本，移除不需要保存的数据
         tasks_to_save = {}
@@ -63,6 +71,8 @@ def stop_task(task_id, tasks=None, tasks_file=None, task_stop_flags=None):
     """
     if task_id in tasks:
         task_stop_flags[task_id] = True
+        # 正在本进程中执行的任务立即断开进行中的模型调用、取消尚未开始的工作单元
+        cancel_task_token(task_id)
         update_task_status(task_id, status='stopped', progress={
             'current_step': 'stopped',
             'completed': 0,
@@ -72,3 +82,18 @@ def stop_task(task_id, tasks=None, tasks_file=None, task_stop_flags=None):
         return True
     return False
 
+
+def merge_stored_task(task_id, task, tasks=None):
+    """
+    把工作进程写入共享存储的任务数据合并到本进程的任务数据
+    已中止（stopped）的任务不被工作进程收到取消请求之前写入的执行中状态覆盖
+    task_id: 任务ID
+    task: 共享存储中的任务数据
+    tasks: 本进程的任务数据
+    返回: 任务状态是否变化
+    """
+    current = tasks.get(task_id, {})
+    if current.get('status') == 'stopped' and task.get('status') not in FINISHED_TASK_STATUSES:
+        return False
+    tasks[task_id] = task
+    return current.get('status') != task.get('status')
@@ -1,10 +1,30 @@
 import json
+import os
+import re
 import threading
+from collections import defaultdict
 from dataclasses import dataclass, field
 from typing import Dict, List, Optional, Tuple
 
 from .api_utils import call_ai_api
 from .bocha_web_search import WebDoc, bocha_web_search, normalize_bocha_results
+from .generate_utils import estimate_tokens
+from .persona_dedup import char_shingles, jaccard
+
+# Per-stage token budgets for the compressed evidence block. Initial reactions get the
+# fullest view; follow-up stages already carry the persona's earlier answers, and the
+# inquiry stage only needs enough context to ask pointed questions.
+DEFAULT_EVIDENCE_STAGE_BUDGETS = {
+    "initial": int(os.getenv("WEB_EVIDENCE_INITIAL_TOKENS", "500")),
+    "refined": int(os.getenv("WEB_EVIDENCE_REFINED_TOKENS", "300")),
+    "optimized_product": int(os.getenv("WEB_EVIDENCE_OPTIMIZE_TOKENS", "250")),
+    "ad_copy": int(os.getenv("WEB_EVIDENCE_AD_COPY_TOKENS", "200")),
+    "inquiry": int(os.getenv("WEB_EVIDENCE_INQUIRY_TOKENS", "100")),
+}
+# Snippets whose character-shingle Jaccard similarity reaches this value are collapsed.
+EVIDENCE_DUPLICATE_THRESHOLD = float(os.getenv("WEB_EVIDENCE_DUPLICATE_THRESHOLD", "0.6"))
+
+_SENTENCE_END = re.compile(r"(?<=[。！？!?；;.])\s*")
 
 
 @dataclass
@@ -152,6 +172,205 @@ def build_web_context_block(session: WebSearchSession, *, max_docs: int = 8) ->
     return "\n".join(lines)
 
 
+def _clean_snippet(text: str) -> str:
+    return " ".join((text or "").split())
+
+
+def _truncate_snippet(snippet: str, max_chars: int) -> str:
+    """
+    Cut a snippet to max_chars, preferring the last sentence boundary that keeps
+    at least half of the allowance.
+    """
+    if len(snippet) <= max_chars:
+        return snippet
+    if max_chars <= 1:
+        return ""
+    head = snippet[:max_chars - 1]
+    cut = 0
+    for match in _SENTENCE_END.finditer(head):
+        if match.start() >= max_chars // 2:
+            cut = match.start()
+    return head[:cut] if cut else head + "…"
+
+
+class WebEvidence:
+    """
+    Ranked, de-duplicated web evidence with one token-budgeted block per simulation stage.
+
+    Used wherever a web_context string is accepted: str() gives the fullest (initial) block
+    and truthiness reflects whether any evidence survived. Prompt builders call
+    for_stage() instead, which also records how many tokens each stage injected so the
+    savings over the uncompressed block can be reported per task.
+    """
+
+    def __init__(self, docs: List[Tuple[WebDoc, float]], product_description: str, *,
+                 baseline_block: str = "", duplicates_removed: int = 0,
+                 stage_budgets: Optional[Dict[str, int]] = None):
+        """
+        docs: (doc, relevance) pairs, most relevant first, duplicates already removed
+        product_description: the simulated product (kept for the summary only)
+        baseline_block: the uncompressed block this evidence replaces
+        duplicates_removed: number of near-duplicate snippets that were collapsed
+        stage_budgets: stage name -> token budget, defaults to DEFAULT_EVIDENCE_STAGE_BUDGETS
+        """
+        self.docs = docs
+        self.product_description = product_description
+        self.duplicates_removed = duplicates_removed
+        self.stage_budgets = dict(stage_budgets or DEFAULT_EVIDENCE_STAGE_BUDGETS)
+        self.baseline_tokens = estimate_tokens(baseline_block)
+        self.blocks = {stage: self._build_block(budget) for stage, budget in self.stage_budgets.items()}
+        self._usage = defaultdict(lambda: [0, 0])  # stage -> [calls, injected tokens]
+        self._lock = threading.Lock()
+
+    def _build_block(self, budget: int) -> str:
+        """
+        Greedily fill the budget with the most relevant snippets; each source gets a title
+        line and as much of its snippet as the remaining budget allows.
+        """
+        if not self.docs or budget <= 0:
+            return ""
+        header = "### Web search evidence (ranked by relevance)"
+        lines = [header]
+        used = estimate_tokens(header)
+        for i, (doc, _) in enumerate(self.docs, start=1):
+            title = (doc.title or "").strip() or doc.url or f"Source {i}"
+            title_line = f"[{i}] {title}"
+            title_tokens = estimate_tokens(title_line)
+            # Approximate chars for the remaining budget using the same 1.5 chars/token ratio.
+            snippet_chars = min(280, int((budget - used - title_tokens) * 1.5) - 6)
+            if snippet_chars < 40:
+                break
+            snippet = _truncate_snippet(_clean_snippet(doc.snippet), snippet_chars)
+            lines.append(title_line)
+            if snippet:
+                lines.append(f"    - {snippet}")
+            used = estimate_tokens("\n".join(lines))
+        return "\n".join(lines) if len(lines) > 1 else ""
+
+    def for_stage(self, stage: Optional[str]) -> str:
+        """
+        Evidence block for a simulation stage (unknown stages get the initial block),
+        recording the injected tokens.
+        """
+        block = self.blocks.get(stage or "initial")
+        if block is None:
+            stage, block = "initial", self.blocks.get("initial", "")
+        if block:
+            with self._lock:
+                usage = self._usage[stage]
+                usage[0] += 1
+                usage[1] += estimate_tokens(block)
+        return block
+
+    def to_payload(self) -> Dict:
+        """
+        Serializable form for simulation units executed on other worker nodes.
+        """
+        return {"blocks": dict(self.blocks), "baseline_tokens": self.baseline_tokens}
+
+    @classmethod
+    def from_payload(cls, payload: Dict) -> "WebEvidence":
+        """
+        Rebuild prebuilt stage blocks on a worker node; usage recorded there is sent back
+        with the unit result and merged into the coordinator's instance.
+        """
+        evidence = cls.__new__(cls)
+        evidence.docs = []
+        evidence.product_description = ""
+        evidence.duplicates_removed = 0
+        evidence.blocks = dict(payload.get("blocks") or {})
+        evidence.stage_budgets = {}
+        evidence.baseline_tokens = payload.get("baseline_tokens", 0)
+        evidence._usage = defaultdict(lambda: [0, 0])
+        evidence._lock = threading.Lock()
+        return evidence
+
+    def usage(self) -> Dict[str, List[int]]:
+        with self._lock:
+            return {stage: list(values) for stage, values in self._usage.items()}
+
+    def merge_usage(self, usage: Dict[str, List[int]]) -> None:
+        with self._lock:
+            for stage, (calls, tokens) in (usage or {}).items():
+                self._usage[stage][0] += calls
+                self._usage[stage][1] += tokens
+
+    def __bool__(self) -> bool:
+        return any(self.blocks.values())
+
+    def __str__(self) -> str:
+        return self.blocks.get("initial", "")
+
+    def summary(self) -> Dict:
+        """
+        Prompt-token accounting: what each stage injected versus injecting the
+        uncompressed block into the same calls.
+        """
+        usage = self.usage()
+        calls = sum(c for c, _ in usage.values())
+        injected = sum(t for _, t in usage.values())
+        baseline = calls * self.baseline_tokens
+        saved = max(0, baseline - injected)
+        return {
+            "documents": len(self.docs),
+            "duplicates_removed": self.duplicates_removed,
+            "baseline_tokens_per_call": self.baseline_tokens,
+            "stage_tokens": {stage: estimate_tokens(block) for stage, block in self.blocks.items()},
+            "calls": {stage: c for stage, (c, _) in usage.items()},
+            "injected_tokens": injected,
+            "baseline_tokens": baseline,
+            "saved_tokens": saved,
+            "saved_ratio": round(saved / baseline, 3) if baseline else 0,
+        }
+
+
+def compress_web_evidence(session: WebSearchSession, product_description: str, *,
+                          max_docs: int = 8,
+                          duplicate_threshold: float = EVIDENCE_DUPLICATE_THRESHOLD,
+                          stage_budgets: Optional[Dict[str, int]] = None) -> WebEvidence:
+    """
+    Rank retrieved snippets against the product description, collapse near-duplicates
+    (same URL or similar snippet text) and return per-stage evidence blocks.
+    Ranking uses character-shingle overlap, so it works for Chinese text without tokenization.
+    """
+    product_shingles = char_shingles(product_description, k=2)
+    scored = []
+    for position, doc in enumerate(session.all_docs()):
+        text = f"{doc.title or ''} {doc.snippet or ''}"
+        shingles = char_shingles(text, k=2)
+        if not shingles:
+            continue
+        overlap = len(shingles & product_shingles)
+        # Normalise by both sizes so long snippets do not win on length alone.
+        relevance = overlap / ((len(shingles) * max(1, len(product_shingles))) ** 0.5)
+        scored.append((relevance, -position, doc))
+    scored.sort(key=lambda item: (item[0], item[1]), reverse=True)
+
+    kept: List[Tuple[WebDoc, float]] = []
+    kept_shingles: List[set] = []
+    seen_urls = set()
+    duplicates = 0
+    for relevance, _, doc in scored:
+        shingles = char_shingles(_clean_snippet(doc.snippet) or doc.title or "")
+        if (doc.url and doc.url in seen_urls) or any(
+                jaccard(shingles, other) >= duplicate_threshold for other in kept_shingles):
+            duplicates += 1
+            continue
+        if doc.url:
+            seen_urls.add(doc.url)
+        kept.append((doc, round(relevance, 4)))
+        kept_shingles.append(shingles)
+        if len(kept) >= max_docs:
+            break
+
+    return WebEvidence(
+        kept, product_description,
+        baseline_block=build_web_context_block(session, max_docs=max_docs),
+        duplicates_removed=duplicates,
+        stage_budgets=stage_budgets,
+    )
+
+
 def summarize_web_docs_with_llm(
     session: WebSearchSession,
     *,
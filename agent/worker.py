@@ -0,0 +1,145 @@
+"""
+独立的任务工作进程：从共享的任务队列领取分析任务并执行，进度和结果写入共享任务存储
+Web进程设置 TASK_WORKER_MODE=external 后只负责入队和提供状态，分析流程和报告生成都在工作进程中执行
+
+用法:
+    python -m agent.worker [--workers 2] [--name worker@主机名]
+
+可以在同一台机器上启动多个工作进程（使用不同的 --name），它们通过 data/jobs.db 协调领取任务
+"""
+import argparse
+import os
+import socket
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from models import load_model_pool
+from agent.utils.job_queue import (
+    DEFAULT_TASK_WORKERS,
+    JobQueue,
+    TaskWorkerPool,
+    get_job_queue_path,
+)
+from agent.utils.cancellation import cancel_task_token
+from agent.utils.runner import INTERRUPTED_TASK_STATUSES, run_queued_task
+from agent.utils.task_store import TaskStore
+from agent.utils.tasks import FINISHED_TASK_STATUSES
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# 执行中任务的进度写入共享存储、检查取消请求的间隔（秒）
+WORKER_SYNC_SECONDS = float(os.getenv("TASK_WORKER_SYNC_SECONDS", "1"))
+
+
+class WorkerApp:
+    """
+    工作进程中代替Flask应用实例，只提供任务流程用到的目录配置（与app.py一致）
+    """
+
+    def __init__(self, root=PROJECT_ROOT):
+        self.config = {
+            'UPLOAD_FOLDER': os.path.join(root, 'data'),
+            'REPORTS_FOLDER': os.path.join(root, 'reports'),
+        }
+        os.makedirs(self.config['UPLOAD_FOLDER'], exist_ok=True)
+        os.makedirs(self.config['REPORTS_FOLDER'], exist_ok=True)
+
+
+class TaskWorker:
+    """
+    工作进程：
+    - 工作线程池从任务队列领取任务，从共享存储读取任务数据后执行
+    - 同步线程定期把执行中任务的进度写入共享存储，并把Web进程的取消请求转为任务的中止标志
+    """
+
+    def __init__(self, app, queue: JobQueue, store: TaskStore, model_pool,
+                 max_workers=DEFAULT_TASK_WORKERS, name=None):
+        self.app = app
+        self.queue = queue
+        self.store = store
+        self.model_pool = model_pool
+        self.name = name or f"worker@{socket.gethostname()}"
+        # 本进程正在执行的任务
+        self.tasks = {}
+        self.task_stop_flags = {}
+        self.pool = TaskWorkerPool(queue, self.run_task, max_workers=max_workers, name=self.name)
+
+    def run_task(self, task_id):
+        task = self.store.get(task_id)
+        if task is None:
+            print(f"共享存储中没有任务数据，跳过: {task_id}")
+            return False
+        self.tasks[task_id] = task
+        try:
+            # 任务流程中的save_tasks会写入共享存储而不是Web进程的tasks.json
+            return run_queued_task(task_id, self.tasks, self.task_stop_flags,
+                                   self.store, self.model_pool, self.app)
+        finally:
+            self.store.put(task_id, self.tasks[task_id])
+            self.tasks.pop(task_id, None)
+            self.task_stop_flags.pop(task_id, None)
+
+    def recover(self):
+        """
+        重新排队本工作进程上次退出时中断的任务，任务状态恢复为pending以便重新执行（已完成部分从检查点恢复）
+        返回: 重新排队的任务ID列表
+        """
+        requeued = self.queue.requeue_running(worker=self.name)
+        for task_id in requeued:
+            task = self.store.get(task_id)
+            if task and task.get('status') in INTERRUPTED_TASK_STATUSES:
+                task['status'] = 'pending'
+                task.pop('error', None)
+                task['resume_count'] = task.get('resume_count', 0) + 1
+                self.store.put(task_id, task)
+            print(f"重新排队中断的任务: {task_id}")
+        return requeued
+
+    def sync_once(self):
+        running = list(self.tasks)
+        for task_id in self.queue.cancel_requested(running):
+            if not self.task_stop_flags.get(task_id):
+                print(f"收到取消请求，中止任务: {task_id}")
+                self.task_stop_flags[task_id] = True
+                cancel_task_token(task_id)
+        for task_id in running:
+            task = self.tasks.get(task_id)
+            if task is None:
+                continue
+            # 收到取消请求后任务很快以stopped结束（run_task最后写入），期间的执行中进度不再写入，以免覆盖Web进程的stopped
+            if self.task_stop_flags.get(task_id) and task.get('status') not in FINISHED_TASK_STATUSES:
+                continue
+            self.store.put(task_id, task)
+
+    def serve_forever(self):
+        self.recover()
+        self.pool.start()
+        print(f"工作进程 {self.name} 已启动，工作线程数 {self.pool.max_workers}")
+        while True:
+            try:
+                self.sync_once()
+            except Exception as e:
+                print(f"同步任务进度时出错: {str(e)}")
+            time.sleep(WORKER_SYNC_SECONDS)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="从共享任务队列领取并执行分析任务")
+    parser.add_argument("--workers", type=int, default=DEFAULT_TASK_WORKERS, help="同时执行的任务数")
+    parser.add_argument("--name", default=None, help="工作进程名称，重启时用同一名称恢复中断的任务")
+    args = parser.parse_args()
+
+    app = WorkerApp()
+    db_path = get_job_queue_path(app)
+    worker = TaskWorker(app, JobQueue(db_path), TaskStore(db_path), load_model_pool(),
+                        max_workers=args.workers, name=args.name)
+    try:
+        worker.serve_forever()
+    except KeyboardInterrupt:
+        print(f"工作进程 {worker.name} 退出")
+
+
+if __name__ == "__main__":
+    main()
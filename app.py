@@ -16,13 +16,35 @@ from dotenv import load_dotenv
 load_dotenv()
 
 from agent import(
-    run_analysis_task,
+    run_queued_task,
+    enqueue_analysis_task,
+    submit_analysis_task,
+    settle_attached_tasks,
+    resume_interrupted_tasks,
+    is_task_auto_resume_enabled,
+    JOB_RUNNING,
+    JobQueue,
+    TaskWorkerPool,
+    TaskStore,
+    ETA_STATUSES,
+    format_remaining_time,
+    get_eta_model,
+    get_job_queue_path,
+    is_external_worker_mode,
+    TaskCheckpoint,
+    get_checkpoint_path,
+    PIPELINE_PROFILES,
+    estimate_pipeline,
+    resolve_pipeline_profile,
+    parse_product_variants,
     generate_user_personas,
+    MAX_PERSONAS,
     simulate_user_reactions,
     save_tasks,
     load_tasks,
     update_task_status,
     stop_task,
+    merge_stored_task,
     call_ai_api,
     call_ai_api_stream,
     call_ai_api_stream_with_web_search,
@@ -73,6 +95,49 @@ CONVERSATIONS_FOLDER = os.path.join(app.config['UPLOAD_FOLDER'], 'conversations'
 tasks = load_tasks(tasks_file=TASKS_FILE)
 MODEL_POOL = load_model_pool()
 
+# 持久化任务队列和有界的任务工作线程池：同时执行的分析任务数受TASK_QUEUE_WORKERS限制
+task_queue = JobQueue(get_job_queue_path(app))
+
+
+def _run_pool_task(task_id):
+    run_queued_task(task_id, tasks, task_stop_flags, TASKS_FILE, MODEL_POOL, app)
+    # 关联到该任务的相同提交获得同一份结果（任务没有完成时改为单独执行）
+    settle_attached_tasks(tasks, task_pool, TASKS_FILE, task_store=task_store, source_ids=[task_id])
+
+
+task_pool = TaskWorkerPool(task_queue, _run_pool_task)
+# 独立工作进程模式：任务由 python -m agent.worker 执行，本进程只入队并从共享存储读取进度和结果
+task_store = TaskStore(get_job_queue_path(app)) if is_external_worker_mode() else None
+if task_store is None:
+    task_pool.start()
+
+_store_sync_lock = threading.Lock()
+_store_synced_at = 0.0
+
+
+@app.before_request
+def sync_tasks_from_store():
+    """
+    独立工作进程模式下，把工作进程写入共享存储的任务进度和结果合并到本进程的任务数据
+    """
+    global _store_synced_at
+    if task_store is None:
+        return
+    with _store_sync_lock:
+        try:
+            changed, _store_synced_at = task_store.changed_since(_store_synced_at)
+        except Exception as e:
+            print(f"读取共享任务数据时出错: {str(e)}")
+            return
+        status_changed = []
+        for task_id, task in changed:
+            if merge_stored_task(task_id, task, tasks=tasks):
+                status_changed.append(task_id)
+        # 状态变化（例如任务完成）时同步保存到tasks.json，Web进程重启后仍能提供结果
+        if status_changed:
+            save_tasks(tasks=tasks, tasks_file=TASKS_FILE)
+            settle_attached_tasks(tasks, task_pool, TASKS_FILE, task_store=task_store, source_ids=status_changed)
+
 # 添加中止任务的API
 @app.route('/api/task/<task_id>/stop', methods=['POST'])
 def stop_task_api(task_id):
@@ -87,7 +152,11 @@ def stop_task_api(task_id):
     if tasks[task_id]['status'] in ['completed', 'failed', 'stopped']:
         return jsonify({'error': '任务已结束'}), 400
     
+    # 排队中的任务直接出队，执行中的任务由中止标志结束
+    task_queue.cancel(task_id)
     if stop_task(task_id, tasks=tasks, tasks_file=TASKS_FILE, task_stop_flags=task_stop_flags):
+        # 排队中被中止的任务不会再执行，关联到它的相同提交在这里改为单独执行
+        settle_attached_tasks(tasks, task_pool, TASKS_FILE, task_store=task_store, source_ids=[task_id])
         return jsonify({'message': '任务已中止'})
     else:
         return jsonify({'error': '中止任务失败'}), 500
@@ -108,23 +177,20 @@ def restart_task_api(task_id):
     # 只有失败或已中止的任务可以重启
     if task['status'] not in ['failed', 'stopped']:
         return jsonify({'error': '只能重启失败或已中止的任务'}), 400
+
+    # 默认从检查点继续，fresh=1 时丢弃检查点从头执行
+    if request.args.get('fresh') == '1':
+        TaskCheckpoint(get_checkpoint_path(task_id, app)).remove()
     
     # 重置任务状态
     task['status'] = 'pending'
     task['progress'] = {'percentage': 0}
     task.pop('error', None)  # 移除错误信息
+    task.pop('attached_to', None)  # 重启的任务单独执行
     save_tasks(tasks=tasks, tasks_file=TASKS_FILE)
     
-    # 启动新的后台任务
-    thread = threading.Thread(
-        target=run_analysis_task, 
-        args=(task_id, task['product_description'], 
-              task['num_personas'], task['num_simulations'],
-              tasks, task_stop_flags,
-              TASKS_FILE, MODEL_POOL, app)
-    )
-    thread.daemon = True
-    thread.start()
+    # 重新进入任务队列
+    enqueue_analysis_task(task_id, tasks, task_pool, task_store=task_store)
     
     return jsonify({'message': '任务已重启'})
 
@@ -239,6 +305,12 @@ def step2():
         # 验证邮箱格式
         if not email or '@' not in email:
             return render_template('step2.html', error="请提供有效的电子邮箱地址", amount=0)
+
+        # 多方案对比：同一组画像分别模拟每个产品方案（对话中的产品描述为基准方案）
+        try:
+            variants = parse_product_variants(request.form.get('variants'), product_description)
+        except ValueError as e:
+            return render_template('step2.html', error=str(e), amount=0)
         
         # 检查是否是VIP用户
         is_vip, vip_info = is_vip_user(email)
@@ -249,8 +321,9 @@ def step2():
         
         if is_vip:
             # VIP用户特殊处理
-            if num_personas > vip_info['max_personas']:
-                num_personas = vip_info['max_personas']
+            max_personas = min(int(vip_info['max_personas']), MAX_PERSONAS)
+            if num_personas > max_personas:
+                num_personas = max_personas
             if num_simulations > vip_info['max_simulations']:
                 num_simulations = vip_info['max_simulations']
             amount = 0
@@ -266,8 +339,8 @@ def step2():
                 num_simulations = 2
                 amount = 0
             else:
-                # 计算费用
-                total_people = num_personas * num_simulations
+                # 计算费用（多方案任务按全部方案的模拟次数计算）
+                total_people = num_personas * num_simulations * max(1, len(variants))
                 invite_code = request.form.get('valid_invite_code', '')
                 
                 if invite_code and verify_and_use_invite_code(invite_code)[0]:
@@ -294,6 +367,25 @@ def step2():
             'created_at': time.strftime("%Y-%m-%d %H:%M:%S"),
             'progress': {'percentage': 0}
         }
+        # 分析深度：非VIP可选fast/standard，VIP按账户配置
+        pipeline_profile = resolve_pipeline_profile(request.form.get('pipeline_profile'),
+                                                    vip_info if is_vip else None)
+        tasks[task_id]['pipeline_profile'] = pipeline_profile
+        tasks[task_id]['pipeline_estimate'] = estimate_pipeline(pipeline_profile, num_personas, num_simulations,
+                                                                model_pool=MODEL_POOL, num_variants=len(variants) or 1)
+        if variants:
+            tasks[task_id]['variants'] = variants
+        if request.form.get('throughput_mode'):
+            # 吞吐模式：多个画像合并到一次模拟调用中，适合大规模任务
+            tasks[task_id]['throughput_mode'] = request.form.get('throughput_mode') == '1'
+        if request.form.get('adaptive_sampling'):
+            # 自适应模拟：置信区间收敛后提前停止，方差高的画像获得更多模拟
+            tasks[task_id]['adaptive_sampling'] = request.form.get('adaptive_sampling') == '1'
+        if is_vip:
+            # VIP任务允许超过默认的40个画像上限（大规模分层生成）
+            tasks[task_id]['max_personas'] = max_personas
+            if vip_info.get('max_concurrent_tasks'):
+                tasks[task_id]['queue_user_cap'] = int(vip_info['max_concurrent_tasks'])
         save_tasks(tasks=tasks, tasks_file=TASKS_FILE)
         
         # 如果是付费任务且不是VIP用户，发送通知邮件并显示付款页面
@@ -312,15 +404,8 @@ def step2():
                                 qr_code_path=qr_code_path,
                                 task=tasks[task_id])
         
-        # VIP用户或免费任务直接启动
-        thread = threading.Thread(
-            target=run_analysis_task, 
-            args=(task_id, product_description, num_personas, num_simulations,
-                  tasks, task_stop_flags,
-                  TASKS_FILE, MODEL_POOL, app)
-        )
-        thread.daemon = True
-        thread.start()
+        # VIP用户或免费任务直接进入任务队列（相同的提交复用已有任务）
+        task_id = submit_analysis_task(task_id, tasks, task_pool, TASKS_FILE, task_store=task_store)
         
         return render_template('step2.html', 
                             task_id=task_id, 
@@ -353,16 +438,8 @@ def start_task_api(task_id):
     task['status'] = 'pending'
     save_tasks(tasks=tasks, tasks_file=TASKS_FILE)
     
-    # 启动任务
-    thread = threading.Thread(
-        target=run_analysis_task, 
-        args=(task_id, task['product_description'], 
-              task['num_personas'], task['num_simulations'],
-              tasks, task_stop_flags,
-              TASKS_FILE, MODEL_POOL, app)
-    )
-    thread.daemon = True
-    thread.start()
+    # 进入任务队列（相同的提交复用已有任务的结果）
+    submit_analysis_task(task_id, tasks, task_pool, TASKS_FILE, task_store=task_store, new_submission=False)
     
     return jsonify({'message': '任务已启动'})
 
@@ -373,43 +450,76 @@ def task_status(task_id):
         return jsonify({'error': 'Task not found'}), 404
     
     task = tasks[task_id]
+    # 关联到执行中的相同任务时，执行状态、进度和预计完成时间取自该任务（该任务结束时由执行方处理关联的提交）
+    view_id, view = task_id, task
+    if task.get('attached_to') and task['status'] == 'pending' and task['attached_to'] in tasks:
+        view_id, view = task['attached_to'], tasks[task['attached_to']]
     
-    # 计算预计完成时间
+    # 预计完成时间：按历史任务学到的各阶段单元耗时、剩余单元数和当前调用延迟估算（排队中的任务加上排队等待）
+    queue_info = task_queue.position(view_id) if view['status'] == 'pending' else None
+    progress = view.get('progress', {'percentage': 0})
     estimated_time = None
-    if task['status'] in ['generating_personas', 'simulating_reactions'] and 'start_time' in task:
-        elapsed = time.time() - task['start_time']
-        progress = task.get('progress', {}).get('percentage', 0)
-        
-        # Only calculate remaining time when progress is meaningful (> 5%)
-        if progress > 5:
-            estimated_total_seconds = (elapsed / progress) * 100
-            remaining_seconds = estimated_total_seconds - elapsed
-            
-            # Handle edge cases: if remaining time is negative or very small, show "即将完成"
-            if remaining_seconds <= 5:
-                estimated_time = "即将完成"
-            else:
-                # 将剩余时间转换为更友好的格式（分钟和秒）
-                minutes, seconds = divmod(int(remaining_seconds), 60)
-                if minutes > 60:
-                    hours, minutes = divmod(minutes, 60)
-                    estimated_time = f"{hours}小时{minutes}分钟"
-                elif minutes > 0:
-                    estimated_time = f"{minutes}分钟{seconds}秒"
-                else:
-                    estimated_time = f"{seconds}秒"
-        elif progress > 0:
-            # Progress is between 0-5%, show "计算中..."
-            estimated_time = "计算中..."
+    eta = None
+    if view['status'] in ETA_STATUSES:
+        try:
+            eta = get_eta_model(tasks, task_queue).estimate(
+                view, queue_info=queue_info, running=task_queue.counts().get(JOB_RUNNING, 0),
+                workers=task_pool.max_workers)
+        except Exception as e:
+            print(f"估算预计完成时间时出错: {str(e)}")
+        if eta is not None:
+            estimated_time = format_remaining_time(eta['remaining_seconds'])
+            if view['status'] != 'pending':
+                # 按已用时间和预计剩余时间计算的总进度，percentage仍为各阶段上报的进度
+                progress = dict(progress, eta_percentage=eta['progress_percentage'])
+    
+    # 多方案任务：各方案的统计（模拟进行中为实时统计）和完整报告，report_url为方案对比报告
+    variants = None
+    if task.get('variants'):
+        variant_stats = view.get('variant_stats') or []
+        variant_files = task.get('files', {}).get('variants', []) if task.get('status') == 'completed' else []
+        variants = [{
+            'label': variant['label'],
+            'product_description': variant['product_description'],
+            'stats': variant_stats[k] if k < len(variant_stats) else {},
+            'report_url': url_for('public_report_download', task_id=task_id, variant=k + 1)
+            if k < len(variant_files) else None,
+        } for k, variant in enumerate(task['variants'])]
     
     return jsonify({
         'id': task_id,
-        'status': task['status'],
-        'progress': task.get('progress', {'percentage': 0}),
+        'status': view['status'],
+        'progress': progress,
         'estimated_completion_time': estimated_time,
-        'stats': task.get('stats', {}),
+        'eta': eta,
+        # 模拟进行中返回实时统计（结构与最终统计相同），完成后返回最终统计
+        'stats': view.get('stats') or view.get('live_stats', {}),
+        'pipeline_profile': task.get('pipeline_profile'),
+        'pipeline_estimate': task.get('pipeline_estimate'),
+        'adaptive_sampling': task.get('adaptive_sampling_summary'),
+        'web_evidence': task.get('web_evidence_stats'),
+        'queue': queue_info,
+        'cancellation': task.get('cancellation'),
         'error': task.get('error'),
-        'report_url': url_for('public_report_download', task_id=task_id) if task.get('status') == 'completed' and task.get('files', {}).get('report') else None
+        # 复用的任务：关联的执行中任务 / 结果来源的任务
+        'attached_to': task.get('attached_to'),
+        'reused_from': task.get('reused_from'),
+        'report_url': url_for('public_report_download', task_id=task_id) if task.get('status') == 'completed' and task.get('files', {}).get('report') else None,
+        'variants': variants,
+    })
+
+# 各分析深度预设及其调用次数、耗时估算
+@app.route('/api/pipeline_profiles')
+def pipeline_profiles():
+    num_personas = request.args.get('num_personas', 10, type=int)
+    num_simulations = request.args.get('num_simulations', 2, type=int)
+    return jsonify({
+        name: {
+            'label': profile['label'],
+            'description': profile['description'],
+            'estimate': estimate_pipeline(name, num_personas, num_simulations, model_pool=MODEL_POOL),
+        }
+        for name, profile in PIPELINE_PROFILES.items()
     })
 
 # Inline: 在step1直接创建并启动分析任务（免邮箱免支付）
@@ -426,6 +536,10 @@ def inline_task():
     product_description = extract_product_description(conversation)
     if not product_description:
         return jsonify({'error': 'missing product description'}), 400
+    try:
+        variants = parse_product_variants(request.form.get('variants'), product_description)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
     task_id = str(uuid.uuid4())
     tasks[task_id] = {
@@ -440,16 +554,21 @@ def inline_task():
         'created_at': time.strftime("%Y-%m-%d %H:%M:%S"),
         'progress': {'percentage': 0}
     }
+    pipeline_profile = resolve_pipeline_profile(request.form.get('pipeline_profile'), {})
+    tasks[task_id]['pipeline_profile'] = pipeline_profile
+    tasks[task_id]['pipeline_estimate'] = estimate_pipeline(pipeline_profile, num_personas, num_simulations,
+                                                            model_pool=MODEL_POOL, num_variants=len(variants) or 1)
+    if variants:
+        tasks[task_id]['variants'] = variants
+    if request.form.get('throughput_mode'):
+        tasks[task_id]['throughput_mode'] = request.form.get('throughput_mode') == '1'
+    if request.form.get('adaptive_sampling'):
+        tasks[task_id]['adaptive_sampling'] = request.form.get('adaptive_sampling') == '1'
+    # inline任务没有邮箱，按来源地址限制并发
+    tasks[task_id]['queue_user'] = f"inline:{request.remote_addr}"
     save_tasks(tasks=tasks, tasks_file=TASKS_FILE)
 
-    thread = threading.Thread(
-        target=run_analysis_task,
-        args=(task_id, product_description, num_personas, num_simulations,
-              tasks, task_stop_flags,
-              TASKS_FILE, MODEL_POOL, app)
-    )
-    thread.daemon = True
-    thread.start()
+    task_id = submit_analysis_task(task_id, tasks, task_pool, TASKS_FILE, task_store=task_store)
 
     return jsonify({'task_id': task_id})
 
@@ -568,6 +687,13 @@ def public_report_download(task_id):
     task = tasks[task_id]
     if task.get('status') != 'completed' or 'files' not in task or not task['files'].get('report'):
         return '文件未就绪', 404
+    # 多方案任务：variant=序号（从1开始）下载该方案的完整报告，默认为方案对比报告
+    variant = request.args.get('variant', type=int)
+    if variant is not None:
+        variant_files = task['files'].get('variants') or []
+        if not 1 <= variant <= len(variant_files):
+            return '方案不存在', 404
+        return send_file(variant_files[variant - 1]['report'], as_attachment=True)
     return send_file(task['files']['report'], as_attachment=True)
 
 # 后台任务管理页面
@@ -849,5 +975,16 @@ if __name__ == '__main__':
     cleanup_thread = threading.Thread(target=cleanup_expired_tasks)
     cleanup_thread.daemon = True
     cleanup_thread.start()
+
+    # 上次进程领取后中断的队列任务重新排队（任务状态不再是pending的会被工作线程跳过）
+    # 独立工作进程领取的任务由工作进程重启时自行恢复
+    task_queue.requeue_running(worker=task_pool.name)
+    # 先合并工作进程在本进程停止期间完成的任务，避免把已完成的任务当作中断任务
+    sync_tasks_from_store()
+    # 重新排队上次进程退出时仍在执行的任务，已完成的部分从检查点恢复
+    if is_task_auto_resume_enabled():
+        resume_interrupted_tasks(tasks, task_pool, TASKS_FILE, task_store=task_store)
+    # 关联的任务在本进程停止期间已经结束的相同提交，取得结果或改为单独执行
+    settle_attached_tasks(tasks, task_pool, TASKS_FILE, task_store=task_store)
     
     app.run(host='0.0.0.0', port=5001, debug=False) 
\ No newline at end of file
@@ -279,6 +279,42 @@ def get_api_config(model_name: str, model_pool: Dict[str, Any]) -> Optional[Dict
         "model": model_data["config"].get("model_name", actual_model.split("/", 1)[1])
     }
 
+def get_model_pool_concurrency(model_pool: Dict[str, Any], cap: int = 16) -> int:
+    """
+    根据模型池中各API密钥的限制估算可同时进行的请求数
+    密钥可以显式配置max_concurrency；未配置时按rate_limit估算
+    （单次调用通常需要20-30秒，每分钟约30个请求对应1个并发）
+
+    Args:
+        model_pool: 模型配置池
+        cap: 并发上限，避免单个任务占满所有密钥
+
+    Returns:
+        建议的最大并发数（至少为1）
+    """
+    total = 0
+    for model_data in (model_pool or {}).values():
+        for key_config in model_data.get("active_keys", []):
+            max_concurrency = key_config.get("max_concurrency")
+            if max_concurrency is None:
+                max_concurrency = max(1, int(key_config.get("rate_limit", 60)) // 30)
+            total += int(max_concurrency)
+    return max(1, min(cap, total))
+
+def model_supports_n(model_name: str, model_pool: Dict[str, Any]) -> bool:
+    """
+    模型配置中声明了supports_n时，一次请求可以用n参数返回多个采样结果
+
+    Args:
+        model_name: 模型名称
+        model_pool: 模型配置池
+
+    Returns:
+        是否支持n采样
+    """
+    model_data = (model_pool or {}).get(model_name) or {}
+    return bool(model_data.get("config", {}).get("supports_n", False))
+
 if __name__ == "__main__":
     model_pool = load_model_pool()
     print(model_pool)
@@ -0,0 +1,115 @@
+"""
+对比逐个画像模拟与吞吐模式（多个画像合并到一次调用）的耗时、调用次数和质量指标
+
+用法:
+    python other/benchmark_throughput_mode.py <personas.json> <产品描述或产品描述文件> [--simulations 2] [--limit 20]
+
+personas.json 可以直接使用任务生成的 uploads/<task_id>_personas.json
+"""
+import argparse
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from models import load_model_pool
+import agent.utils.simulatiton_generate as simulatiton_generate
+from agent.utils.persona_dedup import char_shingles, jaccard
+from agent.utils.simulation_scheduler import get_simulation_scheduler
+
+
+class CallCounter:
+    """
+    统计模拟过程中的API调用次数
+    """
+
+    def __init__(self, call):
+        self.call = call
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, *args, **kwargs):
+        with self.lock:
+            self.count += 1
+        return self.call(*args, **kwargs)
+
+
+def quality_signals(results):
+    """
+    计算质量指标：错误率、字段完整率、反馈长度、意愿比例，以及不同画像反馈之间的平均相似度
+    （合并调用可能让不同画像的反馈趋同，相似度越低说明画像之间越独立）
+    """
+    total = len(results) or 1
+    errors = sum(1 for r in results if "error" in r)
+    fields = ["initial_impression", "perceived_needs", "barrier_to_adoption", "feedback", "suggested_improvements"]
+    filled = sum(1 for r in results for f in fields if r.get(f) and r.get(f) != "未提供")
+    feedbacks = [r.get("feedback", "") for r in results if "error" not in r]
+    shingles = [char_shingles(f) for f in feedbacks]
+    pairs = list(itertools.combinations(range(len(shingles)), 2))
+    similarity = sum(jaccard(shingles[a], shingles[b]) for a, b in pairs) / len(pairs) if pairs else 0.0
+    return {
+        "error_rate": round(errors / total, 3),
+        "field_fill_rate": round(filled / (total * len(fields)), 3),
+        "avg_feedback_chars": round(sum(len(f) for f in feedbacks) / len(feedbacks), 1) if feedbacks else 0,
+        "would_try_rate": round(sum(1 for r in results if r.get("would_try") is True) / total, 3),
+        "would_buy_rate": round(sum(1 for r in results if r.get("would_buy") is True) / total, 3),
+        "avg_cross_persona_similarity": round(similarity, 3),
+    }
+
+
+def run_mode(personas, product_desc, num_simulations, model_pool, throughput_mode):
+    counter = CallCounter(simulatiton_generate.call_ai_api)
+    simulatiton_generate.call_ai_api = counter
+    stats = {}
+    start = time.time()
+    try:
+        results = simulatiton_generate.simulate_task_reactions(
+            f"benchmark_{'throughput' if throughput_mode else 'standard'}",
+            product_desc, personas, num_simulations,
+            model_pool=model_pool, retry_stats=stats, throughput_mode=throughput_mode,
+        )
+    finally:
+        simulatiton_generate.call_ai_api = counter.call
+    return {
+        "wall_seconds": round(time.time() - start, 1),
+        "api_calls": counter.count,
+        "results": len(results),
+        **quality_signals(results),
+        "stats": stats,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="对比逐个画像模拟与吞吐模式")
+    parser.add_argument("personas", help="用户画像JSON文件")
+    parser.add_argument("product", help="产品描述文本或包含产品描述的文件")
+    parser.add_argument("--simulations", type=int, default=2, help="每个画像的模拟次数")
+    parser.add_argument("--limit", type=int, default=20, help="最多使用的画像数量")
+    args = parser.parse_args()
+
+    with open(args.personas, "r", encoding="utf-8") as f:
+        personas = [p for p in json.load(f) if "error" not in p][:args.limit]
+    product_desc = args.product
+    if os.path.exists(product_desc):
+        with open(product_desc, "r", encoding="utf-8") as f:
+            product_desc = f.read()
+
+    model_pool = load_model_pool()
+    scheduler = get_simulation_scheduler(model_pool)
+    print(f"画像 {len(personas)} 个，每个模拟 {args.simulations} 次，调度器线程数 {scheduler.max_workers}")
+
+    report = {}
+    for name, throughput_mode in (("standard", False), ("throughput", True)):
+        print(f"\n===== 运行 {name} 模式 =====")
+        report[name] = run_mode(personas, product_desc, args.simulations, model_pool, throughput_mode)
+
+    print("\n===== 对比结果 =====")
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
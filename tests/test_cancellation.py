@@ -0,0 +1,157 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from agent.utils import api_utils
+from agent.utils.cancellation import (
+    CancellationToken,
+    TaskCancelled,
+    bind_cancellation,
+    check_cancelled,
+    current_cancellation_token,
+)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_cancel_runs_callbacks_once():
+    token = CancellationToken("t")
+    called = []
+    key = token.register(lambda: called.append("a"))
+    token.register(lambda: called.append("b"))
+    token.unregister(key)
+    assert token.cancel("停止") is True
+    assert token.cancel() is False
+    assert called == ["b"]
+    # 已取消的令牌立即执行新登记的回调
+    assert token.register(lambda: called.append("c")) is None
+    assert called == ["b", "c"]
+    with pytest.raises(TaskCancelled):
+        token.raise_if_cancelled()
+
+
+def test_failing_callback_does_not_block_others():
+    token = CancellationToken()
+    called = []
+    token.register(lambda: 1 / 0)
+    token.register(lambda: called.append(True))
+    token.cancel()
+    assert called == [True]
+
+
+def test_usage_after_cancel_is_accounted():
+    token = CancellationToken("t")
+    finished = token.begin_call()
+    token.end_call(finished, prompt_tokens=100, completion_tokens=50)
+    aborted = token.begin_call()
+    completed = token.begin_call()
+    token.cancel()
+    assert not token.drained.is_set()
+    token.end_call(aborted, prompt_tokens=200, completion_tokens=30, aborted=True)
+    token.end_call(completed, prompt_tokens=300, completion_tokens=40)
+
+    report = token.wait_drained(timeout=1)
+    assert report["in_flight"] == 0
+    assert report["in_flight_at_cancel"] == 2
+    assert report["calls_after_cancel"] == 2
+    assert report["aborted_calls"] == 1
+    # 取消前已结束的调用不计入；取消时在途的调用只计入完整返回的回复
+    assert report["prompt_tokens_in_flight"] == 500
+    assert report["tokens_after_cancel"] == 40
+    assert report["drain_seconds"] is not None
+
+
+def test_cancel_without_in_flight_calls_is_drained():
+    token = CancellationToken()
+    token.cancel()
+    report = token.wait_drained(timeout=0)
+    assert report["in_flight_at_cancel"] == 0
+    assert report["drain_seconds"] == 0
+
+
+def test_sleep_is_interrupted_by_cancel():
+    token = CancellationToken()
+    token.register(lambda: None)
+    started = time.time()
+    token.cancel()
+    with pytest.raises(TaskCancelled):
+        token.sleep(5)
+    assert time.time() - started < 1
+
+
+def test_bound_function_sees_token():
+    token = CancellationToken()
+    seen = bind_cancellation(current_cancellation_token, token)()
+    assert seen is token
+    assert current_cancellation_token() is None
+    token.cancel()
+    with pytest.raises(TaskCancelled):
+        bind_cancellation(check_cancelled, token)()
+
+
+@pytest.mark.parametrize("value, expected", [(None, "False"), ("", "False"), ("1", "True"), ("off", "False")])
+def test_cancellable_streaming_is_opt_in(value, expected):
+    # 开关在导入时读取，在单独的进程中检查
+    env = dict(os.environ)
+    env.pop("API_CANCELLABLE_STREAMING", None)
+    if value is not None:
+        env["API_CANCELLABLE_STREAMING"] = value
+    output = subprocess.run(
+        [sys.executable, "-c", "from agent.utils import api_utils; print(api_utils.CANCELLABLE_STREAMING)"],
+        cwd=ROOT, env=env, capture_output=True, text=True, check=True,
+    ).stdout
+    assert output.strip().splitlines()[-1] == expected
+
+
+def test_cancel_interrupts_blocked_plain_request(monkeypatch):
+    # 本地服务收到请求后不回复，模拟长时间生成的模型调用
+    received = threading.Event()
+    release = threading.Event()
+
+    class SlowHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers["Content-Length"]))
+            received.set()
+            release.wait(10)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SlowHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(api_utils, "CANCELLABLE_STREAMING", False)
+
+    token = CancellationToken("t")
+    api_config = {"api_url": f"http://127.0.0.1:{server.server_address[1]}/v1/chat/completions", "headers": {}}
+    payload = {"model": "m", "messages": [{"role": "user", "content": "你好"}], "stream": False}
+    outcome = []
+
+    def call():
+        try:
+            api_utils._post_chat_completion(api_config, payload, token=token)
+        except BaseException as e:
+            outcome.append(e)
+
+    caller = threading.Thread(target=call)
+    try:
+        caller.start()
+        assert received.wait(5)
+        started = time.time()
+        token.cancel()
+        caller.join(5)
+        assert not caller.is_alive()
+        assert time.time() - started < 1
+        assert len(outcome) == 1 and isinstance(outcome[0], TaskCancelled)
+        report = token.wait_drained(timeout=1)
+        assert report["in_flight"] == 0
+        assert report["aborted_calls"] == 1
+    finally:
+        release.set()
+        server.shutdown()
+        server.server_close()
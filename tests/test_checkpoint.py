@@ -0,0 +1,192 @@
+import json
+import re
+import threading
+import uuid
+
+import agent.utils.persona_generate as persona_generate
+import agent.utils.runner as runner
+import agent.utils.simulatiton_generate as simulatiton_generate
+from agent.utils.checkpoint import TaskCheckpoint, get_checkpoint_path
+from agent.utils.pipeline_profiles import get_pipeline_profile, simulation_calls_per_unit
+from agent.utils.simulation_scheduler import SimulationScheduler
+
+MODEL_POOL = {"test/model": {"config": {"max_tokens": 4096}, "active_keys": [{"api_key": "k", "rate_limit": 60}]}}
+
+REACTION = {
+    "initial_impression": "不错",
+    "would_try": True,
+    "would_buy": False,
+    "is_must_have": False,
+    "would_recommend": True,
+    "dependency_level": "无所谓",
+    "alternatives": [],
+    "barrier_to_adoption": "价格",
+    "feedback": "反馈",
+    "suggested_improvements": "建议",
+}
+
+
+def _persona(i):
+    return {
+        "persona_id": f"persona_{i}",
+        "persona_description": f"画像 {i}",
+        "key_needs": ["a"],
+        "usage_scenarios": ["b"],
+        "user_type": "核心用户",
+        "usage_frequency": "每天一次",
+        "location": "北京",
+    }
+
+
+def test_load_keeps_units_of_the_final_persona_list(tmp_path):
+    checkpoint = TaskCheckpoint(str(tmp_path / "t_checkpoint.jsonl"))
+    checkpoint.record_persona(_persona(0))
+    # 画像阶段结束前记录的单元对应旧的画像序号
+    checkpoint.record_unit(0, 0, {"stale": True})
+    checkpoint.record_personas_complete([_persona(0), _persona(1)])
+    checkpoint.record_unit(1, 0, {"ok": 1})
+    checkpoint.record_unit(0, 1, {"ok": 2}, variant=1)
+    with open(checkpoint.path, "a", encoding="utf-8") as f:
+        f.write('{"type": "unit", "index": 0, "sim')
+
+    state = checkpoint.load()
+    assert state["personas_complete"] is True
+    assert [p["persona_id"] for p in state["personas"]] == ["persona_0", "persona_1"]
+    assert state["units"] == {(1, 0): {"ok": 1}}
+    assert state["variant_units"][1] == {(0, 1): {"ok": 2}}
+
+
+def test_streamed_units_survive_personas_complete(tmp_path):
+    checkpoint = TaskCheckpoint(str(tmp_path / "t_checkpoint.jsonl"))
+    checkpoint.record_persona(_persona(0))
+    checkpoint.record_unit(0, 0, {"ok": 1})
+    checkpoint.record_personas_complete([_persona(0)], keep_units=True)
+    assert checkpoint.load()["units"] == {(0, 0): {"ok": 1}}
+
+
+def test_unfinished_persona_phase_renumbers_units(tmp_path):
+    checkpoint = TaskCheckpoint(str(tmp_path / "t_checkpoint.jsonl"))
+    checkpoint.record_persona(_persona(0), position=0)
+    # 到达顺序1是错误替代画像，不记录到检查点
+    checkpoint.record_persona(_persona(2), position=2)
+    checkpoint.record_unit(0, 0, {"ok": 1})
+    checkpoint.record_unit(1, 0, {"error": "画像生成失败"})
+    checkpoint.record_unit(2, 1, {"ok": 2})
+    checkpoint.record_unit(2, 0, {"ok": 3}, variant=1)
+    state = checkpoint.load()
+    assert state["personas_complete"] is False
+    assert state["personas"] == [_persona(0), _persona(2)]
+    assert state["units"] == {(0, 0): {"ok": 1}, (1, 1): {"ok": 2}}
+    assert state["variant_units"][1] == {(1, 0): {"ok": 3}}
+
+
+def test_resume_only_runs_missing_units(tmp_path, monkeypatch):
+    calls = []
+    lock = threading.Lock()
+
+    def fake_call(messages, **kwargs):
+        with lock:
+            calls.append(messages)
+        return json.dumps(REACTION, ensure_ascii=False)
+
+    monkeypatch.setattr(simulatiton_generate, "call_ai_api", fake_call)
+    personas = [_persona(i) for i in range(3)]
+    profile = get_pipeline_profile("fast")
+    checkpoint = TaskCheckpoint(str(tmp_path / "t_checkpoint.jsonl"))
+    checkpoint.record_personas_complete(personas)
+    resumed = {(0, 0): dict(REACTION, sim_index=1, resumed=True),
+               (0, 1): dict(REACTION, sim_index=2, resumed=True),
+               (2, 1): dict(REACTION, sim_index=2, resumed=True)}
+    for (index, sim_index), result in resumed.items():
+        checkpoint.record_unit(index, sim_index, result)
+
+    stats = {}
+    completed = []
+    results = simulatiton_generate.simulate_task_reactions(
+        "t", "产品", personas, 2, model_pool=MODEL_POOL, scheduler=SimulationScheduler(2),
+        retry_stats=stats, completed_units=checkpoint.load()["units"], profile=profile,
+        on_unit_complete=lambda index, sim_index, result: completed.append((index, sim_index)))
+
+    assert len(results) == 6
+    assert [r.get("resumed", False) for r in results] == [True, True, False, False, False, True]
+    assert sorted(completed) == [(1, 0), (1, 1), (2, 0)]
+    assert stats["resumed_units"] == 3
+    assert len(calls) == 3 * simulation_calls_per_unit(profile)
+
+
+class _App:
+    def __init__(self, folder):
+        self.config = {"UPLOAD_FOLDER": str(folder), "REPORTS_FOLDER": str(folder)}
+
+
+def _generated_persona(user_type, usage_frequency):
+    return {
+        "persona_description": f"一位{uuid.uuid4().hex}的用户，平时喜欢{uuid.uuid4().hex}",
+        "key_needs": ["省时间"],
+        "usage_scenarios": ["月底对账"],
+        "user_type": user_type,
+        "usage_frequency": usage_frequency,
+        "location": "北京",
+    }
+
+
+def test_resume_keeps_units_of_an_interrupted_persona_stream(tmp_path, monkeypatch):
+    monkeypatch.setenv("PERSONA_STREAMING_ENABLED", "1")
+    monkeypatch.setattr(runner, "decide_web_search_queries", lambda **kwargs: (False, [], None))
+    # 保留任务完成后的检查点以便检查
+    monkeypatch.setattr(TaskCheckpoint, "remove", lambda self: None)
+    lock = threading.Lock()
+    requested = []
+    calls = []
+
+    def fake_persona_call(messages, **kwargs):
+        cells = re.findall(r'user_type为"(.+?)"，usage_frequency为"(.+?)"', messages[-1]["content"])
+        with lock:
+            requested.extend(cells)
+        return json.dumps([_generated_persona(*cell) for cell in cells], ensure_ascii=False)
+
+    def fake_simulation_call(messages, **kwargs):
+        with lock:
+            calls.append(messages)
+        return json.dumps(REACTION, ensure_ascii=False)
+
+    monkeypatch.setattr(persona_generate, "call_ai_api", fake_persona_call)
+    monkeypatch.setattr(simulatiton_generate, "call_ai_api", fake_simulation_call)
+
+    # 中断前：到达顺序1为错误替代画像，顺序3的画像恢复时与第一个画像重复而不再被接受
+    first = dict(_generated_persona("核心用户", "每天多次"), persona_id="persona_1")
+    second = dict(_generated_persona("边缘用户", "每天一次"), persona_id="persona_3")
+    duplicate = dict(first, user_type="潜在用户", usage_frequency="每周一次", persona_id="persona_4")
+    app = _App(tmp_path)
+    checkpoint = TaskCheckpoint(get_checkpoint_path("t1", app))
+    for position, persona in ((0, first), (2, second), (3, duplicate)):
+        checkpoint.record_persona(persona, position=position)
+    checkpoint.record_unit(0, 0, dict(REACTION, persona_id="persona_1", sim_index=1, resumed=True))
+    checkpoint.record_unit(0, 1, dict(REACTION, persona_id="persona_1", sim_index=2, resumed=True))
+    checkpoint.record_unit(2, 1, dict(REACTION, persona_id="persona_3", sim_index=2, resumed=True))
+    checkpoint.record_unit(3, 0, dict(REACTION, persona_id="persona_4", sim_index=1, resumed=True))
+
+    tasks = {"t1": {"id": "t1", "email": "inline@local", "product_description": "一款记账App",
+                    "num_personas": 4, "num_simulations": 2, "status": "pending", "pipeline_profile": "fast",
+                    "throughput_mode": False, "adaptive_sampling": False}}
+    runner.run_analysis_task("t1", "一款记账App", 4, 2, tasks, {}, str(tmp_path / "tasks.json"), MODEL_POOL, app)
+
+    task = tasks["t1"]
+    assert task["status"] == "completed"
+    assert task["resumed_from_checkpoint"]["personas"] == 3
+    assert task["simulation_retry_stats"]["resumed_units"] == 3
+    # 前两个画像按原顺序重新接受并重新编号，只为剩余的2个配额单元生成画像
+    assert len(requested) == 2
+    with open(task["files"]["personas"], encoding="utf-8") as f:
+        personas = json.load(f)
+    assert [p["persona_description"] for p in personas[:2]] == [first["persona_description"],
+                                                               second["persona_description"]]
+    with open(task["files"]["simulations"], encoding="utf-8") as f:
+        results = json.load(f)
+    assert [r["persona_id"] for r in results] == [p["persona_id"] for p in personas for _ in range(2)]
+    assert [r.get("resumed", False) for r in results] == [True, True, False, True, False, False, False, False]
+    assert len(calls) == 5 * simulation_calls_per_unit(get_pipeline_profile("fast"))
+
+    state = TaskCheckpoint(get_checkpoint_path("t1", app)).load()
+    assert state["personas_complete"] is True
+    assert sorted(state["units"]) == [(index, sim_index) for index in range(4) for sim_index in range(2)]
@@ -0,0 +1,117 @@
+import concurrent.futures
+import time
+
+import pytest
+
+import agent.utils.distributed_units as distributed_units
+from agent.utils.distributed_units import (
+    UNIT_CANCELLED,
+    UNIT_DONE,
+    UNIT_FAILED,
+    LeasedUnitScheduler,
+    WorkUnitStore,
+    get_local_unit_threads,
+)
+from agent.utils.persona_generate import generate_persona_batch
+from models import get_model_pool_concurrency
+
+MODEL_POOL = {"test/model": {"config": {}, "active_keys": [{"api_key": "k", "max_concurrency": 3}]}}
+
+
+class LocalScheduler:
+    stage_executor = None
+
+    def cancel_task(self, task_id):
+        return 0
+
+
+@pytest.fixture
+def store(tmp_path):
+    return WorkUnitStore(str(tmp_path / "work_units.db"))
+
+
+def _wait_until(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return predicate()
+
+
+def test_expired_lease_is_reassigned(store):
+    store.publish("u1", "t", "persona_batch", {"n": 1}, "coordinator")
+    # 租约立即过期，相当于节点失联
+    assert [unit[0] for unit in store.lease("node-a", 5, lease_seconds=-1)] == ["u1"]
+    assert store.heartbeat("node-a", ["u1"], lease_seconds=-1) == {"u1"}
+    assert [unit[0] for unit in store.lease("node-b", 5)] == ["u1"]
+    assert store.heartbeat("node-a", ["u1"]) == set()
+    # 过期节点的迟到结果被忽略，只接受当前持有租约的节点
+    assert store.complete("u1", "node-a", {"late": True}) is False
+    assert store.complete("u1", "node-b", {"ok": True}) is True
+    assert store.collect("coordinator") == [("u1", UNIT_DONE, {"ok": True}, None)]
+    assert store.counts() == {}
+
+
+def test_live_lease_is_not_reassigned(store):
+    store.publish("u1", "t", "persona_batch", {}, "coordinator")
+    assert len(store.lease("node-a", 5, lease_seconds=60)) == 1
+    assert store.lease("node-b", 5) == []
+
+
+def test_unit_fails_after_max_leases(store):
+    store.publish("u1", "t", "persona_batch", {}, "coordinator")
+    assert len(store.lease("node-a", 1, lease_seconds=-1, max_leases=2)) == 1
+    assert len(store.lease("node-b", 1, lease_seconds=-1, max_leases=2)) == 1
+    assert store.lease("node-c", 1, max_leases=2) == []
+    (unit_id, status, result, error), = store.collect("coordinator")
+    assert (unit_id, status, result) == ("u1", UNIT_FAILED, None)
+    assert "2" in error
+
+
+def test_cancel_only_touches_leased_units_when_asked(store):
+    store.publish("u1", "t", "persona_batch", {}, "coordinator")
+    store.publish("u2", "t", "persona_batch", {}, "coordinator")
+    store.lease("node-a", 1)
+    assert store.cancel(["u1", "u2"]) == 1
+    assert store.counts() == {"leased": 1, UNIT_CANCELLED: 1}
+    assert store.cancel(["u1"], include_leased=True) == 1
+    assert store.fail("u1", "node-a", "boom") is False
+
+
+def test_blank_local_unit_threads_uses_pool_concurrency(monkeypatch):
+    monkeypatch.setenv("DISTRIBUTED_LOCAL_UNIT_THREADS", " ")
+    assert get_local_unit_threads(MODEL_POOL) == get_model_pool_concurrency(MODEL_POOL, cap=16) == 3
+    monkeypatch.delenv("DISTRIBUTED_LOCAL_UNIT_THREADS")
+    assert get_local_unit_threads(MODEL_POOL) == 3
+    monkeypatch.setenv("DISTRIBUTED_LOCAL_UNIT_THREADS", "0")
+    assert get_local_unit_threads(MODEL_POOL) == 0
+
+
+def test_scheduler_caps_in_flight_units_and_cancels(store, monkeypatch):
+    monkeypatch.setattr(distributed_units, "UNIT_POLL_SECONDS", 0.02)
+    scheduler = LeasedUnitScheduler(store, LocalScheduler(), max_in_flight=2)
+    futures = [scheduler.submit("t", generate_persona_batch, "产品", "", [], 0.5 + i / 10) for i in range(4)]
+    assert store.counts() == {"pending": 2}
+    assert len(scheduler.waiting) == 2
+
+    # 尚未发布的单元直接出队，等待方立即看到取消
+    assert futures[3].cancel() is True
+    done, _ = concurrent.futures.wait([futures[3]], timeout=0)
+    assert done == {futures[3]}
+
+    # 已被节点领取的单元不能再取消
+    (unit_id, kind, payload), = store.lease("node-a", 1)
+    assert kind == "persona_batch"
+    assert futures[0].cancel() is False
+    assert not futures[0].cancelled()
+
+    # 已发布但尚未领取的单元从存储中撤回，空出的名额发布下一个等待中的单元
+    assert futures[1].cancel() is True
+    assert _wait_until(lambda: not scheduler.waiting and store.counts().get("pending") == 1)
+
+    assert store.complete(unit_id, "node-a", {"personas": [{"persona_id": "p"}], "attempts": 1})
+    assert futures[0].result(timeout=5)[0] == [{"persona_id": "p"}]
+    assert scheduler.cancel_task("t") == 1
+    assert futures[2].cancelled()
+    assert _wait_until(lambda: scheduler.in_flight == 0 and scheduler.pending_count() == 0)
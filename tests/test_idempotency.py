@@ -0,0 +1,91 @@
+import time
+
+import pytest
+
+from agent.utils.idempotency import (
+    REUSE_CACHED,
+    REUSE_IN_FLIGHT,
+    find_reusable_task,
+    is_cross_owner_reuse_enabled,
+    normalize_product_description,
+    task_idempotency_key,
+)
+
+
+@pytest.fixture(autouse=True)
+def default_modes(monkeypatch):
+    monkeypatch.delenv("SIMULATION_THROUGHPUT_MODE", raising=False)
+    monkeypatch.delenv("SIMULATION_ADAPTIVE_MODE", raising=False)
+
+
+def _task(**fields):
+    task = {"product_description": "一款记账App", "num_personas": 10, "num_simulations": 2,
+            "pipeline_profile": "standard"}
+    task.update(fields)
+    return task
+
+
+def test_key_ignores_formatting_differences():
+    key = task_idempotency_key(_task())
+    assert task_idempotency_key(_task(product_description="  一款 记账ＡＰＰ。 ")) == key
+    assert task_idempotency_key(_task(num_personas="10")) == key
+    assert task_idempotency_key(dict(_task(), email="other@example.com", task_id="x")) == key
+    assert len(key) == 64
+
+
+def test_key_changes_with_result_affecting_options():
+    key = task_idempotency_key(_task())
+    assert task_idempotency_key(_task(product_description="一款记账App，支持多币种")) != key
+    assert task_idempotency_key(_task(num_simulations=3)) != key
+    assert task_idempotency_key(_task(pipeline_profile="fast")) != key
+    assert task_idempotency_key(_task(throughput_mode=True)) != key
+    assert task_idempotency_key(_task(adaptive_sampling=True)) != key
+
+
+def test_key_depends_on_variant_order():
+    a = {"product_description": "方案A"}
+    b = {"product_description": "方案B"}
+    assert task_idempotency_key(_task(variants=[a, b])) != task_idempotency_key(_task(variants=[b, a]))
+    assert task_idempotency_key(_task(variants=[a, b])) == task_idempotency_key(
+        _task(variants=[{"product_description": "方案a。"}, b]))
+
+
+def test_normalize_product_description():
+    assert normalize_product_description("Hello   World!") == "hello world"
+    assert normalize_product_description("记账 App  好用，") == "记账app好用"
+    assert normalize_product_description(None) == ""
+
+
+def test_in_flight_task_is_preferred_over_cached(tmp_path):
+    report = tmp_path / "report.html"
+    report.write_text("report")
+    now = time.time()
+    tasks = {
+        "done": {"idempotency_key": "k", "status": "completed", "end_time": now - 10,
+                 "files": {"report": str(report)}, "email": "a@example.com"},
+        "running": {"idempotency_key": "k", "status": "simulating_reactions", "created_at": "2026-01-01",
+                    "email": "a@example.com"},
+        "new": {"idempotency_key": "k", "status": "pending", "email": "a@example.com"},
+    }
+    assert find_reusable_task(tasks, "k", exclude="new", now=now) == ("running", REUSE_IN_FLIGHT)
+    tasks["running"]["status"] = "failed"
+    assert find_reusable_task(tasks, "k", exclude="new", now=now) == ("done", REUSE_CACHED)
+    report.unlink()
+    assert find_reusable_task(tasks, "k", exclude="new", now=now) == (None, None)
+
+
+def test_reuse_is_scoped_to_owner():
+    tasks = {
+        "alice": {"idempotency_key": "k", "status": "running", "email": "alice@example.com"},
+        "inline": {"idempotency_key": "k", "status": "running", "email": "inline@local", "queue_user": "10.0.0.1"},
+    }
+    assert find_reusable_task(tasks, "k", owner="bob@example.com") == (None, None)
+    assert find_reusable_task(tasks, "k", owner="alice@example.com") == ("alice", REUSE_IN_FLIGHT)
+    assert find_reusable_task(tasks, "k", owner="10.0.0.1") == ("inline", REUSE_IN_FLIGHT)
+
+
+def test_cross_owner_reuse_is_opt_in(monkeypatch):
+    monkeypatch.delenv("TASK_DEDUP_CROSS_OWNER", raising=False)
+    assert is_cross_owner_reuse_enabled() is False
+    monkeypatch.setenv("TASK_DEDUP_CROSS_OWNER", "on")
+    assert is_cross_owner_reuse_enabled() is True
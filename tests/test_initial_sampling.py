@@ -0,0 +1,92 @@
+import json
+import re
+import threading
+
+import agent.utils.simulatiton_generate as simulatiton_generate
+from agent.prompt_template import inquiry_system_prompt, simulation_system_prompt
+from agent.utils.simulation_scheduler import SimulationScheduler
+from models import model_supports_n
+
+REACTION = {
+    "initial_impression": "不错",
+    "would_try": True,
+    "would_buy": False,
+    "is_must_have": False,
+    "would_recommend": True,
+    "dependency_level": "无所谓",
+    "alternatives": [],
+    "barrier_to_adoption": "价格",
+    "feedback": "反馈",
+    "suggested_improvements": "建议",
+    "questions": [{"aspect": "价格", "question": "贵吗"}],
+}
+
+
+def _persona(i):
+    return {"persona_id": f"persona_{i}", "persona_description": f"画像 {i}", "key_needs": ["a"],
+            "usage_scenarios": ["b"], "user_type": "核心用户", "usage_frequency": "每天一次", "location": "北京"}
+
+
+def test_model_supports_n():
+    pool = {"n/model": {"config": {"supports_n": True}}, "plain/model": {"config": {}}}
+    assert model_supports_n("n/model", pool)
+    assert not model_supports_n("plain/model", pool)
+    assert not model_supports_n("missing/model", pool)
+
+
+def test_one_sampling_call_fans_out_to_every_simulation(monkeypatch):
+    lock = threading.Lock()
+    sampling = []
+    single_initial = []
+    inquiries = []
+
+    def fake_call(messages, n=None, **kwargs):
+        system, user = messages[0]["content"], messages[-1]["content"]
+        persona = re.search(r"画像 (\d)", user).group(1)
+        with lock:
+            if system is simulation_system_prompt and n:
+                sampling.append((persona, n))
+                # 画像1的采样中有一个不可用，对应的模拟单独补做初步模拟
+                responses = [json.dumps(dict(REACTION, initial_impression=f"sample-{persona}-{i}"), ensure_ascii=False)
+                             for i in range(n)]
+                if persona == "1":
+                    responses[-1] = "不是JSON"
+                return responses
+            if system is simulation_system_prompt:
+                single_initial.append(persona)
+                return json.dumps(dict(REACTION, initial_impression=f"single-{persona}"), ensure_ascii=False)
+            if system is inquiry_system_prompt:
+                inquiries.append(re.search(r"(sample|single)-\d(-\d)?", user).group(0))
+        return json.dumps(REACTION, ensure_ascii=False)
+
+    monkeypatch.setattr(simulatiton_generate, "call_ai_api", fake_call)
+    stats = {}
+    results = simulatiton_generate.simulate_task_reactions(
+        "t", "产品", [_persona(0), _persona(1)], 3,
+        model_pool={"n/model": {"config": {"supports_n": True}, "active_keys": []}},
+        scheduler=SimulationScheduler(2), retry_stats=stats)
+
+    assert len(results) == 6 and not any("error" in r for r in results)
+    assert sorted(sampling) == [("0", 3), ("1", 3)]
+    assert single_initial == ["1"]
+    # 每个模拟单元基于各自的初步反应继续执行
+    assert sorted(inquiries) == ["sample-0-0", "sample-0-1", "sample-0-2", "sample-1-0", "sample-1-1", "single-1"]
+    assert stats["sampling_calls"] == 2
+    assert stats["sampled_initial_reactions"] == 5
+    assert stats["saved_initial_calls"] == 3
+
+
+def test_models_without_n_simulate_each_unit(monkeypatch):
+    calls = []
+
+    def fake_call(messages, n=None, **kwargs):
+        calls.append(n)
+        return json.dumps(REACTION, ensure_ascii=False)
+
+    monkeypatch.setattr(simulatiton_generate, "call_ai_api", fake_call)
+    stats = {}
+    simulatiton_generate.simulate_task_reactions(
+        "t", "产品", [_persona(0)], 2, model_pool={"plain/model": {"config": {}, "active_keys": []}},
+        scheduler=SimulationScheduler(2), retry_stats=stats)
+    assert set(calls) == {None}
+    assert "sampling_calls" not in stats
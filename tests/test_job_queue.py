@@ -0,0 +1,122 @@
+import itertools
+import types
+
+import pytest
+
+import agent.utils.job_queue as job_queue
+from agent.utils.job_queue import JOB_CANCELLED, JOB_DONE, JOB_QUEUED, JOB_RUNNING, JobQueue, task_priority_class
+from agent.utils.task_store import TaskStore
+from agent.utils.tasks import merge_stored_task, stop_task
+from agent.worker import TaskWorker, WorkerApp
+
+
+@pytest.fixture
+def queue(tmp_path, monkeypatch):
+    # 每次取时间都递增，入队顺序不受时钟精度影响
+    ticks = itertools.count(1000.0)
+    monkeypatch.setattr(job_queue, "time", types.SimpleNamespace(time=lambda: next(ticks)))
+    return JobQueue(str(tmp_path / "jobs.db"))
+
+
+def test_claims_by_priority_then_enqueue_order(queue):
+    queue.enqueue("free-1", "free", user="a")
+    queue.enqueue("paid-1", "paid", user="b")
+    queue.enqueue("free-2", "free", user="c")
+    queue.enqueue("vip-1", "vip", user="d")
+    assert [queue.claim("w") for _ in range(5)] == ["vip-1", "paid-1", "free-1", "free-2", None]
+
+
+def test_per_user_cap_skips_busy_users(queue):
+    queue.enqueue("a-1", user="alice")
+    queue.enqueue("a-2", user="alice")
+    queue.enqueue("b-1", user="bob")
+    queue.enqueue("v-1", user="vip", user_cap=2)
+    queue.enqueue("v-2", user="vip", user_cap=2)
+    claimed = [queue.claim("w") for _ in range(5)]
+    assert claimed == ["a-1", "b-1", "v-1", "v-2", None]
+    queue.finish("a-1")
+    assert queue.claim("w") == "a-2"
+
+
+def test_position_counts_jobs_ahead(queue):
+    queue.enqueue("free-1", "free")
+    queue.enqueue("free-2", "free")
+    queue.enqueue("vip-1", "vip")
+    position = queue.position("free-2")
+    assert position["state"] == JOB_QUEUED
+    assert (position["position"], position["ahead"]) == (3, 2)
+    assert queue.position("missing") is None
+
+
+def test_cancel_queued_job_dequeues_it(queue):
+    queue.enqueue("t1")
+    assert queue.cancel("t1") is True
+    assert queue.position("t1")["state"] == JOB_CANCELLED
+    assert queue.claim("w") is None
+
+
+def test_cancel_running_job_records_request(queue):
+    queue.enqueue("t1")
+    assert queue.claim("w") == "t1"
+    assert queue.cancel("t1") is False
+    assert queue.cancel_requested(["t1", "t2"]) == {"t1"}
+    queue.finish("t1", JOB_CANCELLED)
+    assert queue.cancel_requested(["t1"]) == set()
+    assert queue.counts() == {JOB_CANCELLED: 1}
+
+
+def test_requeue_running_keeps_original_order(queue):
+    queue.enqueue("t1")
+    queue.enqueue("t2")
+    assert queue.claim("old-worker") == "t1"
+    assert queue.requeue_running("other-worker") == []
+    assert queue.requeue_running("old-worker") == ["t1"]
+    assert queue.claim("w") == "t1"
+    assert queue.position("t1")["state"] == JOB_RUNNING
+
+
+def test_re_enqueue_finished_job_runs_again(queue):
+    queue.enqueue("t1")
+    queue.claim("w")
+    queue.finish("t1", JOB_DONE)
+    assert [job["task_id"] for job in queue.recent_jobs()] == ["t1"]
+    queue.enqueue("t1")
+    assert queue.claim("w") == "t1"
+
+
+def test_task_priority_class():
+    assert task_priority_class({"email": "inline@local", "is_vip": True}) == "inline"
+    assert task_priority_class({"is_vip": True}) == "vip"
+    assert task_priority_class({"amount": 9.9}) == "paid"
+    assert task_priority_class({}) == "free"
+
+
+def test_stale_running_status_does_not_undo_stop(queue, tmp_path):
+    store = TaskStore(str(tmp_path / "jobs.db"))
+    worker = TaskWorker(WorkerApp(str(tmp_path)), queue, store, {}, max_workers=1, name="w")
+    queue.enqueue("t1")
+    assert queue.claim("w") == "t1"
+    worker.tasks["t1"] = {"status": "simulating_reactions", "progress": {"percentage": 40}}
+    worker.sync_once()
+    web_tasks = {"t1": {"status": "simulating_reactions"}}
+
+    # Web进程中止任务后，工作进程在收到取消请求之前写入的执行中进度不覆盖stopped
+    stop_task("t1", tasks=web_tasks, tasks_file=str(tmp_path / "tasks.json"), task_stop_flags={})
+    queue.cancel("t1")
+    assert merge_stored_task("t1", store.get("t1"), tasks=web_tasks) is False
+    assert web_tasks["t1"]["status"] == "stopped"
+
+    # 工作进程收到取消请求后不再写入执行中的进度，任务以stopped结束时写入
+    worker.tasks["t1"]["progress"] = {"percentage": 45}
+    worker.sync_once()
+    assert worker.task_stop_flags["t1"] is True
+    assert store.get("t1")["progress"] == {"percentage": 40}
+    worker.tasks["t1"].update(status="stopped", error="任务已被中止")
+    worker.sync_once()
+    assert merge_stored_task("t1", store.get("t1"), tasks=web_tasks) is False
+    assert web_tasks["t1"]["error"] == "任务已被中止"
+
+    # 重启后的任务正常接收执行中的状态
+    web_tasks["t1"]["status"] = "pending"
+    assert merge_stored_task("t1", {"status": "generating_personas"}, tasks=web_tasks) is True
+    assert web_tasks["t1"]["status"] == "generating_personas"
@@ -0,0 +1,49 @@
+from agent.utils.persona_dedup import MinHasher, PersonaSimilarityIndex, TextSimilarityIndex, char_shingles, jaccard
+
+
+def _persona(description, needs=("记账",), scenarios=("通勤",)):
+    return {
+        "persona_description": description,
+        "key_needs": list(needs),
+        "usage_scenarios": list(scenarios),
+        "user_type": "核心用户",
+        "usage_frequency": "每天一次",
+        "location": "北京",
+    }
+
+
+def test_shingles_ignore_whitespace_and_punctuation():
+    assert char_shingles("自由 职业，设计师。") == char_shingles("自由职业设计师")
+    assert jaccard(char_shingles("abc"), set()) == 0.0
+
+
+def test_minhash_signature_is_deterministic():
+    shingles = char_shingles("一位在上海工作的自由职业设计师")
+    assert MinHasher(seed=7).signature(shingles) == MinHasher(seed=7).signature(shingles)
+    assert len(MinHasher(num_perm=32).signature(shingles)) == 32
+
+
+def test_near_duplicate_persona_is_detected():
+    index = PersonaSimilarityIndex(threshold=0.5)
+    index.add("persona_1", _persona("一位在上海工作的三十岁自由职业平面设计师，经常在咖啡馆接单，需要管理多个客户的项目进度和收款"))
+    match = index.find_duplicate(
+        _persona("一位在上海工作的三十岁自由职业平面设计师，经常在咖啡馆接单，需要管理多个客户的项目进度与收款。"))
+    assert match is not None
+    assert match[0] == "persona_1"
+    assert match[1] >= 0.5
+
+
+def test_distinct_persona_is_not_a_duplicate():
+    index = PersonaSimilarityIndex(threshold=0.5)
+    index.add("persona_1", _persona("一位在上海工作的三十岁自由职业平面设计师，经常在咖啡馆接单，需要管理多个客户的项目进度和收款"))
+    assert index.find_duplicate(
+        _persona("退休后住在成都的六十五岁中学老师，每天早上去公园打太极，想给孙子找合适的编程课",
+                 needs=("教育",), scenarios=("周末",))) is None
+    assert len(index) == 1
+
+
+def test_query_respects_threshold():
+    index = TextSimilarityIndex(threshold=0.9)
+    index.add("a", "每天早上在地铁上用手机记账的年轻白领")
+    assert index.query("每天早上在地铁上用手机记账的年轻白领") == [("a", 1.0)]
+    assert index.query("每天早上在地铁上用手机听播客的年轻白领") == []
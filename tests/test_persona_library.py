@@ -0,0 +1,92 @@
+import json
+import re
+import threading
+import uuid
+
+import agent.utils.persona_generate as persona_generate
+from agent.utils.persona_library import PersonaLibrary, is_persona_library_enabled
+
+PRODUCT = "一款记账App，可以自动识别账单并按类别统计每月支出"
+SIMILAR_PRODUCT = "一款记账App，可以自动识别账单并按类别统计每月的支出和预算"
+OTHER_PRODUCT = "智能宠物喂食器，支持定时定量喂食和远程视频查看"
+
+
+def _persona(user_type="核心用户", usage_frequency="每天多次"):
+    return {
+        "persona_description": f"一位{uuid.uuid4().hex}的用户，平时喜欢{uuid.uuid4().hex}",
+        "key_needs": ["省时间"],
+        "usage_scenarios": ["月底对账"],
+        "user_type": user_type,
+        "usage_frequency": usage_frequency,
+        "location": "北京",
+    }
+
+
+class _App:
+    def __init__(self, folder):
+        self.config = {"UPLOAD_FOLDER": str(folder)}
+
+
+def test_library_is_disabled_by_default(monkeypatch):
+    monkeypatch.delenv("PERSONA_LIBRARY_ENABLED", raising=False)
+    assert is_persona_library_enabled() is False
+
+
+def test_library_can_be_enabled(monkeypatch):
+    monkeypatch.setenv("PERSONA_LIBRARY_ENABLED", " yes ")
+    assert is_persona_library_enabled() is True
+    monkeypatch.setenv("PERSONA_LIBRARY_ENABLED", "0")
+    assert is_persona_library_enabled() is False
+
+
+def test_lookup_finds_similar_products(tmp_path):
+    library = PersonaLibrary(str(tmp_path / "library"))
+    library.add("t1", PRODUCT, [_persona(), _persona(), dict(_persona(), error="失败")], seconds_per_persona=4.0)
+    library.add("t2", OTHER_PRODUCT, [_persona()], seconds_per_persona=9.0)
+
+    personas, seconds = library.lookup(SIMILAR_PRODUCT, limit=5)
+    assert len(personas) == 2
+    assert seconds == 4.0
+    assert {p["reused_from"]["task_id"] for p in personas} == {"t1"}
+    assert all(p["reused_from"]["product_similarity"] >= library.similarity_threshold for p in personas)
+    assert len(library.lookup(SIMILAR_PRODUCT, limit=1)[0]) == 1
+    assert library.lookup(SIMILAR_PRODUCT, limit=5, exclude_task_id="t1") == ([], 0.0)
+    assert library.lookup("完全不同的在线编程教育平台", limit=5)[0] == []
+
+    # 重新加载后索引与保存前一致
+    reloaded = PersonaLibrary(str(tmp_path / "library"))
+    assert len(reloaded.lookup(SIMILAR_PRODUCT, limit=5)[0]) == 2
+
+
+def test_only_the_quota_gap_is_generated(tmp_path, monkeypatch):
+    monkeypatch.setenv("PERSONA_LIBRARY_ENABLED", "1")
+    library = PersonaLibrary(str(tmp_path / "persona_library"))
+    # 10个画像的配额中每天多次、每天一次各2个名额，其余频率各1个
+    library.add("old", PRODUCT, [_persona("核心用户", "每天多次"), _persona("核心用户", "每天一次"),
+                                 _persona("潜在用户", "每天多次")], seconds_per_persona=5.0)
+    monkeypatch.setattr(persona_generate, "get_persona_library", lambda library_dir: library)
+    lock = threading.Lock()
+    requested = []
+
+    def fake_call(messages, **kwargs):
+        cells = re.findall(r'user_type为"(.+?)"，usage_frequency为"(.+?)"', messages[-1]["content"])
+        with lock:
+            requested.extend(cells)
+        return json.dumps([_persona(*cell) for cell in cells], ensure_ascii=False)
+
+    monkeypatch.setattr(persona_generate, "call_ai_api", fake_call)
+    tasks = {"t1": {}}
+    personas = persona_generate.generate_user_personas(
+        "t1", SIMILAR_PRODUCT, 10, tasks=tasks, model_pool={"test/model": {"config": {}, "active_keys": []}},
+        app=_App(tmp_path), review=False, hierarchical=False)
+
+    assert len(personas) == 10
+    assert sum("reused_from" in p for p in personas) == 3
+    # 只为缺口的7个配额单元请求生成
+    assert len(requested) == 7
+    assert tasks["t1"]["persona_library"] == {
+        "reused": 3, "generated": 7, "hit_rate": 0.3, "estimated_seconds_saved": 15.0,
+    }
+    # 本次生成的画像保存到画像库，复用的画像不重复保存
+    entries = [entry for entry in library.entries.values() if entry["task_id"] == "t1"]
+    assert [len(entry["personas"]) for entry in entries] == [7]
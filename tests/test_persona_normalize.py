@@ -0,0 +1,87 @@
+import pytest
+
+from agent.utils.generate_utils import _normalize_usage_frequency, is_valid_persona, normalize_persona
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("每周两次", "每周几次"),
+    ("一周一次", "每周一次"),
+    ("一天一次", "每天一次"),
+    ("每天3次", "每天多次"),
+    ("天天使用", "每天一次"),
+    ("每个月一次", "每月一次"),
+    ("每两周一次", "每月几次"),
+    ("一星期三次", "每周几次"),
+    ("偶尔", "偶尔使用"),
+    ("每年一两次", "偶尔使用"),
+    ("几乎不用", "几乎不使用"),
+    ("看心情", None),
+])
+def test_usage_frequency_aliases(value, expected):
+    assert _normalize_usage_frequency(value) == expected
+
+
+def test_near_miss_persona_is_repaired():
+    persona = {
+        "persona_description": "  在杭州做电商运营的年轻人 ",
+        "key_needs": "省时间，数据看板、",
+        "usage_scenarios": ["上班", None, " "],
+        "user_type": "重度用户",
+        "usage_frequency": "一周两次",
+        "location": ["杭州", "上海"],
+    }
+    normalized, changed = normalize_persona(persona)
+    assert normalized == {
+        "persona_description": "在杭州做电商运营的年轻人",
+        "key_needs": ["省时间", "数据看板"],
+        "usage_scenarios": ["上班"],
+        "user_type": "核心用户",
+        "usage_frequency": "每周几次",
+        "location": "杭州、上海",
+    }
+    assert set(changed) == {"persona_description", "key_needs", "usage_scenarios",
+                            "user_type", "usage_frequency", "location"}
+    assert is_valid_persona(normalized)
+    # 原画像不被修改
+    assert persona["user_type"] == "重度用户"
+
+
+def test_missing_fields_get_defaults():
+    normalized, changed = normalize_persona({
+        "persona_description": "学生",
+        "user_type": "潜在",
+        "usage_frequency": "每月一次",
+    })
+    assert normalized["key_needs"] == ["未知需求"]
+    assert normalized["usage_scenarios"] == ["未知场景"]
+    assert normalized["location"] == "未知地区"
+    assert normalized["user_type"] == "潜在用户"
+    assert "usage_frequency" not in changed
+
+
+def test_unmappable_values_are_left_for_validation():
+    normalized, changed = normalize_persona({
+        "persona_description": "学生",
+        "key_needs": ["a"],
+        "usage_scenarios": ["b"],
+        "user_type": "路人",
+        "usage_frequency": "看心情",
+        "location": "北京",
+    })
+    assert normalized["user_type"] == "路人"
+    assert normalized["usage_frequency"] == "看心情"
+    assert changed == []
+    assert not is_valid_persona(normalized)
+
+
+def test_valid_persona_is_unchanged():
+    persona = {
+        "persona_description": "学生",
+        "key_needs": ["a"],
+        "usage_scenarios": ["b"],
+        "user_type": "边缘用户",
+        "usage_frequency": "偶尔使用",
+        "location": "北京",
+    }
+    assert normalize_persona(persona) == (persona, [])
+    assert normalize_persona("not a dict") == ("not a dict", [])
@@ -0,0 +1,83 @@
+from collections import Counter
+
+import pytest
+
+from agent.utils.persona_quota import (
+    DEFAULT_LOCATION_TIER_WEIGHTS,
+    DEFAULT_USAGE_FREQUENCY_WEIGHTS,
+    DEFAULT_USER_TYPE_WEIGHTS,
+    PersonaQuotaPlanner,
+    allocate_counts,
+    pair_marginals,
+    plan_persona_quotas,
+)
+
+
+@pytest.mark.parametrize("total", [0, 1, 2, 7, 10, 33, 100])
+@pytest.mark.parametrize("weights", [DEFAULT_USER_TYPE_WEIGHTS, DEFAULT_USAGE_FREQUENCY_WEIGHTS,
+                                     DEFAULT_LOCATION_TIER_WEIGHTS, {"a": 1, "b": 0}])
+def test_allocate_counts_sums_to_total(total, weights):
+    counts = allocate_counts(total, weights)
+    assert list(counts) == list(weights)
+    assert sum(counts.values()) == total
+    for key, weight in weights.items():
+        exact = total * weight / sum(weights.values())
+        assert int(exact) <= counts[key] <= int(exact) + 1
+
+
+def test_allocate_counts_breaks_ties_in_weight_order():
+    assert allocate_counts(10, DEFAULT_USAGE_FREQUENCY_WEIGHTS) == {
+        "每天多次": 2, "每天一次": 2, "每周几次": 1, "每周一次": 1,
+        "每月几次": 1, "每月一次": 1, "偶尔使用": 1, "几乎不使用": 1,
+    }
+
+
+@pytest.mark.parametrize("num_personas", [1, 2, 10, 47])
+def test_plan_keeps_every_marginal(num_personas):
+    plan = plan_persona_quotas(num_personas, seed=7)
+    assert sum(plan.values()) == num_personas
+    for position, weights in enumerate((DEFAULT_USER_TYPE_WEIGHTS, DEFAULT_USAGE_FREQUENCY_WEIGHTS,
+                                        DEFAULT_LOCATION_TIER_WEIGHTS)):
+        marginal = Counter()
+        for cell, count in plan.items():
+            marginal[cell[position]] += count
+        assert +marginal == +Counter(allocate_counts(num_personas, weights))
+    assert plan == plan_persona_quotas(num_personas, seed=7)
+
+
+def test_pair_marginals_sums_to_total():
+    marginals = [Counter({"a": 3, "b": 1}), Counter({"x": 2, "y": 2}), Counter({"t": 4})]
+    cells = pair_marginals(marginals, seed=1)
+    assert sum(cells.values()) == 4
+    assert sum(count for cell, count in cells.items() if cell[0] == "a") == 3
+    assert sum(count for cell, count in cells.items() if cell[1] == "x") == 2
+
+
+def test_planner_reserves_and_fulfils_every_cell():
+    planner = PersonaQuotaPlanner(10, seed=3)
+    cells = planner.reserve(20)
+    assert len(cells) == 10
+    assert not planner.has_available()
+    planner.release(cells[0])
+    assert planner.reserve(5) == [cells[0]]
+    for cell in cells:
+        assert planner.fulfil(cell, {"user_type": cell[0], "usage_frequency": cell[1]}) == cell
+    summary = planner.summary()
+    assert summary["filled"] == summary["target"] == 10
+    assert summary["unfilled_cells"] == []
+
+
+def test_absorbed_personas_reduce_the_gap():
+    planner = PersonaQuotaPlanner(10, seed=3)
+    assert planner.absorb({"user_type": "核心用户", "usage_frequency": "每天多次"}) is not None
+    assert planner.absorb({"user_type": "核心用户", "usage_frequency": "每天多次"}) is not None
+    # 该频率的名额已用完
+    assert planner.absorb({"user_type": "潜在用户", "usage_frequency": "每天多次"}) is None
+    assert planner.absorb({"user_type": "未知", "usage_frequency": "每天一次"}) is None
+    assert sum(planner.targets.values()) == 8
+    assert sum(count for cell, count in planner.targets.items() if cell[0] == "核心用户") == 1
+    summary = planner.summary()
+    assert (summary["absorbed"], summary["target"]) == (2, 10)
+    # 开始预留后不再吸收
+    planner.reserve(1)
+    assert planner.absorb({"user_type": "潜在用户", "usage_frequency": "每天一次"}) is None
@@ -0,0 +1,217 @@
+import json
+import threading
+
+import pytest
+
+import agent.utils.runner as runner
+import agent.utils.simulatiton_generate as simulatiton_generate
+from agent.utils.cancellation import TaskCancelled, cancel_task_token
+from agent.utils.checkpoint import TaskCheckpoint, get_checkpoint_path
+from agent.utils.persona_stream import PersonaStream
+from agent.utils.pipeline_profiles import get_pipeline_profile
+from agent.utils.simulation_scheduler import SimulationScheduler
+
+MODEL_POOL = {"test/model": {"config": {"max_tokens": 4096}, "active_keys": [{"api_key": "k", "rate_limit": 60}]}}
+
+REACTION = {
+    "initial_impression": "不错",
+    "would_try": True,
+    "would_buy": False,
+    "is_must_have": False,
+    "would_recommend": True,
+    "dependency_level": "无所谓",
+    "alternatives": [],
+    "barrier_to_adoption": "价格",
+    "feedback": "反馈",
+    "suggested_improvements": "建议",
+}
+# 等待另一线程的事件的最长时间（秒），超时说明没有重叠执行
+WAIT_SECONDS = 10
+
+
+def _persona(i):
+    return {
+        "persona_id": f"persona_{i}",
+        "persona_description": f"画像 {i}",
+        "key_needs": ["a"],
+        "usage_scenarios": ["b"],
+        "user_type": "核心用户",
+        "usage_frequency": "每天一次",
+        "location": "北京",
+    }
+
+
+def _fake_call(first_call):
+    def fake_call(messages, **kwargs):
+        first_call.set()
+        return json.dumps(REACTION, ensure_ascii=False)
+    return fake_call
+
+
+def test_read_arrival_and_close():
+    stream = PersonaStream(3)
+    arrival = stream.arrival(0)
+    assert not arrival.done()
+    stream.put(_persona(0))
+    assert arrival.done()
+    assert stream.read(0) == ([_persona(0)], False)
+    assert not stream.arrival(1).done()
+    assert stream.expected() == 3
+    stream.close()
+    assert stream.arrival(1).done()
+    assert stream.read(1) == ([], True)
+    assert stream.expected() == 1
+
+
+def test_close_with_error_reaches_reader():
+    stream = PersonaStream(2)
+    arrival = stream.arrival(0)
+    stream.close(error=RuntimeError("画像生成失败"))
+    assert arrival.done()
+    with pytest.raises(RuntimeError):
+        stream.read(0)
+
+
+def test_abandon_stops_producer():
+    stream = PersonaStream(2)
+    stream.put(_persona(0))
+    stream.abandon()
+    with pytest.raises(TaskCancelled):
+        stream.put(_persona(1))
+    assert len(stream.personas) == 1
+
+
+def test_simulations_start_before_last_persona(monkeypatch):
+    first_call = threading.Event()
+    monkeypatch.setattr(simulatiton_generate, "call_ai_api", _fake_call(first_call))
+    stream = PersonaStream(3)
+    overlapped = []
+
+    def produce():
+        stream.put(_persona(2))
+        stream.put(_persona(0))
+        overlapped.append(first_call.wait(WAIT_SECONDS))
+        stream.put(_persona(1))
+        stream.close()
+
+    producer = threading.Thread(target=produce)
+    producer.start()
+    results = simulatiton_generate.simulate_task_reactions(
+        "t", "产品", stream, 2, model_pool=MODEL_POOL, scheduler=SimulationScheduler(2),
+        profile=get_pipeline_profile("fast"))
+    producer.join()
+
+    assert overlapped == [True]
+    # 结果按画像到达的顺序排列
+    assert [r["persona_id"] for r in results] == ["persona_2"] * 2 + ["persona_0"] * 2 + ["persona_1"] * 2
+
+
+def test_generation_error_reaches_simulation(monkeypatch):
+    monkeypatch.setattr(simulatiton_generate, "call_ai_api", _fake_call(threading.Event()))
+    stream = PersonaStream(3)
+    stream.put(_persona(0))
+    stream.close(error=RuntimeError("画像生成失败"))
+    with pytest.raises(RuntimeError, match="画像生成失败"):
+        simulatiton_generate.simulate_task_reactions(
+            "t", "产品", stream, 2, model_pool=MODEL_POOL, scheduler=SimulationScheduler(2),
+            profile=get_pipeline_profile("fast"))
+
+
+class _App:
+    def __init__(self, folder):
+        self.config = {"UPLOAD_FOLDER": str(folder), "REPORTS_FOLDER": str(folder)}
+
+
+def _run_task(tmp_path, monkeypatch, generate, task_stop_flags=None):
+    """
+    以重叠执行模式运行任务，画像生成由generate(on_persona, checkpoint)代替
+    返回: (任务数据, 任务使用的PersonaStream)
+    """
+    streams = []
+
+    class RecordingStream(PersonaStream):
+        def __init__(self, total):
+            super().__init__(total)
+            streams.append(self)
+
+    def fake_generate(task_id, product_desc, num_personas, tasks=None, checkpoint=None, on_persona=None, **kwargs):
+        tasks[task_id]['status'] = 'generating_personas'
+        return generate(on_persona, checkpoint)
+
+    monkeypatch.setenv("PERSONA_STREAMING_ENABLED", "1")
+    monkeypatch.setattr(runner, "PersonaStream", RecordingStream)
+    monkeypatch.setattr(runner, "generate_user_personas", fake_generate)
+    monkeypatch.setattr(runner, "decide_web_search_queries", lambda **kwargs: (False, [], None))
+    tasks = {"t1": {"id": "t1", "email": "inline@local", "product_description": "一款记账App",
+                    "num_personas": 4, "num_simulations": 2, "status": "pending", "pipeline_profile": "fast",
+                    "throughput_mode": False, "adaptive_sampling": False}}
+    runner.run_analysis_task("t1", "一款记账App", 4, 2, tasks, task_stop_flags if task_stop_flags is not None else {},
+                             str(tmp_path / "tasks.json"), MODEL_POOL, _App(tmp_path))
+    return tasks["t1"], streams[0]
+
+
+def test_runner_overlaps_and_keeps_persona_order(tmp_path, monkeypatch):
+    first_call = threading.Event()
+    monkeypatch.setattr(simulatiton_generate, "call_ai_api", _fake_call(first_call))
+    arrival = [_persona(i) for i in (3, 1, 0, 2)]
+    overlapped = []
+    # 保留任务完成后的检查点以便检查
+    monkeypatch.setattr(TaskCheckpoint, "remove", lambda self: None)
+
+    def generate(on_persona, checkpoint):
+        for persona in arrival[:-1]:
+            checkpoint.record_persona(persona)
+            on_persona(persona)
+        overlapped.append(first_call.wait(WAIT_SECONDS))
+        checkpoint.record_persona(arrival[-1])
+        on_persona(arrival[-1])
+        # 生成器返回的顺序与到达顺序不同，画像文件和检查点仍使用到达顺序
+        return sorted(arrival, key=lambda p: p["persona_id"])
+
+    task, stream = _run_task(tmp_path, monkeypatch, generate)
+
+    assert task["status"] == "completed"
+    assert overlapped == [True]
+    assert stream.personas == arrival
+    with open(task["files"]["personas"], encoding="utf-8") as f:
+        assert json.load(f) == arrival
+    with open(task["files"]["simulations"], encoding="utf-8") as f:
+        assert [r["persona_id"] for r in json.load(f)] == [p["persona_id"] for p in arrival for _ in range(2)]
+    state = TaskCheckpoint(get_checkpoint_path("t1", _App(tmp_path))).load()
+    assert state["personas_complete"] is True
+    assert state["personas"] == arrival
+    assert sorted(state["units"]) == [(index, sim_index) for index in range(4) for sim_index in range(2)]
+    for (index, sim_index), result in state["units"].items():
+        assert result["persona_id"] == arrival[index]["persona_id"]
+
+
+def test_runner_abandons_stream_when_simulation_stops(tmp_path, monkeypatch):
+    stop_flags = {}
+    first_call = threading.Event()
+
+    def fake_call(messages, **kwargs):
+        # 与stop_task相同：设置中止标志并取消任务的令牌
+        stop_flags["t1"] = True
+        cancel_task_token("t1")
+        first_call.set()
+        return json.dumps(REACTION, ensure_ascii=False)
+
+    monkeypatch.setattr(simulatiton_generate, "call_ai_api", fake_call)
+    producer = {}
+
+    def generate(on_persona, checkpoint):
+        on_persona(_persona(0))
+        first_call.wait(WAIT_SECONDS)
+        try:
+            while True:
+                on_persona(_persona(1))
+                threading.Event().wait(0.01)
+        except TaskCancelled:
+            producer["cancelled"] = True
+            raise
+
+    task, stream = _run_task(tmp_path, monkeypatch, generate, task_stop_flags=stop_flags)
+
+    assert task["status"] == "stopped"
+    assert stream.abandoned
+    assert producer == {"cancelled": True}
@@ -0,0 +1,90 @@
+import itertools
+import json
+import threading
+
+import pytest
+
+import agent.utils.simulatiton_generate as simulatiton_generate
+from agent.prompt_template import inquiry_system_prompt, refined_system_prompt
+from agent.utils.pipeline_profiles import (
+    estimate_pipeline,
+    get_pipeline_profile,
+    resolve_pipeline_profile,
+    simulation_calls_per_unit,
+)
+
+REACTION = {
+    "initial_impression": "初步",
+    "would_try": True,
+    "would_buy": False,
+    "is_must_have": False,
+    "would_recommend": True,
+    "dependency_level": "无所谓",
+    "alternatives": [],
+    "barrier_to_adoption": "价格",
+    "feedback": "反馈",
+    "suggested_improvements": "建议",
+    "questions": [{"aspect": "价格", "question": "贵吗", "dimension": "d"}],
+}
+
+PERSONA = {"persona_id": "p1", "persona_description": "画像", "key_needs": ["a"], "usage_scenarios": ["b"],
+           "user_type": "核心用户", "usage_frequency": "每天一次", "location": "北京"}
+
+
+@pytest.mark.parametrize("name, rounds, calls", [("fast", 0, 3), ("standard", 1, 7), ("deep", 2, 9)])
+def test_inquiry_rounds_build_the_stage_graph(monkeypatch, name, rounds, calls):
+    lock = threading.Lock()
+    counter = itertools.count(1)
+    sent = []
+
+    def fake_call(messages, **kwargs):
+        with lock:
+            sent.append(messages)
+            if messages[0]["content"] is refined_system_prompt:
+                return json.dumps(dict(REACTION, initial_impression=f"深入{next(counter)}"), ensure_ascii=False)
+        return json.dumps(REACTION, ensure_ascii=False)
+
+    monkeypatch.setattr(simulatiton_generate, "call_ai_api", fake_call)
+    profile = get_pipeline_profile(name)
+    result = simulatiton_generate.run_single_simulation(PERSONA, "p1", 0, "i1", "产品",
+                                                        model_pool={"test/model": {}}, profile=profile)
+
+    assert "error" not in result
+    assert len(sent) == calls == simulation_calls_per_unit(profile)
+    expected = {"initial", "ad_copy", "optimized_product", "total"}
+    for round_index in range(1, rounds + 1):
+        suffix = "" if round_index == 1 else f"_{round_index}"
+        expected |= {f"inquiry{suffix}", f"refined{suffix}"}
+    assert set(result["stage_timings"]) == expected
+    # 每轮自我质疑基于上一轮的结果，最终结果来自最后一轮
+    inquiries = [m[-1]["content"] for m in sent if m[0]["content"] is inquiry_system_prompt]
+    assert len(inquiries) == rounds
+    if rounds == 2:
+        assert "深入1" in inquiries[1]
+    assert result["initial_impression"] == (f"深入{rounds}" if rounds else "初步")
+
+
+def test_unknown_profile_uses_default():
+    assert get_pipeline_profile("unknown")["name"] == "standard"
+    assert get_pipeline_profile(None)["name"] == "standard"
+    assert get_pipeline_profile("deep")["inquiry_rounds"] == 2
+
+
+def test_resolve_pipeline_profile_by_account():
+    assert resolve_pipeline_profile("deep") == "standard"
+    assert resolve_pipeline_profile("fast") == "fast"
+    assert resolve_pipeline_profile("deep", {}) == "deep"
+    vip = {"pipeline_profiles": ["fast", "deep"], "default_pipeline_profile": "deep"}
+    assert resolve_pipeline_profile("standard", vip) == "deep"
+    assert resolve_pipeline_profile(None, {"pipeline_profiles": ["fast"]}) == "fast"
+
+
+def test_estimate_counts_calls_per_profile():
+    fast = estimate_pipeline("fast", 10, 2)
+    deep = estimate_pipeline("deep", 10, 2)
+    assert fast["persona_calls"] == 5
+    assert fast["simulation_calls"] == 10 * 2 * 3
+    assert deep["persona_calls"] == 5 + 2 * 10
+    assert deep["simulation_calls"] == 10 * 2 * 9
+    assert estimate_pipeline("fast", 10, 2, num_variants=3)["simulation_calls"] == 3 * fast["simulation_calls"]
+    assert fast["estimated_seconds"] < deep["estimated_seconds"]
@@ -0,0 +1,81 @@
+import pytest
+
+from agent.utils import product_variants
+from agent.utils.product_variants import compare_variants, parse_product_variants
+from agent.utils.report_generate import generate_variant_comparison_report
+
+
+def test_parse_puts_the_base_description_first_and_dedups():
+    variants = parse_product_variants(
+        '["一款记账App", {"label": "学生版", "product_description": "面向学生的记账App"}, " 一款记账App "]',
+        base_description="一款记账App",
+    )
+
+    assert variants == [
+        {"label": "方案A", "product_description": "一款记账App"},
+        {"label": "学生版", "product_description": "面向学生的记账App"},
+    ]
+
+
+def test_parse_returns_empty_below_two_variants():
+    assert parse_product_variants(None) == []
+    assert parse_product_variants(["一款记账App", "一款记账App"]) == []
+    assert parse_product_variants(["一款记账App"], base_description="一款记账App") == []
+
+
+def test_parse_rejects_bad_input(monkeypatch):
+    with pytest.raises(ValueError):
+        parse_product_variants("不是JSON")
+    with pytest.raises(ValueError):
+        parse_product_variants('{"a": 1}')
+
+    monkeypatch.setattr(product_variants, "MAX_PRODUCT_VARIANTS", 2)
+    with pytest.raises(ValueError):
+        parse_product_variants(["甲", "乙", "丙"])
+
+
+def _result(persona_id, would_try):
+    return {"persona_id": persona_id, "would_try": would_try, "would_buy": False,
+            "is_must_have": False, "would_recommend": False}
+
+
+def test_compare_pairs_results_by_persona():
+    variants = [{"label": "A", "product_description": "甲"}, {"label": "B", "product_description": "乙"}]
+    baseline = [_result("p1", False), _result("p1", False), _result("p2", True), _result("p3", False)]
+    candidate = [_result("p1", True), _result("p1", False), _result("p2", True), _result("p3", True),
+                 {"persona_id": "p4", "error": "超时"}]
+    stats = [{"would_try_percentage": 25.0}, {"would_try_percentage": 75.0}]
+
+    comparison = compare_variants(variants, [baseline, candidate], stats)
+
+    would_try = comparison["metrics"]["would_try"]
+    assert would_try["name"] == "愿意尝试"
+    assert would_try["values"] == [25.0, 75.0]
+    assert would_try["best"] == 1
+    assert would_try["deltas"][0]["delta"] == 0.0
+    delta = would_try["deltas"][1]
+    assert delta["delta"] == 50.0
+    assert (delta["wins"], delta["losses"], delta["paired"]) == (2, 0, 3)
+    assert delta["low"] <= delta["delta"] <= delta["high"]
+
+
+def test_comparison_report_escapes_variant_labels(tmp_path):
+    payload = "</script><script>alert(1)</script>"
+    variants = [
+        {"label": "基准", "product_description": "一款记账App"},
+        {"label": payload, "product_description": f"面向学生的记账App{payload}"},
+    ]
+    results = [[_result("p1", False)], [_result("p1", True)]]
+    stats = [
+        {"would_try_percentage": 0.0, "total_simulations": 1},
+        {"would_try_percentage": 100.0, "total_simulations": 1, "top_barriers": {payload: 1}},
+    ]
+    comparison = compare_variants(variants, results, stats)
+    output_file = tmp_path / "comparison.html"
+
+    assert generate_variant_comparison_report(comparison, str(output_file), 1, 1) == str(output_file)
+
+    html_content = output_file.read_text(encoding="utf-8")
+    assert "alert(1)" in html_content
+    assert payload not in html_content
+    assert html_content.count("</script>") == 2
@@ -0,0 +1,93 @@
+import pytest
+
+from agent.utils.sequential_sampling import TRACKED_METRICS, SequentialSampler, wilson_interval
+
+
+def _personas(count, user_type="核心用户"):
+    return [{"persona_id": f"persona_{i}", "user_type": user_type} for i in range(count)]
+
+
+def _result(value):
+    return {metric: value for metric in TRACKED_METRICS}
+
+
+def test_wilson_interval_edge_cases():
+    assert wilson_interval(0, 0) == (0.0, 1.0)
+    low, high = wilson_interval(0, 10)
+    assert low == 0.0 and 0 < high < 0.5
+    low, high = wilson_interval(10, 10)
+    assert high == 1.0 and 0.5 < low < 1
+    # 成功与失败互换时区间对称
+    low, high = wilson_interval(3, 10)
+    mirror_low, mirror_high = wilson_interval(7, 10)
+    assert low == pytest.approx(1 - mirror_high)
+    assert high == pytest.approx(1 - mirror_low)
+    # 样本越多区间越窄
+    assert wilson_interval(50, 100)[1] - wilson_interval(50, 100)[0] < high - low
+
+
+def test_next_personas_respects_budget():
+    sampler = SequentialSampler(_personas(3), 2)
+    assert (sampler.budget, sampler.max_per_persona) == (6, 4)
+    for index in range(3):
+        sampler.assign(index)
+    selected = sampler.next_personas(10)
+    assert len(selected) == 3
+    assert sampler.remaining_budget() == 0
+    assert sampler.next_personas(1) == []
+
+
+def test_next_personas_respects_max_per_persona():
+    sampler = SequentialSampler(_personas(3), 4, max_per_persona=2)
+    for index in range(3):
+        sampler.assign(index)
+    selected = sampler.next_personas(10)
+    assert sorted(selected) == [0, 1, 2]
+    assert sampler.remaining_budget() == 6
+    assert sampler.next_personas(10) == []
+
+
+def test_excluded_persona_gets_no_extra_simulations():
+    sampler = SequentialSampler(_personas(2), 3)
+    sampler.exclude(1)
+    sampler.assign(0)
+    assert set(sampler.next_personas(4)) == {0}
+
+
+def test_high_variance_persona_is_preferred():
+    sampler = SequentialSampler(_personas(2), 4)
+    for index in range(2):
+        sampler.assign(index)
+        sampler.assign(index)
+    sampler.record(0, _result(True))
+    sampler.record(0, _result(False))
+    sampler.record(1, _result(True))
+    sampler.record(1, _result(True))
+    assert sampler.next_personas(1) == [0]
+
+
+def test_stops_once_converged():
+    sampler = SequentialSampler(_personas(2), 20, target_width=0.2, min_segment_personas=10)
+    for _ in range(10):
+        for index in range(2):
+            sampler.assign(index)
+            sampler.record(index, _result(True))
+    assert sampler.converged()
+    assert sampler.next_personas(5) == []
+    # 出错的结果不计入统计
+    sampler.record(0, {"error": "x", "would_try": False})
+    assert sampler.converged()
+
+
+def test_summary_saved_units():
+    sampler = SequentialSampler(_personas(3), 2)
+    summary = sampler.summary(4, calls_per_unit=3)
+    assert summary["budget_units"] == 6
+    assert summary["executed_units"] == 4
+    assert summary["saved_units"] == 2
+    assert summary["saved_ratio"] == 0.333
+    assert summary["saved_calls"] == 6
+    assert summary["converged"] is False
+    assert set(summary["intervals"]["overall"]) == set(TRACKED_METRICS)
+    assert sampler.summary(8)["saved_units"] == 0
+    assert "saved_calls" not in sampler.summary(8)
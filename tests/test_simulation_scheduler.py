@@ -0,0 +1,231 @@
+import concurrent.futures
+import json
+import threading
+import time
+
+import pytest
+
+import agent.utils.simulation_scheduler as simulation_scheduler
+import agent.utils.simulatiton_generate as simulatiton_generate
+from agent.utils.pipeline_profiles import get_pipeline_profile, simulation_calls_per_unit
+from agent.utils.simulation_scheduler import SimulationScheduler, run_stage_graph
+
+WAIT_SECONDS = 10
+
+
+def _blocked(scheduler, task_id="gate"):
+    """
+    提交一个阻塞的单元占住工作线程，返回放行用的事件和该单元的future
+    """
+    gate = threading.Event()
+    started = threading.Event()
+
+    def block():
+        started.set()
+        gate.wait(WAIT_SECONDS)
+
+    future = scheduler.submit(task_id, block)
+    assert started.wait(WAIT_SECONDS)
+    return gate, future
+
+
+def test_tasks_are_scheduled_fairly():
+    scheduler = SimulationScheduler(1)
+    order = []
+    gate, _ = _blocked(scheduler, "a")
+    futures = [scheduler.submit("a", order.append, f"a{i}") for i in range(3)]
+    futures += [scheduler.submit("b", order.append, f"b{i}") for i in range(2)]
+    gate.set()
+    concurrent.futures.wait(futures, timeout=WAIT_SECONDS)
+    # 同一任务内按提交顺序，任务之间轮转
+    assert order == ["a0", "b0", "a1", "b1", "a2"]
+
+
+def test_cancel_task_cancels_queued_units():
+    scheduler = SimulationScheduler(1)
+    gate, running = _blocked(scheduler, "x")
+    queued = [scheduler.submit("x", lambda: "x") for _ in range(3)]
+    other = scheduler.submit("y", lambda: "y")
+    assert scheduler.pending_count() == 4
+    assert scheduler.cancel_task("x") == 3
+    assert scheduler.pending_count("x") == 0
+    gate.set()
+    assert other.result(WAIT_SECONDS) == "y"
+    assert all(future.cancelled() for future in queued)
+    # 正在执行的单元继续运行到结束
+    running.result(WAIT_SECONDS)
+    assert scheduler.cancel_task("unknown") == 0
+
+
+def test_concurrency_never_exceeds_max_workers_with_stage_fan_out():
+    scheduler = SimulationScheduler(2)
+    lock = threading.Lock()
+    active = [0, 0]
+
+    def stage(outputs):
+        with lock:
+            active[0] += 1
+            active[1] = max(active[1], active[0])
+        time.sleep(0.01)
+        with lock:
+            active[0] -= 1
+        return True
+
+    def unit():
+        stages = {"initial": ((), stage)}
+        stages.update({f"parallel_{i}": (("initial",), stage) for i in range(3)})
+        outputs, _ = run_stage_graph(stages, executor=scheduler.stage_executor)
+        return sorted(outputs)
+
+    futures = [scheduler.submit(f"t{i % 2}", unit) for i in range(6)]
+    for future in futures:
+        assert future.result(WAIT_SECONDS) == ["initial", "parallel_0", "parallel_1", "parallel_2"]
+    assert active[1] == 2
+
+
+def test_stage_graph_runs_in_dependency_order():
+    order = []
+
+    def stage(name):
+        def fn(outputs):
+            order.append(name)
+            return dict(outputs)
+        return fn
+
+    stages = {
+        "c": (("a", "b"), stage("c")),
+        "a": ((), stage("a")),
+        "b": (("a",), stage("b")),
+    }
+    outputs, timings = run_stage_graph(stages)
+    assert order == ["a", "b", "c"]
+    assert sorted(outputs["c"]) == ["a", "b"]
+    assert set(timings) == {"a", "b", "c"}
+
+
+def test_unsatisfiable_dependencies_raise():
+    with pytest.raises(ValueError):
+        run_stage_graph({"a": (("missing",), lambda outputs: 1)})
+    with pytest.raises(ValueError):
+        run_stage_graph({"a": (("b",), lambda outputs: 1), "b": (("a",), lambda outputs: 2)},
+                        executor=concurrent.futures.ThreadPoolExecutor(2))
+
+
+def test_parallel_outputs_are_kept_when_a_stage_fails():
+    executor = concurrent.futures.ThreadPoolExecutor(2)
+
+    def fail(outputs):
+        raise RuntimeError("阶段失败")
+
+    def slow(outputs):
+        time.sleep(0.05)
+        return "slow"
+
+    outputs = {}
+    # 第一个就绪阶段在当前线程执行并失败，并行中的阶段结束后其输出仍被保留
+    with pytest.raises(RuntimeError):
+        run_stage_graph({"fail": ((), fail), "slow": ((), slow)}, executor=executor, outputs=outputs)
+    assert outputs == {"slow": "slow"}
+
+
+def test_failed_stage_is_retried_alone(monkeypatch):
+    monkeypatch.setattr(simulation_scheduler, "cancellable_sleep", lambda seconds: None)
+    local = threading.local()
+    runs = []
+    failures = []
+
+    def call():
+        local.count = getattr(local, "count", 0) + 1
+
+    def stage(name, fail_times=0, calls=1):
+        def fn(outputs):
+            runs.append(name)
+            for _ in range(calls):
+                call()
+            if runs.count(name) <= fail_times:
+                raise RuntimeError(f"{name} 失败")
+            return name
+        return fn
+
+    stages = {
+        "initial": ((), stage("initial")),
+        "ad_copy": (("initial",), stage("ad_copy", fail_times=1, calls=2)),
+        "optimized_product": (("initial",), stage("optimized_product")),
+    }
+    outputs, _ = run_stage_graph(stages, executor=concurrent.futures.ThreadPoolExecutor(2), max_attempts=2,
+                                 on_stage_failure=lambda *args: failures.append(args),
+                                 call_counter=lambda: getattr(local, "count", 0))
+    assert outputs == {name: name for name in stages}
+    assert sorted(runs) == ["ad_copy", "ad_copy", "initial", "optimized_product"]
+    # 失败的尝试发出了2次调用
+    assert [(name, attempt, calls) for name, attempt, _, calls in failures] == [("ad_copy", 1, 2)]
+
+
+def test_completed_outputs_are_reused(monkeypatch):
+    monkeypatch.setattr(simulation_scheduler, "cancellable_sleep", lambda seconds: None)
+    runs = []
+    failures = []
+    attempts = {"refined": 0}
+
+    def stage(name):
+        def fn(outputs):
+            runs.append(name)
+            if name == "refined":
+                attempts[name] += 1
+                if attempts[name] <= 2:
+                    raise RuntimeError("refined 失败")
+            return name
+        return fn
+
+    stages = {name: (deps, stage(name)) for name, deps in
+              (("initial", ()), ("inquiry", ("initial",)), ("refined", ("inquiry",)))}
+    outputs = {}
+    with pytest.raises(RuntimeError):
+        run_stage_graph(stages, outputs=outputs, max_attempts=2,
+                        on_stage_failure=lambda *args: failures.append(args))
+    assert outputs == {"initial": "initial", "inquiry": "inquiry"}
+    # 未提供call_counter时每次失败的尝试计为一次调用
+    assert [(name, attempt, calls) for name, attempt, _, calls in failures] == [("refined", 1, 1), ("refined", 2, 1)]
+
+    # 重新执行单元时已完成的阶段直接复用
+    outputs, timings = run_stage_graph(stages, outputs=outputs, max_attempts=2)
+    assert outputs == {name: name for name in stages}
+    assert set(timings) == {"refined"}
+    assert runs == ["initial", "inquiry", "refined", "refined", "refined"]
+
+
+def test_unit_retries_only_the_failed_stage(monkeypatch):
+    monkeypatch.setattr(simulation_scheduler, "cancellable_sleep", lambda seconds: None)
+    local = threading.local()
+    calls = []
+    failed = []
+    reaction = {"initial_impression": "不错", "would_try": True, "would_buy": False, "is_must_have": False,
+                "would_recommend": True, "dependency_level": "无所谓", "alternatives": [],
+                "barrier_to_adoption": "价格", "feedback": "反馈", "suggested_improvements": "建议",
+                "questions": [{"dimension": "d", "question": "q", "aspect": "a"}]}
+
+    def fake_call(messages, **kwargs):
+        local.count = getattr(local, "count", 0) + 1
+        calls.append(messages)
+        # 第一次改进广告文案的调用失败
+        if "请根据以下问题改进广告文案" in messages[-1]["content"] and not failed:
+            failed.append(True)
+            raise RuntimeError("连接中断")
+        return json.dumps(reaction, ensure_ascii=False)
+
+    monkeypatch.setattr(simulatiton_generate, "call_ai_api", fake_call)
+    monkeypatch.setattr(simulatiton_generate, "model_call_count", lambda: getattr(local, "count", 0))
+    profile = get_pipeline_profile("standard")
+    persona = {"persona_id": "p1", "persona_description": "画像", "key_needs": ["a"], "usage_scenarios": ["b"],
+               "user_type": "核心用户", "usage_frequency": "每天一次", "location": "北京"}
+    stats = {}
+    results = simulatiton_generate.simulate_task_reactions(
+        "t", "产品", [persona], 1, model_pool={"test/model": {"config": {}, "active_keys": []}},
+        scheduler=SimulationScheduler(2), retry_stats=stats, profile=profile)
+
+    assert len(results) == 1 and "error" not in results[0]
+    # 只有广告文案阶段（初始文案、评审、改进共3次调用）被重新执行
+    assert len(calls) == simulation_calls_per_unit(profile) + 3
+    assert stats["stage_retries"] == 1
+    assert stats["unit_retries"] == 0
+    assert stats["wasted_calls"] == 3
@@ -0,0 +1,136 @@
+import pandas as pd
+
+from agent.utils.generate_utils import create_error_result
+from agent.utils.simulation_stats import SimulationStatsAggregator
+
+# 原先报告清理模拟结果时保留的字段
+STANDARD_FIELDS = [
+    'initial_impression', 'perceived_needs', 'would_try', 'would_buy', 'is_must_have', 'would_recommend',
+    'dependency_level', 'alternatives', 'barrier_to_adoption', 'feedback', 'suggested_improvements',
+    'user_type', 'usage_frequency', 'simulation_id', 'persona_id', 'simulated_at',
+]
+
+
+def _results():
+    results = [
+        {'would_try': True, 'would_buy': True, 'is_must_have': True, 'would_recommend': True,
+         'dependency_level': '痛苦', 'user_type': '核心用户', 'usage_frequency': '每天多次', 'location': '北京',
+         'barrier_to_adoption': '价格偏高，学习成本'},
+        {'would_try': True, 'would_buy': False, 'is_must_have': False, 'would_recommend': True,
+         'dependency_level': '可以接受', 'user_type': '潜在用户', 'usage_frequency': '每周几次', 'location': '上海',
+         'barrier_to_adoption': '价格偏高, 隐私担忧'},
+        {'would_try': 'yes', 'would_buy': 1, 'is_must_have': 'no', 'would_recommend': 0,
+         'dependency_level': '其他', 'user_type': '核心用户', 'usage_frequency': '每天多次',
+         'barrier_to_adoption': '未提供'},
+        # 缺少字段
+        {'would_try': True, 'barrier_to_adoption': '价格偏高'},
+        # 字段值为None
+        {'would_try': None, 'would_buy': None, 'is_must_have': None, 'would_recommend': None,
+         'dependency_level': None, 'user_type': None, 'usage_frequency': None, 'location': None,
+         'barrier_to_adoption': None},
+        {'would_try': False, 'would_buy': False, 'is_must_have': True, 'would_recommend': False,
+         'dependency_level': '痛苦', 'user_type': '边缘用户', 'usage_frequency': '很少使用', 'location': '北京',
+         'barrier_to_adoption': '学习成本，a，功能单一'},
+    ]
+    # 模拟出错的结果
+    results.append(create_error_result('p1', '超时', 'timeout', instance_id='i1', user_type='潜在用户', usage_frequency='每周几次'))
+    results.append(create_error_result('p2', '超时', 'timeout', sim_index=1, instance_id='i2', user_type=None, usage_frequency=None))
+    return results
+
+
+def _baseline_stats(results, total_personas):
+    """
+    run_analysis_task原先逐项扫描全部结果的统计
+    """
+    total = len(results)
+
+    def percentage(field):
+        return round(sum(1 for sim in results if sim.get(field) == True) / total * 100, 1)
+
+    def counts(field):
+        values = {}
+        for sim in results:
+            value = sim.get(field, '未知')
+            values[value] = values.get(value, 0) + 1
+        return {key: round(value / total * 100, 1) for key, value in values.items()}
+
+    dependency_counts = {"痛苦": 0, "可以接受": 0, "无所谓": 0}
+    for sim in results:
+        if sim.get('dependency_level') in dependency_counts:
+            dependency_counts[sim.get('dependency_level')] += 1
+    barrier_keywords = {}
+    for sim in results:
+        barrier = sim.get('barrier_to_adoption', '')
+        if barrier and barrier != "未提供" and barrier != "模拟出错":
+            for k in [k.strip() for k in barrier.replace('，', ',').split(',')]:
+                if k and len(k) > 1:
+                    barrier_keywords[k] = barrier_keywords.get(k, 0) + 1
+    return {
+        'would_try_percentage': percentage('would_try'),
+        'would_buy_percentage': percentage('would_buy'),
+        'must_have_percentage': percentage('is_must_have'),
+        'would_recommend_percentage': percentage('would_recommend'),
+        'dependency_percentages': {k: round(v / total * 100, 1) for k, v in dependency_counts.items()},
+        'user_type_percentages': counts('user_type'),
+        'usage_frequency_percentages': counts('usage_frequency'),
+        'location_percentages': counts('location'),
+        'top_barriers': dict(sorted(barrier_keywords.items(), key=lambda x: x[1], reverse=True)[:5]),
+        'total_personas': total_personas,
+        'total_simulations': total,
+    }
+
+
+def _baseline_report(results):
+    """
+    报告原先用pandas对清理后的模拟结果的统计
+    """
+    df = pd.DataFrame([{field: sim.get(field, '') for field in STANDARD_FIELDS} for sim in results])
+    total = len(df)
+    return {
+        'total': total,
+        'user_types': df['user_type'].fillna('未知').value_counts().to_dict(),
+        'must_have_percentage': df['is_must_have'].fillna(False).astype(bool).sum() / total * 100,
+        'would_recommend_percentage': df['would_recommend'].fillna(False).astype(bool).sum() / total * 100,
+        'dependency_counts': df['dependency_level'].fillna('无所谓').value_counts().to_dict(),
+        'frequency_counts': df['usage_frequency'].fillna('未知').value_counts().to_dict(),
+    }
+
+
+def _assert_same(actual, expected):
+    # 比较数值和字典的顺序
+    assert actual == expected
+    for key, value in expected.items():
+        if isinstance(value, dict):
+            assert list(actual[key].items()) == list(value.items()), key
+
+
+def test_stats_match_baseline_scan():
+    results = _results()
+    aggregator = SimulationStatsAggregator.from_results(results, total_personas=4)
+    stats = aggregator.stats()
+    _assert_same(stats, _baseline_stats(results, 4))
+    assert stats['user_type_percentages']['未知'] == 12.5
+    assert None in stats['user_type_percentages']
+    assert stats['total_personas'] == 4
+    assert aggregator.stats(total_personas=9)['total_personas'] == 9
+
+
+def test_report_view_matches_baseline_pandas():
+    results = _results()
+    view = SimulationStatsAggregator.from_results(results).report_view()
+    expected = _baseline_report(results)
+    assert view['must_have_percentage'] == expected.pop('must_have_percentage')
+    assert view['would_recommend_percentage'] == expected.pop('would_recommend_percentage')
+    view.pop('must_have_percentage')
+    view.pop('would_recommend_percentage')
+    _assert_same(view, expected)
+
+
+def test_incremental_matches_every_prefix():
+    results = _results()
+    aggregator = SimulationStatsAggregator(total_personas=4)
+    assert aggregator.stats() == {}
+    assert aggregator.report_view()['total'] == 0
+    for count, result in enumerate(results, 1):
+        aggregator.add(result)
+        _assert_same(aggregator.stats(), _baseline_stats(results[:count], 4))
@@ -0,0 +1,135 @@
+import types
+
+import pytest
+
+from agent.utils import task_eta
+from agent.utils.task_eta import ETA_STAGES, EtaModel, StageTimer, plan_stages
+
+# 历史任务各阶段每单元的耗时（秒）
+STAGE_RATES = {'personas': 3.0, 'web_search': 5.0, 'simulations': 2.0, 'report': 10.0}
+NUM_PERSONAS = 10
+NUM_SIMULATIONS = 2
+
+
+def _timings(start, latency=1.0, scale=1.0, stages=ETA_STAGES):
+    """
+    按STAGE_RATES依次执行各阶段的stage_timings
+    """
+    timings = {}
+    now = start
+    for stage, plan in plan_stages(NUM_PERSONAS, NUM_SIMULATIONS).items():
+        seconds = plan['units'] * STAGE_RATES[stage] * scale
+        timings[stage] = dict(plan, started_at=None, finished_at=None, done=0, completed=0, latency=None)
+        if stage in stages:
+            timings[stage].update(started_at=now, finished_at=now + seconds, completed=plan['units'], latency=latency)
+            now += seconds
+    return timings, now
+
+
+def _history(count=5, latency=1.0):
+    history = []
+    for i in range(count):
+        start = 1000.0 * i
+        timings, end = _timings(start, latency=latency, scale=1 + (i % 3 - 1) * 0.05)
+        history.append({'id': f'h{i}', 'status': 'completed', 'stage_timings': timings,
+                        'start_time': start, 'end_time': end})
+    return history
+
+
+def _pending_task():
+    return {'status': 'pending', 'num_personas': NUM_PERSONAS, 'num_simulations': NUM_SIMULATIONS}
+
+
+def _total_seconds():
+    return sum(plan['units'] * STAGE_RATES[stage]
+               for stage, plan in plan_stages(NUM_PERSONAS, NUM_SIMULATIONS).items())
+
+
+def _check_bounds(eta):
+    assert eta['low_seconds'] <= eta['remaining_seconds'] <= eta['high_seconds']
+
+
+def test_no_history_uses_defaults():
+    eta = EtaModel([]).estimate(_pending_task(), now=0, latency=1.0)
+    _check_bounds(eta)
+    assert eta['remaining_seconds'] > 0
+    assert {stage['source'] for stage in eta['stages'].values()} == {'default'}
+    assert eta['calibration'] == {'factor': 1.0, 'spread': None, 'samples': 0}
+    assert eta['confidence_level'] == 'low'
+    assert eta['progress_percentage'] == 0
+
+
+def test_pending_task_uses_history():
+    model = EtaModel(_history())
+    assert model.calibration['samples'] == 5
+    assert model.calibration['factor'] == pytest.approx(1.0, abs=0.1)
+    eta = model.estimate(_pending_task(), now=0, latency=1.0)
+    _check_bounds(eta)
+    assert {stage['source'] for stage in eta['stages'].values()} == {'history'}
+    assert eta['remaining_seconds'] == pytest.approx(_total_seconds(), rel=0.1)
+    assert eta['current_stage'] is None
+    assert eta['confidence_level'] in ('high', 'medium')
+
+
+def test_history_is_scaled_by_current_latency():
+    model = EtaModel(_history(latency=1.0))
+    slow = model.estimate(_pending_task(), now=0, latency=2.0)
+    fast = model.estimate(_pending_task(), now=0, latency=1.0)
+    assert slow['remaining_seconds'] == pytest.approx(2 * fast['remaining_seconds'], rel=0.05)
+
+
+def test_mid_stage_task_uses_observed_rate():
+    timings, now = _timings(100.0, stages=('personas', 'web_search'))
+    simulations = timings['simulations']
+    # 模拟阶段实测每单元4秒（比历史慢一倍），已完成一半
+    simulations.update(started_at=now, completed=10, latency=1.0)
+    task = {'status': 'simulating_reactions', 'start_time': 100.0, 'stage_timings': timings,
+            'num_personas': NUM_PERSONAS, 'num_simulations': NUM_SIMULATIONS}
+    eta = EtaModel(_history()).estimate(task, now=now + 40, latency=1.0)
+    _check_bounds(eta)
+    assert eta['current_stage'] == 'simulations'
+    assert set(eta['stages']) == {'simulations', 'report'}
+    assert eta['stages']['simulations']['source'] == 'observed'
+    assert eta['stages']['simulations']['remaining_units'] == 10
+    # 实测速度占主要权重：剩余10个单元介于历史速度（20秒）和实测速度（40秒）之间，更接近实测
+    assert 30 < eta['stages']['simulations']['remaining_seconds'] < 40
+    assert 0 < eta['progress_percentage'] < 100
+
+
+def test_queue_wait_for_pending_task():
+    jobs = [{'started_at': 0.0, 'finished_at': 100.0}] * 3
+    model = EtaModel(_history(), jobs)
+    eta = model.estimate(_pending_task(), now=0, latency=1.0,
+                         queue_info={'state': 'queued', 'ahead': 2}, running=1, workers=2)
+    # 前面2个、执行中1个任务占用2个工作线程：还需等待 (2 - 0.5) / 2 个任务执行时长
+    assert eta['queue_seconds'] == 75
+    _check_bounds(eta)
+    assert model.queue_wait({'state': 'running'}) == (0.0, 0.0)
+
+
+@pytest.mark.parametrize("history", [[], _history()])
+def test_progress_is_monotone(monkeypatch, history):
+    """
+    任务按历史速度推进时，预计进度随时间单调不减（包括两次单元完成之间），剩余时间的区间始终包含估计值
+    """
+    clock = [100.0]
+    monkeypatch.setattr(task_eta, 'time', types.SimpleNamespace(time=lambda: clock[0]))
+    monkeypatch.setattr(task_eta, 'current_call_latency', lambda: 1.0)
+    model = EtaModel(history)
+    task = {'status': 'running', 'start_time': clock[0], 'num_personas': NUM_PERSONAS,
+            'num_simulations': NUM_SIMULATIONS}
+    timer = StageTimer(task, plan_stages(NUM_PERSONAS, NUM_SIMULATIONS))
+    percentages = []
+    for stage in ETA_STAGES:
+        timer.start(stage)
+        units = timer.timings[stage]['units']
+        for completed in range(1, units + 1):
+            for _ in range(4):
+                clock[0] += STAGE_RATES[stage] / 4
+                eta = model.estimate(task, now=clock[0])
+                _check_bounds(eta)
+                percentages.append(eta['progress_percentage'])
+            timer.progress(stage, completed)
+        timer.finish(stage)
+    assert percentages == sorted(percentages)
+    assert 0 < percentages[len(percentages) // 2] < percentages[-1] < 100
@@ -0,0 +1,99 @@
+import json
+import re
+
+import agent.utils.simulatiton_generate as simulatiton_generate
+from agent.prompt_template import inquiry_system_prompt, refined_system_prompt, simulation_system_prompt
+from agent.utils.simulatiton_generate import (
+    THROUGHPUT_MAX_PERSONAS_PER_CALL,
+    _parse_batch_reactions,
+    choose_simulation_pack_size,
+    run_simulation_pack,
+)
+
+
+def _persona(i, description="画像"):
+    return {"persona_id": f"p{i}", "persona_description": f"{description} {i}"}
+
+
+def _reaction(label):
+    return {"initial_impression": label, "would_try": True, "feedback": label}
+
+
+def _pool(**config):
+    return {"test/model": {"config": config, "active_keys": []}}
+
+
+def test_pack_size_fits_output_and_context_limits():
+    personas = [_persona(i) for i in range(3)]
+    # 4096个输出token的80%最多容纳4个反应
+    assert choose_simulation_pack_size(_pool(max_tokens=4096), personas, "产品") == 4
+    # 更大的max_tokens按call_ai_api固定发送的4096计算
+    assert choose_simulation_pack_size(_pool(max_tokens=100000), personas, "产品") == 4
+    assert choose_simulation_pack_size(_pool(max_tokens=1500), personas, "产品") == 1
+    # 上下文放不下输出和输入时至少打包1个画像
+    assert choose_simulation_pack_size(_pool(context_window=6000), personas, "产品") == 1
+    small_context = choose_simulation_pack_size(_pool(context_window=7000), personas, "产品")
+    assert 1 < small_context < 4
+    long_persona = [_persona(0, "很长的画像描述" * 500)]
+    assert choose_simulation_pack_size(_pool(context_window=7000), long_persona, "产品") < small_context
+    # 模型池中所有模型都要满足
+    pool = dict(_pool(max_tokens=4096), **{"other/model": {"config": {"max_tokens": 1500}}})
+    assert choose_simulation_pack_size(pool, personas, "产品") == 1
+    assert choose_simulation_pack_size({}, personas, "产品") == THROUGHPUT_MAX_PERSONAS_PER_CALL
+
+
+def test_batch_reactions_are_split_by_persona_id():
+    response = json.dumps({"reactions": [
+        {"persona_id": "p1", "reaction": _reaction("a")},
+        {"persona_id": 2, "reaction": _reaction("b")},
+        {"persona_id": "p3", "reaction": {"feedback": "缺少意愿字段"}},
+        {"persona_id": "unknown", "reaction": _reaction("c")},
+        "不是对象",
+    ]}, ensure_ascii=False)
+    assert _parse_batch_reactions(response, {"p1": {}, "2": {}, "p3": {}}) == {
+        "p1": _reaction("a"), "2": _reaction("b"),
+    }
+    # 也接受直接返回的数组
+    assert _parse_batch_reactions(json.dumps([{"persona_id": "p1", "reaction": _reaction("a")}]), {"p1": {}}) == {
+        "p1": _reaction("a"),
+    }
+    assert _parse_batch_reactions("不是JSON", {"p1": {}}) == {}
+
+
+def test_pack_fills_each_unit_and_leaves_missing_ones(monkeypatch):
+    calls = []
+
+    def fake_call(messages, **kwargs):
+        system, user = messages[0]["content"], messages[-1]["content"]
+        calls.append(system)
+        ids = re.findall(r"画像ID (p\d+)：", user)
+        if system is simulation_system_prompt:
+            # p3的初步反应缺失
+            return json.dumps({"reactions": [{"persona_id": i, "reaction": _reaction(f"initial {i}")}
+                                             for i in ids if i != "p3"]}, ensure_ascii=False)
+        if system is inquiry_system_prompt:
+            # p2没有质疑问题
+            questions = [] if "画像 2" in user else [{"aspect": "价格", "question": "贵吗"}]
+            return json.dumps({"questions": questions}, ensure_ascii=False)
+        if system is refined_system_prompt:
+            return json.dumps({"reactions": [{"persona_id": i, "reaction": _reaction(f"refined {i}")}
+                                             for i in reversed(ids)]}, ensure_ascii=False)
+        raise AssertionError("unexpected call")
+
+    monkeypatch.setattr(simulatiton_generate, "call_ai_api", fake_call)
+    units = [(_persona(i), f"p{i}", {}) for i in (1, 2, 3)]
+    packs = []
+    run_simulation_pack(units, "产品", model_pool=_pool(), on_pack_call=lambda *args: packs.append(args))
+
+    outputs = {persona_id: unit_outputs for _, persona_id, unit_outputs in units}
+    assert outputs["p1"]["initial"] == _reaction("initial p1")
+    assert outputs["p1"]["refined"] == _reaction("refined p1")
+    # 没有问题的画像直接沿用初步结果，不进入合并的深入模拟
+    assert outputs["p2"]["inquiry"] == []
+    assert outputs["p2"]["refined"] == _reaction("initial p2")
+    # 缺失的画像留给逐个模拟补齐
+    assert outputs["p3"] == {}
+    assert packs == [(3, 1), (1, 0)]
+    assert calls.count(simulation_system_prompt) == 1
+    assert calls.count(refined_system_prompt) == 1
+    assert calls.count(inquiry_system_prompt) == 2
@@ -0,0 +1,91 @@
+from agent.utils.bocha_web_search import WebDoc
+from agent.utils.generate_utils import estimate_tokens
+from agent.utils.web_search_pipeline import (
+    DEFAULT_EVIDENCE_STAGE_BUDGETS,
+    WebEvidence,
+    WebSearchQueryRun,
+    WebSearchSession,
+    _truncate_snippet,
+    compress_web_evidence,
+)
+
+PRODUCT = "一款记账App，自动识别账单并按类别统计每月支出"
+
+
+def _session():
+    topics = ["自动识别账单的准确率", "按类别统计每月支出", "预算提醒和超支预警", "多账户同步与家庭共享",
+              "数据隐私与本地加密", "会员价格和免费功能"]
+    relevant = [
+        WebDoc(title=f"记账App评测：{topic}", url=f"https://a.example/{i}",
+               snippet=f"记账App的{topic}是用户最关心的问题。" + "".join(f"第{j}位受访者谈到{topic}的体验{j * i}。" for j in range(12)))
+        for i, topic in enumerate(topics)
+    ]
+    duplicate_url = WebDoc(title="记账App评测转载", url="https://a.example/1", snippet="转载的评测内容")
+    duplicate_text = WebDoc(title="记账App评测 镜像", url="https://b.example/0", snippet=relevant[0].snippet)
+    unrelated = WebDoc(title="宠物喂食器", url="https://c.example/1", snippet="定时定量喂食，远程视频查看宠物。")
+    return WebSearchSession(runs=[
+        WebSearchQueryRun(query="记账", docs=[unrelated] + relevant[:3]),
+        WebSearchQueryRun(query="记账 评测", docs=[duplicate_url, duplicate_text] + relevant[3:]),
+    ])
+
+
+def test_stage_blocks_stay_within_budget():
+    evidence = compress_web_evidence(_session(), PRODUCT)
+    assert evidence
+    for stage, budget in DEFAULT_EVIDENCE_STAGE_BUDGETS.items():
+        assert 0 < estimate_tokens(evidence.blocks[stage]) <= budget, stage
+    # 预算越小的阶段证据越短
+    assert estimate_tokens(evidence.blocks["inquiry"]) < estimate_tokens(evidence.blocks["initial"])
+    assert str(evidence) == evidence.blocks["initial"]
+    custom = compress_web_evidence(_session(), PRODUCT, stage_budgets={"initial": 60, "ad_copy": 0})
+    assert estimate_tokens(custom.blocks["initial"]) <= 60
+    assert custom.blocks["ad_copy"] == ""
+
+
+def test_duplicates_are_collapsed_and_relevant_docs_ranked_first():
+    evidence = compress_web_evidence(_session(), PRODUCT)
+    urls = [doc.url for doc, _ in evidence.docs]
+    assert len(urls) == len(set(urls)) == 7
+    assert evidence.duplicates_removed == 2
+    assert urls[-1] == "https://c.example/1"
+    relevance = [score for _, score in evidence.docs]
+    assert relevance == sorted(relevance, reverse=True)
+    assert len(compress_web_evidence(_session(), PRODUCT, max_docs=2).docs) == 2
+
+
+def test_truncate_prefers_sentence_boundaries():
+    assert _truncate_snippet("短句。", 10) == "短句。"
+    assert _truncate_snippet("第一句话很长很长。第二句话也很长很长很长。", 15) == "第一句话很长很长。"
+    assert _truncate_snippet("没有标点的一段很长的文字没有标点", 8) == "没有标点的一段…"
+
+
+def test_stage_usage_is_recorded():
+    evidence = compress_web_evidence(_session(), PRODUCT)
+    evidence.for_stage("initial")
+    evidence.for_stage("initial")
+    evidence.for_stage("inquiry")
+    # 未知阶段使用初步模拟的证据
+    evidence.for_stage("unknown")
+    summary = evidence.summary()
+    assert summary["calls"] == {"initial": 3, "inquiry": 1}
+    assert summary["injected_tokens"] == (3 * estimate_tokens(evidence.blocks["initial"])
+                                          + estimate_tokens(evidence.blocks["inquiry"]))
+    assert summary["baseline_tokens"] == 4 * summary["baseline_tokens_per_call"]
+    assert 0 < summary["saved_ratio"] < 1
+    assert not WebEvidence([], PRODUCT)
+
+
+def test_worker_usage_merges_into_coordinator():
+    evidence = compress_web_evidence(_session(), PRODUCT)
+    evidence.for_stage("initial")
+    worker = WebEvidence.from_payload(evidence.to_payload())
+    assert worker.for_stage("ad_copy") == evidence.blocks["ad_copy"]
+    worker.for_stage("ad_copy")
+    assert worker.usage() == {"ad_copy": [2, 2 * estimate_tokens(evidence.blocks["ad_copy"])]}
+
+    evidence.merge_usage(worker.usage())
+    evidence.merge_usage({})
+    usage = evidence.usage()
+    assert usage["initial"] == [1, estimate_tokens(evidence.blocks["initial"])]
+    assert usage["ad_copy"] == worker.usage()["ad_copy"]
+    assert evidence.summary()["calls"] == {"initial": 1, "ad_copy": 2}